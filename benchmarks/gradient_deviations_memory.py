@@ -0,0 +1,103 @@
+"""Benchmark of the memory use of the gradient deviations when creating the kernel data of a model.
+
+This writes simulated per-volume gradient deviations, in the (x, y, z, m, 3, 3) format, to an uncompressed nifti file
+and loads it memory mapped. It then creates the gradient deviations kernel data for all voxels, in batches of voxels
+like the processing strategies do, and reports the peak memory allocated during that process (using tracemalloc) for:
+
+* the previous implementation, which loaded the deviations of all voxels in the mask before slicing the batches
+* the current implementation, loading only the voxels of each batch, in single precision
+* the current implementation with the half precision storage (the ``gradient_deviations`` configuration section)
+
+Usage::
+
+    python benchmarks/gradient_deviations_memory.py [--shape 40 48 40] [--volumes 30] [--batch-size 10000]
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import mdt
+from mdt.configuration import config_context, YamlStringAction
+from mdt.lib.nifti import load_nifti, write_nifti
+from mdt.utils import SimpleMRIInputData
+from mot.lib.utils import split_in_batches
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-30'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def previous_kernel_data(input_data, batch_size):
+    """The previous implementation, converting the deviations of all voxels before slicing the batches."""
+    gradient_deviations = input_data.gradient_deviations
+    gradient_deviations = gradient_deviations.reshape(-1, gradient_deviations.shape[1], 9)
+
+    zero_locations = [np.all(gradient_deviations[..., ind] == 0) for ind in range(9)]
+    if any(zero_locations):
+        gradient_deviations = np.delete(gradient_deviations, [ind for ind in range(9) if zero_locations[ind]], axis=-1)
+
+    for batch_start, batch_end in split_in_batches(input_data.nmr_problems, batch_size):
+        np.require(gradient_deviations[np.arange(batch_start, batch_end)], np.float32, ['C', 'A', 'O'])
+
+
+def current_kernel_data(input_data, batch_size, half_precision):
+    with config_context(YamlStringAction('gradient_deviations: {{half_precision: {}}}'.format(half_precision))):
+        model = mdt.get_model('Tensor')(volume_selection=False)
+        model.set_input_data(input_data)
+
+        callback = model._get_gradient_deviation_proposal_callback()
+        for batch_start, batch_end in split_in_batches(input_data.nmr_problems, batch_size):
+            callback.get_kernel_input_data(np.arange(batch_start, batch_end))
+
+
+def get_input_data(shape, nmr_volumes, nifti_file):
+    random_state = np.random.RandomState(0)
+    mask = random_state.rand(*shape) < 0.5
+
+    gradients = random_state.normal(size=(nmr_volumes, 3))
+    gradients /= np.linalg.norm(gradients, axis=1)[:, None]
+    protocol = mdt.protocols.Protocol({'gx': gradients[:, 0], 'gy': gradients[:, 1], 'gz': gradients[:, 2],
+                                       'b': np.full(nmr_volumes, 1e9)})
+
+    deviations = np.eye(3) + random_state.normal(scale=0.02, size=shape + (nmr_volumes, 3, 3))
+    write_nifti(deviations.astype(np.float32), nifti_file)
+    del deviations
+
+    signals = np.full(shape + (nmr_volumes,), 1000, dtype=np.float32)
+    return lambda: SimpleMRIInputData(protocol, signals, mask, None, noise_std=1,
+                                      gradient_deviations=load_nifti(nifti_file).get_data())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--shape', type=int, nargs=3, default=[40, 48, 40])
+    parser.add_argument('--volumes', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_data_factory = get_input_data(tuple(args.shape), args.volumes, os.path.join(tmp_dir, 'grad_dev.nii'))
+        print('Gradient deviations of {} voxels in the mask with {} volumes:'.format(
+            input_data_factory().nmr_problems, args.volumes))
+
+        for name, func in [('previous', lambda d: previous_kernel_data(d, args.batch_size)),
+                           ('current, single precision', lambda d: current_kernel_data(d, args.batch_size, False)),
+                           ('current, half precision', lambda d: current_kernel_data(d, args.batch_size, True))]:
+            input_data = input_data_factory()
+
+            tracemalloc.start()
+            start = time.time()
+            func(input_data)
+            duration = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print('    {}: peak memory {:.1f} MB, {:.2f} seconds'.format(name, peak / 1024. ** 2, duration))
+
+
+if __name__ == '__main__':
+    main()
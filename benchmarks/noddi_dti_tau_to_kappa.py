@@ -0,0 +1,71 @@
+"""Benchmark of the tau to kappa conversion used in the NODDI-DTI maps.
+
+This compares the vectorized table inversion in :func:`mdt.lib.post_processing._tau_to_kappa` with the previous
+implementation, which found every kappa using a non-linear optimization in OpenCL. Both are timed on the tau's of
+uniformly drawn kappa's and compared to these kappa's.
+
+Usage::
+
+    python benchmarks/noddi_dti_tau_to_kappa.py [--voxels 10000]
+"""
+import argparse
+import time
+import numpy as np
+from mdt.lib.lookup_tables import watson_hindered_diffusion_factor
+from mdt.lib.post_processing import _tau_to_kappa
+from mot import minimize
+from mot.lib.cl_function import SimpleCLFunction
+from mot.lib.kernel_data import Array, Struct
+from mot.library_functions import dawson
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-23'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def minimization_tau_to_kappa(tau):
+    """The previous implementation, using a non-linear optimization per voxel."""
+    tau_func = SimpleCLFunction.from_string('''
+        double tau(double kappa){
+            if(kappa < 1e-12){
+                return 1/3.0;
+            }
+            return 0.5 * ( 1 / ( sqrt(kappa) * dawson(sqrt(kappa) ) ) - 1/kappa);
+        }''', dependencies=[dawson()])
+
+    objective_func = SimpleCLFunction.from_string('''
+        double tau_to_kappa(local const mot_float_type* const x, void* data, local mot_float_type* objective_list){
+            return pown(tau(x[0]) - ((_tau_to_kappa_data*)data)->tau, 2);
+        }
+    ''', dependencies=[tau_func])
+
+    kappa = minimize(objective_func, np.ones_like(tau),
+                     data=Struct({'tau': Array(tau, 'mot_float_type', as_scalar=True)},
+                                 '_tau_to_kappa_data')).x
+    kappa[kappa > 64] = 1
+    kappa[kappa < 0] = 1
+    return kappa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--voxels', type=int, default=10000)
+    args = parser.parse_args()
+
+    kappa = np.random.RandomState(0).uniform(0.01, 64, args.voxels)
+    tau = watson_hindered_diffusion_factor(kappa)
+
+    for name, method in [('minimization', minimization_tau_to_kappa), ('table inversion', _tau_to_kappa)]:
+        start = time.time()
+        estimates = np.squeeze(method(tau[:, None].copy()))
+        duration = time.time() - start
+
+        errors = np.abs(estimates - kappa)
+        print('{}: {:.3f} seconds for {} voxels, absolute error in kappa (median, maximum): {:.3g}, {:.3g}'.format(
+            name, duration, args.voxels, np.median(errors), np.max(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark of the evaluation of the model signals in NumPy against the evaluation using OpenCL.
+
+This simulates the signals of a few models with the protocol of the MDT example data, for an increasing number of
+parameter sets, using :func:`mdt.simulations.simulate_signals`. For every number of problems we report the time
+needed with the evaluation in OpenCL (including the compilation of the kernel) and with the evaluation in NumPy, and
+the maximum relative difference between the two. The cross-over point gives a suitable value for the
+``numpy_evaluation.max_nmr_problems`` setting in the configuration.
+
+Usage::
+
+    python benchmarks/numpy_evaluation.py [--models BallStick_r1 Tensor] [--nmr-problems 10 100 1000 10000]
+"""
+import argparse
+import glob
+import time
+import numpy as np
+import pkg_resources
+import mdt
+from mdt.configuration import config_context, YamlStringAction
+from mdt.simulations import simulate_signals
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-02-02'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_parameters(model, nmr_problems):
+    random_state = np.random.RandomState(0)
+    initial = np.array(model.get_initial_parameters()[0])
+    return initial * random_state.uniform(0.5, 1.5, (nmr_problems, len(initial)))
+
+
+def timed_simulation(model, protocol, parameters, max_nmr_problems):
+    with config_context(YamlStringAction('numpy_evaluation: {{max_nmr_problems: {}}}'.format(max_nmr_problems))):
+        start = time.time()
+        signals = simulate_signals(model, protocol, parameters)
+        return signals, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--models', nargs='+', default=['BallStick_r1', 'BallStick_r3', 'Tensor'])
+    parser.add_argument('--nmr-problems', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    args = parser.parse_args()
+
+    mdt.reset_logging()
+    protocol = mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+        'mdt', 'data/mdt_example_data/multishell_b6k_max/*.prtcl'))[0])
+
+    for model_name in args.models:
+        model = mdt.get_model(model_name)(volume_selection=False)
+        print('Model {} with {} volumes:'.format(model_name, protocol.length))
+
+        for nmr_problems in args.nmr_problems:
+            parameters = get_parameters(model, nmr_problems)
+            cl_signals, cl_duration = timed_simulation(model, protocol, parameters, 0)
+            numpy_signals, numpy_duration = timed_simulation(model, protocol, parameters, nmr_problems)
+
+            print('    {:>6} problems: OpenCL {:.3f} seconds, NumPy {:.3f} seconds, '
+                  'maximum relative difference {:.2g}'.format(
+                    nmr_problems, cl_duration, numpy_duration,
+                    np.max(np.abs(numpy_signals - cl_signals) / np.abs(cl_signals))))
+
+
+if __name__ == '__main__':
+    main()
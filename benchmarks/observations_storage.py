@@ -0,0 +1,116 @@
+"""Benchmark of the storage types of the observations in the input data.
+
+This simulates noisy Tensor signals with the protocols of the MDT example datasets, stored like a scanner would as
+integer values in a floating point volume (as is the result of loading a scaled int16 nifti file). For each storage
+type of the observations (see the ``observations`` section of the configuration) this reports:
+
+* the size of the stored observations, the peak memory allocated while creating them and the memory still held by
+  the input data afterwards, which includes the DWI volume for the native storage type (using tracemalloc)
+* the differences in the log-likelihoods, evaluated at the ground truth parameters
+* the differences in the fitted FA and MD maps of the Tensor model
+
+Usage::
+
+    python benchmarks/observations_storage.py [--voxels 100000] [--fit-voxels 1000] [--snr 30]
+"""
+import argparse
+import glob
+import os
+import tempfile
+import tracemalloc
+import numpy as np
+import pkg_resources
+import mdt
+from mdt.simulations import simulate_signals
+from mdt.utils import SimpleMRIInputData
+from mot.cl_routines import compute_log_likelihood
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-31'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_example_protocols():
+    example_data_dir = pkg_resources.resource_filename('mdt', 'data/mdt_example_data')
+    return {os.path.basename(os.path.dirname(fname)): mdt.load_protocol(fname)
+            for fname in sorted(glob.glob(os.path.join(example_data_dir, '*', '*.prtcl')))}
+
+
+def simulate_volume(protocol, nmr_voxels, snr):
+    random_state = np.random.RandomState(0)
+    d = random_state.uniform(1e-9, 2.5e-9, nmr_voxels)
+    parameters = {'S0.s0': np.full(nmr_voxels, 3000.),
+                  'Tensor.d': d,
+                  'Tensor.dperp0': d * random_state.uniform(0.2, 1, nmr_voxels),
+                  'Tensor.dperp1': d * random_state.uniform(0.1, 0.2, nmr_voxels),
+                  'Tensor.theta': random_state.uniform(0, np.pi, nmr_voxels),
+                  'Tensor.phi': random_state.uniform(0, np.pi, nmr_voxels),
+                  'Tensor.psi': random_state.uniform(0, np.pi, nmr_voxels)}
+    signals = simulate_signals(mdt.get_model('Tensor')(volume_selection=False), protocol, parameters)
+
+    noise_std = 3000. / snr
+    noisy_signals = np.hypot(signals + random_state.normal(scale=noise_std, size=signals.shape),
+                             random_state.normal(scale=noise_std, size=signals.shape))
+    return np.round(noisy_signals)[:, None, None, :], noise_std, parameters
+
+
+def get_input_data(protocol, volume, noise_std, storage_type):
+    return SimpleMRIInputData(protocol, volume, np.ones(volume.shape[:3], dtype=np.bool), None, noise_std=noise_std,
+                              observations_storage_type=storage_type)
+
+
+def get_log_likelihoods(input_data, parameters):
+    model = mdt.get_model('Tensor')(volume_selection=False)
+    model.set_input_data(input_data)
+    return compute_log_likelihood(model.get_log_likelihood_function(), model.param_dict_to_array(parameters),
+                                  data=model.get_kernel_data())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--voxels', type=int, default=100000, help='the number of voxels for the memory use')
+    parser.add_argument('--fit-voxels', type=int, default=1000, help='the number of voxels for the fit comparison')
+    parser.add_argument('--snr', type=float, default=30)
+    args = parser.parse_args()
+
+    mdt.reset_logging()
+    storage_types = ['native', 'float16', 'int16']
+
+    for protocol_name, protocol in get_example_protocols().items():
+        print('Protocol {} with {} volumes:'.format(protocol_name, protocol.length))
+        volume, noise_std, parameters = simulate_volume(protocol, args.voxels, args.snr)
+
+        log_likelihoods = {}
+        for storage_type in storage_types:
+            tracemalloc.start()
+            input_data = get_input_data(protocol, volume.copy(), noise_std, storage_type)
+            input_data.nmr_problems
+            held, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            log_likelihoods[storage_type] = get_log_likelihoods(input_data, parameters)
+            print('    {:7}: stored {:.1f} MB, peak memory {:.1f} MB, held memory {:.1f} MB, '
+                  'maximum log-likelihood difference {:.3g}'.format(
+                      storage_type, input_data._get_observation_list().nbytes / 1024. ** 2, peak / 1024. ** 2,
+                      held / 1024. ** 2, np.max(np.abs(log_likelihoods[storage_type] - log_likelihoods['native']))))
+
+        if args.fit_voxels:
+            fitted = {}
+            for storage_type in storage_types:
+                input_data = get_input_data(protocol, volume[:args.fit_voxels], noise_std, storage_type)
+                with tempfile.TemporaryDirectory() as output_folder:
+                    fitted[storage_type] = mdt.fit_model('Tensor', input_data, output_folder)
+
+            print('    Relative differences of the fitted maps to the native storage (median, maximum):')
+            for storage_type in storage_types[1:]:
+                for name in ['Tensor.FA', 'Tensor.MD']:
+                    differences = np.abs(fitted[storage_type][name] - fitted['native'][name]) \
+                                  / np.abs(fitted['native'][name])
+                    print('        {:7} {}: {:.3g}, {:.3g}'.format(
+                        storage_type, name, np.median(differences), np.max(differences)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark of the voxel-wise sorting of the orientations of multi-direction models.
+
+This compares the sorting routines in :mod:`mdt.lib.sorting` with the previous implementations, on simulated
+BallStick_r3-like output maps of a whole brain sized volume in which part of the voxels are in the mask:
+
+* sorting the weights and the orientation maps with :func:`~mdt.lib.sorting.sort_orientations`, previously on the
+  full volume, now only on the voxels in the ``UsedMask``
+* undoing the sort with :func:`~mdt.lib.sorting.undo_sort_volumes_per_voxel`, previously a loop over all voxels
+
+Usage::
+
+    python benchmarks/orientation_sorting.py [--shape 96 114 96] [--mask-fraction 0.4]
+"""
+import argparse
+import itertools
+import time
+import numpy as np
+from mdt.lib.sorting import create_4d_sort_matrix, sort_orientations, undo_sort_volumes_per_voxel
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-29'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def previous_sort_orientations(input_maps, weight_names, extra_sortable_maps):
+    """The previous implementation, sorting the full volumes using an open grid index."""
+    result_maps = dict(input_maps)
+    sort_index_matrix = create_4d_sort_matrix([input_maps[k] for k in weight_names], reversed_sort=True)
+
+    for sortable_map_names in extra_sortable_maps + [weight_names]:
+        volumes = [input_maps[k] if input_maps[k].ndim == 4 else input_maps[k][..., None]
+                   for k in sortable_map_names]
+        volume = np.concatenate(volumes, axis=3)
+        sorted_volume = volume[list(np.ogrid[[slice(x) for x in volume.shape]][:-1]) + [sort_index_matrix]]
+        result_maps.update({name: sorted_volume[..., ind, None] for ind, name in enumerate(sortable_map_names)})
+    return result_maps
+
+
+def previous_undo_sort_volumes_per_voxel(input_volumes, sort_matrix):
+    """The previous implementation, looping over all voxels."""
+    results = [np.zeros_like(vol) for vol in input_volumes]
+    shape = input_volumes[0].shape
+    for x, y, z in itertools.product(range(shape[0]), range(shape[1]), range(shape[2])):
+        for ind, sort_ind in enumerate(list(sort_matrix[x, y, z])):
+            results[sort_ind][x, y, z] = input_volumes[ind][x, y, z]
+    return results
+
+
+def get_maps(shape, mask_fraction):
+    random_state = np.random.RandomState(0)
+    mask = random_state.rand(*shape) < mask_fraction
+
+    maps = {'UsedMask': mask}
+    for ind in range(3):
+        maps['w_stick{}.w'.format(ind)] = random_state.rand(*shape) * mask
+        for param in ['theta', 'phi']:
+            maps['Stick{}.{}'.format(ind, param)] = random_state.rand(*shape) * np.pi * mask
+    return maps
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--shape', type=int, nargs=3, default=[96, 114, 96])
+    parser.add_argument('--mask-fraction', type=float, default=0.4)
+    args = parser.parse_args()
+
+    maps = get_maps(tuple(args.shape), args.mask_fraction)
+    weight_names = ['w_stick{}.w'.format(ind) for ind in range(3)]
+    extra_sortable_maps = [['Stick{}.{}'.format(ind, param) for ind in range(3)] for param in ['theta', 'phi']]
+
+    print('Sorting {} voxels of which {} in the mask:'.format(np.prod(args.shape), np.count_nonzero(maps['UsedMask'])))
+
+    previous, duration = timed(previous_sort_orientations, maps, weight_names, extra_sortable_maps)
+    print('    sort_orientations, previous: {:.3f} seconds'.format(duration))
+    current, duration = timed(sort_orientations, maps, weight_names, extra_sortable_maps)
+    print('    sort_orientations, current: {:.3f} seconds'.format(duration))
+    print('    maximum difference: {}'.format(max(np.max(np.abs(previous[k] - current[k])) for k in weight_names)))
+
+    sort_matrix = create_4d_sort_matrix([maps[k] for k in weight_names], reversed_sort=True)
+    volumes = [current[k] for k in weight_names]
+
+    previous, duration = timed(previous_undo_sort_volumes_per_voxel, volumes, sort_matrix)
+    print('    undo_sort_volumes_per_voxel, previous: {:.3f} seconds'.format(duration))
+    current, duration = timed(undo_sort_volumes_per_voxel, volumes, sort_matrix)
+    print('    undo_sort_volumes_per_voxel, current: {:.3f} seconds'.format(duration))
+    print('    maximum difference: {}'.format(max(np.max(np.abs(p - c)) for p, c in zip(previous, current))))
+
+
+if __name__ == '__main__':
+    main()
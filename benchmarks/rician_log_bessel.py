@@ -0,0 +1,130 @@
+"""Benchmark of the fast log-Bessel approximation in the Rician likelihood.
+
+This simulates noisy Ball&Stick signals at a low SNR and compares the exact and the fast evaluation of
+``log(I0(x))`` in the Rician likelihood (see the ``likelihood_functions`` section of the configuration), on:
+
+* the throughput of the log-likelihood evaluation, the first of the repeated evaluations is discarded to exclude
+  the kernel compilation
+* the differences in the fitted parameters
+
+Usage::
+
+    python benchmarks/rician_log_bessel.py [--voxels 100000] [--fit-voxels 1000] [--snr 5]
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+import mdt
+from mdt import CompositeModelTemplate
+from mdt.configuration import config_context, YamlStringAction
+from mdt.lib.components import temporary_component_updates
+from mdt.simulations import simulate_signals
+from mdt.utils import SimpleMRIInputData
+from mot.cl_routines import compute_log_likelihood
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-22'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_protocol():
+    """A protocol with 6 unweighted volumes and two shells of 30 directions, at b=1000 and b=3000 s/mm^2."""
+    gradients = np.random.RandomState(0).normal(size=(60, 3))
+    gradients /= np.linalg.norm(gradients, axis=1)[:, None]
+    gradients = np.concatenate([np.zeros((6, 3)), gradients])
+    b_values = np.concatenate([np.zeros(6), np.full(30, 1e9), np.full(30, 3e9)])
+    return mdt.protocols.Protocol({'gx': gradients[:, 0], 'gy': gradients[:, 1], 'gz': gradients[:, 2],
+                                   'b': b_values})
+
+
+def get_model(fast_log_bessel):
+    with config_context(YamlStringAction(
+            'likelihood_functions: {{rician: {{fast_log_bessel: {}}}}}'.format(fast_log_bessel))):
+        return mdt.get_model('BallStick_r1_Rician')()
+
+
+def simulate_input_data(nmr_voxels, snr, protocol):
+    random_state = np.random.RandomState(1)
+    parameters = {'S0.s0': np.full(nmr_voxels, 1000.),
+                  'w_stick0.w': random_state.uniform(0.2, 0.8, nmr_voxels),
+                  'Stick0.theta': random_state.uniform(0, np.pi, nmr_voxels),
+                  'Stick0.phi': random_state.uniform(0, np.pi, nmr_voxels)}
+    signals = simulate_signals(get_model(False), protocol, parameters)
+
+    noise_std = 1000. / snr
+    noisy_signals = np.hypot(signals + random_state.normal(scale=noise_std, size=signals.shape),
+                             random_state.normal(scale=noise_std, size=signals.shape))
+
+    return SimpleMRIInputData(protocol, noisy_signals[:, None, None, :], np.ones((nmr_voxels, 1, 1), dtype=np.bool),
+                              None, noise_std=noise_std), parameters
+
+
+def time_log_likelihood(model, input_data, parameters, repeats=3):
+    """Time the evaluation of the log-likelihood function for all voxels.
+
+    Returns:
+        float: the number of log-likelihood evaluations (over all observations of a voxel) per second
+    """
+    model.set_input_data(input_data)
+    parameters = model.param_dict_to_array(parameters)
+
+    durations = []
+    for _ in range(repeats + 1):
+        start = time.time()
+        compute_log_likelihood(model.get_log_likelihood_function(), parameters, data=model.get_kernel_data())
+        durations.append(time.time() - start)
+    return input_data.nmr_problems / min(durations[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--voxels', type=int, default=100000, help='the number of voxels for the throughput')
+    parser.add_argument('--fit-voxels', type=int, default=1000, help='the number of voxels for the fit comparison')
+    parser.add_argument('--snr', type=float, default=5)
+    args = parser.parse_args()
+
+    mdt.reset_logging()
+    protocol = get_protocol()
+
+    with temporary_component_updates():
+        class BallStick_r1_Rician(CompositeModelTemplate):
+
+            model_expression = '''
+                S0 * ( (Weight(w_ball) * Ball) +
+                       (Weight(w_stick0) * Stick(Stick0)) )
+            '''
+            fixes = {'Ball.d': 3.0e-9,
+                     'Stick0.d': 1.7e-9}
+            likelihood_function = 'Rician'
+
+        run_benchmarks(args, protocol)
+
+
+def run_benchmarks(args, protocol):
+    """Run the throughput and fit comparisons, this requires the ``BallStick_r1_Rician`` model to be defined."""
+    input_data, parameters = simulate_input_data(args.voxels, args.snr, protocol)
+    print('Log-likelihood evaluations per second ({} voxels):'.format(args.voxels))
+    for fast_log_bessel in [False, True]:
+        throughput = time_log_likelihood(get_model(fast_log_bessel), input_data, parameters)
+        print('    {:5}: {:.4g}'.format('fast' if fast_log_bessel else 'exact', throughput))
+
+    input_data, parameters = simulate_input_data(args.fit_voxels, args.snr, protocol)
+    fitted = {}
+    for fast_log_bessel in [False, True]:
+        with tempfile.TemporaryDirectory() as output_folder:
+            start = time.time()
+            fitted[fast_log_bessel] = mdt.fit_model(get_model(fast_log_bessel), input_data, output_folder)
+            print('Fitting {} voxels with the {} log-Bessel function took {:.2f} seconds'.format(
+                args.fit_voxels, 'fast' if fast_log_bessel else 'exact', time.time() - start))
+
+    print('Absolute differences in the fitted parameters (median, maximum):')
+    for name in sorted(parameters):
+        differences = np.abs(fitted[True][name] - fitted[False][name])
+        print('    {}: {:.3g}, {:.3g}'.format(name, np.median(differences), np.max(differences)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Benchmark of the streaming simulations against the simulations in memory.
+
+This simulates noisy BallStick_r1 signals with the protocol of the MDT example data, for several SNRs, using:
+
+* the previous approach, :func:`~mdt.simulations.simulate_signals` for all samples at once followed by
+  :func:`~mdt.simulations.add_rician_noise` per SNR
+* the streaming simulations of :func:`~mdt.simulations.stream_simulated_signals`, adding the noise in the kernel
+  and writing the chunks to ``.npy`` files
+
+For both we report the throughput and the peak memory allocated in Python (using tracemalloc).
+
+Usage::
+
+    python benchmarks/simulation_throughput.py [--samples 200000] [--snrs 10 20 50] [--chunk-size 10000]
+"""
+import argparse
+import glob
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pkg_resources
+import mdt
+from mdt.configuration import config_context, YamlStringAction
+from mdt.simulations import simulate_signals, add_rician_noise, stream_simulated_signals, Uniform, \
+    UniformOrientation
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-02-04'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_distributions():
+    return {'S0.s0': Uniform(500, 2000),
+            'w_stick0.w': Uniform(0.2, 0.8),
+            ('Stick0.theta', 'Stick0.phi'): UniformOrientation()}
+
+
+def previous_simulations(protocol, nmr_samples, snrs):
+    """The previous approach, simulating all signals in memory and adding the noise in NumPy."""
+    random_state = np.random.RandomState(0)
+    orientations = UniformOrientation().draw(nmr_samples, random_state)
+    parameters = np.column_stack([random_state.uniform(500, 2000, nmr_samples),
+                                  random_state.uniform(0.2, 0.8, nmr_samples),
+                                  orientations[:, 0], orientations[:, 1]])
+
+    with config_context(YamlStringAction('numpy_evaluation: {max_nmr_problems: 0}')):
+        signals = simulate_signals('BallStick_r1', protocol, parameters)
+    return [add_rician_noise(signals, parameters[:, :1] / snr) for snr in snrs]
+
+
+def streaming_simulations(protocol, nmr_samples, snrs, chunk_size):
+    with tempfile.TemporaryDirectory() as output_dir:
+        results = stream_simulated_signals('BallStick_r1', protocol, get_distributions(), nmr_samples, output_dir,
+                                           snrs=snrs, chunk_size=chunk_size, seed=0)
+        del results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--samples', type=int, default=200000)
+    parser.add_argument('--snrs', type=float, nargs='+', default=[10, 20, 50])
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    mdt.reset_logging()
+    protocol = mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+        'mdt', 'data/mdt_example_data/multishell_b6k_max/*.prtcl'))[0])
+    print('Simulating {} samples with {} volumes at {} SNRs:'.format(args.samples, protocol.length, len(args.snrs)))
+
+    for name, func, func_args in [('previous', previous_simulations, (protocol, args.samples, args.snrs)),
+                                  ('streaming', streaming_simulations,
+                                   (protocol, args.samples, args.snrs, args.chunk_size))]:
+        tracemalloc.start()
+        start = time.time()
+        func(*func_args)
+        duration = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print('    {}: {:.1f} seconds, {:.0f} samples per second, peak memory {:.1f} MB'.format(
+            name, duration, args.samples / duration, peak / 1024. ** 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark of the memory use of input data objects with a subset of the volumes.
+
+This simulates a dataset with the shells of the HCP MGH protocol (552 volumes, at b=0, 1000, 3000, 5000 and
+10000 s/mm^2) and creates the input data of several models fitted on a different selection of shells, as done by
+the volume selection of the composite models. Next, the observations of every selection are extracted in batches of
+voxels, like the processing strategies do. We report the peak memory allocated during that process (using
+tracemalloc) for:
+
+* the previous implementation, copying the selected volumes of the DWI volume for every selection
+* the current implementation, in which every selection references the data of the full input data object
+
+Usage::
+
+    python benchmarks/volume_subsets_memory.py [--shape 40 48 40] [--batch-size 10000]
+"""
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import mdt
+from mdt.utils import SimpleMRIInputData, create_roi
+from mot.lib.utils import split_in_batches
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-02-01'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_input_data(shape):
+    random_state = np.random.RandomState(0)
+    b_values = np.concatenate([np.full(40, 0), np.full(64, 1e9), np.full(64, 3e9), np.full(128, 5e9),
+                               np.full(256, 10e9)])
+    gradients = random_state.normal(size=(len(b_values), 3))
+    gradients /= np.linalg.norm(gradients, axis=1)[:, None]
+    protocol = mdt.protocols.Protocol({'gx': gradients[:, 0], 'gy': gradients[:, 1], 'gz': gradients[:, 2],
+                                       'b': b_values})
+
+    mask = random_state.rand(*shape) < 0.5
+    signals = np.round(random_state.uniform(100, 1000, size=shape + (len(b_values),))).astype(np.float32)
+    return SimpleMRIInputData(protocol, signals, mask, None, noise_std=1, observations_storage_type='native')
+
+
+def get_selections(protocol):
+    """The volumes used by the Tensor, the Kurtosis and a multi-shell model."""
+    b_values = protocol['b']
+    return [np.where(b_values <= 1.5e9 + 0.1e9)[0],
+            np.where(b_values <= 3e9 + 0.1e9)[0],
+            np.where(b_values <= 5e9 + 0.1e9)[0],
+            np.arange(protocol.length)]
+
+
+def previous_subsets(input_data, selections, batch_size):
+    """The previous implementation, copying the selected volumes and their observations per selection."""
+    subsets = []
+    for volumes in selections:
+        signal4d = input_data.signal4d[..., volumes]
+        observations = create_roi(signal4d, input_data.mask)
+        subsets.append((signal4d, observations))
+        for batch_start, batch_end in split_in_batches(observations.shape[0], batch_size):
+            observations[batch_start:batch_end].astype(np.float32)
+    return subsets
+
+
+def current_subsets(input_data, selections, batch_size):
+    subsets = []
+    for volumes in selections:
+        subsets.append(input_data.get_subset(volumes_to_keep=volumes))
+        for batch_start, batch_end in split_in_batches(subsets[-1].nmr_problems, batch_size):
+            subsets[-1].get_observations(np.arange(batch_start, batch_end)).astype(np.float32)
+    return subsets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--shape', type=int, nargs=3, default=[40, 48, 40])
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    selections = get_selections(get_input_data((1, 1, 1)).protocol)
+    print('Selections of {} volumes of {} voxels:'.format(
+        ', '.join(str(len(volumes)) for volumes in selections), np.prod(args.shape)))
+
+    for name, func in [('previous', previous_subsets), ('current', current_subsets)]:
+        input_data = get_input_data(tuple(args.shape))
+
+        tracemalloc.start()
+        start = time.time()
+        subsets = func(input_data, selections, args.batch_size)
+        duration = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del subsets
+
+        print('    {}: peak memory {:.1f} MB, {:.2f} seconds'.format(name, peak / 1024. ** 2, duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,12 +30,12 @@ from mdt.utils import estimate_noise_std, get_cl_devices, load_input_data,\
     create_blank_mask, create_index_matrix, \
     volume_index_to_roi_index, roi_index_to_volume_index, load_brain_mask, init_user_settings, restore_volumes, \
     apply_mask, create_roi, volume_merge, protocol_merge, create_median_otsu_brain_mask, create_brain_mask, \
-    load_samples, load_sample, load_nifti, write_slice_roi, apply_mask_to_file, extract_volumes, \
+    load_samples, load_sample, get_voxel_samples, load_nifti, write_slice_roi, apply_mask_to_file, extract_volumes, \
     get_slice_in_dimension, per_model_logging_context, \
     get_temporary_results_dir, get_example_data, SimpleInitializationData, InitializationData, load_volume_maps,\
     covariance_to_correlation, check_user_components, unzip_nifti, zip_nifti
 from mdt.lib.sorting import sort_orientations, create_4d_sort_matrix, sort_volumes_per_voxel
-from mdt.simulations import create_signal_estimates, simulate_signals, add_rician_noise
+from mdt.simulations import create_signal_estimates, simulate_signals, add_rician_noise, stream_simulated_signals
 from mdt.lib.batch_utils import run_function_on_batch_fit_output, batch_apply, \
     batch_profile_factory, get_subject_selection
 from mdt.protocols import load_bvec_bval, load_protocol, auto_load_protocol, write_protocol, write_bvec_bval, \
@@ -43,7 +43,9 @@ from mdt.protocols import load_bvec_bval, load_protocol, auto_load_protocol, wri
 from mdt.configuration import config_context, get_processing_strategy, get_config_option, set_config_option
 from mdt.lib.exceptions import InsufficientProtocolError
 from mdt.lib.nifti import write_nifti
+from mdt.lib.packed_covariances import load_covariance_maps, load_covariance_matrices, get_voxel_covariance_matrix
 from mdt.lib.components import get_model, get_batch_profile, get_component, get_template
+from mdt.lib.parcel_fitting import fit_parcels, sample_parcels, create_parcel_input_data, paint_parcel_results
 
 
 __author__ = 'Robbert Harms'
@@ -53,7 +55,7 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
-def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None):
+def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None, method='cascade'):
     """Get better optimization starting points for the given model.
 
     Since initialization can make quite a difference in optimization results, this function can generate
@@ -81,12 +83,18 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
             model name in it.
         cl_device_ind (int or list): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices(). This can also be a list of device indices.
+        method (str): the initialization method, either 'cascade' or 'dictionary'. The cascade method fits a chain of
+            simpler models and only supports the models shipped with MDT. The dictionary method matches every voxel
+            against a cached dictionary of simulated model signals and works for any composite model.
 
     Returns:
         dict: a dictionary with initialization points for the selected model
+
+    Raises:
+        ValueError: if the initialization method is not supported
     """
     from mdt.lib.model_fitting import get_optimization_inits
-    return get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=cl_device_ind)
+    return get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=cl_device_ind, method=method)
 
 
 def fit_model(model, input_data, output_folder,
@@ -207,6 +215,49 @@ def fit_model(model, input_data, output_folder,
     return model_fit.run()
 
 
+def fit_model_set(models, input_data, output_folder, information_criterion='BIC', method=None, recalculate=False,
+                  cl_device_ind=None, double_precision=False, tmp_results_dir=True, initialization_data=None,
+                  optimizer_options=None):
+    """Fit a set of candidate models in one pass and select per voxel the best model.
+
+    All candidates share the loaded input data and are processed together, chunk by chunk. Per voxel, the information
+    criterion maps of the candidates are compared to produce a winner map, the Akaike weights of every candidate and
+    model-averaged estimates of the free parameters. These maps are written to ``<output_folder>/ModelSelection``, the
+    results of every candidate are written as usual to ``<output_folder>/<model_name>``.
+
+    Args:
+        models (list of str or :class:`~mdt.models.composite.DMRICompositeModel`): the candidate composite models
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data object containing all
+            the info needed for the model fitting.
+        output_folder (string): The path to the folder where to place the output.
+        information_criterion (str): the information criterion to use for the selection, one of 'BIC', 'AIC'
+            or 'AICc'.
+        method (str): The optimization method to use, if not given we use the configured method per model.
+        recalculate (boolean): If we want to recalculate the results if they are already present.
+        cl_device_ind (int or list): the index of the CL device to use. The index is from the list from the function
+            utils.get_cl_devices(). This can also be a list of device indices.
+        double_precision (boolean): if we would like to do the calculations in double precision
+        tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
+            that path directly, set to True to use the config value, set to None to disable.
+        initialization_data (dict): per model name the initialization data for that model. Please see
+            :func:`fit_model` for the format of the initialization data.
+        optimizer_options (dict): extra options passed to the optimization routines.
+
+    Returns:
+        dict: the model selection maps as ROI lists.
+    """
+    import mdt.utils
+    from mdt.lib.model_fitting import fit_model_set
+
+    if not mdt.utils.check_user_components():
+        init_user_settings(pass_if_exists=True)
+
+    return fit_model_set(models, input_data, output_folder, information_criterion=information_criterion,
+                         method=method, recalculate=recalculate, cl_device_ind=cl_device_ind,
+                         double_precision=double_precision, tmp_results_dir=tmp_results_dir,
+                         initialization_data=initialization_data, optimizer_options=optimizer_options)
+
+
 def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None, thinning=None,
                  method=None, recalculate=False, cl_device_ind=None, double_precision=False,
                  store_samples=True, sample_items_to_save=None, tmp_results_dir=True,
@@ -238,8 +289,9 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
         cl_device_ind (int): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices().
         double_precision (boolean): if we would like to do the calculations in double precision
-        store_samples (boolean): determines if we store any of the samples. If set to False we will store none
-            of the samples.
+        store_samples (boolean or :class:`~mdt.lib.processing_strategies.SamplesStorageStrategy`): determines if we
+            store any of the samples. If set to False we will store none of the samples. For compact storage, set this
+            to a :class:`~mdt.lib.processing_strategies.SaveQuantizedSamples` instance.
         sample_items_to_save (list): list of output names we want to store the samples of. If given, we only
             store the items specified in this list. Valid items are the free parameter names of the model and the
             items 'LogLikelihood' and 'LogPrior'.
@@ -330,6 +382,87 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
                                       sampler_options=sampler_options)
 
 
+def bootstrap_model(model, input_data, output_folder, nmr_bootstraps=100, bootstrap_method='residual',
+                    quantiles=(0.025, 0.5, 0.975), seed=None, optimization_results=None, method=None,
+                    recalculate=False, cl_device_ind=None, double_precision=False, tmp_results_dir=True,
+                    optimizer_options=None):
+    """Estimate the uncertainty of a model fit using bootstrapping.
+
+    Per voxel this generates ``nmr_bootstraps`` resampled observation sets from the model signal and residuals of the
+    original fit, and fits every replicate warm-started from the original fit. Only the mean, standard deviation and the
+    requested quantiles over the replicates are stored, per free parameter.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel` or str): the model to bootstrap
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data object containing all
+            the info needed for the model fitting.
+        output_folder (string): The path to the folder where to place the output, we will make a subdir with the
+            model name in it (for the optimization results) and then a subdir with the bootstrap output.
+        nmr_bootstraps (int): the number of bootstrap replicates per voxel
+        bootstrap_method (str): either 'residual', to resample the residuals with replacement, or 'wild', to
+            multiply the residuals with random signs.
+        quantiles (tuple of float): the quantiles of the bootstrap distribution to store
+        seed (int): the seed for the random number generator, set for reproducible results
+        optimization_results (str or dict): the results of the original model fit. If not given we use the
+            optimization results in the output folder, which are computed if not present.
+        method (str): The optimization method to use, defaults to the configured optimizer for this model.
+        recalculate (boolean): If we want to recalculate the results if they are already present.
+        cl_device_ind (int): the index of the CL device to use. The index is from the list from the function
+            utils.get_cl_devices().
+        double_precision (boolean): if we would like to do the calculations in double precision
+        tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
+                that path directly, set to True to use the config value, set to None to disable.
+        optimizer_options (dict): extra options passed to the optimization routine.
+
+    Returns:
+        dict: per output map the ROI list with the bootstrap statistics.
+    """
+    import mdt.utils
+    from mdt.lib.model_bootstrapping import bootstrap_composite_model
+    from mdt.models.cascade import DMRICascadeModelInterface
+    import mot.configuration
+
+    if not mdt.utils.check_user_components():
+        init_user_settings(pass_if_exists=True)
+
+    if isinstance(model, str):
+        model = get_model(model)()
+
+    if isinstance(model, DMRICascadeModelInterface):
+        raise ValueError('The function \'bootstrap_model()\' does not accept cascade models.')
+
+    if optimization_results is None:
+        optimization_results = fit_model(model.name, input_data, output_folder, method=method,
+                                         cl_device_ind=cl_device_ind, double_precision=double_precision,
+                                         tmp_results_dir=tmp_results_dir, optimizer_options=optimizer_options)
+
+    if cl_device_ind is None:
+        cl_context_action = mot.configuration.VoidConfigurationAction()
+    else:
+        cl_context_action = mot.configuration.RuntimeConfigurationAction(
+            cl_environments=get_cl_devices(cl_device_ind),
+            double_precision=double_precision)
+
+    with mot.configuration.config_context(cl_context_action):
+        base_dir = os.path.join(output_folder, model.name, 'bootstrap')
+
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+
+        if recalculate:
+            shutil.rmtree(base_dir)
+
+        logger = logging.getLogger(__name__)
+        logger.info('Using MDT version {}'.format(__version__))
+        logger.info('Preparing for model {0}'.format(model.name))
+
+        return bootstrap_composite_model(model, input_data, base_dir, optimization_results,
+                                         get_temporary_results_dir(tmp_results_dir),
+                                         nmr_bootstraps=nmr_bootstraps, bootstrap_method=bootstrap_method,
+                                         quantiles=quantiles, seed=seed, method=method, recalculate=recalculate,
+                                         optimizer_options=optimizer_options)
+
+
 def batch_fit(data_folder, models_to_fit, output_folder=None, batch_profile=None,
               subjects_selection=None, recalculate=False,
               cl_device_ind=None, dry_run=False,
@@ -552,6 +685,47 @@ def sort_maps(input_maps, reversed_sort=False, sort_index_matrix=None):
     return sort_volumes_per_voxel(input_maps, sort_index_matrix)
 
 
+def compute_tensor_maps(results_folder, compartment_name=None, output_folder=None, batch_size=10000):
+    """Recompute the DTI and DKI measures (FA, MD, MK, etc.) from the maps in an existing output folder.
+
+    This does not require OpenCL and processes the voxels in batches to bound the memory usage.
+
+    Args:
+        results_folder (str): the folder with the output maps of a model, for example ``<output>/Kurtosis``
+        compartment_name (str): the name of the Tensor-like compartment in the results. If not given, we use the
+            single compartment with the maps ``d``, ``dperp0`` and ``dperp1`` in the results folder.
+        output_folder (str): the folder to write the maps to, defaults to the results folder
+        batch_size (int): the number of voxels to process at once
+
+    Returns:
+        dict: the computed maps as volumes
+    """
+    from mdt.lib.post_processing import compute_tensor_maps
+    return compute_tensor_maps(results_folder, compartment_name=compartment_name, output_folder=output_folder,
+                               batch_size=batch_size)
+
+
+def compute_derived_maps(results_folder, map_names=None, output_folder=None, batch_size=10000):
+    """Compute the maps which can be derived from the maps in an existing output folder, but which are missing.
+
+    See :mod:`mdt.lib.derived_maps` for the registry of maps which can be derived, like the DTI and NODDI measures.
+    These are not computed after optimization if the ``derived_maps`` switch of the post processing configuration
+    is disabled.
+
+    Args:
+        results_folder (str): the folder with the output maps of a model, for example ``<output>/Tensor``
+        map_names (list of str): if given, only compute these maps
+        output_folder (str): the folder to write the maps to, defaults to the results folder
+        batch_size (int): the number of voxels to process at once
+
+    Returns:
+        dict: the computed maps as volumes
+    """
+    from mdt.lib.derived_maps import compute_derived_maps
+    return compute_derived_maps(results_folder, map_names=map_names, output_folder=output_folder,
+                                batch_size=batch_size)
+
+
 def get_volume_names(directory):
     """Get the names of the Nifti volume maps in the given directory.
 
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Compute the maps which can be derived from the output maps of a model, but which are not yet in the folder.
+
+This computes, for example, the DTI measures from the Tensor parameters or the NDI and ODI from the NODDI parameters.
+These maps are not computed during optimization if the ``derived_maps`` switch of the post processing configuration
+is disabled. This does not require OpenCL.
+"""
+import argparse
+import os
+import mdt
+from argcomplete.completers import FilesCompleter
+import textwrap
+
+from mdt.lib.shell_utils import BasicShellApplication
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-28'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class ComputeDerivedMaps(BasicShellApplication):
+
+    def _get_arg_parser(self, doc_parser=False):
+        description = textwrap.dedent(__doc__)
+
+        examples = textwrap.dedent('''
+            mdt-compute-derived-maps output/brain_mask/Tensor
+            mdt-compute-derived-maps output/brain_mask/NODDI -m NDI ODI
+            mdt-compute-derived-maps output/brain_mask/Kurtosis -o /tmp/kurtosis_maps
+        ''')
+        epilog = self._format_examples(doc_parser, examples)
+
+        parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+
+        parser.add_argument('results_folder', help='the folder with the output maps of the model').completer = \
+            FilesCompleter()
+
+        parser.add_argument('-m', '--map-names', nargs='+',
+                            help='the names of the maps to compute, by default all missing derived maps')
+        parser.add_argument('-o', '--output-folder',
+                            help='the folder to write the maps to, defaults to the results folder').completer = \
+            FilesCompleter()
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='the number of voxels to process at once, defaults to 10000')
+
+        return parser
+
+    def run(self, args, extra_args):
+        output_folder = None
+        if args.output_folder:
+            output_folder = os.path.realpath(args.output_folder)
+            if not os.path.isdir(output_folder):
+                os.makedirs(output_folder)
+
+        mdt.compute_derived_maps(os.path.realpath(args.results_folder), map_names=args.map_names,
+                                 output_folder=output_folder, batch_size=args.batch_size)
+
+
+def get_doc_arg_parser():
+    return ComputeDerivedMaps().get_documentation_arg_parser()
+
+
+if __name__ == '__main__':
+    ComputeDerivedMaps().start()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Recompute the DTI and DKI measures from the output maps of a Tensor or Kurtosis model.
+
+This computes maps like FA, MD, AD, RD and, for the Kurtosis models, MK, AK and RK from the fitted parameter maps
+in an existing output folder. This does not require OpenCL.
+"""
+import argparse
+import os
+import mdt
+from argcomplete.completers import FilesCompleter
+import textwrap
+
+from mdt.lib.shell_utils import BasicShellApplication
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-24'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class ComputeTensorMaps(BasicShellApplication):
+
+    def _get_arg_parser(self, doc_parser=False):
+        description = textwrap.dedent(__doc__)
+
+        examples = textwrap.dedent('''
+            mdt-compute-tensor-maps output/brain_mask/Kurtosis
+            mdt-compute-tensor-maps output/brain_mask/Tensor -o /tmp/tensor_maps
+            mdt-compute-tensor-maps output/brain_mask/Tensor -c Tensor --batch-size 50000
+        ''')
+        epilog = self._format_examples(doc_parser, examples)
+
+        parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+
+        parser.add_argument('results_folder', help='the folder with the output maps of the model').completer = \
+            FilesCompleter()
+
+        parser.add_argument('-c', '--compartment-name',
+                            help='the name of the Tensor compartment, by default autodetected')
+        parser.add_argument('-o', '--output-folder',
+                            help='the folder to write the maps to, defaults to the results folder').completer = \
+            FilesCompleter()
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='the number of voxels to process at once, defaults to 10000')
+
+        return parser
+
+    def run(self, args, extra_args):
+        output_folder = None
+        if args.output_folder:
+            output_folder = os.path.realpath(args.output_folder)
+            if not os.path.isdir(output_folder):
+                os.makedirs(output_folder)
+
+        mdt.compute_tensor_maps(os.path.realpath(args.results_folder), compartment_name=args.compartment_name,
+                                output_folder=output_folder, batch_size=args.batch_size)
+
+
+def get_doc_arg_parser():
+    return ComputeTensorMaps().get_documentation_arg_parser()
+
+
+if __name__ == '__main__':
+    ComputeTensorMaps().start()
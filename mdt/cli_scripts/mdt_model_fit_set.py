@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Fit a set of candidate models to the given data and select per voxel the best model.
+
+All candidate models are fitted in one pass, sharing the loaded data. Afterwards, the models are compared per voxel
+using an information criterion (BIC by default). The output folder will contain the results of every candidate model
+and a directory "ModelSelection" with the winner map, the Akaike weights per model and the model-averaged parameters.
+"""
+import argparse
+import os
+import mdt
+from argcomplete.completers import FilesCompleter
+
+from mdt.cli_scripts.mdt_model_fit import get_extra_protocol
+from mdt.lib.shell_utils import BasicShellApplication
+from mot.lib import cl_environments
+import textwrap
+
+__author__ = 'Robbert Harms'
+__date__ = "2019-01-14"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class ModelFitSet(BasicShellApplication):
+
+    def __init__(self):
+        super().__init__()
+        self.available_devices = list((ind for ind, env in
+                                       enumerate(cl_environments.CLEnvironmentFactory.smart_device_selection())))
+
+    def _get_arg_parser(self, doc_parser=False):
+        description = textwrap.dedent(__doc__)
+
+        examples = textwrap.dedent('''
+            mdt-model-fit-set data.nii.gz data.prtcl roi_mask_0_50.nii.gz -m BallStick_r1 BallStick_r2 Tensor
+            mdt-model-fit-set ... --information-criterion AIC
+            mdt-model-fit-set ... --cl-device-ind 1
+           ''')
+        epilog = self._format_examples(doc_parser, examples)
+
+        parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+        parser.add_argument(
+            'dwi', action=mdt.lib.shell_utils.get_argparse_extension_checker(['.nii', '.nii.gz', '.hdr', '.img']),
+            help='the diffusion weighted image').completer = FilesCompleter(['nii', 'gz', 'hdr', 'img'],
+                                                                            directories=False)
+        parser.add_argument(
+            'protocol', action=mdt.lib.shell_utils.get_argparse_extension_checker(['.prtcl']),
+            help='the protocol file, see mdt-create-protocol').completer = FilesCompleter(['prtcl'],
+                                                                                          directories=False)
+        parser.add_argument(
+            'mask', action=mdt.lib.shell_utils.get_argparse_extension_checker(['.nii', '.nii.gz', '.hdr', '.img']),
+            help='the (brain) mask to use').completer = FilesCompleter(['nii', 'gz', 'hdr', 'img'],
+                                                                       directories=False)
+        parser.add_argument('-m', '--models', nargs='+', required=True, choices=mdt.get_models_list(),
+                            help='the candidate models, see mdt-list-models')
+
+        parser.add_argument('-o', '--output_folder',
+                            help='the directory for the output, defaults to "output/<mask_name>" '
+                                 'in the same directory as the dwi volume').completer = FilesCompleter()
+
+        parser.add_argument('-n', '--noise-std', default=None,
+                            help='the noise std, defaults to None for automatic noise estimation.'
+                                 'Either set this to a value, or to a filename.')
+
+        parser.add_argument('--information-criterion', default='BIC', choices=['BIC', 'AIC', 'AICc'],
+                            help='The information criterion used to compare the models, defaults to BIC.')
+
+        parser.add_argument(
+            '--gradient-deviations',
+            action=mdt.lib.shell_utils.get_argparse_extension_checker(['.nii', '.nii.gz', '.hdr', '.img']),
+            help="The volume with the gradient deviations to use, in HCP WUMINN format.").\
+            completer = FilesCompleter(['nii', 'gz', 'hdr', 'img'], directories=False)
+
+        parser.add_argument('--cl-device-ind', type=int, nargs='*', choices=self.available_devices,
+                            help="The index of the device we would like to use. This follows the indices "
+                                 "in mdt-list-devices and defaults to the first GPU.")
+
+        parser.add_argument('--recalculate', dest='recalculate', action='store_true',
+                            help="Recalculate the model(s) if the output exists. (default)")
+        parser.add_argument('--no-recalculate', dest='recalculate', action='store_false',
+                            help="Do not recalculate the model(s) if the output exists.")
+        parser.set_defaults(recalculate=True)
+
+        parser.add_argument('--method', default=None,
+                            choices=['Powell', 'Nelder-Mead', 'Levenberg-Marquardt', 'Subplex'],
+                            help='The optimization method to use, defaults to the configured method per model.')
+
+        parser.add_argument('--double', dest='double_precision', action='store_true',
+                            help="Calculate in double precision.")
+        parser.add_argument('--float', dest='double_precision', action='store_false',
+                            help="Calculate in single precision. (default)")
+        parser.set_defaults(double_precision=False)
+
+        parser.add_argument('--tmp-results-dir', dest='tmp_results_dir', default='True', type=str,
+                            help='The directory for the temporary results. The default ("True") uses the config file '
+                                 'setting. Set to the literal "None" to disable.').completer = FilesCompleter()
+
+        parser.add_argument('--config-context', dest='config_context', type=str,
+                            help='The configuration context to use during fitting the models. '
+                                 'Same syntax as config files')
+
+        parser.add_argument('--extra-protocol', dest='extra_protocol', type=str, nargs='+',
+                            help='Additional protocol values, provide as <key>=<value> pairs')
+
+        return parser
+
+    def run(self, args, extra_args):
+        mask_name = os.path.splitext(os.path.basename(os.path.realpath(args.mask)))[0]
+        mask_name = mask_name.replace('.nii', '')
+        output_folder = args.output_folder or os.path.join(os.path.dirname(args.dwi), 'output', mask_name)
+
+        tmp_results_dir = args.tmp_results_dir
+        for match, to_set in [('true', True), ('false', False), ('none', None)]:
+            if tmp_results_dir.lower() == match:
+                tmp_results_dir = to_set
+                break
+
+        noise_std = args.noise_std
+        if noise_std is not None:
+            if not os.path.isfile(os.path.realpath(noise_std)):
+                noise_std = float(noise_std)
+
+        def fit_model_set():
+            input_data = mdt.load_input_data(
+                os.path.realpath(args.dwi),
+                os.path.realpath(args.protocol),
+                os.path.realpath(args.mask),
+                gradient_deviations=args.gradient_deviations,
+                noise_std=noise_std,
+                extra_protocol=get_extra_protocol(args.extra_protocol,
+                                                  os.path.realpath('')))
+
+            mdt.fit_model_set(args.models,
+                              input_data,
+                              output_folder,
+                              information_criterion=args.information_criterion,
+                              method=args.method,
+                              recalculate=args.recalculate,
+                              cl_device_ind=args.cl_device_ind,
+                              double_precision=args.double_precision,
+                              tmp_results_dir=tmp_results_dir)
+
+        if args.config_context:
+            with mdt.config_context(args.config_context):
+                fit_model_set()
+        else:
+            fit_model_set()
+
+
+def get_doc_arg_parser():
+    return ModelFitSet().get_documentation_arg_parser()
+
+
+if __name__ == '__main__':
+    ModelFitSet().start()
@@ -3,9 +3,11 @@ import numpy as np
 from mdt.component_templates.base import ComponentBuilder, ComponentTemplate
 from mdt.lib.components import get_component, has_component
 from mdt.models.compartments import DMRICompartmentModelFunction, WeightCompartment, CacheInfo
+from mdt.lib.quadrature import gauss_legendre, gauss_laguerre, get_quadrature_cl_code
 from mdt.utils import spherical_to_cartesian
 from mot.lib.cl_function import CLFunction, SimpleCLFunction, SimpleCLFunctionParameter, SimpleCLCodeObject
-from mdt.model_building.parameters import CurrentObservationParam, DataCacheParameter, NoiseStdInputParameter
+from mdt.model_building.parameters import CurrentObservationParam, DataCacheParameter, NoiseStdInputParameter, \
+    PrecomputedProtocolParameter
 
 __author__ = 'Robbert Harms'
 __date__ = "2017-02-14"
@@ -27,9 +29,17 @@ class CompartmentBuilder(ComponentBuilder):
         class AutoCreatedDMRICompartmentModel(DMRICompartmentModelFunction):
 
             def __init__(self, nickname=None):
-                parameters = _resolve_parameters(template.parameters, template.name)
+                parameter_list = list(template.parameters)
+                if template.quadrature is not None and '@cache' not in parameter_list:
+                    parameter_list.append('@cache')
+
+                parameters = _resolve_parameters(parameter_list, template.name,
+                                                 protocol_precompute=template.protocol_precompute)
                 dependencies = _resolve_dependencies(template.dependencies)
 
+                if template.quadrature is not None:
+                    dependencies.append(SimpleCLCodeObject(builder._get_quadrature_constants(template)))
+
                 if template.cl_extra:
                     extra_code = '''
                         #ifndef {inclusion_guard_name}
@@ -44,7 +54,7 @@ class CompartmentBuilder(ComponentBuilder):
                     template.return_type,
                     template.name,
                     parameters,
-                    template.cl_code,
+                    builder._get_cl_code(template),
                     dependencies=dependencies,
                     model_function_priors=_resolve_prior(template.extra_prior, template.name,
                                                          [p.name for p in parameters]),
@@ -133,12 +143,101 @@ class CompartmentBuilder(ComponentBuilder):
 
         return callbacks
 
+    def _get_cl_code(self, template):
+        """Get the CL code of the compartment, with the quadrature evaluation added if the template defines one."""
+        if template.quadrature is None:
+            return template.cl_code
+
+        return '''
+            {cl_code}
+            double quadrature_sum = 0;
+            double {variable};
+            for(uint quadrature_ind = 0; quadrature_ind < {name}_order; quadrature_ind++){{
+                {variable} = cache->quadrature_nodes[quadrature_ind];
+                quadrature_sum += cache->quadrature_weights[quadrature_ind] * ({integrand});
+            }}
+            return quadrature_sum / *cache->quadrature_weight_sum;
+        '''.format(cl_code=template.cl_code or '', variable=template.quadrature['variable'],
+                   name=_get_quadrature_name(template), integrand=template.quadrature['integrand'])
+
+    def _get_quadrature_constants(self, template):
+        """Get the CL code with the nodes and weights of the quadrature rule of the given template.
+
+        For the Gauss-Laguerre rule the weights are multiplied by ``exp(x)``, such that both rules integrate the
+        given function itself instead of the product of the function with the weight function of the rule.
+        """
+        rule = template.quadrature.get('rule', 'legendre')
+        order = template.quadrature['order']
+
+        if rule == 'legendre':
+            nodes, weights = gauss_legendre(order)
+        elif rule == 'laguerre':
+            nodes, weights = gauss_laguerre(order)
+            weights = weights * np.exp(nodes)
+        else:
+            raise ValueError('The quadrature rule "{}" of the compartment "{}" is not supported, use "legendre" '
+                             'or "laguerre".'.format(rule, template.name))
+
+        return '''
+            #ifndef {inclusion_guard_name}
+            #define {inclusion_guard_name}
+            {constants}
+            #endif // {inclusion_guard_name}
+        '''.format(inclusion_guard_name='INCLUDE_GUARD_QUADRATURE_{}'.format(template.name),
+                   constants=get_quadrature_cl_code(_get_quadrature_name(template), nodes, weights))
+
+    def _get_quadrature_cache_info(self, template):
+        """Get the cache fields and the CL code computing the quadrature nodes and weights of the given template."""
+        order = template.quadrature['order']
+        lower, width = template.quadrature['domain']
+
+        if template.quadrature.get('rule', 'legendre') == 'legendre':
+            offset_code = '''
+                double quadrature_lower = {lower};
+                double quadrature_upper = {upper};
+                double quadrature_offset = (quadrature_upper + quadrature_lower) / 2;
+                double quadrature_width = (quadrature_upper - quadrature_lower) / 2;
+            '''.format(lower=lower, upper=width)
+        else:
+            offset_code = '''
+                double quadrature_offset = {lower};
+                double quadrature_width = {scale};
+            '''.format(lower=lower, scale=width)
+
+        fields = [('double', 'quadrature_nodes', order),
+                  ('double', 'quadrature_weights', order),
+                  'double quadrature_weight_sum']
+
+        cl_code = '''
+            {offset_code}
+            double {variable};
+            *cache->quadrature_weight_sum = 0;
+            for(uint quadrature_ind = 0; quadrature_ind < {name}_order; quadrature_ind++){{
+                {variable} = quadrature_offset + quadrature_width * {name}_nodes[quadrature_ind];
+                cache->quadrature_nodes[quadrature_ind] = {variable};
+                cache->quadrature_weights[quadrature_ind] = {name}_weights[quadrature_ind] * ({distribution});
+                *cache->quadrature_weight_sum += cache->quadrature_weights[quadrature_ind];
+            }}
+        '''.format(offset_code=offset_code, variable=template.quadrature['variable'],
+                   name=_get_quadrature_name(template), distribution=template.quadrature['distribution'])
+        return fields, cl_code
+
     def _get_cache_info(self, template):
-        if template.cache_info is None:
+        if template.cache_info is None and template.quadrature is None:
             return None
 
+        cache_fields = []
+        cache_cl_code = ''
+        if template.cache_info is not None:
+            cache_fields.extend(template.cache_info['fields'])
+            cache_cl_code += template.cache_info['cl_code']
+        if template.quadrature is not None:
+            quadrature_fields, quadrature_cl_code = self._get_quadrature_cache_info(template)
+            cache_fields.extend(quadrature_fields)
+            cache_cl_code += quadrature_cl_code
+
         fields = []
-        for field in template.cache_info['fields']:
+        for field in cache_fields:
             if isinstance(field, str):
                 param = SimpleCLFunctionParameter(field)
 
@@ -155,15 +254,15 @@ class CompartmentBuilder(ComponentBuilder):
 
             fields.append((ctype, name, nmr_elements))
 
-        if template.cache_info.get('use_local_reduction', True):
+        if (template.cache_info or {}).get('use_local_reduction', True):
             cl_code = '''
                 if(get_local_id(0) == 0){{
                     {}
                 }}
                 barrier(CLK_LOCAL_MEM_FENCE);
-            '''.format(template.cache_info['cl_code'])
+            '''.format(cache_cl_code)
         else:
-            cl_code = template.cache_info['cl_code']
+            cl_code = cache_cl_code
 
         return CacheInfo(fields, cl_code)
 
@@ -296,6 +395,51 @@ class CompartmentTemplate(ComponentTemplate):
             to a variable using the cache. An optional element in the cache info is "use_local_reduction"
             which specifies that for this compartment we use all workitems in the workgroup. If not set, or if False,
             we will execute the cache CL code only for the first work item. The default is True.
+
+        quadrature (dict): if set, the compartment signal is the average of an integrand over a distribution of one of
+            its tissue properties, for example the radii of the cylinders, evaluated using Gaussian quadrature (see
+            :mod:`mdt.lib.quadrature`). The quadrature nodes and the distribution weights only depend on the free
+            parameters and are computed in the data cache, the ``@cache`` parameter is added automatically.
+            The ``cl_code``, if given, is evaluated once per observation before the integration and can define
+            variables used in the integrand. The elements of the dictionary are:
+
+            * ``variable``: the name of the integration variable in the CL code
+            * ``integrand``: a CL expression of the signal for the current value of the variable
+            * ``distribution``: a CL expression of the (unnormalized) density of the variable, this may only depend
+              on the variable and the free parameters
+            * ``domain``: a tuple with two CL expressions in terms of the free parameters. For the ``legendre`` rule
+              these are the lower and upper bound, for the ``laguerre`` rule the lower bound and a scale, such that
+              the nodes are placed at ``lower + scale * x`` for the Gauss-Laguerre nodes ``x``.
+            * ``order``: the number of quadrature nodes
+            * ``rule``: either ``legendre`` (the default) for a finite domain or ``laguerre`` for a half-infinite
+              domain
+
+            Example, integrating cylinders over a Gamma distribution of the radii:
+
+            .. code-block:: python
+
+                cl_code = 'double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);'
+                quadrature = {'variable': 'radius',
+                              'integrand': '''exp(-b * d * direction_2 + (1 - direction_2)
+                                                  * VanGelderenCylinder(G, Delta, delta, d, radius))''',
+                              'distribution': 'gamma_pdf(radius, shape, scale)',
+                              'domain': ('gamma_ppf(0.01, shape, scale)', 'gamma_ppf(0.99, shape, scale)'),
+                              'order': 10}
+
+        protocol_precompute (dict): quantities which only depend on the protocol and which can therefore be computed
+            once, instead of in every voxel at every model evaluation. Per name this holds a Python function with as
+            arguments the names of the protocol parameters it depends on, or a tuple with such a function and the power
+            of the gradient amplitude in the computed quantity (required for use with gradient deviations, see
+            :class:`~mdt.model_building.parameters.PrecomputedProtocolParameter`). The computed values are available
+            in the CL code by adding the name to the list of parameters. Since these are loaded as protocol
+            parameters, the names should be unique among all compartments, unless they represent the same quantity.
+
+            Example:
+
+            .. code-block:: python
+
+                parameters = ('g', 'b', 'diffusion_time')
+                protocol_precompute = {'diffusion_time': lambda Delta, delta: Delta - delta / 3.0}
     """
     _component_type = 'compartment_models'
     _builder = CompartmentBuilder()
@@ -313,6 +457,8 @@ class CompartmentTemplate(ComponentTemplate):
     extra_sampling_maps = []
     spherical_parameters = ('theta', 'phi')
     cache_info = None
+    quadrature = None
+    protocol_precompute = {}
 
 
 class WeightCompartmentTemplate(ComponentTemplate):
@@ -333,6 +479,11 @@ class WeightCompartmentTemplate(ComponentTemplate):
     return_type = 'double'
 
 
+def _get_quadrature_name(template):
+    """Get the name prefix of the CL constants with the quadrature nodes and weights of the given template."""
+    return '{}_quadrature'.format(template.name)
+
+
 def _resolve_dependencies(dependencies):
     """Resolve the dependency list such that the result contains all functions.
 
@@ -383,13 +534,16 @@ def _resolve_prior(prior, compartment_name, compartment_parameters):
     return [SimpleCLFunction('mot_float_type', 'prior_' + compartment_name, parameters, prior)]
 
 
-def _resolve_parameters(parameter_list, compartment_name):
+def _resolve_parameters(parameter_list, compartment_name, protocol_precompute=None):
     """Convert all the parameters in the given parameter list to actual parameter objects.
 
     Args:
         parameter_list (list): a list containing a mix of either parameter objects, strings or tuples. If it is a
             parameter we add a copy of it to the return list. If it is a string we will autoload it. It is possible to
             specify a nickname for that parameter in this compartment using the syntax: ``<param>(<nickname>)``.
+        compartment_name (str): the name of the compartment
+        protocol_precompute (dict): the precomputed protocol parameters of this compartment, strings matching
+            these names are resolved to a :class:`~mdt.model_building.parameters.PrecomputedProtocolParameter`.
 
     Returns:
         list: the list of actual parameter objects
@@ -406,6 +560,12 @@ def _resolve_parameters(parameter_list, compartment_name):
                 parameters.append(DataCacheParameter(compartment_name, 'cache'))
             elif item == '@noise_std':
                 parameters.append(NoiseStdInputParameter(name='noise_std'))
+            elif protocol_precompute and item in protocol_precompute:
+                function, gradient_scaling = protocol_precompute[item], None
+                if isinstance(function, (tuple, list)):
+                    function, gradient_scaling = function
+                parameters.append(PrecomputedProtocolParameter('mot_float_type ' + item, function,
+                                                               gradient_scaling=gradient_scaling))
             else:
                 if '(' in item:
                     param_name = item[:item.index('(')].strip()
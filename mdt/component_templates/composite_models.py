@@ -4,6 +4,7 @@ import numpy as np
 import tatsu
 
 from mdt.component_templates.base import ComponentBuilder, ComponentTemplate
+from mdt.configuration import config_context, SetModelLookupTables
 from mdt.lib.components import get_component
 from mdt.models.composite import DMRICompositeModel
 from mot.lib.cl_function import CLFunction, SimpleCLFunction
@@ -39,9 +40,12 @@ class DMRICompositeModelBuilder(ComponentBuilder):
         class AutoCreatedDMRICompositeModel(DMRICompositeModel):
 
             def __init__(self, volume_selection=True):
+                with config_context(SetModelLookupTables([template.name])):
+                    model_tree = CompartmentModelTree(parse_composite_model_expression(template.model_expression))
+
                 super().__init__(
                     deepcopy(template.name),
-                    CompartmentModelTree(parse_composite_model_expression(template.model_expression)),
+                    model_tree,
                     deepcopy(_resolve_likelihood_function(template.likelihood_function)),
                     signal_noise_model=_resolve_signal_noise_model(template.signal_noise_model),
                     enforce_weights_sum_to_one=template.enforce_weights_sum_to_one,
@@ -66,9 +70,11 @@ class DMRICompositeModelBuilder(ComponentBuilder):
                     self._model_functions_info.get_compartment_models()))
                 self._post_optimization_modifiers.extend(deepcopy(template.post_optimization_modifiers))
 
+                include_derived_maps = self._post_processing['optimization']['derived_maps']
                 self._extra_optimization_maps_funcs.extend(_get_model_extra_optimization_maps_funcs(
-                    self._model_functions_info.get_compartment_models()))
-                self._extra_optimization_maps_funcs.extend(deepcopy(template.extra_optimization_maps))
+                    self._model_functions_info.get_compartment_models(), include_derived_maps=include_derived_maps))
+                self._extra_optimization_maps_funcs.extend(_filter_derived_maps_funcs(
+                    deepcopy(template.extra_optimization_maps), include_derived_maps))
 
                 self._extra_sampling_maps_funcs.extend(_get_model_extra_sampling_maps_funcs(
                     self._model_functions_info.get_compartment_models()))
@@ -335,7 +341,7 @@ def _get_model_post_optimization_modifiers(compartments):
     return modifiers
 
 
-def _get_model_extra_optimization_maps_funcs(compartments):
+def _get_model_extra_optimization_maps_funcs(compartments, include_derived_maps=True):
     """Get a list of all the additional result functions defined in the compartments.
 
     This function will add a wrapper around the modification routines to make the input and output maps relative to the
@@ -345,6 +351,8 @@ def _get_model_extra_optimization_maps_funcs(compartments):
 
     Args:
         compartments (list): the list of compartment models from which to get the modifiers
+        include_derived_maps (boolean): if False, we skip the functions whose maps can be derived from the stored
+            maps afterwards, see :mod:`mdt.lib.derived_maps`
 
     Returns:
         list: the list of modification routines taken from the compartment models.
@@ -371,12 +379,30 @@ def _get_model_extra_optimization_maps_funcs(compartments):
         return wrapped_modifier
 
     for compartment in compartments:
-        for func in compartment.get_extra_optimization_maps_funcs():
+        for func in _filter_derived_maps_funcs(compartment.get_extra_optimization_maps_funcs(), include_derived_maps):
             funcs.append(get_wrapped_func(compartment.name, func))
 
     return funcs
 
 
+def _filter_derived_maps_funcs(extra_optimization_maps_funcs, include_derived_maps):
+    """Remove the extra optimization maps functions which are replaced by derived maps, if requested.
+
+    Args:
+        extra_optimization_maps_funcs (list): the extra optimization maps functions
+        include_derived_maps (boolean): if True we return all the functions, if False we remove the functions
+            whose maps can be derived from the stored maps afterwards, see :mod:`mdt.lib.derived_maps`
+
+    Returns:
+        list: the functions to run after optimization
+    """
+    if include_derived_maps:
+        return list(extra_optimization_maps_funcs)
+
+    from mdt.lib.derived_maps import is_replaced_by_derived_maps
+    return [func for func in extra_optimization_maps_funcs if not is_replaced_by_derived_maps(func)]
+
+
 def _get_model_extra_sampling_maps_funcs(compartments):
     """Get a list of all the additional post-sample functions defined in the compartments.
 
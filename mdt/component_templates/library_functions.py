@@ -44,7 +44,9 @@ class LibraryFunctionsBuilder(ComponentBuilder):
                     str = ''
                     if template.cl_extra is not None:
                         str += template.cl_extra
-                    if template.cl_code is not None:
+                    if callable(template.cl_code):
+                        str += template.cl_code()
+                    elif template.cl_code is not None:
                         str += template.cl_code
 
                     cl_code = '''
@@ -75,7 +77,9 @@ class LibraryFunctionTemplate(ComponentTemplate):
         parameters (list): the list of parameters to use. If a parameter is a string we will
             use it automatically, if not it is supposed to be a LibraryParameter
             instance that we append directly.
-        cl_code (str): the CL code definition to use.
+        cl_code (str): the CL code definition to use. For libraries with ``is_function`` set to False this can also
+            be a callable returning the CL code, which is evaluated every time the library is constructed. Use this
+            for code that depends on the configuration.
         cl_extra (str): auxiliary functions for the library, prepended to the generated CL function.
         dependencies (list): the list of functions this function depends on, can contain string which will be
             resolved as library functions.
@@ -309,6 +309,8 @@ class ProcessingStrategySectionLoader(ConfigSectionLoader):
             _config_insert(['processing_strategies', 'optimization'], value['optimization'])
         if 'sampling' in value:
             _config_insert(['processing_strategies', 'sampling'], value['sampling'])
+        if 'bootstrap' in value:
+            _config_insert(['processing_strategies', 'bootstrap'], value['bootstrap'])
 
 
 class TmpResultsDirSectionLoader(ConfigSectionLoader):
@@ -334,6 +336,8 @@ class ActivePostProcessingLoader(ConfigSectionLoader):
         optimization = value.get('optimization', {})
         optimization['uncertainties'] = optimization.get('uncertainties', True)
         optimization['store_covariances'] = optimization.get('store_covariances', True)
+        optimization['packed_covariances'] = optimization.get('packed_covariances', False)
+        optimization['derived_maps'] = optimization.get('derived_maps', True)
 
         _config_insert(['active_post_processing', 'optimization'], optimization)
         _config_insert(['active_post_processing', 'sampling'], sampling)
@@ -347,6 +351,53 @@ class AutomaticCascadeModels(ConfigSectionLoader):
         _config_insert(['auto_generate_cascade_models', 'excluded'], value.get('excluded', []))
 
 
+class LookupTablesLoader(ConfigSectionLoader):
+    """Load the lookup table settings.
+
+    The general switches can also be given directly in the section, like ``lookup_tables: {noddi_watson: True}``,
+    which is the same as setting them under ``general``.
+    """
+
+    def load(self, value):
+        general = {key: enabled for key, enabled in value.items() if key not in ('general', 'model_specific')}
+        general.update(value.get('general') or {})
+
+        for table_name, enabled in general.items():
+            _config_insert(['lookup_tables', 'general', table_name], bool(enabled))
+
+        for key, tables in (value.get('model_specific') or {}).items():
+            _config_insert(['lookup_tables', 'model_specific', key], tables)
+
+
+class LikelihoodFunctionsLoader(ConfigSectionLoader):
+    """Load the likelihood function settings."""
+
+    def load(self, value):
+        rician = value.get('rician', {})
+        _config_insert(['likelihood_functions', 'rician', 'fast_log_bessel'], rician.get('fast_log_bessel', False))
+
+
+class GradientDeviationsLoader(ConfigSectionLoader):
+    """Load the gradient deviations settings."""
+
+    def load(self, value):
+        _config_insert(['gradient_deviations', 'half_precision'], value.get('half_precision', False))
+
+
+class ObservationsLoader(ConfigSectionLoader):
+    """Load the observations storage settings."""
+
+    def load(self, value):
+        _config_insert(['observations', 'storage_type'], value.get('storage_type', 'native'))
+
+
+class NumPyEvaluationLoader(ConfigSectionLoader):
+    """Load the settings for the evaluation of the models in NumPy."""
+
+    def load(self, value):
+        _config_insert(['numpy_evaluation', 'max_nmr_problems'], int(value.get('max_nmr_problems', 0)))
+
+
 class RuntimeSettingsLoader(ConfigSectionLoader):
 
     def load(self, value):
@@ -400,6 +451,21 @@ def get_section_loader(section):
     if section == 'active_post_processing':
         return ActivePostProcessingLoader()
 
+    if section == 'lookup_tables':
+        return LookupTablesLoader()
+
+    if section == 'likelihood_functions':
+        return LikelihoodFunctionsLoader()
+
+    if section == 'gradient_deviations':
+        return GradientDeviationsLoader()
+
+    if section == 'observations':
+        return ObservationsLoader()
+
+    if section == 'numpy_evaluation':
+        return NumPyEvaluationLoader()
+
     raise ValueError('Could not find a suitable configuration loader for the section {}.'.format(section))
 
 
@@ -447,7 +513,7 @@ def get_processing_strategy(processing_type, *args, **kwargs):
     """Get the correct processing strategy for the given model.
 
     Args:
-        processing_type (str): 'optimization', 'sampling' or any other of the
+        processing_type (str): 'optimization', 'sampling', 'bootstrap' or any other of the
             processing_strategies defined in the config
         model_names (list of str): the list of model names (the full recursive cascade of model names)
         **kwargs: passed to the constructor of the loaded processing strategy.
@@ -548,6 +614,68 @@ def get_automatic_generated_cascades_excluded():
     return _config['auto_generate_cascade_models']['excluded']
 
 
+def use_lookup_table(table_name):
+    """Check if we want to use the interpolated lookup table with the given name.
+
+    Args:
+        table_name (str): the name of the lookup table, as listed in the ``lookup_tables`` section of the configuration
+
+    Returns:
+        boolean: True if the lookup table should be used, False otherwise
+    """
+    return _config.get('lookup_tables', {}).get('general', {}).get(table_name, False)
+
+
+def get_lookup_tables_for_model(model_names):
+    """Get the model specific lookup table settings for the given model.
+
+    Args:
+        model_names (list of str): the list of model names (typically a cascade of models) for which we
+            want to get the lookup table settings.
+
+    Returns:
+        dict: mapping table names to booleans, only holds the tables with a model specific setting
+    """
+    return get_model_config(model_names, _config.get('lookup_tables', {}).get('model_specific', {})) or {}
+
+
+def use_fast_rician_log_bessel():
+    """Check if we want to use the fast approximation of the log of the Bessel function in the Rician likelihood.
+
+    Returns:
+        boolean: True if the Rician likelihood should use the fast approximation, False otherwise
+    """
+    return _config.get('likelihood_functions', {}).get('rician', {}).get('fast_log_bessel', False)
+
+
+def use_half_precision_gradient_deviations():
+    """Check if we want to store the gradient deviations in half precision in the kernel data.
+
+    Returns:
+        boolean: True if the deviations from the identity matrix should be stored as float16, False for storing the
+            full matrices as float32
+    """
+    return _config.get('gradient_deviations', {}).get('half_precision', False)
+
+
+def get_observations_storage_type():
+    """Get the data type in which the input data objects store the observations.
+
+    Returns:
+        str: one of 'native' (the data type of the DWI volume), 'float16' or 'int16' (with a scale factor per volume)
+    """
+    return _config.get('observations', {}).get('storage_type', 'native')
+
+
+def get_numpy_evaluation_max_nmr_problems():
+    """Get the maximum number of problems for which we evaluate the models in NumPy instead of OpenCL.
+
+    Returns:
+        int: the maximum number of problems, if 0 we always use OpenCL
+    """
+    return _config.get('numpy_evaluation', {}).get('max_nmr_problems', 0)
+
+
 def get_model_config(model_names, config):
     """Get from the given dictionary the config for the given model.
 
@@ -730,6 +858,21 @@ class YamlStringAction(SimpleConfigAction):
         load_from_yaml(self._yaml_str)
 
 
+class SetModelLookupTables(SimpleConfigAction):
+
+    def __init__(self, model_names):
+        """Apply the model specific lookup table settings of the given model to the general settings.
+
+        Args:
+            model_names (list of str): the list of model names for which to apply the model specific settings
+        """
+        super().__init__()
+        self._model_names = model_names
+
+    def _apply(self):
+        LookupTablesLoader().load({'general': get_lookup_tables_for_model(self._model_names)})
+
+
 class SetGeneralSampler(SimpleConfigAction):
 
     def __init__(self, sampler_name, settings=None):
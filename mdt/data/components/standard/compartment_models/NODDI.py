@@ -40,9 +40,13 @@ class NODDI_IC(CompartmentTemplate):
 
 
 class BinghamNODDI_EN(CompartmentTemplate):
-    """The Extra-Neurite tissue model of Bingham NODDI."""
+    """The Extra-Neurite tissue model of Bingham NODDI.
+
+    The dispersed diffusivities depend on the derivatives of the log of the Bingham normalization constant with
+    respect to kappa and beta, see ``ConfluentHyperGeometricFirstKindLogGradient``.
+    """
     parameters = ('g', 'b', 'd', 'dperp0', 'theta', 'phi', 'psi', 'k1', 'kw', '@cache')
-    dependencies = ['ConfluentHyperGeometricFirstKind', 'SphericalToCartesian', 'Tensor']
+    dependencies = ['ConfluentHyperGeometricFirstKindLogGradient', 'SphericalToCartesian', 'Tensor']
     cl_code = '''
         double d_mu_1 = dperp0 + (d - dperp0) * *cache->diff_kappa;
         double d_mu_2 = dperp0 + (d - dperp0) * *cache->diff_beta;
@@ -57,16 +61,11 @@ class BinghamNODDI_EN(CompartmentTemplate):
             double kappa = k1;
             double beta = k1 / kw;
 
-            double DELTA = 1e-4;
-            double normalization_constant = ConfluentHyperGeometricFirstKind(-kappa, -beta, 0);
-
-            *cache->diff_kappa = (ConfluentHyperGeometricFirstKind(-(kappa+DELTA), -beta, 0) -
-                                  ConfluentHyperGeometricFirstKind(-(kappa-DELTA), -beta, 0))
-                                  / (2*DELTA) / normalization_constant;
+            double gradient[3];
+            ConfluentHyperGeometricFirstKindLogGradient(-kappa, -beta, 0, gradient);
 
-            *cache->diff_beta = (ConfluentHyperGeometricFirstKind(-kappa, -(beta+DELTA), 0) -
-                                 ConfluentHyperGeometricFirstKind(-kappa, -(beta-DELTA), 0))
-                                 / (2*DELTA) / normalization_constant;
+            *cache->diff_kappa = -gradient[0];
+            *cache->diff_beta = -gradient[1];
         '''
     }
 
@@ -1,3 +1,4 @@
+import numpy as np
 from mdt import CompartmentTemplate, FreeParameterTemplate
 from mdt.model_building.parameter_functions.transformations import ScaleTransform
 
@@ -23,12 +24,15 @@ class TimeDependentZeppelin(CompartmentTemplate):
             improves in vivo estimates of axonal diameter and density in human white matter, NeuroImage 2016.
     """
     parameters = ('g', 'b', 'd', 'd_bulk', 'theta', 'phi', 'time_dependent_characteristic_coefficient(A)',
-                  'Delta', 'delta')
+                  'time_dependence')
     dependencies = ('Zeppelin',)
     cl_code = '''
-        double dperp0 = d_bulk + A * (log(Delta/delta) + 3/2.0)/(Delta - delta/3.0);
+        double dperp0 = d_bulk + A * time_dependence;
         return Zeppelin(g, b, d, dperp0, theta, phi);
     '''
+    protocol_precompute = {
+        'time_dependence': lambda Delta, delta: (np.log(Delta / delta) + 3 / 2.0) / (Delta - delta / 3.0)
+    }
 
     class time_dependent_characteristic_coefficient(FreeParameterTemplate):
         """The time dependent characteristic as used in the TimeDependentZeppelin model. Values are in m^2."""
@@ -2,7 +2,7 @@ import numpy as np
 from mdt import CompartmentTemplate, CompositeModelTemplate, FreeParameterTemplate, ProtocolParameterTemplate, \
     LibraryFunctionTemplate
 from mdt.model_building.parameter_functions.transformations import ScaleTransform
-from mdt.utils import voxelwise_vector_matrix_vector_product, create_covariance_matrix
+from mdt.lib.error_propagation import propagate_map_uncertainty
 from mot.library_functions import simpsons_rule
 
 
@@ -148,17 +148,16 @@ def produce_reduced_ramani_model(lineshape_method_name):
         if len(R_obs.shape) > 1:
             R_obs = R_obs[:, 0]
 
-        Ra = R_obs / (1.0 + ((RM0a * fterm * (Rb - R_obs)) / (Rb - R_obs + RM0a)))
-        f = fterm * Ra / (1.0 + fterm * Ra)
+        Ra = get_ra(RM0a, fterm, Rb, R_obs)
+        f = get_f(RM0a, fterm, Rb, R_obs)
 
-        covars = create_covariance_matrix(
-            results, ['QMT.RM0a', 'QMT.fterm', 'QMT.Rb'], results.get('covariances', None))
-
-        Ra_gradient = get_ra_gradient(R_obs, RM0a, fterm, Rb)
-        Ra_std = np.nan_to_num(np.sqrt(voxelwise_vector_matrix_vector_product(Ra_gradient, covars, Ra_gradient)))
-
-        f_gradient = get_f_gradient(R_obs, RM0a, fterm, Rb)
-        f_std = np.nan_to_num(np.sqrt(voxelwise_vector_matrix_vector_product(f_gradient, covars, f_gradient)))
+        propagated_names = ['QMT.RM0a', 'QMT.fterm', 'QMT.Rb']
+        Ra_std = np.nan_to_num(propagate_map_uncertainty(
+            get_ra, results, propagated_names, constants=[R_obs],
+            jacobian=lambda RM0a, fterm, Rb, R_obs: get_ra_gradient(R_obs, RM0a, fterm, Rb)))
+        f_std = np.nan_to_num(propagate_map_uncertainty(
+            get_f, results, propagated_names, constants=[R_obs],
+            jacobian=lambda RM0a, fterm, Rb, R_obs: get_f_gradient(R_obs, RM0a, fterm, Rb)))
 
         values = {
             'QMT.PD': gM0a * s0,
@@ -179,6 +178,13 @@ def produce_reduced_ramani_model(lineshape_method_name):
         })
         return values
 
+    def get_ra(RM0a, fterm, Rb, R_obs):
+        return R_obs / (1.0 + ((RM0a * fterm * (Rb - R_obs)) / (Rb - R_obs + RM0a)))
+
+    def get_f(RM0a, fterm, Rb, R_obs):
+        Ra = get_ra(RM0a, fterm, Rb, R_obs)
+        return fterm * Ra / (1.0 + fterm * Ra)
+
     def get_ra_gradient(R_obs, RM0a, fterm, Rb):
         """Compute the standard deviation of Ra with respect to RM0a, fterm, Rb"""
         return np.column_stack([
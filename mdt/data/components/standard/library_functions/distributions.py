@@ -1,4 +1,6 @@
 from mdt import LibraryFunctionTemplate
+from mdt.configuration import use_lookup_table
+from mdt.lib.lookup_tables import get_bingham_tables
 
 __author__ = 'Robbert Harms'
 __date__ = '2018-08-27'
@@ -7,13 +9,37 @@ __email__ = 'robbert.harms@maastrichtuniversity.nl'
 __licence__ = 'LGPL v3'
 
 
+class BinghamLookupTables(LibraryFunctionTemplate):
+    """Interpolated lookup table for the Bingham normalization constant, see :mod:`mdt.lib.lookup_tables`.
+
+    If enabled in the configuration (``lookup_tables.general.bingham``), this defines ``BINGHAM_LOOKUP_TABLES``, the
+    domain ``BINGHAM_LOOKUP_TABLES_UPPER_BOUND`` and the table function ``BinghamLogNormalizationTable``. The
+    configuration is read when the library is constructed, that is, when the model is constructed.
+    """
+    is_function = False
+
+    @staticmethod
+    def cl_code():
+        if not use_lookup_table('bingham'):
+            return ''
+        table = get_bingham_tables()[0]
+        return '#define BINGHAM_LOOKUP_TABLES\n#define BINGHAM_LOOKUP_TABLES_UPPER_BOUND {!r}\n{}'.format(
+            float(table.upper_bound), table.get_cl_code())
+
+
 class ConfluentHyperGeometricFirstKind(LibraryFunctionTemplate):
     """Computes 1F1(1/2; 3/2; e), the confluent hypergeometric function of the first kind for a 3x3 matrix [1].
 
     This can be used to compute the normalization factor of the Bingham distribution for a 3x3 matrix.
-    This implementation uses a saddlepoint approximation [2].
+    By default this uses the saddlepoint approximation of ``ConfluentHyperGeometricFirstKindSaddlepoint``.
 
-    This approximation is only valid if all eigenvalues are non-zero.
+    If the lookup tables are enabled, this instead interpolates the exact value from a table, see
+    ``BinghamLookupTables``. Since points on the sphere have unit length, shifting all eigenvalues by the same value
+    only scales the result, such that the table only needs to cover the differences with the smallest eigenvalue.
+    For differences outside of the table we use the saddlepoint approximation, corrected by its error on the border of
+    the table, at the largest difference set to the upper bound of the table. This makes the result continuous at the
+    border. Since the error of the saddlepoint approximation hardly changes with the largest difference beyond the
+    table, this also reduces the error from about 1e-2 to about 1e-4 in the log.
 
     Args:
         e0, e1, e2: the eigenvalues of the 3x3 matrix for which you want to compute the Bingham
@@ -22,7 +48,87 @@ class ConfluentHyperGeometricFirstKind(LibraryFunctionTemplate):
     References:
     [1] Mardia, K.V., Jupp, P.E., 2000. Distributions on spheres. Directional Statistics.
         John Wiley & Sons, pp. 159–192
-    [2] Kume A, Wood ATA. Saddlepoint approximations for the Bingham and Fisher-Bingham normalising constants.
+    """
+    dependencies = ['ConfluentHyperGeometricFirstKindSaddlepoint', 'BinghamLookupTables']
+    return_type = 'double'
+    parameters = ['double e0', 'double e1', 'double e2']
+    cl_code = '''
+        #ifdef BINGHAM_LOOKUP_TABLES
+            double e_min = min(e0, min(e1, e2));
+            double e_max = max(e0, max(e1, e2));
+            double e_mid = e0 + e1 + e2 - e_min - e_max;
+
+            if(e_max - e_min <= BINGHAM_LOOKUP_TABLES_UPPER_BOUND){
+                return exp(BinghamLogNormalizationTable(e_mid - e_min, e_max - e_min) - e_min);
+            }
+
+            double border_mid = min(e_mid - e_min, (double)BINGHAM_LOOKUP_TABLES_UPPER_BOUND);
+            double correction = BinghamLogNormalizationTable(border_mid, BINGHAM_LOOKUP_TABLES_UPPER_BOUND)
+                - log(ConfluentHyperGeometricFirstKindSaddlepoint(0, border_mid, BINGHAM_LOOKUP_TABLES_UPPER_BOUND));
+            return ConfluentHyperGeometricFirstKindSaddlepoint(e0, e1, e2) * exp(correction);
+        #else
+            return ConfluentHyperGeometricFirstKindSaddlepoint(e0, e1, e2);
+        #endif
+    '''
+
+
+class ConfluentHyperGeometricFirstKindLogGradient(LibraryFunctionTemplate):
+    """Computes the gradient of the log of ``ConfluentHyperGeometricFirstKind`` with respect to the eigenvalues.
+
+    If the lookup tables are enabled and the differences of the eigenvalues are within the table, this uses the
+    exact derivatives of the interpolated table. Else, this uses central differences with a step of 1e-4.
+
+    Args:
+        e0, e1, e2: the eigenvalues of the 3x3 matrix
+        gradient: the output array for the three derivatives
+    """
+    dependencies = ['ConfluentHyperGeometricFirstKind', 'BinghamLookupTables']
+    return_type = 'void'
+    parameters = ['double e0', 'double e1', 'double e2', 'double* gradient']
+    cl_code = '''
+        #ifdef BINGHAM_LOOKUP_TABLES
+            double e_min = min(e0, min(e1, e2));
+            double e_max = max(e0, max(e1, e2));
+
+            if(e_max - e_min <= BINGHAM_LOOKUP_TABLES_UPPER_BOUND){
+                int min_ind = (e0 == e_min) ? 0 : ((e1 == e_min) ? 1 : 2);
+                int max_ind = (e2 == e_max && min_ind != 2) ? 2 : ((e1 == e_max && min_ind != 1) ? 1 : 0);
+                int mid_ind = 3 - min_ind - max_ind;
+
+                double e[3] = {e0, e1, e2};
+                double table_gradient[2];
+                BinghamLogNormalizationTable_gradient(e[mid_ind] - e_min, e_max - e_min, table_gradient);
+
+                gradient[mid_ind] = table_gradient[0];
+                gradient[max_ind] = table_gradient[1];
+                gradient[min_ind] = -table_gradient[0] - table_gradient[1] - 1;
+                return;
+            }
+        #endif
+
+        double delta = 1e-4;
+        for(int i = 0; i < 3; i++){
+            double e_upper[3] = {e0, e1, e2};
+            double e_lower[3] = {e0, e1, e2};
+            e_upper[i] += delta;
+            e_lower[i] -= delta;
+            gradient[i] = (log(ConfluentHyperGeometricFirstKind(e_upper[0], e_upper[1], e_upper[2]))
+                           - log(ConfluentHyperGeometricFirstKind(e_lower[0], e_lower[1], e_lower[2]))) / (2 * delta);
+        }
+    '''
+
+
+class ConfluentHyperGeometricFirstKindSaddlepoint(LibraryFunctionTemplate):
+    """Computes 1F1(1/2; 3/2; e) for a 3x3 matrix using a saddlepoint approximation [1].
+
+    This approximation is only valid if all eigenvalues are non-zero.
+
+    Args:
+        e0, e1, e2: the eigenvalues of the 3x3 matrix for which you want to compute the Bingham
+            normalization factor.
+
+    References:
+    [1] Kume A, Wood ATA. Saddlepoint approximations for the Bingham and Fisher-Bingham normalising constants.
         Biometrika. 2005;92(2):465-476. doi:10.1093/biomet/92.2.465.
     """
     dependencies = ['real_zeros_cubic_pol']
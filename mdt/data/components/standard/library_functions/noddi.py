@@ -1,4 +1,6 @@
 from mdt import LibraryFunctionTemplate
+from mdt.configuration import use_lookup_table
+from mdt.lib.lookup_tables import get_noddi_watson_tables
 
 __author__ = 'Robbert Harms'
 __date__ = '2018-10-10'
@@ -116,6 +118,24 @@ class NODDI_LegendreGaussianIntegral(LibraryFunctionTemplate):
     '''
 
 
+class NODDI_WatsonLookupTables(LibraryFunctionTemplate):
+    """Interpolated lookup tables for the Watson distribution functions, see :mod:`mdt.lib.lookup_tables`.
+
+    If enabled in the configuration (``lookup_tables.general.noddi_watson``), this defines
+    ``NODDI_WATSON_LOOKUP_TABLES`` and the table functions ``NODDI_WatsonSHCoeffTable`` and
+    ``NODDI_WatsonHinderedDiffusionTable``. The configuration is read when the library is constructed, that is, when
+    the model is constructed.
+    """
+    is_function = False
+
+    @staticmethod
+    def cl_code():
+        if not use_lookup_table('noddi_watson'):
+            return ''
+        return '#define NODDI_WATSON_LOOKUP_TABLES\n' + '\n'.join(
+            table.get_cl_code() for table in get_noddi_watson_tables())
+
+
 class NODDI_WatsonSHCoeff(LibraryFunctionTemplate):
     """Computes the spherical harmonic (SH) coefficients of the Watson's distribution up to the 12th order.
 
@@ -124,6 +144,9 @@ class NODDI_WatsonSHCoeff(LibraryFunctionTemplate):
 
     Truncating at the 12th order gives good approximation for kappa up to 64.
 
+    If the lookup tables are enabled, the coefficients are interpolated from a table instead,
+    see ``NODDI_WatsonLookupTables``.
+
     Note that the SH coefficients of the odd orders are always zero and are therefore not returned.
 
     Args:
@@ -138,13 +161,16 @@ class NODDI_WatsonSHCoeff(LibraryFunctionTemplate):
     """
     parameters = ['double kappa',
                   'double* result']
-    dependencies = ('erfi',)
+    dependencies = ('erfi', 'NODDI_WatsonLookupTables')
     cl_code = '''
         // do not change this value! It would require adding approximations
         #define NODDI_IC_MAX_POLYNOMIAL_ORDER 6
 
         result[0] = sqrt(M_PI) * 2;
 
+        #ifdef NODDI_WATSON_LOOKUP_TABLES
+            NODDI_WatsonSHCoeffTable(kappa, result + 1);
+        #else
         if(kappa <= 30){
             double ks[NODDI_IC_MAX_POLYNOMIAL_ORDER - 1];
             ks[0] = kappa * kappa;
@@ -230,6 +256,7 @@ class NODDI_WatsonSHCoeff(LibraryFunctionTemplate):
             result[5] = 6.30113 + 6.09914*lnkd[0] - 0.16088*lnkd[1] - 1.05578*lnkd[2] + 0.338069*lnkd[3] + 0.0937157*lnkd[4] - 0.106935*lnkd[5];
             result[6] = 4.65678 + 6.30069*lnkd[0] + 1.13754*lnkd[1] - 1.38393*lnkd[2] - 0.0134758*lnkd[3] + 0.331686*lnkd[4] - 0.105954*lnkd[5];
         }
+        #endif
     '''
 
 
@@ -248,15 +275,23 @@ class NODDI_WatsonHinderedDiffusionCoeff(LibraryFunctionTemplate):
          dperp0: INPUT: the hindered diffusivity outside the cylinders in perpendicular directions.
                  OUTPUT: the equivalent diffusivity after integration
          kappa: the concentration parameter of the Watson's distribution
+
+    If the lookup tables are enabled, the kappa dependent factor is interpolated from a table instead,
+    see ``NODDI_WatsonLookupTables``.
     """
     parameters = ['mot_float_type* d',
                   'mot_float_type* dperp0',
                   'mot_float_type kappa']
-    dependencies = ['dawson']
+    dependencies = ['dawson', 'NODDI_WatsonLookupTables']
     cl_code = '''
         double tmp;
         double dw_0, dw_1;
 
+        #ifdef NODDI_WATSON_LOOKUP_TABLES
+            NODDI_WatsonHinderedDiffusionTable(kappa, &tmp);
+            dw_0 = *dperp0 + (*d - *dperp0) * tmp;
+            dw_1 = (*d + *dperp0) / 2.0 - (*d - *dperp0) * tmp / 2.0;
+        #else
         if(kappa > 1e-5){
             tmp = sqrt(kappa)/dawson(sqrt(kappa));
             dw_0 = ( -(*d - *dperp0) + 2 * *dperp0 * kappa + (*d - *dperp0) * tmp) / (2.0 * kappa);
@@ -267,6 +302,7 @@ class NODDI_WatsonHinderedDiffusionCoeff(LibraryFunctionTemplate):
             dw_0 = ((2 * *dperp0 + *d) / 3.0) + (tmp/22.5) + ((tmp * kappa) / 236.0);
             dw_1 = ((2 * *dperp0 + *d) / 3.0) - (tmp/45.0) - ((tmp * kappa) / 472.0);
         }
+        #endif
         *d = dw_0;
         *dperp0 = dw_1;
     '''
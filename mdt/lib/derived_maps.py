@@ -0,0 +1,297 @@
+"""Registry of maps which can be derived from the stored output maps of a model.
+
+Many of the extra output maps of the models, like the DTI measures or the NODDI indices, are simple functions of the
+parameter maps. Instead of computing and storing these maps after every optimization, they can also be computed on
+request from the parameter maps in an output folder. This module holds the registry with, for each set of derived
+maps, the maps it depends on and the function computing them.
+
+The derived maps are used by :func:`mdt.lib.nifti.get_all_nifti_data` (and hence by :func:`mdt.load_volume_maps`)
+to add the missing derived maps to the loaded maps, computed on the moment they are first accessed. With the
+``derived_maps`` switch of the ``active_post_processing`` configuration set to False, the extra optimization maps
+functions replaced by these derived maps are not run after optimization.
+"""
+import os
+import re
+import numpy as np
+from mot.lib.utils import split_in_batches
+
+from mdt.lib.nifti import load_nifti, write_all_as_nifti, yield_nifti_info
+from mdt.lib.packed_covariances import load_covariance_maps
+from mdt.lib.post_processing import DTIMeasures, DKIMeasures, NODDIMeasures
+from mdt.utils import create_roi, load_brain_mask, restore_volumes
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-28'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class DerivedMaps:
+
+    def __init__(self, name, function, dependencies, outputs, compartment_maps=True, use_covariances=False,
+                 replaces=None):
+        """A set of maps which can be computed from other maps.
+
+        Args:
+            name (str): the name of this set of derived maps
+            function (Callable): the function computing the derived maps, called with a dictionary with the
+                dependencies as one dimensional arrays (one value per voxel) and returning a dictionary with (at least)
+                the outputs.
+            dependencies (list of str): the names of the maps needed for computing the derived maps
+            outputs (list of str): the names of the maps computed by the function
+            compartment_maps (boolean): if True, the dependencies and outputs are relative to a compartment. That is,
+                for every compartment ``<c>`` with all the maps ``<c>.<dependency>`` we can compute the maps
+                ``<c>.<output>``. If False, the names are the complete map names.
+            use_covariances (boolean): if True, we add the covariances between the dependencies, if available, as
+                the dictionary ``covariances`` to the input of the function.
+            replaces (Callable): the extra optimization maps function made redundant by these derived maps
+        """
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.outputs = list(outputs)
+        self.compartment_maps = compartment_maps
+        self.use_covariances = use_covariances
+        self.replaces = replaces
+
+    def get_prefixes(self, map_names):
+        """Get the prefixes for which we can compute these derived maps from the given maps.
+
+        Args:
+            map_names (collections.Iterable): the names of the available maps
+
+        Returns:
+            list: the prefixes for the dependency and output names, ``'<compartment>.'`` for compartment maps and an
+                empty string for the other maps.
+        """
+        map_names = set(map_names)
+        if not self.compartment_maps:
+            return [''] if all(name in map_names for name in self.dependencies) else []
+
+        suffix = '.' + self.dependencies[0]
+        prefixes = [name[:-len(self.dependencies[0])] for name in map_names if name.endswith(suffix)]
+        return sorted(prefix for prefix in prefixes
+                      if all(prefix + dependency in map_names for dependency in self.dependencies))
+
+
+_derived_maps = []
+
+
+def register_derived_maps(derived_maps):
+    """Add a set of derived maps to the registry.
+
+    Args:
+        derived_maps (DerivedMaps): the derived maps to add
+    """
+    _derived_maps.append(derived_maps)
+
+
+def get_registered_derived_maps():
+    """Get all the derived maps in the registry.
+
+    Returns:
+        list of DerivedMaps: the registered derived maps
+    """
+    return list(_derived_maps)
+
+
+def is_replaced_by_derived_maps(extra_optimization_maps_func):
+    """Check if the given extra optimization maps function is replaced by derived maps in the registry.
+
+    Args:
+        extra_optimization_maps_func (Callable): one of the extra optimization maps functions of a model
+
+    Returns:
+        boolean: if the maps of the given function can be computed from the stored maps instead
+    """
+    return any(derived_maps.replaces is extra_optimization_maps_func for derived_maps in _derived_maps)
+
+
+def get_derived_maps_proxies(directory, map_names=None, persist=False):
+    """Get proxies for the derived maps which can be computed from the maps in the given directory.
+
+    Only the derived maps not already present in the directory are returned. Each of the proxies computes its map
+    when its ``get_data()`` is called, for all the outputs of the corresponding set of derived maps at once.
+
+    Args:
+        directory (str): the directory with the output maps of a model
+        map_names (list of str): if given, only return proxies for these maps
+        persist (boolean): if we want to write the derived maps to the directory once computed
+
+    Returns:
+        dict: the proxies per derived map name, with a method ``get_data()`` to compute the map
+    """
+    available_maps = {map_name for _, map_name, _ in yield_nifti_info(directory)}
+
+    proxies = {}
+    for derived_maps in _derived_maps:
+        for prefix in derived_maps.get_prefixes(available_maps):
+            computer = _DerivedMapsComputer(derived_maps, prefix, directory, persist=persist)
+            for output in derived_maps.outputs:
+                map_name = prefix + output
+                if map_name not in available_maps and map_name not in proxies \
+                        and (not map_names or map_name in map_names):
+                    proxies[map_name] = _DerivedMapProxy(computer, map_name)
+    return proxies
+
+
+def compute_derived_maps(results_folder, map_names=None, output_folder=None, batch_size=10000):
+    """Compute the derived maps missing in the given results folder and write them to disk.
+
+    Args:
+        results_folder (str): the folder with the output maps of a model, for example ``<output>/Tensor``
+        map_names (list of str): if given, only compute these maps
+        output_folder (str): the folder to write the maps to, defaults to the results folder
+        batch_size (int): the number of voxels to process at once
+
+    Returns:
+        dict: the computed maps as volumes
+    """
+    proxies = get_derived_maps_proxies(results_folder, map_names=map_names)
+
+    volumes = {}
+    for map_name, proxy in proxies.items():
+        proxy.batch_size = batch_size
+        volumes[map_name] = proxy.get_data()
+
+    for map_name in volumes:
+        header = proxies[map_name].get_header()
+        write_all_as_nifti({map_name: volumes[map_name]}, output_folder or results_folder, nifti_header=header)
+    return volumes
+
+
+class _DerivedMapProxy:
+
+    def __init__(self, computer, map_name, batch_size=10000):
+        """Proxy for a single derived map, with the same ``get_data()`` method as the nibabel proxies.
+
+        Args:
+            computer (_DerivedMapsComputer): the computer of the set of derived maps this map belongs to
+            map_name (str): the name of this map
+            batch_size (int): the number of voxels to process at once
+        """
+        self._computer = computer
+        self._map_name = map_name
+        self.batch_size = batch_size
+
+    def get_data(self):
+        return self._computer.get_volumes(self.batch_size)[self._map_name]
+
+    def get_header(self):
+        return self._computer.get_header()
+
+
+class _DerivedMapsComputer:
+
+    def __init__(self, derived_maps, prefix, directory, persist=False):
+        """Computes and caches all the outputs of a set of derived maps for one prefix.
+
+        Args:
+            derived_maps (DerivedMaps): the derived maps to compute
+            prefix (str): the prefix of the dependency and output names
+            directory (str): the directory with the maps
+            persist (boolean): if we want to write the computed maps to the directory
+        """
+        self._derived_maps = derived_maps
+        self._prefix = prefix
+        self._directory = directory
+        self._persist = persist
+        self._volumes = None
+
+    def get_header(self):
+        return load_nifti(os.path.join(self._directory, self._prefix + self._derived_maps.dependencies[0])).header
+
+    def get_volumes(self, batch_size):
+        if self._volumes is None:
+            self._volumes = self._compute(batch_size)
+            if self._persist:
+                write_all_as_nifti(self._volumes, self._directory, nifti_header=self.get_header(),
+                                   overwrite_volumes=False)
+        return self._volumes
+
+    def _compute(self, batch_size):
+        dependencies = {name: load_nifti(os.path.join(self._directory, self._prefix + name)).get_data()
+                        for name in self._derived_maps.dependencies}
+
+        used_mask = [path for path, map_name, _ in yield_nifti_info(self._directory) if map_name == 'UsedMask']
+        if used_mask:
+            mask = load_brain_mask(used_mask[0])
+        else:
+            mask = np.ones(dependencies[self._derived_maps.dependencies[0]].shape[:3], dtype=np.bool)
+
+        inputs = {name: np.squeeze(create_roi(volume, mask), axis=1) if volume.ndim < 4 or volume.shape[3] == 1
+                  else create_roi(volume, mask) for name, volume in dependencies.items()}
+        covariances = self._load_covariances(mask) if self._derived_maps.use_covariances else {}
+
+        nmr_voxels = np.count_nonzero(mask)
+        output = {}
+        for batch_start, batch_end in split_in_batches(nmr_voxels, batch_size):
+            batch = {name: value[batch_start:batch_end] for name, value in inputs.items()}
+            if self._derived_maps.use_covariances:
+                batch['covariances'] = {name: value[batch_start:batch_end] for name, value in covariances.items()}
+
+            results = self._derived_maps.function(batch)
+            for name in self._derived_maps.outputs:
+                output.setdefault(self._prefix + name, []).append(
+                    np.reshape(results[name], (batch_end - batch_start, -1)))
+
+        output = {name: np.squeeze(np.concatenate(batches), axis=1) if batches[0].shape[1] == 1
+                  else np.concatenate(batches) for name, batches in output.items()}
+        return restore_volumes(output, mask, with_volume_dim=False)
+
+    def _load_covariances(self, mask):
+        """Load the covariances between the dependencies from the ``covariances`` subdirectory, if present."""
+        names = '|'.join(re.escape(self._prefix + name) for name in self._derived_maps.dependencies)
+        pattern = re.compile(r'^({0})_to_({0})$'.format(names))
+
+        covariances = {}
+        for map_name, volume in load_covariance_maps(self._directory).items():
+            if pattern.match(map_name):
+                name = map_name.replace(self._prefix, '') if self._prefix else map_name
+                covariances[name] = np.reshape(create_roi(volume, mask), (-1,))
+        return covariances
+
+
+def _select(function, outputs):
+    """Limit the output of the given function to the given outputs."""
+    def selection(results):
+        computed = function(results)
+        return {name: computed[name] for name in outputs}
+    return selection
+
+
+_kurtosis_elements = ['W_0000', 'W_1000', 'W_1100', 'W_1110', 'W_1111', 'W_2000', 'W_2100', 'W_2110', 'W_2111',
+                      'W_2200', 'W_2210', 'W_2211', 'W_2220', 'W_2221', 'W_2222']
+
+register_derived_maps(DerivedMaps(
+    'DTI', _select(DTIMeasures.extra_optimization_maps, ['FA', 'MD', 'AD', 'RD']),
+    ['d', 'dperp0', 'dperp1'], ['FA', 'MD', 'AD', 'RD'],
+    replaces=DTIMeasures.extra_optimization_maps))
+
+register_derived_maps(DerivedMaps(
+    'DTI uncertainties', _select(DTIMeasures.extra_optimization_maps, ['FA.std', 'MD.std', 'AD.std', 'RD.std']),
+    ['d', 'dperp0', 'dperp1', 'd.std', 'dperp0.std', 'dperp1.std'], ['FA.std', 'MD.std', 'AD.std', 'RD.std'],
+    use_covariances=True, replaces=DTIMeasures.extra_optimization_maps))
+
+register_derived_maps(DerivedMaps(
+    'DTI eigenvectors', _select(DTIMeasures.extra_optimization_maps, ['vec0', 'vec1', 'vec2']),
+    ['d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi'], ['vec0', 'vec1', 'vec2'],
+    replaces=DTIMeasures.extra_optimization_maps))
+
+register_derived_maps(DerivedMaps(
+    'DKI', DKIMeasures.extra_optimization_maps,
+    ['d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi'] + _kurtosis_elements, ['MK', 'AK', 'RK'],
+    replaces=DKIMeasures.extra_optimization_maps))
+
+register_derived_maps(DerivedMaps(
+    'NODDI Watson', NODDIMeasures.noddi_watson_extra_optimization_maps,
+    ['w_ic.w', 'w_ec.w', 'NODDI_IC.kappa'], ['NDI', 'ODI'], compartment_maps=False,
+    replaces=NODDIMeasures.noddi_watson_extra_optimization_maps))
+
+for _ind in range(2):
+    register_derived_maps(DerivedMaps(
+        'NODDI Bingham {}'.format(_ind), NODDIMeasures.noddi_bingham_extra_optimization_maps,
+        ['BinghamNODDI_IN{}.k1'.format(_ind), 'BinghamNODDI_IN{}.kw'.format(_ind)],
+        [name + str(_ind) for name in ['ODI_p', 'ODI_s', 'ODI', 'DAI']], compartment_maps=False,
+        replaces=NODDIMeasures.noddi_bingham_extra_optimization_maps))
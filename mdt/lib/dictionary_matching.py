@@ -0,0 +1,309 @@
+"""Dictionary matching for generating optimization starting points.
+
+Instead of running a cascade of intermediate model fits, this module simulates a dictionary of model signals over a
+grid of parameter values and matches every voxel to the most similar dictionary entry. The comparison is a normalized
+inner product, making the match independent of the signal scale, which is afterwards recovered as the ``S0.s0``
+estimate.
+
+Orientations are not part of the parameter grid. Instead, we estimate the principal diffusion direction per voxel using
+a quick linear tensor fit and simulate the dictionary for a fixed set of directions on the sphere. Each voxel is then
+only matched against the entries simulated with the direction closest to its tensor direction. For models with
+multiple orientations, like the multi-fibre models, the tensor direction is used for the first orientation. The other
+orientations are drawn independently and uniformly over the sphere for every dictionary entry and are initialized
+from the best matching entry.
+
+Since simulating the dictionary can take some time, the simulated dictionaries are cached on disk, keyed by a checksum
+of the model configuration, the protocol and the grid. Subjects scanned with the same acquisition will reuse the same
+dictionary, while a change of the model definition or of the protocol results in a new dictionary.
+"""
+import hashlib
+import itertools
+import logging
+import os
+import numpy as np
+
+from mdt.configuration import get_config_dir
+from mdt.lib.components import get_model
+from mdt.lib.fingerprints import get_protocol_checksum
+from mdt.simulations import simulate_signals
+from mdt.utils import MockMRIInputData, restore_volumes, is_scalar, cartesian_to_spherical, spherical_to_cartesian
+from mot.lib.utils import split_in_batches
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-09-12'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+_orientation_param_names = ('theta', 'phi', 'psi')
+
+
+def get_dictionary_matching_inits(model_name, input_data, grid=None, nmr_grid_steps=5, nmr_directions=64,
+                                  cache_dir=None, max_batch_size=5000):
+    """Get optimization starting points using dictionary matching.
+
+    This simulates a dictionary of signals for the model over a grid of parameter values and returns, per voxel,
+    the parameters of the best matching dictionary entry.
+
+    Args:
+        model_name (str): the name of the composite model for which we want to generate the starting points
+        input_data (mdt.utils.MRIInputData): the input data with the signals to match
+        grid (dict): mapping parameter names to a list of values to use in the dictionary. Free parameters not in
+            this dictionary are gridded using ``nmr_grid_steps`` points within their bounds.
+        nmr_grid_steps (int): the number of points per parameter for the parameters not specified in ``grid``.
+        nmr_directions (int): the number of orientations on the hemisphere for which we simulate the dictionary
+        cache_dir (str): the directory for caching the simulated dictionaries. If not set we use a sub directory of
+            the MDT configuration directory.
+        max_batch_size (int): the maximum number of voxels we match at once
+
+    Returns:
+        dict: per free parameter a volume with the initialization values.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Generating initialization point using dictionary matching.')
+
+    model = get_model(model_name)()
+    model.set_input_data(MockMRIInputData(protocol=input_data.protocol))
+    free_param_names = model.get_free_param_names()
+
+    dictionary_grid = _get_parameter_grid(model, grid or {}, nmr_grid_steps)
+    directions = _get_hemisphere_directions(nmr_directions)
+
+    signals, grid_parameters = _load_dictionary(model, input_data.protocol, dictionary_grid, directions,
+                                                cache_dir or os.path.join(get_config_dir(), 'dictionary_cache'))
+    nmr_grid_points = grid_parameters.shape[0] // directions.shape[0]
+
+    observations = np.nan_to_num(input_data.get_observations())
+    principal_directions = _get_principal_tensor_directions(input_data.protocol, observations)
+    direction_indices = np.argmax(np.abs(np.dot(principal_directions, directions.T)), axis=1)
+
+    best_indices = np.zeros(observations.shape[0], dtype=np.int64)
+    scales = np.zeros(observations.shape[0], dtype=np.float64)
+
+    for direction_ind in np.unique(direction_indices):
+        voxels = np.where(direction_indices == direction_ind)[0]
+        rows = slice(direction_ind * nmr_grid_points, (direction_ind + 1) * nmr_grid_points)
+
+        indices, voxel_scales = match_dictionary(observations[voxels], signals[rows], max_batch_size=max_batch_size)
+        best_indices[voxels] = indices + direction_ind * nmr_grid_points
+        scales[voxels] = voxel_scales
+
+    results = dict(zip(free_param_names, grid_parameters[best_indices].T))
+
+    orientations = _get_orientation_compartments(free_param_names)
+    if orientations:
+        theta, phi = cartesian_to_spherical(principal_directions)
+        results[orientations[0] + '.theta'] = theta
+        results[orientations[0] + '.phi'] = phi
+
+    if 'S0.s0' in results:
+        results['S0.s0'] = scales
+
+    logger.info('Finished generating initialization point using dictionary matching.')
+    return restore_volumes(results, input_data.mask)
+
+
+def match_dictionary(observations, dictionary, max_batch_size=5000):
+    """Find per observation the best matching dictionary entry using the normalized inner product.
+
+    Args:
+        observations (ndarray): a (n, m) matrix with the n signals to match
+        dictionary (ndarray): a (d, m) matrix with the dictionary signals
+        max_batch_size (int): the maximum number of observations we process at once
+
+    Returns:
+        tuple: the index of the best matching dictionary entry per observation and the least-squares scaling factor
+            between the observation and that dictionary entry.
+    """
+    dictionary = dictionary.astype(np.float64)
+    dictionary_norms = np.linalg.norm(dictionary, axis=1)
+    dictionary_norms[dictionary_norms == 0] = 1
+    normalized_dictionary = dictionary / dictionary_norms[:, None]
+
+    indices = np.zeros(observations.shape[0], dtype=np.int64)
+    scales = np.zeros(observations.shape[0], dtype=np.float64)
+
+    for batch_start, batch_end in split_in_batches(observations.shape[0], max_batch_size=max_batch_size):
+        inner_products = np.dot(observations[batch_start:batch_end], normalized_dictionary.T)
+        batch_indices = np.argmax(inner_products, axis=1)
+
+        indices[batch_start:batch_end] = batch_indices
+        scales[batch_start:batch_end] = (inner_products[np.arange(batch_indices.shape[0]), batch_indices]
+                                         / dictionary_norms[batch_indices])
+    return indices, scales
+
+
+def _load_dictionary(model, protocol, dictionary_grid, directions, cache_dir):
+    """Load the dictionary from the cache, or simulate and cache it if it does not yet exist.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model, with the protocol loaded
+
+    Returns:
+        tuple: the simulated signals and the matrix with the corresponding parameters
+    """
+    logger = logging.getLogger(__name__)
+
+    cache_file = os.path.join(cache_dir, '{}_{}.npz'.format(
+        model.name, _get_cache_key(model, protocol, dictionary_grid, directions)))
+
+    if os.path.isfile(cache_file):
+        logger.info('Using cached dictionary from "{}".'.format(cache_file))
+        with np.load(cache_file) as cached:
+            return cached['signals'], cached['parameters']
+
+    parameters = _get_dictionary_parameters(model, dictionary_grid, directions)
+    logger.info('Simulating a dictionary of {} entries.'.format(parameters.shape[0]))
+    signals = simulate_signals(model, protocol, parameters)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    np.savez(cache_file, signals=signals, parameters=parameters)
+
+    return signals, parameters
+
+
+def _get_cache_key(model, protocol, dictionary_grid, directions):
+    """Get a hash uniquely identifying the dictionary for this model, protocol and grid.
+
+    This covers the configuration of the model (see
+    :meth:`~mdt.models.composite.DMRICompositeModel.get_configuration_checksum`), such that changing the model
+    definition, for example its CL code, fixed values or initial values, results in a new dictionary.
+    """
+    key = hashlib.md5()
+    key.update(model.name.encode('utf-8'))
+    key.update(model.get_configuration_checksum().encode('utf-8'))
+    key.update(get_protocol_checksum(protocol).encode('utf-8'))
+    for param_name, values in dictionary_grid:
+        key.update(param_name.encode('utf-8'))
+        key.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    key.update(np.ascontiguousarray(directions, dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+def _get_dictionary_parameters(model, dictionary_grid, directions):
+    """Create the matrix with all parameter combinations for the dictionary.
+
+    The returned matrix is ordered by the direction of the first orientation, that is, the first block of rows holds
+    all the grid combinations for the first direction, the second block for the second direction, etc. The other
+    orientations of the model are drawn independently and uniformly over the sphere for every entry, using a fixed
+    seed such that the dictionary is reproducible.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model, with the protocol loaded
+
+    Returns:
+        ndarray: a matrix with per row the free parameters of one dictionary entry
+    """
+    free_param_names = model.get_free_param_names()
+    weight_names = model.get_free_weight_names()
+    default_values = model.get_initial_parameters()[0]
+
+    grid_names = [name for name, _ in dictionary_grid]
+    combinations = np.array(list(itertools.product(*[values for _, values in dictionary_grid])))
+    if not len(combinations):
+        combinations = np.zeros((1, 0))
+
+    gridded_weights = [grid_names.index(name) for name in weight_names if name in grid_names]
+    if gridded_weights:
+        combinations = combinations[np.sum(combinations[:, gridded_weights], axis=1) <= 1]
+
+    nmr_entries = combinations.shape[0] * directions.shape[0]
+    parameters = np.tile(default_values, (nmr_entries, 1))
+    for ind, param_name in enumerate(free_param_names):
+        if param_name in grid_names:
+            parameters[:, ind] = np.tile(combinations[:, grid_names.index(param_name)], directions.shape[0])
+        elif param_name.split('.')[-1] == 'psi':
+            parameters[:, ind] = 0
+        elif param_name == 'S0.s0':
+            parameters[:, ind] = 1
+
+    random_state = np.random.RandomState(0)
+    for orientation_ind, compartment_name in enumerate(_get_orientation_compartments(free_param_names)):
+        if orientation_ind == 0:
+            theta, phi = [np.repeat(angles, combinations.shape[0]) for angles in cartesian_to_spherical(directions)]
+        else:
+            theta, phi = cartesian_to_spherical(random_state.normal(size=(nmr_entries, 3)))
+        parameters[:, free_param_names.index(compartment_name + '.theta')] = theta
+        parameters[:, free_param_names.index(compartment_name + '.phi')] = phi
+
+    return parameters
+
+
+def _get_orientation_compartments(free_param_names):
+    """Get the names of the compartments with a free orientation, that is, with free ``theta`` and ``phi``.
+
+    Returns:
+        list of str: the compartment names in the order of the free parameters
+    """
+    compartments = []
+    for param_name in free_param_names:
+        compartment_name, short_name = param_name.rsplit('.', 1)
+        if short_name == 'theta' and compartment_name + '.phi' in free_param_names:
+            compartments.append(compartment_name)
+    return compartments
+
+
+def _get_parameter_grid(model, user_grid, nmr_grid_steps):
+    """Get the grid of values per parameter to use for the dictionary.
+
+    Orientations and the ``S0.s0`` parameter are excluded from the grid since these are estimated separately.
+    Parameters with voxel-wise bounds are not gridded but use their default initial value.
+
+    Returns:
+        list: list of (parameter name, values) tuples
+    """
+    grid = []
+    for param_name, lower, upper in zip(model.get_free_param_names(), model.get_lower_bounds(),
+                                        model.get_upper_bounds()):
+        if param_name in user_grid:
+            grid.append((param_name, np.array(user_grid[param_name], dtype=np.float64)))
+        elif param_name.split('.')[-1] in _orientation_param_names or param_name == 'S0.s0':
+            continue
+        elif is_scalar(lower) and is_scalar(upper) and np.isfinite(lower) and np.isfinite(upper):
+            grid.append((param_name, np.linspace(lower, upper, nmr_grid_steps + 2)[1:-1]))
+    return grid
+
+
+def _get_hemisphere_directions(nmr_directions):
+    """Get an approximately uniform set of unit vectors on the hemisphere using a Fibonacci lattice.
+
+    Returns:
+        ndarray: a (nmr_directions, 3) matrix with unit vectors
+    """
+    indices = np.arange(nmr_directions) + 0.5
+    theta = np.arccos(1 - indices / nmr_directions)
+    phi = np.pi * (1 + 5 ** 0.5) * indices
+    return spherical_to_cartesian(theta, phi)
+
+
+def _get_principal_tensor_directions(protocol, observations):
+    """Estimate per voxel the principal diffusion direction using a log-linear least squares tensor fit.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol with at least the columns ``b`` and ``g``.
+        observations (ndarray): the (n, m) matrix with the signals per voxel
+
+    Returns:
+        ndarray: a (n, 3) matrix with the principal eigenvector of the diffusion tensor per voxel
+    """
+    b = protocol.get_column('b')[:, 0]
+    g = protocol.get_columns(['gx', 'gy', 'gz'])
+
+    design_matrix = np.column_stack([
+        np.ones_like(b),
+        -b * g[:, 0] ** 2, -b * g[:, 1] ** 2, -b * g[:, 2] ** 2,
+        -2 * b * g[:, 0] * g[:, 1], -2 * b * g[:, 0] * g[:, 2], -2 * b * g[:, 1] * g[:, 2]])
+    design_matrix[:, 1:] /= np.max(b)
+
+    coefficients = np.dot(np.linalg.pinv(design_matrix),
+                          np.log(np.maximum(observations, np.finfo(np.float32).tiny)).T).T
+
+    tensors = np.zeros((observations.shape[0], 3, 3))
+    for ind, (row, column) in enumerate([(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]):
+        tensors[:, row, column] = coefficients[:, ind + 1]
+        tensors[:, column, row] = coefficients[:, ind + 1]
+
+    eigenvectors = np.linalg.eigh(tensors)[1]
+    return eigenvectors[..., -1]
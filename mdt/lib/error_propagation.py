@@ -0,0 +1,203 @@
+"""First order (delta method) propagation of parameter uncertainties to derived maps.
+
+Given a function of the model parameters, ``y = f(x)``, and the covariance matrix of the parameters per voxel,
+``C_x``, the delta method approximates the covariance of the derived values by ``C_y = J C_x J^T``, with ``J`` the
+Jacobian of the function evaluated at the parameter estimates. This module computes these products for all voxels at
+once, in batches of voxels to bound the memory usage.
+
+The function can be given as a NumPy function or as a CL function. The Jacobian can be given as a NumPy function,
+else it is approximated using central differences, evaluated for all voxels and parameters in one call to the
+function per batch.
+"""
+import numpy as np
+from mot.lib.cl_function import CLFunction
+from mot.lib.utils import split_in_batches
+
+from mdt.utils import create_covariance_matrix
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-25'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def propagate_uncertainty(function, parameters, covariances, jacobian=None, constants=None, return_covariances=False,
+                          batch_size=10000):
+    """Propagate the parameter covariances through the given function using the delta method.
+
+    Args:
+        function (Callable or mot.lib.cl_function.CLFunction): the function to propagate the uncertainties through.
+            A NumPy function is called with one vector per parameter and should return a vector with one value per
+            voxel or a matrix with multiple values per voxel. A CL function should return a single value and
+            have one scalar argument per parameter.
+        parameters (ndarray): the (n, p) matrix with the parameter estimates of p parameters for n voxels
+        covariances (ndarray): the (n, p, p) matrix with the covariances of the parameters per voxel
+        jacobian (Callable): optionally, a NumPy function returning the Jacobian of the function. This is called
+            with one vector per parameter and should return a (n, p) matrix for a function with a single value per
+            voxel, or a (n, m, p) matrix for m values per voxel. If not given we approximate the Jacobian using
+            central differences.
+        constants (list): additional arguments to the function and the Jacobian, given after the parameters,
+            for which we do not propagate the uncertainty. These can be scalars or vectors with a value per voxel.
+        return_covariances (boolean): if True, return the full covariance matrix of the function values instead of
+            the standard deviations
+        batch_size (int): the number of voxels to process at once
+
+    Returns:
+        ndarray: the standard deviations as a vector, or as a (n, m) matrix if the function returns m values per
+            voxel. If return_covariances is set, the (n, m, m) covariance matrices.
+    """
+    parameters = np.asarray(parameters, dtype=np.float64)
+    if parameters.ndim < 2:
+        parameters = parameters[None, :]
+    covariances = np.asarray(covariances, dtype=np.float64)
+
+    if isinstance(function, CLFunction):
+        function = _wrap_cl_function(function)
+
+    results = []
+    single_output = False
+    for batch_start, batch_end in split_in_batches(parameters.shape[0], batch_size):
+        batch_parameters = parameters[batch_start:batch_end]
+        batch_covariances = covariances[batch_start:batch_end] if covariances.shape[0] > 1 else covariances
+        batch_constants = [_get_voxel_batch(value, batch_start, batch_end, parameters.shape[0])
+                           for value in constants or []]
+
+        if jacobian is None:
+            batch_jacobian = _numerical_jacobian(function, batch_parameters, batch_covariances, batch_constants)
+        else:
+            batch_jacobian = np.asarray(jacobian(*(list(batch_parameters.T) + batch_constants)), dtype=np.float64)
+
+        if batch_jacobian.ndim < 3:
+            single_output = True
+            batch_jacobian = batch_jacobian[:, None, :]
+
+        if return_covariances:
+            results.append(np.einsum('nip,npq,njq->nij', batch_jacobian, batch_covariances, batch_jacobian))
+        else:
+            results.append(np.sqrt(np.maximum(np.einsum('nip,npq,niq->ni', batch_jacobian, batch_covariances,
+                                                        batch_jacobian), 0)))
+
+    result = np.concatenate(results)
+    if single_output and not return_covariances:
+        return result[:, 0]
+    return result
+
+
+def propagate_map_uncertainty(function, results, parameter_names, covariances=None, jacobian=None, constants=None,
+                              return_covariances=False, batch_size=10000):
+    """Propagate the uncertainties of the given maps through the given function using the delta method.
+
+    This is the equivalent of :func:`propagate_uncertainty` for the results dictionaries of the optimization routines,
+    in which the standard deviations are stored as ``<name>.std`` and the covariances as ``<name>_to_<name>``.
+
+    Args:
+        function (Callable or mot.lib.cl_function.CLFunction): the function to propagate the uncertainties through,
+            see :func:`propagate_uncertainty`. The arguments are given in the order of the parameter names.
+        results (dict): the results dictionary, with the parameter maps and their standard deviations
+        parameter_names (List[str]): the names of the maps to use as arguments to the function
+        covariances (dict): the covariances between the maps as ``<name>_to_<name>``. If not given we use the
+            element ``covariances`` of the results, if present. Missing covariances are assumed to be zero.
+        jacobian (Callable): optionally, a NumPy function returning the Jacobian of the function,
+            see :func:`propagate_uncertainty`.
+        constants (list): additional arguments to the function and the Jacobian, given after the parameters,
+            for which we do not propagate the uncertainty. These can be scalars or vectors with a value per voxel.
+        return_covariances (boolean): if True, return the full covariance matrix of the function values instead of
+            the standard deviations
+        batch_size (int): the number of voxels to process at once
+
+    Returns:
+        ndarray: the standard deviations or covariances, see :func:`propagate_uncertainty`.
+    """
+    if covariances is None:
+        covariances = results.get('covariances', None)
+
+    parameters = [np.reshape(results[name], (-1,)) for name in parameter_names]
+    nmr_voxels = max(len(parameter) for parameter in parameters)
+    parameters = np.column_stack([np.broadcast_to(parameter, (nmr_voxels,)) for parameter in parameters])
+
+    std_maps = {name + '.std': results.get(name + '.std', 0) for name in parameter_names}
+
+    def get_batch(elements, batch_start, batch_end):
+        return {key: _get_voxel_batch(value, batch_start, batch_end, nmr_voxels) for key, value in elements.items()}
+
+    propagated = []
+    for batch_start, batch_end in split_in_batches(nmr_voxels, batch_size):
+        batch_covariances = create_covariance_matrix(
+            get_batch(std_maps, batch_start, batch_end), parameter_names,
+            get_batch(covariances or {}, batch_start, batch_end))
+
+        propagated.append(propagate_uncertainty(
+            function, parameters[batch_start:batch_end], batch_covariances, jacobian=jacobian,
+            constants=[_get_voxel_batch(value, batch_start, batch_end, nmr_voxels) for value in constants or []],
+            return_covariances=return_covariances, batch_size=batch_size))
+    return np.concatenate(propagated)
+
+
+def _numerical_jacobian(function, parameters, covariances, constants):
+    """Approximate the Jacobian of the given function using central differences.
+
+    The step size per parameter is the cube root of the machine precision, relative to the magnitude of the parameter
+    or, if that is zero, to its standard deviation.
+
+    Args:
+        function (Callable): the NumPy function, called with one vector per parameter
+        parameters (ndarray): the (n, p) parameter estimates
+        covariances (ndarray): the (n, p, p) or (1, p, p) covariance matrices
+        constants (list): the additional arguments to the function, scalars or vectors with a value per voxel
+
+    Returns:
+        ndarray: the (n, p) Jacobian for a function with a single value per voxel, else the (n, m, p) Jacobian.
+    """
+    nmr_voxels, nmr_params = parameters.shape
+
+    scale = np.abs(parameters)
+    stds = np.sqrt(np.abs(np.diagonal(covariances, axis1=1, axis2=2)))
+    scale = np.where(scale > 0, scale, np.broadcast_to(stds, scale.shape))
+    steps = np.finfo(np.float64).eps ** (1 / 3.) * np.where(scale > 0, scale, 1)
+
+    offsets = np.zeros((2, nmr_params, nmr_voxels, nmr_params))
+    offsets[0, np.arange(nmr_params), :, np.arange(nmr_params)] = steps.T
+    offsets[1] = -offsets[0]
+
+    evaluation_points = np.reshape(parameters[None, None] + offsets, (-1, nmr_params))
+    repeated_constants = [np.tile(value, 2 * nmr_params) if np.ndim(value) else value for value in constants]
+    values = np.asarray(function(*(list(evaluation_points.T) + repeated_constants)), dtype=np.float64)
+    values = np.reshape(values, (2, nmr_params, nmr_voxels, -1))
+
+    jacobian = np.transpose((values[0] - values[1]) / (2 * steps.T[..., None]), (1, 2, 0))
+    if jacobian.shape[1] == 1:
+        return jacobian[:, 0, :]
+    return jacobian
+
+
+def _get_voxel_batch(value, batch_start, batch_end, nmr_voxels):
+    """Get the values of the given batch of voxels, if the given value has one value per voxel.
+
+    Args:
+        value (ndarray or float): a scalar or an array with one value per voxel on the first axis
+        batch_start (int): the index of the first voxel in the batch
+        batch_end (int): the index after the last voxel in the batch
+        nmr_voxels (int): the total number of voxels
+
+    Returns:
+        ndarray or float: the values of the batch of voxels, or the value itself if it is the same for all voxels
+    """
+    value = np.squeeze(value)
+    if np.ndim(value) and value.shape[0] == nmr_voxels:
+        return value[batch_start:batch_end]
+    return value
+
+
+def _wrap_cl_function(cl_function):
+    """Wrap a CL function such that it can be called like a NumPy function.
+
+    Args:
+        cl_function (mot.lib.cl_function.CLFunction): a CL function with one scalar argument per parameter
+
+    Returns:
+        Callable: a function accepting one vector per parameter and returning a vector with the function values
+    """
+    def wrapped(*parameters):
+        return cl_function.evaluate([np.ascontiguousarray(p) for p in parameters], len(parameters[0]))
+    return wrapped
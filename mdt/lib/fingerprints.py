@@ -0,0 +1,278 @@
+"""Fingerprints identifying the exact inputs of a model fit.
+
+A fingerprint is computed over the input data (observations, mask, protocol and the other voxel-wise inputs), the model
+configuration (the generated CL code, initial values, fixed values and bounds), the optimizer settings and the MDT
+version. It is stored next to the optimization results such that existing results can be reused only if they were
+computed from exactly the same inputs.
+
+Since the fingerprint of a model does not depend on how the model is used afterwards, the results of intermediate
+models (for example the models used to generate initialization points) are reused by every final model that shares them.
+
+Next to the complete fingerprint, we store a mask independent ``settings`` checksum and a signature per voxel over all
+the voxel-wise inputs. If only the mask changed, this allows reusing the results of the voxels that were already
+computed with exactly the same inputs, see :func:`get_reusable_voxels`.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+
+from mdt.__version__ import __version__
+from mdt.utils import is_scalar
+from mot.configuration import CLRuntimeInfo
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-16'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+FINGERPRINT_FILENAME = 'fingerprint.json'
+VOXEL_SIGNATURES_FILENAME = 'fingerprint_voxels.npy'
+
+
+def get_model_fit_fingerprint(model, input_data, method, optimizer_options=None):
+    """Get the fingerprint of fitting the given model on the given data.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the composite model, with the input data set
+            and all the initialization data applied.
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data used for the fit
+        method (str): the optimization routine used
+        optimizer_options (dict): the extra options for the optimization routine
+
+    Returns:
+        dict: per component of the fingerprint a checksum, and under the key ``fingerprint`` the checksum over all
+            the components.
+    """
+    components = {
+        'data': get_input_data_checksum(input_data),
+        'mask': _get_array_checksum(input_data.mask),
+        'protocol': get_protocol_checksum(input_data.protocol),
+        'model': model.get_configuration_checksum(),
+        'optimizer': hashlib.md5(json.dumps(
+            {'method': method, 'options': optimizer_options or {},
+             'double_precision': CLRuntimeInfo().double_precision}, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest(),
+        'mdt_version': __version__
+    }
+
+    settings = hashlib.md5()
+    for value in [components['protocol'], model.get_configuration_checksum(exclude_voxelwise=True),
+                  components['optimizer'], components['mdt_version'], _get_non_voxelwise_input_checksum(input_data)]:
+        settings.update(value.encode('utf-8'))
+    components['settings'] = settings.hexdigest()
+
+    fingerprint = hashlib.md5()
+    for name in sorted(set(components) - {'settings'}):
+        fingerprint.update('{}:{}'.format(name, components[name]).encode('utf-8'))
+
+    components['fingerprint'] = fingerprint.hexdigest()
+    return components
+
+
+def get_input_data_checksum(input_data):
+    """Get a checksum over the voxel-wise data of the given input data object.
+
+    This covers the observations, the noise standard deviation, the gradient deviations and the volume weights, all
+    within the mask. The protocol and the mask are not included, see :func:`get_protocol_checksum`.
+
+    Args:
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data
+
+    Returns:
+        str: the checksum as an hexadecimal string
+    """
+    checksum = hashlib.md5()
+    for name in ['observations', 'noise_std', 'gradient_deviations', 'volume_weights']:
+        value = getattr(input_data, name)
+        checksum.update(name.encode('utf-8'))
+        if value is None:
+            checksum.update(b'None')
+        elif is_scalar(value):
+            checksum.update(repr(float(value)).encode('utf-8'))
+        else:
+            checksum.update(_get_array_checksum(value).encode('utf-8'))
+    return checksum.hexdigest()
+
+
+def get_protocol_checksum(protocol):
+    """Get a checksum over all the columns of the given protocol.
+
+    Args:
+        protocol (mdt.protocols.Protocol): the protocol
+
+    Returns:
+        str: the checksum as an hexadecimal string
+    """
+    checksum = hashlib.md5()
+    for column_name in sorted(protocol.column_names):
+        checksum.update(column_name.encode('utf-8'))
+        checksum.update(np.ascontiguousarray(protocol.get_column(column_name), dtype=np.float64).tobytes())
+    return checksum.hexdigest()
+
+
+def get_voxel_signatures(model, input_data, max_batch_size=10000):
+    """Get per voxel a signature over all the voxel-wise inputs of a model fit.
+
+    This covers the observations, noise standard deviation, gradient deviations and volume weights of every voxel, and
+    the voxel-wise initial values, fixed values and bounds of the model. The signature is a 64 bit FNV-1a hash over
+    the values of each voxel, which is enough to detect changes, but it is not a cryptographic hash.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the composite model, with the input data set
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data used for the fit
+        max_batch_size (int): the number of voxels to process at once, this limits the memory usage
+
+    Returns:
+        ndarray: a vector of unsigned 64 bit integers with one signature per voxel in the mask
+    """
+    nmr_voxels = input_data.nmr_problems
+    signatures = np.full(nmr_voxels, 14695981039346656037, dtype=np.uint64)
+    prime = np.uint64(1099511628211)
+
+    def update(values):
+        for start in range(0, nmr_voxels, max_batch_size):
+            batch = slice(start, min(start + max_batch_size, nmr_voxels))
+            batch_values = np.ascontiguousarray(values[batch], dtype=np.float64)
+            batch_values = np.reshape(batch_values, (batch_values.shape[0], -1)).view(np.uint64)
+            for column in range(batch_values.shape[1]):
+                np.bitwise_xor(signatures[batch], batch_values[:, column], out=signatures[batch])
+                np.multiply(signatures[batch], prime, out=signatures[batch])
+
+    for name in ['observations', 'noise_std', 'gradient_deviations', 'volume_weights']:
+        value = getattr(input_data, name)
+        if value is not None and not is_scalar(value):
+            update(value)
+
+    for value in model.get_voxelwise_configuration():
+        update(value)
+
+    return signatures
+
+
+def get_reusable_voxels(output_path, fingerprint, voxel_signatures, mask):
+    """Get the voxels of which the existing results in the output path can be reused.
+
+    Existing results can be reused if they were computed with the same settings (see :func:`get_model_fit_fingerprint`)
+    and if the voxel-wise inputs of a voxel did not change. This is the case if for example the mask was extended,
+    then only the newly added voxels need to be computed.
+
+    Args:
+        output_path (str): the directory with the model results
+        fingerprint (dict): the current fingerprint
+        voxel_signatures (ndarray): the current voxel signatures, see :func:`get_voxel_signatures`.
+        mask (ndarray): the current mask
+
+    Returns:
+        ndarray: a boolean volume with the voxels in the current mask for which we can reuse the existing results
+    """
+    reusable = np.zeros(mask.shape[:3], dtype=np.bool)
+
+    stored = load_fingerprint(output_path)
+    signatures_path = os.path.join(output_path, VOXEL_SIGNATURES_FILENAME)
+    if stored is None or stored.get('settings') != fingerprint['settings'] or not os.path.isfile(signatures_path):
+        return reusable
+
+    stored_signatures = np.load(signatures_path, mmap_mode='r')
+    if stored_signatures.shape != mask.shape[:3]:
+        return reusable
+
+    mask = mask.astype(np.bool)
+    reusable[mask] = stored_signatures[mask] == voxel_signatures
+    reusable &= _load_used_mask(output_path)
+    return reusable
+
+
+def write_fingerprint(output_path, fingerprint, voxel_signatures=None, mask=None):
+    """Store the fingerprint in the given output directory.
+
+    Args:
+        output_path (str): the directory with the model results
+        fingerprint (dict): the fingerprint, as returned by :func:`get_model_fit_fingerprint`.
+        voxel_signatures (ndarray): if given, the signatures per voxel to store as well
+        mask (ndarray): the mask belonging to the voxel signatures, required if the signatures are given
+    """
+    with open(os.path.join(output_path, FINGERPRINT_FILENAME), 'w') as f:
+        json.dump(fingerprint, f, sort_keys=True, indent=4)
+
+    if voxel_signatures is not None:
+        signatures = np.zeros(mask.shape[:3], dtype=np.uint64)
+        signatures[mask.astype(np.bool)] = voxel_signatures
+        np.save(os.path.join(output_path, VOXEL_SIGNATURES_FILENAME), signatures)
+
+
+def remove_fingerprint(output_path):
+    """Remove the fingerprint files from the given output directory, if present.
+
+    Args:
+        output_path (str): the directory with the model results
+    """
+    for filename in [FINGERPRINT_FILENAME, VOXEL_SIGNATURES_FILENAME]:
+        if os.path.isfile(os.path.join(output_path, filename)):
+            os.remove(os.path.join(output_path, filename))
+
+
+def load_fingerprint(output_path):
+    """Load the fingerprint stored in the given output directory.
+
+    Args:
+        output_path (str): the directory with the model results
+
+    Returns:
+        dict or None: the stored fingerprint, or None if no (readable) fingerprint is present.
+    """
+    try:
+        with open(os.path.join(output_path, FINGERPRINT_FILENAME), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def get_changed_components(output_path, fingerprint):
+    """Get the fingerprint components that differ from the fingerprint stored in the output directory.
+
+    Args:
+        output_path (str): the directory with the model results
+        fingerprint (dict): the current fingerprint
+
+    Returns:
+        list of str: the names of the components that changed, empty if the fingerprints match exactly. If no
+            fingerprint is stored, this returns ``['fingerprint']``.
+    """
+    stored = load_fingerprint(output_path)
+    if stored is None:
+        return ['fingerprint']
+    if stored.get('fingerprint') == fingerprint['fingerprint']:
+        return []
+    return sorted(name for name in fingerprint if name != 'fingerprint' and stored.get(name) != fingerprint[name])
+
+
+def _get_non_voxelwise_input_checksum(input_data):
+    """Get a checksum over the elements of the input data that are the same for every voxel."""
+    noise_std = input_data.noise_std
+    if noise_std is not None and is_scalar(noise_std):
+        return repr(float(noise_std))
+    return 'None' if noise_std is None else 'voxelwise'
+
+
+def _load_used_mask(output_path):
+    """Load the mask of the voxels computed in the given output directory."""
+    from mdt.lib.nifti import get_all_nifti_data
+    maps = get_all_nifti_data(output_path, map_names=['UsedMask'])
+    if 'UsedMask' not in maps:
+        return False
+    used_mask = np.asarray(maps['UsedMask'])
+    if used_mask.ndim > 3:
+        used_mask = used_mask[..., 0]
+    return used_mask > 0
+
+
+def _get_array_checksum(array):
+    """Get the checksum of the shape, type and content of an array."""
+    array = np.ascontiguousarray(array)
+    checksum = hashlib.md5()
+    checksum.update('{} {}'.format(array.shape, array.dtype.str).encode('utf-8'))
+    checksum.update(array.data if array.size else b'')
+    return checksum.hexdigest()
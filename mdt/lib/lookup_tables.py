@@ -0,0 +1,389 @@
+"""Interpolated lookup tables for special functions used in the model kernels.
+
+Some compartment models evaluate expensive special functions in every voxel, for every observation and at every
+iteration. If these functions only depend on a small number of parameters, they can be tabulated once on the host
+and interpolated in the kernel.
+
+All tables are interpolated using cubic Catmull-Rom splines on a grid that is uniform over a transformation of the
+input domain. The one dimensional tables use a grid uniform in ``sqrt(x)``. Since the tabulated functions are smooth
+functions of their input ``x``, they are even functions of ``sqrt(x)``, which gives a natural boundary condition at
+zero. The two dimensional tables use a grid uniform in ``log(1 + x / scale)``, which places most nodes where the
+tabulated functions vary the most. The interpolation error of every table is measured against the reference
+implementation on a dense grid when the table is created, see :attr:`CubicLookupTable.max_error` and
+:attr:`BicubicLookupTable.max_error`.
+
+The use of the lookup tables is enabled per table using the ``lookup_tables`` section of the configuration.
+"""
+import numpy as np
+from scipy.special import dawsn, eval_legendre, i0e
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-20'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+class CubicLookupTable:
+
+    def __init__(self, name, function, upper_bound, nmr_nodes, nmr_test_points_per_interval=16):
+        """A lookup table of a (vector valued) function on the domain [0, upper_bound].
+
+        The function is tabulated at ``nmr_nodes`` points uniformly spaced in ``sqrt(x)``, plus one point beyond the
+        upper bound to support the interpolation of the last interval. Inputs outside of the domain are clamped.
+
+        Args:
+            name (str): the name of the table, used as the name of the generated CL function
+            function (Callable): the reference function, should accept a vector of inputs and return either a vector
+                or a matrix of shape (inputs, outputs).
+            upper_bound (float): the upper bound of the domain
+            nmr_nodes (int): the number of nodes within the domain
+            nmr_test_points_per_interval (int): the number of points per interval used to measure the interpolation
+                error, the points are spaced uniformly in ``sqrt(x)`` such that every interval is covered equally.
+        """
+        self.name = name
+        self.upper_bound = upper_bound
+        self.nmr_nodes = nmr_nodes
+        self._spacing = np.sqrt(upper_bound) / (nmr_nodes - 1)
+
+        nodes = np.arange(nmr_nodes + 1) * self._spacing
+        self.values = np.reshape(function(nodes ** 2), (nmr_nodes + 1, -1))
+
+        test_points = np.linspace(0, np.sqrt(upper_bound), (nmr_nodes - 1) * nmr_test_points_per_interval + 1) ** 2
+        errors = np.abs(self.interpolate(test_points) - np.reshape(function(test_points), (len(test_points), -1)))
+        self.max_error = np.max(errors, axis=0)
+
+    @property
+    def nmr_outputs(self):
+        """The number of values returned per input."""
+        return self.values.shape[1]
+
+    def interpolate(self, x):
+        """Interpolate the table at the given points, using the same scheme as the CL code.
+
+        Args:
+            x (ndarray): the points at which to interpolate
+
+        Returns:
+            ndarray: matrix of shape (points, outputs) with the interpolated values
+        """
+        position = np.sqrt(np.clip(x, 0, self.upper_bound)) / self._spacing
+        index = np.minimum(position.astype(np.int64), self.nmr_nodes - 2)
+        t = (position - index)[:, None]
+
+        p0, p1, p2, p3 = [self.values[np.abs(index + offset)] for offset in range(-1, 3)]
+        return 0.5 * (2 * p1 + (p2 - p0) * t + (2 * p0 - 5 * p1 + 4 * p2 - p3) * t ** 2
+                      + (3 * (p1 - p2) + p3 - p0) * t ** 3)
+
+    def get_cl_code(self):
+        """Get the CL code for the table constants and the interpolation function.
+
+        This generates a function ``void <name>(double x, double* result)`` which writes the interpolated values
+        to the result array.
+
+        Returns:
+            str: the CL code
+        """
+        return '''
+            __constant double {name}_values[] = {{{values}}};
+
+            void {name}(double x, double* result){{
+                double position = sqrt(clamp(x, 0.0, {upper_bound!r})) / {spacing!r};
+                int index = min((int)position, {nmr_nodes} - 2);
+                double t = position - index;
+
+                __constant double* p0 = {name}_values + abs(index - 1) * {nmr_outputs};
+                __constant double* p1 = {name}_values + index * {nmr_outputs};
+                __constant double* p2 = p1 + {nmr_outputs};
+                __constant double* p3 = p2 + {nmr_outputs};
+
+                for(int i = 0; i < {nmr_outputs}; i++){{
+                    result[i] = 0.5 * (2 * p1[i] + (p2[i] - p0[i]) * t
+                                       + (2 * p0[i] - 5 * p1[i] + 4 * p2[i] - p3[i]) * t * t
+                                       + (3 * (p1[i] - p2[i]) + p3[i] - p0[i]) * t * t * t);
+                }}
+            }}
+        '''.format(name=self.name, values=', '.join(repr(float(v)) for v in self.values.flatten()),
+                   upper_bound=float(self.upper_bound), spacing=float(self._spacing),
+                   nmr_nodes=self.nmr_nodes, nmr_outputs=self.nmr_outputs)
+
+
+class BicubicLookupTable:
+
+    def __init__(self, name, function, upper_bound, nmr_nodes, scale=1, nmr_test_points_per_interval=4):
+        """A lookup table of a scalar function of two inputs, on the domain [0, upper_bound] x [0, upper_bound].
+
+        The function is tabulated at ``nmr_nodes`` points per input, uniformly spaced in ``log(1 + x / scale)``, plus
+        one point on both sides of the domain to support the interpolation of the first and last intervals. The values
+        at the point below zero are extrapolated quadratically from the first three nodes. Inputs outside of the
+        domain are clamped.
+
+        Args:
+            name (str): the name of the table, used as the name of the generated CL function
+            function (Callable): the reference function, should accept two arrays of inputs and return an array of
+                the same shape.
+            upper_bound (float): the upper bound of the domain of both inputs
+            nmr_nodes (int): the number of nodes per input within the domain
+            scale (float): the scale of the logarithmic grid, the grid is approximately uniform below this scale
+            nmr_test_points_per_interval (int): the number of points per interval and per input used to measure the
+                interpolation error.
+        """
+        self.name = name
+        self.upper_bound = upper_bound
+        self.nmr_nodes = nmr_nodes
+        self.scale = scale
+        self._spacing = np.log1p(upper_bound / scale) / (nmr_nodes - 1)
+
+        nodes = scale * np.expm1(np.arange(-1, nmr_nodes + 1) * self._spacing)
+        nodes[0] = 0
+        self.values = function(nodes[:, None], nodes[None, :])
+        self.values[0, :] = 3 * self.values[1, :] - 3 * self.values[2, :] + self.values[3, :]
+        self.values[:, 0] = 3 * self.values[:, 1] - 3 * self.values[:, 2] + self.values[:, 3]
+
+        test_points = scale * np.expm1(np.linspace(0, np.log1p(upper_bound / scale),
+                                                   (nmr_nodes - 1) * nmr_test_points_per_interval + 1))
+        x, y = np.meshgrid(test_points, test_points, indexing='ij')
+        self.max_error = np.max(np.abs(self.interpolate(x, y) - function(x, y)))
+
+    def interpolate(self, x, y):
+        """Interpolate the table at the given points, using the same scheme as the CL code.
+
+        Args:
+            x (ndarray): the first input of the points at which to interpolate
+            y (ndarray): the second input, of the same shape as the first
+
+        Returns:
+            ndarray: the interpolated values, of the same shape as the inputs
+        """
+        x_index, x_weights, _ = self._get_index_and_weights(x)
+        y_index, y_weights, _ = self._get_index_and_weights(y)
+        return self._combine(x_index, x_weights, y_index, y_weights)
+
+    def interpolate_gradient(self, x, y):
+        """Compute the gradient of the interpolated function, using the same scheme as the CL code.
+
+        This is the exact derivative of the interpolating spline, not a finite difference. Outside of the domain,
+        where the inputs are clamped, the derivative with respect to that input is zero.
+
+        Args:
+            x (ndarray): the first input of the points at which to interpolate
+            y (ndarray): the second input, of the same shape as the first
+
+        Returns:
+            tuple: the derivatives with respect to the first and the second input, of the same shape as the inputs
+        """
+        x_index, x_weights, x_derivative_weights = self._get_index_and_weights(x)
+        y_index, y_weights, y_derivative_weights = self._get_index_and_weights(y)
+        return (self._combine(x_index, x_derivative_weights, y_index, y_weights),
+                self._combine(x_index, x_weights, y_index, y_derivative_weights))
+
+    def _get_index_and_weights(self, v):
+        """Get the index of the first node and the spline weights of the four nodes around the given points.
+
+        Returns:
+            tuple: the indices, the four weights and the four derivatives of the weights with respect to the input
+        """
+        v = np.asarray(v, dtype=np.float64)
+        position = np.log1p(np.clip(v, 0, self.upper_bound) / self.scale) / self._spacing
+        index = np.minimum(position.astype(np.int64), self.nmr_nodes - 2)
+        t = position - index
+
+        weights = [0.5 * (-t + 2 * t ** 2 - t ** 3),
+                   0.5 * (2 - 5 * t ** 2 + 3 * t ** 3),
+                   0.5 * (t + 4 * t ** 2 - 3 * t ** 3),
+                   0.5 * (-t ** 2 + t ** 3)]
+
+        position_derivative = np.where((v >= 0) & (v <= self.upper_bound),
+                                       1 / (self._spacing * (self.scale + np.clip(v, 0, self.upper_bound))), 0)
+        derivative_weights = [0.5 * (-1 + 4 * t - 3 * t ** 2) * position_derivative,
+                              0.5 * (-10 * t + 9 * t ** 2) * position_derivative,
+                              0.5 * (1 + 8 * t - 9 * t ** 2) * position_derivative,
+                              0.5 * (-2 * t + 3 * t ** 2) * position_derivative]
+        return index, weights, derivative_weights
+
+    def _combine(self, x_index, x_weights, y_index, y_weights):
+        result = 0
+        for i in range(4):
+            for j in range(4):
+                result = result + x_weights[i] * y_weights[j] * self.values[x_index + i, y_index + j]
+        return result
+
+    def get_cl_code(self):
+        """Get the CL code for the table constants and the interpolation function.
+
+        This generates a function ``double <name>(double x, double y)`` which returns the interpolated value and a
+        function ``void <name>_gradient(double x, double y, double* gradient)`` which writes the two derivatives of the
+        interpolated function to the gradient array, see :meth:`interpolate_gradient`.
+
+        Returns:
+            str: the CL code
+        """
+        return '''
+            __constant double {name}_values[] = {{{values}}};
+
+            void {name}_weights(double v, int* index, double* weights, double* derivative_weights){{
+                double position = log1p(clamp(v, 0.0, {upper_bound!r}) / {scale!r}) / {spacing!r};
+                *index = min((int)position, {nmr_nodes} - 2);
+                double t = position - *index;
+
+                weights[0] = 0.5 * (-t + 2 * t * t - t * t * t);
+                weights[1] = 0.5 * (2 - 5 * t * t + 3 * t * t * t);
+                weights[2] = 0.5 * (t + 4 * t * t - 3 * t * t * t);
+                weights[3] = 0.5 * (-t * t + t * t * t);
+
+                double position_derivative = 0;
+                if(v >= 0 && v <= {upper_bound!r}){{
+                    position_derivative = 1 / ({spacing!r} * ({scale!r} + v));
+                }}
+                derivative_weights[0] = 0.5 * (-1 + 4 * t - 3 * t * t) * position_derivative;
+                derivative_weights[1] = 0.5 * (-10 * t + 9 * t * t) * position_derivative;
+                derivative_weights[2] = 0.5 * (1 + 8 * t - 9 * t * t) * position_derivative;
+                derivative_weights[3] = 0.5 * (-2 * t + 3 * t * t) * position_derivative;
+            }}
+
+            double {name}_combine(int x_index, double* x_weights, int y_index, double* y_weights){{
+                double result = 0;
+                for(int i = 0; i < 4; i++){{
+                    __constant double* row = {name}_values + (x_index + i) * {row_length} + y_index;
+                    result += x_weights[i] * (y_weights[0] * row[0] + y_weights[1] * row[1]
+                                              + y_weights[2] * row[2] + y_weights[3] * row[3]);
+                }}
+                return result;
+            }}
+
+            double {name}(double x, double y){{
+                int x_index, y_index;
+                double x_weights[4], y_weights[4], x_derivative_weights[4], y_derivative_weights[4];
+                {name}_weights(x, &x_index, x_weights, x_derivative_weights);
+                {name}_weights(y, &y_index, y_weights, y_derivative_weights);
+                return {name}_combine(x_index, x_weights, y_index, y_weights);
+            }}
+
+            void {name}_gradient(double x, double y, double* gradient){{
+                int x_index, y_index;
+                double x_weights[4], y_weights[4], x_derivative_weights[4], y_derivative_weights[4];
+                {name}_weights(x, &x_index, x_weights, x_derivative_weights);
+                {name}_weights(y, &y_index, y_weights, y_derivative_weights);
+                gradient[0] = {name}_combine(x_index, x_derivative_weights, y_index, y_weights);
+                gradient[1] = {name}_combine(x_index, x_weights, y_index, y_derivative_weights);
+            }}
+        '''.format(name=self.name, values=', '.join(repr(float(v)) for v in self.values.flatten()),
+                   upper_bound=float(self.upper_bound), scale=float(self.scale), spacing=float(self._spacing),
+                   nmr_nodes=self.nmr_nodes, row_length=self.nmr_nodes + 2)
+
+
+def watson_sh_coefficients(kappa, nmr_quadrature_points=400):
+    """Compute the even spherical harmonic coefficients of the Watson distribution up to the 12th order.
+
+    This is the reference implementation used for the NODDI lookup tables. In contrast to the approximations used in
+    the CL function ``NODDI_WatsonSHCoeff``, the coefficients are computed by numerical integration over the
+    orientations, which is accurate for the complete range of kappa.
+
+    Args:
+        kappa (ndarray): the concentration parameters
+        nmr_quadrature_points (int): the number of Gauss-Legendre points used in the integration
+
+    Returns:
+        ndarray: matrix of shape (kappas, 7) with the coefficients of order 0, 2, ..., 12
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(nmr_quadrature_points)
+    mu = (nodes + 1) / 2.
+
+    kappa = np.atleast_1d(kappa).astype(np.float64)[:, None]
+    weighted_density = np.exp(kappa * (mu ** 2 - 1)) * weights
+    normalization = np.sum(weighted_density, axis=1)
+
+    return np.stack([2 * np.sqrt(np.pi) * np.sqrt(4 * order + 1)
+                     * np.sum(weighted_density * eval_legendre(2 * order, mu), axis=1) / normalization
+                     for order in range(7)], axis=1)
+
+
+def watson_hindered_diffusion_factor(kappa):
+    """Compute the factor used in the Watson dispersed hindered diffusion coefficients.
+
+    The dispersed diffusivities are given by ``dperp0 + (d - dperp0) * f`` and
+    ``(d + dperp0) / 2 - (d - dperp0) * f / 2`` with ``f = (sqrt(kappa) / dawson(sqrt(kappa)) - 1) / (2 * kappa)``
+    this factor.
+
+    Args:
+        kappa (ndarray): the concentration parameters
+
+    Returns:
+        ndarray: the factor per kappa
+    """
+    kappa = np.atleast_1d(kappa).astype(np.float64)
+    factor = 1 / 3. + 4 * kappa / 45.
+
+    large = kappa > 1e-3
+    sqrt_kappa = np.sqrt(kappa[large])
+    factor[large] = (sqrt_kappa / dawsn(sqrt_kappa) - 1) / (2 * kappa[large])
+    return factor
+
+
+def bingham_log_normalization(a, b, nmr_quadrature_points=200):
+    """Compute the logarithm of the Bingham normalization constant for the eigenvalues (0, a, b).
+
+    This computes ``log(c(0, a, b))`` with ``c(e0, e1, e2)`` the integral over the unit sphere of
+    ``exp(-(e0 * x**2 + e1 * y**2 + e2 * z**2))``. The integral over the azimuth is solved analytically using a
+    modified Bessel function, the remaining integral is computed using Gauss-Legendre quadrature.
+
+    Args:
+        a (ndarray): the first non-negative eigenvalue
+        b (ndarray): the second non-negative eigenvalue, should be broadcastable with a
+
+    Returns:
+        ndarray: the logarithm of the normalization constant
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(nmr_quadrature_points)
+    a = np.asarray(a, dtype=np.float64)[..., None]
+    b = np.asarray(b, dtype=np.float64)[..., None]
+    return np.log(2 * np.pi * np.sum(weights * np.exp(-b * nodes ** 2) * i0e(a * (1 - nodes ** 2) / 2), axis=-1))
+
+
+def bingham_normalization_constant(e0, e1, e2):
+    """Compute the Bingham normalization constant for the given eigenvalues.
+
+    This is the reference implementation for the CL function ``ConfluentHyperGeometricFirstKind``, which computes
+    ``4 * pi * 1F1(1/2; 3/2; -diag(e0, e1, e2))``. Since the points lie on the unit sphere, shifting all eigenvalues by
+    the same value only scales the constant, such that it reduces to a function of two non-negative inputs.
+
+    Args:
+        e0, e1, e2 (ndarray): the eigenvalues, all of the same shape
+
+    Returns:
+        ndarray: the normalization constants
+    """
+    eigenvalues = np.sort(np.stack(np.broadcast_arrays(e0, e1, e2)).astype(np.float64), axis=0)
+    return np.exp(bingham_log_normalization(eigenvalues[1] - eigenvalues[0], eigenvalues[2] - eigenvalues[0])
+                  - eigenvalues[0])
+
+
+def get_bingham_tables():
+    """Get the lookup tables for the Bingham normalization constant.
+
+    Returns:
+        list of BicubicLookupTable: the table ``BinghamLogNormalizationTable`` with the logarithm of the normalization
+            constant for the eigenvalues (0, a, b), for a and b from 0 to 128.
+    """
+    if 'bingham' not in _tables_cache:
+        _tables_cache['bingham'] = [
+            BicubicLookupTable('BinghamLogNormalizationTable', bingham_log_normalization, 128, 64)]
+    return _tables_cache['bingham']
+
+
+def get_noddi_watson_tables():
+    """Get the lookup tables for the NODDI Watson compartments.
+
+    Returns:
+        list of CubicLookupTable: the table ``NODDI_WatsonSHCoeffTable`` with the spherical harmonic coefficients of
+            order 2 to 12 and the table ``NODDI_WatsonHinderedDiffusionTable`` with the hindered diffusion factor.
+            Both cover kappa from 0 to 64.
+    """
+    if 'noddi_watson' not in _tables_cache:
+        _tables_cache['noddi_watson'] = [
+            CubicLookupTable('NODDI_WatsonSHCoeffTable', lambda k: watson_sh_coefficients(k)[:, 1:], 64, 256),
+            CubicLookupTable('NODDI_WatsonHinderedDiffusionTable', watson_hindered_diffusion_factor, 64, 256)]
+    return _tables_cache['noddi_watson']
+
+
+_tables_cache = {}
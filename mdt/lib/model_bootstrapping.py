@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+import logging
+import os
+import timeit
+import time
+
+from mdt import get_processing_strategy
+from mdt.configuration import get_optimizer_for_model
+from mdt.lib.nifti import get_all_nifti_data
+from mdt.utils import create_roi, per_model_logging_context, SimpleInitializationData
+from mdt.lib.processing_strategies import BootstrapProcessor, get_full_tmp_results_path
+from mdt.lib.exceptions import InsufficientProtocolError
+
+
+__author__ = 'Robbert Harms'
+__date__ = "2019-01-15"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+def bootstrap_composite_model(model, input_data, output_folder, optimization_results, tmp_dir,
+                              nmr_bootstraps=100, bootstrap_method='residual', quantiles=(0.025, 0.5, 0.975),
+                              seed=None, method=None, recalculate=False, optimizer_options=None):
+    """Bootstrap a composite model fit.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): a composite model to bootstrap
+        input_data (:class:`~mdt.utils.MRIInputData`): The input data object with which the model
+            is initialized before running
+        output_folder (string): The full path to the folder where to place the output
+        optimization_results (str or dict): the results of the original model fit, either a directory with the
+            optimization results or a dictionary with per parameter a volume. These are used to compute the residuals
+            and as starting point for fitting every bootstrap replicate.
+        tmp_dir (str): the preferred temporary storage dir
+        nmr_bootstraps (int): the number of bootstrap replicates per voxel
+        bootstrap_method (str): either 'residual' or 'wild', see
+            :class:`~mdt.lib.processing_strategies.BootstrapProcessor`.
+        quantiles (tuple of float): the quantiles of the bootstrap distribution to store
+        seed (int): the seed for the random number generator, set for reproducible results
+        method (str): The optimization method to use, defaults to the configured optimizer for this model.
+        recalculate (boolean): If we want to recalculate the results if they are already present.
+        optimizer_options (dict): extra options passed to the optimization routine.
+
+    Returns:
+        dict: per output map the ROI list with the bootstrap statistics.
+    """
+    if not model.is_input_data_sufficient(input_data):
+        raise InsufficientProtocolError(
+            'The provided protocol is insufficient for this model. '
+            'The reported errors where: {}'.format(model.get_input_data_problems(input_data)))
+
+    logger = logging.getLogger(__name__)
+
+    if not recalculate:
+        if os.path.exists(os.path.join(output_folder, 'UsedMask.nii.gz')) \
+                or os.path.exists(os.path.join(output_folder, 'UsedMask.nii')):
+            logger.info('Not recalculating {} model'.format(model.name))
+            return create_roi(get_all_nifti_data(output_folder), input_data.mask)
+
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+
+    if isinstance(optimization_results, str):
+        optimization_results = get_all_nifti_data(optimization_results, map_names=model.get_free_param_names())
+
+    model.set_input_data(input_data)
+
+    with per_model_logging_context(output_folder, overwrite=recalculate):
+        logger.info('Using the optimization results as starting point for the bootstrap replicates.')
+        SimpleInitializationData(inits={name: optimization_results[name] for name in model.get_free_param_names()}
+                                 ).apply_to_model(model, input_data)
+
+        with _log_info(logger, model.name, nmr_bootstraps, bootstrap_method):
+            worker = BootstrapProcessor(
+                method or get_optimizer_for_model([model.name]),
+                model, input_data.mask, input_data.nifti_header, output_folder,
+                get_full_tmp_results_path(output_folder, tmp_dir), recalculate,
+                nmr_bootstraps=nmr_bootstraps, bootstrap_method=bootstrap_method, quantiles=quantiles,
+                seed=seed, optimizer_options=optimizer_options)
+
+            processing_strategy = get_processing_strategy('bootstrap')
+            return processing_strategy.process(worker)
+
+
+@contextmanager
+def _log_info(logger, model_name, nmr_bootstraps, bootstrap_method):
+    minimize_start_time = timeit.default_timer()
+    logger.info('Bootstrapping {} model using {} {} bootstrap replicates'.format(
+        model_name, nmr_bootstraps, bootstrap_method))
+    yield
+    run_time = timeit.default_timer() - minimize_start_time
+    run_time_str = time.strftime('%H:%M:%S', time.gmtime(run_time))
+    logger.info('Bootstrapped {0} model with runtime {1} (h:m:s).'.format(model_name, run_time_str))
@@ -13,9 +13,12 @@ from mdt.lib.nifti import get_all_nifti_data
 from mdt.lib.components import get_model
 from mdt.configuration import get_processing_strategy, get_optimizer_for_model
 from mdt.models.cascade import DMRICascadeModelInterface
-from mdt.utils import create_roi, get_cl_devices, model_output_exists, \
+from mdt.utils import create_roi, get_cl_devices, model_output_exists, restore_volumes, \
     per_model_logging_context, get_temporary_results_dir, SimpleInitializationData, InitializationData
-from mdt.lib.processing_strategies import FittingProcessor, get_full_tmp_results_path
+from mdt.lib.processing_strategies import FittingProcessor, ModelSelectionProcessor, get_full_tmp_results_path
+from mdt.lib.dictionary_matching import get_dictionary_matching_inits
+from mdt.lib.fingerprints import get_model_fit_fingerprint, get_changed_components, write_fingerprint, \
+    get_voxel_signatures, get_reusable_voxels, load_fingerprint, remove_fingerprint
 from mdt.lib.exceptions import InsufficientProtocolError
 import mot.configuration
 from mot.configuration import CLRuntimeInfo, CLRuntimeAction
@@ -27,7 +30,7 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
-def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None):
+def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None, method='cascade'):
     """Get better optimization starting points for the given model.
 
     Since initialization can make quite a difference in optimization results, this function can generate
@@ -55,10 +58,21 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
             model name in it.
         cl_device_ind (int or list): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices(). This can also be a list of device indices.
+        method (str): the initialization method, either 'cascade' or 'dictionary'. The cascade method fits a chain of
+            simpler models to initialize the requested model, this only supports the models shipped with MDT.
+            The dictionary method matches every voxel against a simulated dictionary of model signals,
+            see :func:`mdt.lib.dictionary_matching.get_dictionary_matching_inits`. This works for any composite model.
 
     Returns:
         dict: a dictionary with initialization points for the selected model
+
+    Raises:
+        ValueError: if the initialization method is not supported
     """
+    if method not in ('cascade', 'dictionary'):
+        raise ValueError('The initialization method "{}" is not supported, '
+                         'use either "cascade" or "dictionary".'.format(method))
+
     logger = logging.getLogger(__name__)
 
     def get_subset(param_names, fit_results):
@@ -71,13 +85,19 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
         logger.info('Finished intermediate optimization for generating initialization point.')
         return results
 
+    def get_mean_signal(volume_indices=None):
+        observations = input_data.get_observations()
+        if volume_indices is not None:
+            observations = observations[:, volume_indices]
+        return restore_volumes(np.mean(observations, axis=1), input_data.mask, with_volume_dim=False)
+
     def get_init_data(model_name):
         inits = {}
         free_parameters = get_model(model_name)().get_free_param_names()
 
         if 'S0.s0' in free_parameters and input_data.has_input_data('b'):
             unweighted_locations = np.where(input_data.get_input_data('b') < 250e6)[0]
-            inits['S0.s0'] = np.mean(input_data.signal4d[..., unweighted_locations], axis=-1)
+            inits['S0.s0'] = get_mean_signal(unweighted_locations)
 
         if model_name.startswith('BallStick_r2'):
             inits.update(get_subset(free_parameters, get_model_fit('BallStick_r1')))
@@ -150,7 +170,7 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
             inits['CylinderGPD.theta'] = fit_results['Stick0.theta']
             inits['CylinderGPD.phi'] = fit_results['Stick0.phi']
         elif model_name.startswith('QMT_ReducedRamani'):
-            inits['S0.s0'] = np.mean(input_data.signal4d, axis=-1)
+            inits['S0.s0'] = get_mean_signal()
 
         return inits
 
@@ -159,6 +179,8 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
         cl_environments = get_cl_devices(cl_device_ind)
 
     with mot_config_context(mot.configuration.RuntimeConfigurationAction(cl_environments=cl_environments)):
+        if method == 'dictionary':
+            return get_dictionary_matching_inits(model_name, input_data)
         return get_init_data(model_name)
 
 
@@ -432,24 +454,28 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
             'The given protocol is insufficient for this model. '
             'The reported errors where: {}'.format(model.get_input_data_problems(input_data)))
 
+    model.set_input_data(input_data)
+    fingerprint = get_model_fit_fingerprint(model, input_data, method, optimizer_options)
+    voxel_signatures = get_voxel_signatures(model, input_data)
+    reusable_voxels = None
+
     if not recalculate and model_output_exists(model, output_folder):
-        maps = get_all_nifti_data(output_path)
-        logger.info('Not recalculating {} model'.format(model.name))
-        return create_roi(maps, input_data.mask)
+        changed = get_changed_components(output_path, fingerprint)
+        if not changed:
+            maps = get_all_nifti_data(output_path)
+            logger.info('Not recalculating {} model'.format(model.name))
+            return create_roi(maps, input_data.mask)
+
+        logger.info('Recalculating {} model, the existing results do not match the current inputs '
+                    '(changed: {}).'.format(model.name, ', '.join(changed)))
+        reusable_voxels = get_reusable_voxels(output_path, fingerprint, voxel_signatures, input_data.mask)
+        recalculate = True
 
     with per_model_logging_context(output_path):
         logger.info('Using MDT version {}'.format(__version__))
         logger.info('Preparing for model {0}'.format(model.name))
         logger.info('Current cascade: {0}'.format(cascade_names))
 
-        model.set_input_data(input_data)
-
-        if recalculate:
-            if os.path.exists(output_path):
-                list(map(os.remove, glob.glob(os.path.join(output_path, '*.nii*'))))
-                if os.path.exists(os.path.join(output_path + 'covariances')):
-                    shutil.rmtree(os.path.join(output_path + 'covariances'))
-
         if not os.path.exists(output_path):
             os.makedirs(output_path)
 
@@ -461,8 +487,137 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
                                       input_data.nifti_header, output_path,
                                       tmp_dir, recalculate, optimizer_options=optimizer_options)
 
+            if reusable_voxels is not None and np.any(reusable_voxels):
+                reused = worker.reuse_results(reusable_voxels, output_path,
+                                              maps_subdirs=load_fingerprint(output_path).get('maps_subdirs', ['']))
+                logger.info('Reusing the existing results of {} voxels, only the remaining {} voxels '
+                            'are computed.'.format(len(reused), input_data.nmr_problems - len(reused)))
+
+            if recalculate:
+                list(map(os.remove, glob.glob(os.path.join(output_path, '*.nii*'))))
+                remove_fingerprint(output_path)
+                if os.path.exists(os.path.join(output_path, 'covariances')):
+                    shutil.rmtree(os.path.join(output_path, 'covariances'))
+
             processing_strategy = get_processing_strategy('optimization')
-            return processing_strategy.process(worker)
+            results = processing_strategy.process(worker)
+
+        fingerprint['maps_subdirs'] = worker.maps_subdirs
+        write_fingerprint(output_path, fingerprint, voxel_signatures=voxel_signatures, mask=input_data.mask)
+        return results
+
+
+def fit_model_set(models, input_data, output_folder, information_criterion='BIC', method=None, recalculate=False,
+                  cl_device_ind=None, double_precision=False, tmp_results_dir=True, initialization_data=None,
+                  optimizer_options=None):
+    """Fit a set of candidate models together and select per voxel the best model.
+
+    All candidates share the same input data and processing strategy. Per chunk of voxels, every candidate is fitted,
+    after which the information criterion maps of the candidates are compared. The results of each candidate are stored
+    in ``<output_folder>/<model_name>`` as with regular model fitting. The model selection maps are stored in
+    ``<output_folder>/ModelSelection``, these are:
+
+    * ``Winner``: the index of the best model per voxel, following the order in ``models`` (see ``models.txt``)
+    * ``<model_name>.weight``: the Akaike weights (or Schwarz weights when using the BIC) per candidate model
+    * ``<param_name>``: the model-averaged estimate for every free parameter
+
+    Candidates for which the output already exists are not refitted, unless ``recalculate`` is set or the stored
+    fingerprint does not match the current inputs (see :mod:`mdt.lib.fingerprints`).
+
+    Args:
+        models (list of str or :class:`~mdt.models.composite.DMRICompositeModel`): the candidate composite models
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data shared by all candidates
+        output_folder (string): the path to the folder where to place the output
+        information_criterion (str): the information criterion to use, one of 'BIC', 'AIC' or 'AICc'
+        method (str): the optimization method to use, if not given we use the configured method per model.
+        recalculate (boolean): if we want to recalculate the results if they are already present.
+        cl_device_ind (int or list): the index of the CL device to use.
+        double_precision (boolean): if we would like to do the calculations in double precision
+        tmp_results_dir (str, True or None): The temporary dir for the calculations.
+        initialization_data (dict): per model name the initialization data for that model,
+            see :func:`mdt.fit_model` for the format.
+        optimizer_options (dict): extra options passed to the optimization routines.
+
+    Returns:
+        dict: the model selection results as ROI lists per map.
+    """
+    logger = logging.getLogger(__name__)
+    tmp_results_dir = get_temporary_results_dir(tmp_results_dir)
+    initialization_data = initialization_data or {}
+
+    models = [get_model(model)() if isinstance(model, str) else model for model in models]
+    selection_output_path = os.path.join(output_folder, 'ModelSelection')
+
+    if not os.path.exists(selection_output_path):
+        os.makedirs(selection_output_path)
+    with open(os.path.join(selection_output_path, 'models.txt'), 'w') as f:
+        f.write('\n'.join('{} {}'.format(ind, model.name) for ind, model in enumerate(models)) + '\n')
+
+    cl_runtime_info = CLRuntimeInfo(double_precision=double_precision)
+    if cl_device_ind is not None:
+        cl_runtime_info = CLRuntimeInfo(cl_environments=get_cl_devices(cl_device_ind),
+                                        double_precision=double_precision)
+
+    with mot.configuration.config_context(CLRuntimeAction(cl_runtime_info)), \
+            per_model_logging_context(selection_output_path):
+        logger.info('Using MDT version {}'.format(__version__))
+        logger.info('Fitting the candidate models {} and selecting using the {}.'.format(
+            [model.name for model in models], information_criterion))
+
+        candidates = []
+        new_fingerprints = []
+        for model in models:
+            if not model.is_input_data_sufficient(input_data):
+                raise InsufficientProtocolError(
+                    'The given protocol is insufficient for the model {}. The reported errors where: {}'.format(
+                        model.name, model.get_input_data_problems(input_data)))
+
+            output_path = os.path.join(output_folder, model.name)
+            free_param_names = model.get_free_param_names()
+            model_method = method or get_optimizer_for_model([model.name])
+
+            if model.name in initialization_data:
+                model_init_data = initialization_data[model.name]
+                if not isinstance(model_init_data, InitializationData):
+                    model_init_data = SimpleInitializationData(**model_init_data)
+                model_init_data.apply_to_model(model, input_data)
+
+            model.set_input_data(input_data)
+            fingerprint = get_model_fit_fingerprint(model, input_data, model_method, optimizer_options)
+
+            model_recalculate = recalculate
+            if not recalculate and model_output_exists(model, output_folder):
+                if not get_changed_components(output_path, fingerprint):
+                    logger.info('Not recalculating {} model, using the existing results.'.format(model.name))
+                    maps = get_all_nifti_data(output_path, map_names=free_param_names + [information_criterion])
+                    candidates.append((model.name, free_param_names, create_roi(maps, input_data.mask)))
+                    continue
+                logger.info('Recalculating {} model, the existing results do not match the current inputs.'.format(
+                    model.name))
+                model_recalculate = True
+
+            if not os.path.exists(output_path):
+                os.makedirs(output_path)
+            remove_fingerprint(output_path)
+
+            worker = FittingProcessor(model_method, model, input_data.mask,
+                                      input_data.nifti_header, output_path,
+                                      get_full_tmp_results_path(output_path, tmp_results_dir), model_recalculate,
+                                      optimizer_options=optimizer_options)
+            candidates.append((model.name, free_param_names, worker))
+            new_fingerprints.append((output_path, fingerprint, get_voxel_signatures(model, input_data), worker))
+
+        worker = ModelSelectionProcessor(candidates, input_data.mask, input_data.nifti_header, selection_output_path,
+                                         get_full_tmp_results_path(selection_output_path, tmp_results_dir),
+                                         recalculate, information_criterion=information_criterion)
+
+        results = get_processing_strategy('optimization').process(worker)
+
+        for output_path, fingerprint, voxel_signatures, fitting_worker in new_fingerprints:
+            fingerprint['maps_subdirs'] = fitting_worker.maps_subdirs
+            write_fingerprint(output_path, fingerprint, voxel_signatures=voxel_signatures, mask=input_data.mask)
+
+        return results
 
 
 @contextmanager
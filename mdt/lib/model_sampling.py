@@ -7,7 +7,7 @@ import time
 from mdt import get_processing_strategy
 from mdt.utils import load_samples, per_model_logging_context
 from mdt.lib.processing_strategies import SamplingProcessor, SaveAllSamples, \
-    SaveNoSamples, get_full_tmp_results_path, SaveSpecificMaps
+    SaveNoSamples, get_full_tmp_results_path, SaveSpecificMaps, SamplesStorageStrategy
 from mdt.lib.exceptions import InsufficientProtocolError
 
 
@@ -46,7 +46,8 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
             False, we will store none of the samples. If set to True we will save all samples. If set to a sequence we
             expect a sequence of integer numbers with sample positions to store. Finally, you can also give a subclass
             instance of :class:`~mdt.lib.processing_strategies.SamplesStorageStrategy` (it is then typically set to
-            a :class:`mdt.lib.processing_strategies.SaveThinnedSamples` instance).
+            a :class:`mdt.lib.processing_strategies.SaveThinnedSamples` or
+            :class:`mdt.lib.processing_strategies.SaveQuantizedSamples` instance).
         sample_items_to_save (list): list of output names we want to store the samples of. If given, we only
             store the items specified in this list. Valid items are the free parameter names of the model and the
             items 'LogLikelihood' and 'LogPrior'.
@@ -61,7 +62,9 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
             as additional keyword arguments to the constructor.
     """
     samples_storage_strategy = SaveAllSamples()
-    if store_samples:
+    if isinstance(store_samples, SamplesStorageStrategy):
+        samples_storage_strategy = store_samples
+    elif store_samples:
         if sample_items_to_save:
             samples_storage_strategy = SaveSpecificMaps(included=sample_items_to_save)
     else:
@@ -63,23 +63,35 @@ def load_all_niftis(directory, map_names=None):
     return {k: load_nifti(v) for k, v in maps_paths.items()}
 
 
-def get_all_nifti_data(directory, map_names=None, deferred=True):
+def get_all_nifti_data(directory, map_names=None, deferred=True, derived_maps=False, persist_derived_maps=False):
     """Get the data of all the nifti volumes in the given directory.
 
     If map_names is given we will only load the given map names. Else, we load all .nii and .nii.gz files in the
     given directory.
 
+    If ``derived_maps`` is set, we also add the maps which are not in the directory but which can be derived from the
+    maps in the directory, like the DTI measures from the Tensor parameters. See :mod:`mdt.lib.derived_maps` for the
+    registry of these maps. These maps are computed on the moment they are requested.
+
     Args:
         directory (str): the directory from which we want to read a number of maps
         map_names (list of str): the names of the maps we want to use. If given, we only use and return these maps.
         deferred (boolean): if True we return an deferred loading dictionary instead of a dictionary with the values
             loaded as arrays.
+        derived_maps (boolean): if we want to add the derived maps missing in the directory
+        persist_derived_maps (boolean): if set, we write the derived maps to the directory once computed
 
     Returns:
         dict: A dictionary with the volumes. The keys of the dictionary are the filenames
             without the extension of the .nii(.gz) files in the given directory.
     """
     proxies = load_all_niftis(directory, map_names=map_names)
+
+    if derived_maps:
+        from mdt.lib.derived_maps import get_derived_maps_proxies
+        derived_proxies = get_derived_maps_proxies(directory, map_names=map_names, persist=persist_derived_maps)
+        proxies.update({k: v for k, v in derived_proxies.items() if k not in proxies})
+
     if deferred:
         return DeferredActionDict(lambda _, item: item.get_data(), proxies)
     else:
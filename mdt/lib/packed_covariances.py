@@ -0,0 +1,215 @@
+"""Packed storage of the parameter covariances estimated after optimization.
+
+By default, the covariances between the free parameters are written as one map per parameter pair, named
+``<p1>_to_<p2>`` in the ``covariances`` subdirectory of the results. With the ``packed_covariances`` switch of the
+optimization post-processing enabled, the covariances are instead stored in a single 4d volume,
+``covariances/packed_covariances.nii(.gz)``, holding per voxel the upper triangle (including the diagonal) of the
+covariance matrix, in row-major order. The names of the parameters, in the order of the rows of the matrix, are
+stored in ``covariances/packed_covariances.json``.
+
+The functions :func:`load_covariance_maps`, :func:`load_covariance_matrices` and :func:`get_voxel_covariance_matrix`
+load the covariances per parameter pair, as full matrices for all voxels or as a full matrix for a single voxel.
+"""
+import itertools
+import json
+import os
+import numpy as np
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-02-05'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+PACKED_COVARIANCES_MAP_NAME = 'packed_covariances'
+PACKED_COVARIANCES_PARAMETERS_FILENAME = 'packed_covariances.json'
+
+
+def get_packed_index(nmr_parameters, row, column):
+    """Get the index of an element of the covariance matrix in the packed upper triangle.
+
+    Args:
+        nmr_parameters (int): the number of rows (and columns) of the covariance matrix
+        row (int): the row of the element
+        column (int): the column of the element, since the matrix is symmetric this may be smaller than the row
+
+    Returns:
+        int: the index of that element in the last dimension of the packed covariances
+    """
+    row, column = min(row, column), max(row, column)
+    return row * nmr_parameters - row * (row - 1) // 2 + column - row
+
+
+def packed_to_matrices(packed, nmr_parameters):
+    """Unpack the upper triangles to full symmetric matrices.
+
+    Args:
+        packed (ndarray): matrix of shape (..., p * (p + 1) / 2) with the packed upper triangles
+        nmr_parameters (int): the number of rows (and columns) p of the matrices
+
+    Returns:
+        ndarray: matrix of shape (..., p, p) with the full symmetric matrices
+    """
+    packed = np.asarray(packed)
+    if packed.shape[-1] != nmr_parameters * (nmr_parameters + 1) // 2:
+        raise ValueError('The last dimension of the packed covariances ({}) does not match '
+                         'the number of parameters ({}).'.format(packed.shape[-1], nmr_parameters))
+
+    matrices = np.zeros(packed.shape[:-1] + (nmr_parameters, nmr_parameters), dtype=packed.dtype)
+    rows, columns = np.triu_indices(nmr_parameters)
+    matrices[..., rows, columns] = packed
+    matrices[..., columns, rows] = packed
+    return matrices
+
+
+def matrices_to_packed(matrices):
+    """Pack the upper triangles of the given symmetric matrices.
+
+    Args:
+        matrices (ndarray): matrix of shape (..., p, p)
+
+    Returns:
+        ndarray: matrix of shape (..., p * (p + 1) / 2) with the upper triangles in row-major order
+    """
+    matrices = np.asarray(matrices)
+    rows, columns = np.triu_indices(matrices.shape[-1])
+    return matrices[..., rows, columns]
+
+
+def write_packed_covariances_parameters(covariances_dir, parameter_names):
+    """Write the names of the parameters in the packed covariances.
+
+    Args:
+        covariances_dir (str): the directory with the packed covariances
+        parameter_names (list of str): the names of the parameters, in the order of the rows of the matrix
+    """
+    with open(os.path.join(covariances_dir, PACKED_COVARIANCES_PARAMETERS_FILENAME), 'w') as f:
+        json.dump(list(parameter_names), f)
+
+
+def remove_packed_covariances_parameters(covariances_dir):
+    """Remove the file with the names of the parameters of the packed covariances, if present."""
+    path = os.path.join(covariances_dir, PACKED_COVARIANCES_PARAMETERS_FILENAME)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def load_packed_covariances_parameters(covariances_dir):
+    """Load the names of the parameters in the packed covariances.
+
+    Args:
+        covariances_dir (str): the directory with the covariances
+
+    Returns:
+        list of str or None: the names of the parameters, in the order of the rows of the covariance matrix,
+            or None if there are no packed covariances in this directory.
+    """
+    from mdt.lib.nifti import yield_nifti_info
+
+    names_path = os.path.join(covariances_dir, PACKED_COVARIANCES_PARAMETERS_FILENAME)
+    if not os.path.isfile(names_path) or not any(map_name == PACKED_COVARIANCES_MAP_NAME for _, map_name, _
+                                                 in yield_nifti_info(covariances_dir)):
+        return None
+    with open(names_path, 'r') as f:
+        return json.load(f)
+
+
+def load_covariance_maps(results_folder):
+    """Load the covariances between the parameters as one volume per parameter pair.
+
+    This works for both the separate and the packed storage of the covariances. For the packed storage, the volumes
+    are views on the packed covariances volume.
+
+    Args:
+        results_folder (str): the folder with the output maps of a model, for example ``<output>/BallStick_r1``
+
+    Returns:
+        dict: per parameter pair, named like ``<p1>_to_<p2>``, the covariance volume.
+            Empty if there are no covariances in the given folder.
+    """
+    from mdt.lib.nifti import load_nifti
+    from mdt.utils import load_volume_maps
+
+    covariances_dir = os.path.join(results_folder, 'covariances')
+    if not os.path.isdir(covariances_dir):
+        return {}
+
+    parameter_names = load_packed_covariances_parameters(covariances_dir)
+    if parameter_names is None:
+        return load_volume_maps(covariances_dir)
+
+    packed = load_nifti(os.path.join(covariances_dir, PACKED_COVARIANCES_MAP_NAME)).get_data()
+    nmr_parameters = len(parameter_names)
+    return {'{}_to_{}'.format(parameter_names[x], parameter_names[y]):
+            packed[..., get_packed_index(nmr_parameters, x, y)]
+            for x, y in itertools.combinations(range(nmr_parameters), 2)}
+
+
+def load_covariance_matrices(results_folder, mask=None):
+    """Load the full covariance matrices of the voxels in the given mask.
+
+    This requires the covariances to be stored in the packed format.
+
+    Args:
+        results_folder (str): the folder with the output maps of a model, for example ``<output>/BallStick_r1``
+        mask (ndarray or str): the voxels to load, as a mask or the filename of a mask. Defaults to the ``UsedMask``
+            in the results folder, if present, else all voxels.
+
+    Returns:
+        tuple: the list of parameter names, in the order of the rows, and the (n, p, p) matrix with the covariance
+            matrices of the n voxels in the mask.
+
+    Raises:
+        ValueError: if there are no packed covariances in the given folder
+    """
+    from mdt.lib.nifti import load_nifti, yield_nifti_info
+    from mdt.utils import load_brain_mask, create_roi
+
+    covariances_dir = os.path.join(results_folder, 'covariances')
+    parameter_names = _get_packed_covariances_parameters(covariances_dir)
+    packed = load_nifti(os.path.join(covariances_dir, PACKED_COVARIANCES_MAP_NAME)).get_data()
+
+    if mask is None:
+        used_mask = [path for path, map_name, _ in yield_nifti_info(results_folder) if map_name == 'UsedMask']
+        if used_mask:
+            mask = load_brain_mask(used_mask[0])
+        else:
+            mask = np.ones(packed.shape[:3], dtype=np.bool)
+    elif isinstance(mask, str):
+        mask = load_brain_mask(mask)
+
+    return parameter_names, packed_to_matrices(create_roi(packed, mask), len(parameter_names))
+
+
+def get_voxel_covariance_matrix(results_folder, xyz):
+    """Get the full covariance matrix of a single voxel.
+
+    This requires the covariances to be stored in the packed format.
+
+    Args:
+        results_folder (str): the folder with the output maps of a model, for example ``<output>/BallStick_r1``
+        xyz (tuple of int): the voxel location in the volume
+
+    Returns:
+        tuple: the list of parameter names, in the order of the rows, and the (p, p) covariance matrix of that voxel
+
+    Raises:
+        ValueError: if there are no packed covariances in the given folder
+    """
+    from mdt.lib.nifti import load_nifti
+
+    covariances_dir = os.path.join(results_folder, 'covariances')
+    parameter_names = _get_packed_covariances_parameters(covariances_dir)
+    packed = load_nifti(os.path.join(covariances_dir, PACKED_COVARIANCES_MAP_NAME)).dataobj[
+        tuple(int(el) for el in xyz[:3])]
+    return parameter_names, packed_to_matrices(packed, len(parameter_names))
+
+
+def _get_packed_covariances_parameters(covariances_dir):
+    """Load the names of the parameters in the packed covariances, raising an error if not present."""
+    parameter_names = load_packed_covariances_parameters(covariances_dir)
+    if parameter_names is None:
+        raise ValueError('Could not find packed covariances in the directory "{}". Please enable the '
+                         '"packed_covariances" switch of the optimization post-processing.'.format(covariances_dir))
+    return parameter_names
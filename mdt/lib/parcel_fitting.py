@@ -0,0 +1,250 @@
+"""Fitting and sampling models on parcels of voxels instead of on individual voxels.
+
+Given a label volume (for example an atlas parcellation), the observations of all voxels with the same label are
+aggregated into a single observation vector. All labels are then processed together as one batch of problems using
+the regular fitting and sampling routines, afterwards the results are written as a per-label table and are painted back
+into volumes with the shape of the label volume.
+
+For Gaussian noise, fitting the mean signal of a parcel is equivalent to maximizing the joint likelihood of all member
+voxels under a shared set of parameters. Since the mean signal has a lower noise level than the individual voxels, the
+noise standard deviation is scaled per parcel by the square root of the number of member voxels.
+"""
+import logging
+import os
+import numpy as np
+
+from mdt.configuration import gzip_optimization_results, gzip_sampling_results
+from mdt.lib.components import get_model
+from mdt.lib.nifti import write_all_as_nifti
+from mdt.utils import create_roi, load_brain_mask, load_nifti, is_scalar, restore_volumes
+
+__author__ = 'Robbert Harms'
+__date__ = '2018-09-14'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def fit_parcels(model, input_data, labels, output_folder, aggregation='mean', **fit_model_kwargs):
+    """Fit a model to the aggregated signal of every parcel in a label volume.
+
+    The parcel-level results are stored in ``<output_folder>/parcels/<model>``, the results painted back into the
+    label volume and the per-label table (``parcels.tsv``) are stored in ``<output_folder>/<model>``.
+
+    Args:
+        model (str or :class:`~mdt.models.composite.DMRICompositeModel`): the model to fit
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data object with the voxel-wise data
+        labels (str or ndarray): the label volume (or a filename of a nifti file) with per voxel an integer label.
+            Voxels with a label of zero, or outside the mask of the input data, are not used.
+        output_folder (str): the path to the folder where to place the output
+        aggregation (str): how to aggregate the observations of the voxels in a parcel, either 'mean' or 'median'
+        **fit_model_kwargs: additional keyword arguments for :func:`mdt.fit_model`. Any initialization data provided
+            should be in parcel space, that is, with one value per label.
+
+    Returns:
+        dict: per output map a matrix with one row per label, as ordered in the returned 'labels' element.
+    """
+    from mdt import fit_model
+
+    if isinstance(model, str):
+        model = get_model(model)()
+
+    parcel_data, label_values, nmr_voxels = create_parcel_input_data(input_data, labels, aggregation=aggregation)
+
+    fit_model_kwargs['use_cascaded_inits'] = fit_model_kwargs.get('use_cascaded_inits', False)
+    results = fit_model(model, parcel_data, os.path.join(output_folder, 'parcels'), **fit_model_kwargs)
+    results = create_roi(dict(results), parcel_data.mask)
+
+    _write_parcel_results(results, labels, label_values, nmr_voxels, input_data,
+                          os.path.join(output_folder, model.name), gzip_optimization_results())
+
+    results.update({'labels': label_values, 'nmr_voxels': nmr_voxels})
+    return results
+
+
+def sample_parcels(model, input_data, labels, output_folder, aggregation='mean', **sample_model_kwargs):
+    """Sample a model using the aggregated signal of every parcel in a label volume.
+
+    The samples are stored in ``<output_folder>/parcels/<model>/samples``. The sample mean and standard deviation
+    of every parameter are painted back into the label volume and written, together with the per-label table, to
+    ``<output_folder>/<model>/samples``.
+
+    Args:
+        model (str or :class:`~mdt.models.composite.DMRICompositeModel`): the model to sample
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data object with the voxel-wise data
+        labels (str or ndarray): the label volume (or a filename of a nifti file) with per voxel an integer label.
+        output_folder (str): the path to the folder where to place the output
+        aggregation (str): how to aggregate the observations of the voxels in a parcel, either 'mean' or 'median'
+        **sample_model_kwargs: additional keyword arguments for :func:`mdt.sample_model`.
+
+    Returns:
+        dict: per parameter the samples with one row per label, as ordered in the returned 'labels' element.
+            If no samples are stored, this only contains the labels and the number of voxels per label.
+    """
+    from mdt import sample_model
+
+    if isinstance(model, str):
+        model = get_model(model)()
+
+    parcel_data, label_values, nmr_voxels = create_parcel_input_data(input_data, labels, aggregation=aggregation)
+    samples = sample_model(model, parcel_data, os.path.join(output_folder, 'parcels'), **sample_model_kwargs) or {}
+
+    summary = {}
+    for name, value in samples.items():
+        summary[name] = np.mean(value, axis=1)
+        summary[name + '.std'] = np.std(value, axis=1)
+
+    _write_parcel_results(summary, labels, label_values, nmr_voxels, input_data,
+                          os.path.join(output_folder, model.name, 'samples'), gzip_sampling_results())
+
+    results = dict(samples)
+    results.update({'labels': label_values, 'nmr_voxels': nmr_voxels})
+    return results
+
+
+def create_parcel_input_data(input_data, labels, aggregation='mean'):
+    """Create an input data object with one problem instance per label.
+
+    The returned input data has a signal volume of shape (n, 1, 1, m), with n the number of labels and m the number of
+    observations, and a mask of all ones. Problem instance ``i`` corresponds to the label ``label_values[i]``.
+
+    Voxel-wise noise standard deviations, gradient deviations and volume weights are aggregated per label as well.
+
+    Args:
+        input_data (:class:`~mdt.utils.MRIInputData`): the input data object with the voxel-wise data
+        labels (str or ndarray): the label volume or the filename of a nifti file with the labels.
+        aggregation (str): how to aggregate the observations of the voxels in a parcel, either 'mean' or 'median'
+
+    Returns:
+        tuple: the parcel input data, the label values and the number of voxels per label.
+    """
+    if aggregation not in ('mean', 'median'):
+        raise ValueError('The aggregation method "{}" is not supported, use "mean" or "median".'.format(aggregation))
+
+    labels_roi = create_roi(_load_labels(labels), input_data.mask)
+    voxels_in_parcels = np.where(labels_roi != 0)[0]
+    label_values, label_indices, nmr_voxels = np.unique(labels_roi[voxels_in_parcels],
+                                                        return_inverse=True, return_counts=True)
+
+    logger = logging.getLogger(__name__)
+    logger.info('Aggregating {} voxels into {} parcels using the {}.'.format(
+        len(voxels_in_parcels), len(label_values), aggregation))
+
+    def aggregate(roi_data, method=aggregation):
+        return _aggregate_per_label(roi_data[voxels_in_parcels], label_indices, len(label_values), method)
+
+    def as_volume(parcel_data):
+        return np.reshape(parcel_data, (parcel_data.shape[0], 1, 1) + parcel_data.shape[1:])
+
+    noise_std = input_data.noise_std
+    if is_scalar(noise_std):
+        noise_std = np.full(len(label_values), noise_std, dtype=np.float64)
+    else:
+        noise_std = aggregate(noise_std, method='mean')
+    noise_std = noise_std / np.sqrt(nmr_voxels)
+    if aggregation == 'median':
+        noise_std *= np.sqrt(np.pi / 2)
+
+    updates = {'noise_std': as_volume(noise_std), 'gradient_deviations': None, 'volume_weights': None}
+
+    if input_data.gradient_deviations is not None:
+        updates['gradient_deviations'] = as_volume(aggregate(input_data.gradient_deviations, method='mean'))
+
+    if input_data.volume_weights is not None:
+        updates['volume_weights'] = as_volume(aggregate(input_data.volume_weights.astype(np.float64), method='mean'))
+
+    extra_protocol = {}
+    for name, value in _get_extra_protocol(input_data).items():
+        if not is_scalar(value) and len(np.array(value).shape) >= 3:
+            extra_protocol[name] = as_volume(aggregate(create_roi(value, input_data.mask), method='mean'))
+        else:
+            extra_protocol[name] = value
+
+    parcel_data = input_data.copy_with_updates(
+        input_data.protocol,
+        as_volume(aggregate(input_data.observations.astype(np.float64))),
+        np.ones((len(label_values), 1, 1), dtype=np.bool),
+        input_data.nifti_header,
+        extra_protocol=extra_protocol,
+        **updates)
+
+    return parcel_data, label_values, nmr_voxels
+
+
+def paint_parcel_results(results, labels, label_values, mask=None):
+    """Paint the per-label results back into volumes with the shape of the label volume.
+
+    Args:
+        results (dict): per map a matrix with one row per label
+        labels (str or ndarray): the label volume or the filename of a nifti file with the labels.
+        label_values (ndarray): the label value of every row in the results
+        mask (ndarray): if given, only paint the voxels within this mask
+
+    Returns:
+        dict: per map a volume in which every voxel holds the value of its label. Voxels without a label are zero.
+    """
+    labels = _load_labels(labels)
+    if mask is None:
+        mask = labels != 0
+    mask = load_brain_mask(mask) & np.isin(labels, label_values)
+
+    row_indices = np.searchsorted(label_values, create_roi(labels, mask))
+    return restore_volumes({name: np.asarray(value)[row_indices] for name, value in results.items()}, mask)
+
+
+def _write_parcel_results(results, labels, label_values, nmr_voxels, input_data, output_dir, gzip):
+    """Write the parcel results as a table and as painted volumes."""
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    painted = paint_parcel_results(results, labels, label_values, mask=input_data.mask)
+    write_all_as_nifti(painted, output_dir, nifti_header=input_data.nifti_header, gzip=gzip)
+
+    scalar_maps = sorted(name for name, value in results.items() if np.squeeze(value).ndim <= 1)
+    with open(os.path.join(output_dir, 'parcels.tsv'), 'w') as f:
+        f.write('\t'.join(['label', 'nmr_voxels'] + scalar_maps) + '\n')
+        for ind, label in enumerate(label_values):
+            values = [repr(float(np.atleast_1d(np.squeeze(results[name]))[ind])) for name in scalar_maps]
+            f.write('\t'.join([str(label), str(nmr_voxels[ind])] + values) + '\n')
+
+
+def _aggregate_per_label(roi_data, label_indices, nmr_labels, aggregation):
+    """Aggregate the rows of the given ROI data per label.
+
+    Args:
+        roi_data (ndarray): the data with one row per voxel
+        label_indices (ndarray): per voxel the index of its label
+        nmr_labels (int): the number of labels
+        aggregation (str): 'mean' or 'median'
+
+    Returns:
+        ndarray: the aggregated data with one row per label
+    """
+    sort_index = np.argsort(label_indices, kind='mergesort')
+    sorted_data = roi_data[sort_index]
+    boundaries = np.searchsorted(label_indices[sort_index], np.arange(nmr_labels + 1))
+
+    if aggregation == 'mean':
+        sums = np.add.reduceat(sorted_data, boundaries[:-1], axis=0)
+        counts = np.diff(boundaries).reshape((-1,) + (1,) * (sorted_data.ndim - 1))
+        return sums / counts
+
+    return np.stack([np.median(sorted_data[boundaries[ind]:boundaries[ind + 1]], axis=0)
+                     for ind in range(nmr_labels)])
+
+
+def _get_extra_protocol(input_data):
+    """Get the extra protocol items of the given input data, if any."""
+    if hasattr(input_data, '_get_constructor_args'):
+        return input_data._get_constructor_args()[1].get('extra_protocol', None) or {}
+    return {}
+
+
+def _load_labels(labels):
+    """Load the label volume as a 3d integer array."""
+    if isinstance(labels, str):
+        labels = load_nifti(labels).get_data()
+    labels = np.asarray(labels)
+    if labels.ndim > 3:
+        labels = labels[..., 0]
+    return np.round(labels).astype(np.int64)
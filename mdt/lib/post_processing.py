@@ -1,15 +1,18 @@
 """This module contains various standard post-processing routines for use after optimization or sample."""
+import itertools
+import os
+import re
 import numpy as np
+from scipy.special import dawsn
 
 from mdt.lib.sorting import create_2d_sort_matrix
-from mdt.utils import tensor_spherical_to_cartesian, tensor_cartesian_to_spherical, \
-    voxelwise_vector_matrix_vector_product, create_covariance_matrix
-from mot import minimize
-from mot.lib.cl_function import SimpleCLFunction
-from mot.lib.utils import split_in_batches, parse_cl_function
-from mot.lib.kernel_data import Array, Zeros, Scalar, Struct
-from mdt.lib.components import get_component
-from mot.library_functions import dawson
+from mdt.lib.nifti import load_nifti, nifti_filepath_resolution, write_all_as_nifti
+from mdt.lib.error_propagation import propagate_map_uncertainty
+from mdt.lib.packed_covariances import load_covariance_maps
+from mdt.utils import tensor_spherical_to_cartesian, tensor_cartesian_to_spherical, create_roi, load_brain_mask, \
+    load_volume_maps, restore_volumes
+from mot.lib.utils import split_in_batches
+from mdt.lib.lookup_tables import watson_hindered_diffusion_factor
 
 __author__ = 'Robbert Harms'
 __date__ = '2017-12-10'
@@ -245,12 +248,13 @@ class DTIMeasures:
         Returns:
             ndarray: the standard deviation of the fraction anisotropy using error propagation of the diffusivities.
         """
-        gradient = DTIMeasures._get_fractional_anisotropy_gradient(d, dperp0, dperp1)
-        covars = create_covariance_matrix(
-                {'d.std': d_std, 'dperp0.std': dperp0_std, 'dperp1.std': dperp1_std},
-                ['d', 'dperp0', 'dperp1'], covariances)
-
-        return np.nan_to_num(np.sqrt(voxelwise_vector_matrix_vector_product(gradient, covars, gradient)))
+        std = propagate_map_uncertainty(
+            DTIMeasures.fractional_anisotropy,
+            {'d': d, 'dperp0': dperp0, 'dperp1': dperp1, 'd.std': d_std, 'dperp0.std': dperp0_std,
+             'dperp1.std': dperp1_std},
+            ['d', 'dperp0', 'dperp1'], covariances=covariances or {},
+            jacobian=DTIMeasures._get_fractional_anisotropy_gradient)
+        return np.nan_to_num(std)
 
     @staticmethod
     def _get_fractional_anisotropy_gradient(d, dperp0, dperp1):
@@ -273,24 +277,20 @@ class DTIMeasures:
         Returns:
             ndarray: a 2d vector with the gradient per voxel.
         """
-        np.warnings.simplefilter("ignore")
-
         d, dperp0, dperp1 = (np.squeeze(el).astype(np.float64) for el in [d, dperp0, dperp1])
 
-        gradient = np.stack([
-            (d ** 2 * (dperp0 + dperp1) + 2 * d * dperp0 * dperp1 - dperp0 ** 3
-             - dperp0 ** 2 * dperp1 - dperp0 * dperp1 ** 2 - dperp1 ** 3)
-            / (2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.)
-               * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2)),
-            (-d ** 3 - d ** 2 * dperp1 + d * (dperp0 ** 2 + 2 * dperp0 * dperp1 - dperp1 ** 2) + dperp1 * (
-            dperp0 ** 2 - dperp1 ** 2))
-            / (2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.)
-               * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2)),
-            (-d ** 3 - d ** 2 * dperp0 + d * (
-            -dperp0 ** 2 + 2 * dperp0 * dperp1 + dperp1 ** 2) - dperp0 ** 3 + dperp0 * dperp1 ** 2)
-            / (2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.)
-               * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2))
-        ], axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = 2 * (d ** 2 + dperp0 ** 2 + dperp1 ** 2) ** (3 / 2.) \
+                * np.sqrt(d ** 2 - d * (dperp0 + dperp1) + dperp0 ** 2 - dperp0 * dperp1 + dperp1 ** 2)
+
+            gradient = np.stack([
+                (d ** 2 * (dperp0 + dperp1) + 2 * d * dperp0 * dperp1 - dperp0 ** 3
+                 - dperp0 ** 2 * dperp1 - dperp0 * dperp1 ** 2 - dperp1 ** 3),
+                (-d ** 3 - d ** 2 * dperp1 + d * (dperp0 ** 2 + 2 * dperp0 * dperp1 - dperp1 ** 2)
+                 + dperp1 * (dperp0 ** 2 - dperp1 ** 2)),
+                (-d ** 3 - d ** 2 * dperp0 + d * (-dperp0 ** 2 + 2 * dperp0 * dperp1 + dperp1 ** 2)
+                 - dperp0 ** 3 + dperp0 * dperp1 ** 2)
+            ], axis=-1) / denominator[..., None]
 
         if len(gradient.shape) < 2:
             return gradient[None, :]
@@ -305,7 +305,8 @@ class DTIMeasures:
                 for each voxel either a scalar or a vector.
 
         Returns:
-            tuple: the sorted eigenvalues,
+            tuple: the sorted eigenvalues as a (n, 3) matrix, the sorted eigenvectors as a (3, n, 3) matrix and the
+                (n, 3) ranking matrix used for the sorting.
         """
         eigenvectors = np.stack(tensor_spherical_to_cartesian(np.squeeze(parameters_dict['theta']),
                                                               np.squeeze(parameters_dict['phi']),
@@ -317,10 +318,8 @@ class DTIMeasures:
 
         ranking = np.atleast_2d(np.squeeze(np.argsort(eigenvalues, axis=1, kind='mergesort')[:, ::-1]))
         voxels_range = np.arange(ranking.shape[0])
-        sorted_eigenvalues = np.concatenate([eigenvalues[voxels_range, ranking[:, ind], None]
-                                             for ind in range(ranking.shape[1])], axis=1)
-        sorted_eigenvectors = np.stack([eigenvectors[ranking[:, ind], voxels_range, :]
-                                        for ind in range(ranking.shape[1])])
+        sorted_eigenvalues = eigenvalues[voxels_range[:, None], ranking]
+        sorted_eigenvectors = eigenvectors[ranking.T, voxels_range[None, :]]
 
         return sorted_eigenvalues, sorted_eigenvectors, ranking
 
@@ -331,11 +330,15 @@ class DKIMeasures:
     def extra_optimization_maps(parameters_dict):
         """Calculate DKI statistics like the mean, axial and radial kurtosis.
 
-        The Mean Kurtosis (MK) is calculated by averaging the Kurtosis over orientations on the unit sphere.
-        The Axial Kurtosis (AK) is obtained using the principal direction of diffusion (fe; first eigenvec)
-        from the Tensor as its direction and then averaging the Kurtosis over +fe and -fe.
-        Finally, the Radial Kurtosis (RK) is calculated by averaging the Kurtosis over a circle of directions around
-        the first eigenvec.
+        The Mean Kurtosis (MK) is the average of the apparent Kurtosis over all orientations on the unit sphere.
+        The Axial Kurtosis (AK) is the apparent Kurtosis along the principal direction of diffusion (the first
+        eigenvector) and the Radial Kurtosis (RK) is the average of the apparent Kurtosis over the circle of
+        directions perpendicular to the first eigenvector.
+
+        All three are computed using the analytic solutions of Tabesh et al. [1], which express these averages in
+        terms of the eigenvalues of the diffusion Tensor and the elements of the Kurtosis tensor rotated to the
+        eigenvector frame. For (nearly) equal eigenvalues, where these solutions are numerically unstable, we
+        extrapolate from slightly separated eigenvalues, with a relative error below 1e-4.
 
         Args:
             parameters_dict (dict): the fitted Kurtosis parameters, this requires a dictionary with at least
@@ -346,400 +349,188 @@ class DKIMeasures:
 
         Returns:
             dict: maps for the Mean Kurtosis (MK), Axial Kurtosis (AK) and Radial Kurtosis (RK).
+
+        References:
+            1. Tabesh A, Jensen JH, Ardekani BA, Helpern JA. Estimation of tensors and tensor-derived measures in
+                diffusional kurtosis imaging. Magn Reson Med. 2011;65(3):823-836. doi:10.1002/mrm.22655.
         """
-        param_names = ['d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi', 'W_0000', 'W_1000', 'W_1100', 'W_1110',
-                       'W_1111', 'W_2000', 'W_2100', 'W_2110', 'W_2111', 'W_2200', 'W_2210', 'W_2211',
-                       'W_2220', 'W_2221', 'W_2222']
+        eigenvalues, eigenvectors, _ = DTIMeasures._sort_eigensystem(parameters_dict)
+        rotated_kurtosis = DKIMeasures._get_rotated_kurtosis_elements(
+            DKIMeasures._get_kurtosis_tensor(parameters_dict), eigenvectors)
 
-        parameters = np.column_stack([parameters_dict[n] for n in param_names])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_kurtosis = np.sum(DKIMeasures._get_mean_kurtosis_coefficients(eigenvalues) * rotated_kurtosis, axis=1)
 
-        nmr_voxels = parameters.shape[0]
-        kernel_data = {'parameters': Array(parameters, ctype='mot_float_type'),
-                       'directions': Array(DKIMeasures._get_spherical_samples(), ctype='float4',
-                                           offset_str='0'),
-                       'nmr_directions': Scalar(DKIMeasures._get_spherical_samples().shape[0]),
-                       'nmr_radial_directions': Scalar(256),
-                       'mks': Zeros((nmr_voxels,), ctype='float'),
-                       'aks': Zeros((nmr_voxels,), ctype='float'),
-                       'rks': Zeros((nmr_voxels,), ctype='float')}
+            l1, l2, l3 = eigenvalues.T
+            axial_kurtosis = ((l1 + l2 + l3) / (3 * l1)) ** 2 * rotated_kurtosis[:, 0]
 
-        DKIMeasures._get_compute_function(param_names).evaluate(kernel_data, nmr_voxels)
+            sqrt_l2, sqrt_l3 = np.sqrt(l2), np.sqrt(l3)
+            radial_kurtosis = (l1 + l2 + l3) ** 2 * (
+                (2 * sqrt_l2 + sqrt_l3) / (18 * l2 * sqrt_l2 * (sqrt_l2 + sqrt_l3) ** 2) * rotated_kurtosis[:, 1]
+                + (2 * sqrt_l3 + sqrt_l2) / (18 * l3 * sqrt_l3 * (sqrt_l2 + sqrt_l3) ** 2) * rotated_kurtosis[:, 2]
+                + 1 / (3 * sqrt_l2 * sqrt_l3 * (sqrt_l2 + sqrt_l3) ** 2) * rotated_kurtosis[:, 5])
 
-        return {'MK': kernel_data['mks'].get_data(),
-                'AK': kernel_data['aks'].get_data(),
-                'RK': kernel_data['rks'].get_data()}
+        return {'MK': np.clip(np.nan_to_num(mean_kurtosis), 0, 3),
+                'AK': np.clip(np.nan_to_num(axial_kurtosis), 0, 10),
+                'RK': np.maximum(np.nan_to_num(radial_kurtosis), 0)}
 
     @staticmethod
-    def _get_compute_function(param_names):
-        def get_param_cl_ref(param_name):
-            return 'parameters[{}]'.format(param_names.index(param_name))
-
-        param_expansions = ['mot_float_type {} = params[{}];'.format(name, ind) for ind, name in enumerate(param_names)]
-
-        return parse_cl_function('''
-            double apparent_kurtosis(
-                    global mot_float_type* params,
-                    float4 direction,
-                    float4 vec0,
-                    float4 vec1,
-                    float4 vec2){
-
-                ''' + '\n'.join(param_expansions) + '''
-
-                double adc = d *      pown(dot(vec0, direction), 2) +
-                             dperp0 * pown(dot(vec1, direction), 2) +
-                             dperp1 * pown(dot(vec2, direction), 2);
-
-                double tensor_md = (d + dperp0 + dperp1) / 3.0;
-
-                double kurtosis_sum = KurtosisMultiplication(
-                    W_0000, W_1111, W_2222, W_1000, W_2000, W_1110,
-                    W_2220, W_2111, W_2221, W_1100, W_2200, W_2211,
-                    W_2100, W_2110, W_2210, direction);
-
-                return pown(tensor_md / adc, 2) * kurtosis_sum;
-            }
-        
-            void get_principal_and_perpendicular_eigenvector(
-                    mot_float_type d,
-                    mot_float_type dperp0,
-                    mot_float_type dperp1,
-                    float4* vec0,
-                    float4* vec1,
-                    float4* vec2,
-                    float4** principal_vec,
-                    float4** perpendicular_vec){
-
-                if(d >= dperp0 && d >= dperp1){
-                    *principal_vec = vec0;
-                    *perpendicular_vec = vec1;
-                }
-                if(dperp0 >= d && dperp0 >= dperp1){
-                    *principal_vec = vec1;
-                    *perpendicular_vec = vec0;
-                }
-                *principal_vec = vec2;
-                *perpendicular_vec = vec0;
-            }
-        
-            void calculate_measures(global mot_float_type* parameters, 
-                                    global float4* directions,
-                                    uint nmr_directions,
-                                    uint nmr_radial_directions,
-                                    global float* mks,
-                                    global float* aks,
-                                    global float* rks){
-                int i, j;
-
-                float4 vec0, vec1, vec2;
-                TensorSphericalToCartesian(
-                    ''' + get_param_cl_ref('theta') + ''',
-                    ''' + get_param_cl_ref('phi') + ''',
-                    ''' + get_param_cl_ref('psi') + ''',
-                    &vec0, &vec1, &vec2);
-
-                float4* principal_vec;
-                float4* perpendicular_vec;
-                get_principal_and_perpendicular_eigenvector(
-                    ''' + get_param_cl_ref('d') + ''',
-                    ''' + get_param_cl_ref('dperp0') + ''',
-                    ''' + get_param_cl_ref('dperp1') + ''',
-                    &vec0, &vec1, &vec2,
-                    &principal_vec, &perpendicular_vec);
-
-                // Mean Kurtosis integrated over a set of directions
-                double mean = 0;
-                for(i = 0; i < nmr_directions; i++){
-                    mean += apparent_kurtosis(parameters, directions[i], vec0, vec1, vec2);
-                }
-                *(mks) = clamp(mean / nmr_directions, 0.0, 3.0);
-
-
-                // Axial Kurtosis over the principal direction of diffusion
-                *(aks) = clamp(apparent_kurtosis(parameters, *principal_vec, vec0, vec1, vec2), 0.0, 10.0);
-
-
-                // Radial Kurtosis integrated over a unit circle around the principal eigenvector.
-                mean = 0;
-                float4 rotated_vec;
-                for(i = 0; i < nmr_radial_directions; i++){
-                    rotated_vec = RotateOrthogonalVector(*principal_vec, *perpendicular_vec,
-                                                         i * (2 * M_PI_F) / nmr_radial_directions);
-
-                    mean += (apparent_kurtosis(parameters, rotated_vec, vec0, vec1, vec2) - mean) / (i + 1);
-                }
-                *(rks) = max(mean, 0.0);
-            }
-        ''', dependencies=[get_component('library_functions', 'RotateOrthogonalVector')(),
-                           get_component('library_functions', 'TensorSphericalToCartesian')(),
-                           get_component('library_functions', 'KurtosisMultiplication')()])
+    def _get_kurtosis_tensor(parameters_dict):
+        """Get the full, symmetric, (n, 3, 3, 3, 3) Kurtosis tensor from the 15 independent elements.
+
+        Args:
+            parameters_dict (dict): the dictionary with the independent elements 'W_0000', 'W_1000', etc.
+
+        Returns:
+            ndarray: the full Kurtosis tensor per voxel
+        """
+        elements = {name: np.reshape(parameters_dict[name], (-1,)).astype(np.float64)
+                    for name in parameters_dict if re.match(r'^W_\d{4}$', name)}
+        nmr_voxels = elements['W_0000'].shape[0]
+
+        tensor = np.zeros((nmr_voxels, 3, 3, 3, 3))
+        for name, values in elements.items():
+            for index in set(itertools.permutations(int(el) for el in name[2:])):
+                tensor[(slice(None),) + index] = values
+        return tensor
+
+    @staticmethod
+    def _get_rotated_kurtosis_elements(kurtosis_tensor, eigenvectors):
+        """Get the elements of the Kurtosis tensor in the frame of the eigenvectors, used in the analytic solutions.
+
+        Args:
+            kurtosis_tensor (ndarray): the (n, 3, 3, 3, 3) Kurtosis tensors
+            eigenvectors (ndarray): the (3, n, 3) eigenvectors, sorted by decreasing eigenvalue
+
+        Returns:
+            ndarray: a (n, 6) matrix with per voxel the rotated elements W_1111, W_2222, W_3333, W_1122, W_1133 and
+                W_2233, with the indices referring to the sorted eigenvectors.
+        """
+        contracted = [np.einsum('nijkl,nk,nl->nij', kurtosis_tensor, vector, vector) for vector in eigenvectors]
+
+        def rotated_element(first, second):
+            return np.einsum('nij,ni,nj->n', contracted[second], eigenvectors[first], eigenvectors[first])
+
+        return np.stack([rotated_element(0, 0), rotated_element(1, 1), rotated_element(2, 2),
+                         rotated_element(0, 1), rotated_element(0, 2), rotated_element(1, 2)], axis=1)
 
     @staticmethod
-    def _get_spherical_samples():
-        """Get a number of 3d coordinates mapping an unit sphere.
+    def _get_mean_kurtosis_coefficients(eigenvalues, minimum_separation=1e-4):
+        """Get the coefficients of the rotated Kurtosis elements in the analytic solution of the Mean Kurtosis.
 
-        List taken from "dki_parameters.m" by Jelle Veraart
-        (https://github.com/NYU-DiffusionMRI/Diffusion-Kurtosis-Imaging/blob/master/dki_parameters.m).
+        The analytic solution is singular if two or more eigenvalues are equal, even though the limit exists. For the
+        voxels with eigenvalues closer than the given relative separation, we evaluate the solution at eigenvalues
+        separated by once and twice this separation and extrapolate linearly to the original eigenvalues.
+
+        Args:
+            eigenvalues (ndarray): the (n, 3) eigenvalues, sorted in decreasing order
+            minimum_separation (float): the minimum relative separation between the eigenvalues
 
         Returns:
-            ndarray: a list of 3d coordinates mapping an unit sphere.
+            ndarray: a (n, 6) matrix with the coefficients of the elements returned by
+                :meth:`_get_rotated_kurtosis_elements`.
         """
-        return np.array([[0, 0, 1.0000],
-                         [0.5924, 0, 0.8056],
-                         [-0.7191, -0.1575, -0.6768],
-                         [-0.9151, -0.3479, 0.2040],
-                         [0.5535, 0.2437, 0.7964],
-                         [-0.0844, 0.9609, -0.2636],
-                         [0.9512, -0.3015, 0.0651],
-                         [-0.4225, 0.8984, 0.1202],
-                         [0.5916, -0.6396, 0.4909],
-                         [0.3172, 0.8818, -0.3489],
-                         [-0.1988, -0.6687, 0.7164],
-                         [-0.2735, 0.3047, -0.9123],
-                         [0.9714, -0.1171, 0.2066],
-                         [-0.5215, -0.4013, 0.7530],
-                         [-0.3978, -0.9131, -0.0897],
-                         [0.2680, 0.8196, 0.5063],
-                         [-0.6824, -0.6532, -0.3281],
-                         [0.4748, -0.7261, -0.4973],
-                         [0.4504, -0.4036, 0.7964],
-                         [-0.5551, -0.8034, -0.2153],
-                         [0.0455, -0.2169, 0.9751],
-                         [0.0483, 0.5845, 0.8099],
-                         [-0.1909, -0.1544, -0.9694],
-                         [0.8383, 0.5084, 0.1969],
-                         [-0.2464, 0.1148, 0.9623],
-                         [-0.7458, 0.6318, 0.2114],
-                         [-0.0080, -0.9831, -0.1828],
-                         [-0.2630, 0.5386, -0.8005],
-                         [-0.0507, 0.6425, -0.7646],
-                         [0.4476, -0.8877, 0.1081],
-                         [-0.5627, 0.7710, 0.2982],
-                         [-0.3790, 0.7774, -0.5020],
-                         [-0.6217, 0.4586, -0.6350],
-                         [-0.1506, 0.8688, -0.4718],
-                         [-0.4579, 0.2131, 0.8631],
-                         [-0.8349, -0.2124, 0.5077],
-                         [0.7682, -0.1732, -0.6163],
-                         [0.0997, -0.7168, -0.6901],
-                         [0.0386, -0.2146, -0.9759],
-                         [0.9312, 0.1655, -0.3249],
-                         [0.9151, 0.3053, 0.2634],
-                         [0.8081, 0.5289, -0.2593],
-                         [-0.3632, -0.9225, 0.1305],
-                         [0.2709, -0.3327, -0.9033],
-                         [-0.1942, -0.9790, -0.0623],
-                         [0.6302, -0.7641, 0.1377],
-                         [-0.6948, -0.3137, 0.6471],
-                         [-0.6596, -0.6452, 0.3854],
-                         [-0.9454, 0.2713, 0.1805],
-                         [-0.2586, -0.7957, 0.5477],
-                         [-0.3576, 0.6511, 0.6695],
-                         [-0.8490, -0.5275, 0.0328],
-                         [0.3830, 0.2499, -0.8893],
-                         [0.8804, -0.2392, -0.4095],
-                         [0.4321, -0.4475, -0.7829],
-                         [-0.5821, -0.1656, 0.7961],
-                         [0.3963, 0.6637, 0.6344],
-                         [-0.7222, -0.6855, -0.0929],
-                         [0.2130, -0.9650, -0.1527],
-                         [0.4737, 0.7367, -0.4825],
-                         [-0.9956, 0.0891, 0.0278],
-                         [-0.5178, 0.7899, -0.3287],
-                         [-0.8906, 0.1431, -0.4317],
-                         [0.2431, -0.9670, 0.0764],
-                         [-0.6812, -0.3807, -0.6254],
-                         [-0.1091, -0.5141, 0.8507],
-                         [-0.2206, 0.7274, -0.6498],
-                         [0.8359, 0.2674, 0.4794],
-                         [0.9873, 0.1103, 0.1147],
-                         [0.7471, 0.0659, -0.6615],
-                         [0.6119, -0.2508, 0.7502],
-                         [-0.6191, 0.0776, 0.7815],
-                         [0.7663, -0.4739, 0.4339],
-                         [-0.5699, 0.5369, 0.6220],
-                         [0.0232, -0.9989, 0.0401],
-                         [0.0671, -0.4207, -0.9047],
-                         [-0.2145, 0.5538, 0.8045],
-                         [0.8554, -0.4894, 0.1698],
-                         [-0.7912, -0.4194, 0.4450],
-                         [-0.2341, 0.0754, -0.9693],
-                         [-0.7725, 0.6346, -0.0216],
-                         [0.0228, 0.7946, -0.6067],
-                         [0.7461, -0.3966, -0.5348],
-                         [-0.4045, -0.0837, -0.9107],
-                         [-0.4364, 0.6084, -0.6629],
-                         [0.6177, -0.3175, -0.7195],
-                         [-0.4301, -0.0198, 0.9026],
-                         [-0.1489, -0.9706, 0.1892],
-                         [0.0879, 0.9070, -0.4117],
-                         [-0.7764, -0.4707, -0.4190],
-                         [0.9850, 0.1352, -0.1073],
-                         [-0.1581, -0.3154, 0.9357],
-                         [0.8938, -0.3246, 0.3096],
-                         [0.8358, -0.4464, -0.3197],
-                         [0.4943, 0.4679, 0.7327],
-                         [-0.3095, 0.9015, -0.3024],
-                         [-0.3363, -0.8942, -0.2956],
-                         [-0.1271, -0.9274, -0.3519],
-                         [0.3523, -0.8717, -0.3407],
-                         [0.7188, -0.6321, 0.2895],
-                         [-0.7447, 0.0924, -0.6610],
-                         [0.1622, 0.7186, 0.6762],
-                         [-0.9406, -0.0829, -0.3293],
-                         [-0.1229, 0.9204, 0.3712],
-                         [-0.8802, 0.4668, 0.0856],
-                         [-0.2062, -0.1035, 0.9730],
-                         [-0.4861, -0.7586, -0.4338],
-                         [-0.6138, 0.7851, 0.0827],
-                         [0.8476, 0.0504, 0.5282],
-                         [0.3236, 0.4698, -0.8213],
-                         [-0.7053, -0.6935, 0.1473],
-                         [0.1511, 0.3778, 0.9135],
-                         [0.6011, 0.5847, 0.5448],
-                         [0.3610, 0.3183, 0.8766],
-                         [0.9432, 0.3304, 0.0341],
-                         [0.2423, -0.8079, -0.5372],
-                         [0.4431, -0.1578, 0.8825],
-                         [0.6204, 0.5320, -0.5763],
-                         [-0.2806, -0.5376, -0.7952],
-                         [-0.5279, -0.8071, 0.2646],
-                         [-0.4214, -0.6159, 0.6656],
-                         [0.6759, -0.5995, -0.4288],
-                         [0.5670, 0.8232, -0.0295],
-                         [-0.0874, 0.4284, -0.8994],
-                         [0.8780, -0.0192, -0.4782],
-                         [0.0166, 0.8421, 0.5391],
-                         [-0.7741, 0.2931, -0.5610],
-                         [0.9636, -0.0579, -0.2611],
-                         [0, 0, -1.0000],
-                         [-0.5924, 0, -0.8056],
-                         [0.7191, 0.1575, 0.6768],
-                         [0.9151, 0.3479, -0.2040],
-                         [-0.5535, -0.2437, -0.7964],
-                         [0.0844, -0.9609, 0.2636],
-                         [-0.9512, 0.3015, -0.0651],
-                         [0.4225, -0.8984, -0.1202],
-                         [-0.5916, 0.6396, -0.4909],
-                         [-0.3172, -0.8818, 0.3489],
-                         [0.1988, 0.6687, -0.7164],
-                         [0.2735, -0.3047, 0.9123],
-                         [-0.9714, 0.1171, -0.2066],
-                         [0.5215, 0.4013, -0.7530],
-                         [0.3978, 0.9131, 0.0897],
-                         [-0.2680, -0.8196, -0.5063],
-                         [0.6824, 0.6532, 0.3281],
-                         [-0.4748, 0.7261, 0.4973],
-                         [-0.4504, 0.4036, -0.7964],
-                         [0.5551, 0.8034, 0.2153],
-                         [-0.0455, 0.2169, -0.9751],
-                         [-0.0483, -0.5845, -0.8099],
-                         [0.1909, 0.1544, 0.9694],
-                         [-0.8383, -0.5084, -0.1969],
-                         [0.2464, -0.1148, -0.9623],
-                         [0.7458, -0.6318, -0.2114],
-                         [0.0080, 0.9831, 0.1828],
-                         [0.2630, -0.5386, 0.8005],
-                         [0.0507, -0.6425, 0.7646],
-                         [-0.4476, 0.8877, -0.1081],
-                         [0.5627, -0.7710, -0.2982],
-                         [0.3790, -0.7774, 0.5020],
-                         [0.6217, -0.4586, 0.6350],
-                         [0.1506, -0.8688, 0.4718],
-                         [0.4579, -0.2131, -0.8631],
-                         [0.8349, 0.2124, -0.5077],
-                         [-0.7682, 0.1732, 0.6163],
-                         [-0.0997, 0.7168, 0.6901],
-                         [-0.0386, 0.2146, 0.9759],
-                         [-0.9312, -0.1655, 0.3249],
-                         [-0.9151, -0.3053, -0.2634],
-                         [-0.8081, -0.5289, 0.2593],
-                         [0.3632, 0.9225, -0.1305],
-                         [-0.2709, 0.3327, 0.9033],
-                         [0.1942, 0.9790, 0.0623],
-                         [-0.6302, 0.7641, -0.1377],
-                         [0.6948, 0.3137, -0.6471],
-                         [0.6596, 0.6452, -0.3854],
-                         [0.9454, -0.2713, -0.1805],
-                         [0.2586, 0.7957, -0.5477],
-                         [0.3576, -0.6511, -0.6695],
-                         [0.8490, 0.5275, -0.0328],
-                         [-0.3830, -0.2499, 0.8893],
-                         [-0.8804, 0.2392, 0.4095],
-                         [-0.4321, 0.4475, 0.7829],
-                         [0.5821, 0.1656, -0.7961],
-                         [-0.3963, -0.6637, -0.6344],
-                         [0.7222, 0.6855, 0.0929],
-                         [-0.2130, 0.9650, 0.1527],
-                         [-0.4737, -0.7367, 0.4825],
-                         [0.9956, -0.0891, -0.0278],
-                         [0.5178, -0.7899, 0.3287],
-                         [0.8906, -0.1431, 0.4317],
-                         [-0.2431, 0.9670, -0.0764],
-                         [0.6812, 0.3807, 0.6254],
-                         [0.1091, 0.5141, -0.8507],
-                         [0.2206, -0.7274, 0.6498],
-                         [-0.8359, -0.2674, -0.4794],
-                         [-0.9873, -0.1103, -0.1147],
-                         [-0.7471, -0.0659, 0.6615],
-                         [-0.6119, 0.2508, -0.7502],
-                         [0.6191, -0.0776, -0.7815],
-                         [-0.7663, 0.4739, -0.4339],
-                         [0.5699, -0.5369, -0.6220],
-                         [-0.0232, 0.9989, -0.0401],
-                         [-0.0671, 0.4207, 0.9047],
-                         [0.2145, -0.5538, -0.8045],
-                         [-0.8554, 0.4894, -0.1698],
-                         [0.7912, 0.4194, -0.4450],
-                         [0.2341, -0.0754, 0.9693],
-                         [0.7725, -0.6346, 0.0216],
-                         [-0.0228, -0.7946, 0.6067],
-                         [-0.7461, 0.3966, 0.5348],
-                         [0.4045, 0.0837, 0.9107],
-                         [0.4364, -0.6084, 0.6629],
-                         [-0.6177, 0.3175, 0.7195],
-                         [0.4301, 0.0198, -0.9026],
-                         [0.1489, 0.9706, -0.1892],
-                         [-0.0879, -0.9070, 0.4117],
-                         [0.7764, 0.4707, 0.4190],
-                         [-0.9850, -0.1352, 0.1073],
-                         [0.1581, 0.3154, -0.9357],
-                         [-0.8938, 0.3246, -0.3096],
-                         [-0.8358, 0.4464, 0.3197],
-                         [-0.4943, -0.4679, -0.7327],
-                         [0.3095, -0.9015, 0.3024],
-                         [0.3363, 0.8942, 0.2956],
-                         [0.1271, 0.9274, 0.3519],
-                         [-0.3523, 0.8717, 0.3407],
-                         [-0.7188, 0.6321, -0.2895],
-                         [0.7447, -0.0924, 0.6610],
-                         [-0.1622, -0.7186, -0.6762],
-                         [0.9406, 0.0829, 0.3293],
-                         [0.1229, -0.9204, -0.3712],
-                         [0.8802, -0.4668, -0.0856],
-                         [0.2062, 0.1035, -0.9730],
-                         [0.4861, 0.7586, 0.4338],
-                         [0.6138, -0.7851, -0.0827],
-                         [-0.8476, -0.0504, -0.5282],
-                         [-0.3236, -0.4698, 0.8213],
-                         [0.7053, 0.6935, -0.1473],
-                         [-0.1511, -0.3778, -0.9135],
-                         [-0.6011, -0.5847, -0.5448],
-                         [-0.3610, -0.3183, -0.8766],
-                         [-0.9432, -0.3304, -0.0341],
-                         [-0.2423, 0.8079, 0.5372],
-                         [-0.4431, 0.1578, -0.8825],
-                         [-0.6204, -0.5320, 0.5763],
-                         [0.2806, 0.5376, 0.7952],
-                         [0.5279, 0.8071, -0.2646],
-                         [0.4214, 0.6159, -0.6656],
-                         [-0.6759, 0.5995, 0.4288],
-                         [-0.5670, -0.8232, 0.0295],
-                         [0.0874, -0.4284, 0.8994],
-                         [-0.8780, 0.0192, 0.4782],
-                         [-0.0166, -0.8421, -0.5391],
-                         [0.7741, -0.2931, 0.5610],
-                         [-0.9636, 0.0579, 0.2611]])
+        def separated(eigenvalues, separation):
+            l1 = eigenvalues[:, 0]
+            l2 = np.minimum(eigenvalues[:, 1], l1 * (1 - separation))
+            l3 = np.minimum(eigenvalues[:, 2], l2 * (1 - separation))
+            return l1, l2, l3
+
+        def coefficients(l1, l2, l3):
+            return np.stack([_tabesh_f1(l1, l2, l3), _tabesh_f1(l2, l1, l3), _tabesh_f1(l3, l2, l1),
+                             _tabesh_f2(l3, l2, l1), _tabesh_f2(l2, l1, l3), _tabesh_f2(l1, l2, l3)], axis=1)
+
+        eigenvalues = eigenvalues.astype(np.float64)
+        degenerate = np.any(eigenvalues[:, 1:] > eigenvalues[:, :-1] * (1 - minimum_separation), axis=1)
+
+        result = coefficients(*eigenvalues.T)
+        if np.any(degenerate):
+            result[degenerate] = (2 * coefficients(*separated(eigenvalues[degenerate], minimum_separation))
+                                  - coefficients(*separated(eigenvalues[degenerate], 2 * minimum_separation)))
+        return result
+
+
+def _tabesh_f1(l1, l2, l3):
+    """The function F1 in the analytic solution of the Mean Kurtosis in Tabesh et al. (2011)."""
+    rf = _carlson_rf(l1 / l2, l1 / l3, 1)
+    rd = _carlson_rd(l1 / l2, l1 / l3, 1)
+    return (l1 + l2 + l3) ** 2 / (18 * (l1 - l2) * (l1 - l3)) * (
+        np.sqrt(l2 * l3) / l1 * rf
+        + (3 * l1 ** 2 - l1 * l2 - l1 * l3 - l2 * l3) / (3 * l1 * np.sqrt(l2 * l3)) * rd - 1)
+
+
+def _tabesh_f2(l1, l2, l3):
+    """The function F2 in the analytic solution of the Mean Kurtosis in Tabesh et al. (2011)."""
+    rf = _carlson_rf(l1 / l2, l1 / l3, 1)
+    rd = _carlson_rd(l1 / l2, l1 / l3, 1)
+    return (l1 + l2 + l3) ** 2 / (3 * (l2 - l3) ** 2) * (
+        (l2 + l3) / np.sqrt(l2 * l3) * rf + (2 * l1 - l2 - l3) / (3 * np.sqrt(l2 * l3)) * rd - 2)
+
+
+def _carlson_rf(x, y, z, tolerance=1e-4):
+    """Carlson's elliptic integral of the first kind, R_F(x, y, z), for non-negative inputs.
+
+    This uses the duplication algorithm of Carlson (1995), vectorized over the inputs.
+
+    Args:
+        x, y, z (ndarray): the inputs, broadcastable to the same shape
+        tolerance (float): the relative tolerance at which the duplication stops, the relative error of the
+            result is of the order of this tolerance to the power of six.
+
+    Returns:
+        ndarray: the values of the integral
+    """
+    x, y, z = (np.array(el, dtype=np.float64) for el in np.broadcast_arrays(x, y, z))
+    while True:
+        mean = (x + y + z) / 3
+        dx, dy = 1 - x / mean, 1 - y / mean
+        dz = -dx - dy
+        if not np.any(np.maximum(np.maximum(np.abs(dx), np.abs(dy)), np.abs(dz)) >= tolerance):
+            break
+        sqrt_x, sqrt_y, sqrt_z = np.sqrt(x), np.sqrt(y), np.sqrt(z)
+        multiplier = sqrt_x * sqrt_y + sqrt_x * sqrt_z + sqrt_y * sqrt_z
+        x, y, z = (x + multiplier) / 4, (y + multiplier) / 4, (z + multiplier) / 4
+
+    e2 = dx * dy - dz ** 2
+    e3 = dx * dy * dz
+    return (1 - e2 / 10. + e3 / 14. + e2 ** 2 / 24. - 3 * e2 * e3 / 44.) / np.sqrt(mean)
+
+
+def _carlson_rd(x, y, z, tolerance=1e-4):
+    """Carlson's elliptic integral of the second kind, R_D(x, y, z), for non-negative inputs.
+
+    This uses the duplication algorithm of Carlson (1995), vectorized over the inputs.
+
+    Args:
+        x, y, z (ndarray): the inputs, broadcastable to the same shape
+        tolerance (float): the relative tolerance at which the duplication stops, the relative error of the
+            result is of the order of this tolerance to the power of six.
+
+    Returns:
+        ndarray: the values of the integral
+    """
+    x, y, z = (np.array(el, dtype=np.float64) for el in np.broadcast_arrays(x, y, z))
+    summation = np.zeros_like(x)
+    factor = 1.
+    while True:
+        mean = (x + y + 3 * z) / 5
+        dx, dy, dz = 1 - x / mean, 1 - y / mean, 1 - z / mean
+        if not np.any(np.maximum(np.maximum(np.abs(dx), np.abs(dy)), np.abs(dz)) >= tolerance):
+            break
+        sqrt_x, sqrt_y, sqrt_z = np.sqrt(x), np.sqrt(y), np.sqrt(z)
+        multiplier = sqrt_x * sqrt_y + sqrt_x * sqrt_z + sqrt_y * sqrt_z
+        summation += factor / (sqrt_z * (z + multiplier))
+        factor /= 4
+        x, y, z = (x + multiplier) / 4, (y + multiplier) / 4, (z + multiplier) / 4
+
+    ea = dx * dy
+    eb = dz ** 2
+    ec = ea - eb
+    ed = ea - 6 * eb
+    ee = ed + 2 * ec
+    return 3 * summation + factor * (
+        1 + ed * (-3 / 14. + 9 / 88. * ed - 9 / 52. * dz * ee)
+        + dz * (ee / 6. + dz * (-9 / 22. * ec + dz * 3 / 26. * ea))) / (mean * np.sqrt(mean))
 
 
 class NODDIMeasures:
@@ -829,7 +620,8 @@ def noddi_dti_maps(results):
 
             - FA (ndarray): if computed already, the Fractional Anisotropy of the given diffusivities
             - MD (ndarray): if computed already, the Mean Diffusivity of the given diffusivities
-            - MK (ndarray): if computing for Kurtosis, the computed Mean Kurtosis. If not given, we assume unity.
+            - MK (ndarray): if computing for Kurtosis, the computed Mean Kurtosis. If not given, we compute it from
+                the Kurtosis elements, if present, else we assume unity.
 
     Returns:
         dict: maps for the the NODDI-DTI, NDI and ODI measures.
@@ -865,7 +657,11 @@ def noddi_dti_maps(results):
 
         sum = (d ** 2 + dperp0 ** 2 + dperp1 ** 2) / 5 + 2 * (d * dperp0 + d * dperp1 + dperp0 * dperp1) / 15
 
-        MD += ((b / 6) * sum) * results.get('MK', 1)
+        MK = results.get('MK', 1)
+        if 'MK' not in results and 'W_0000' in results:
+            MK = DKIMeasures.extra_optimization_maps(results)['MK']
+
+        MD += ((b / 6) * sum) * MK
 
     ndi = 1 - np.sqrt(0.5 * ((3 * MD) / noddi_d - 1))
     ndi = np.clip(np.nan_to_num(ndi), 0, 1)
@@ -874,7 +670,14 @@ def noddi_dti_maps(results):
 
 
 def _tau_to_kappa(tau):
-    """Using non-linear optimization, convert the NODDI-DTI Tau variables to NODDI kappa's.
+    """Convert the NODDI-DTI Tau variables to NODDI kappa's.
+
+    The relation between tau and kappa, ``tau = (sqrt(kappa) / dawson(sqrt(kappa)) - 1) / (2 * kappa)``, increases
+    monotonically from 1/3 at a kappa of zero towards 1 for large kappa's. We invert this relation for all voxels
+    at once, using linear interpolation in a dense table of the relation followed by one Newton iteration.
+
+    Kappa's larger than 64 are set to 1, as are the tau's for which no kappa exists. Tau's of 1/3 and lower
+    correspond to an isotropic distribution and are set to zero.
 
     Args:
         tau (ndarray): the list of tau's per voxel.
@@ -882,24 +685,105 @@ def _tau_to_kappa(tau):
     Returns:
         ndarray: the list of corresponding kappa's
     """
-    tau_func = SimpleCLFunction.from_string('''
-        double tau(double kappa){
-            if(kappa < 1e-12){
-                return 1/3.0;
-            }
-            return 0.5 * ( 1 / ( sqrt(kappa) * dawson(sqrt(kappa) ) ) - 1/kappa);
-        }''', dependencies=[dawson()])
-
-    objective_func = SimpleCLFunction.from_string('''
-        double tau_to_kappa(local const mot_float_type* const x, void* data, local mot_float_type* objective_list){
-            return pown(tau(x[0]) - ((_tau_to_kappa_data*)data)->tau, 2); 
-        }
-    ''', dependencies=[tau_func])
+    max_kappa = 64
+    sqrt_kappa_nodes = np.linspace(0, np.sqrt(max_kappa), 1025)
+    tau_nodes = watson_hindered_diffusion_factor(sqrt_kappa_nodes ** 2)
+
+    tau = np.asarray(tau, dtype=np.float64)
+    kappa = np.interp(tau, tau_nodes, sqrt_kappa_nodes) ** 2
 
-    kappa = minimize(objective_func, np.ones_like(tau),
-                     data=Struct({'tau': Array(tau, 'mot_float_type', as_scalar=True)},
-                                 '_tau_to_kappa_data')).x
-    kappa[kappa > 64] = 1
-    kappa[kappa < 0] = 1
+    newton_step = (watson_hindered_diffusion_factor(kappa.flatten()) - tau.flatten()) \
+        / _tau_to_kappa_derivative(kappa.flatten())
+    kappa = np.clip(kappa - np.reshape(newton_step, kappa.shape), 0, None)
+
+    kappa[tau >= tau_nodes[-1]] = 1
     return kappa
 
+
+def _tau_to_kappa_derivative(kappa):
+    """The derivative of tau with respect to kappa, used for the Newton iteration in :func:`_tau_to_kappa`.
+
+    Args:
+        kappa (ndarray): a vector of kappa's
+
+    Returns:
+        ndarray: the derivative of tau at every kappa
+    """
+    derivative = np.full_like(kappa, 4 / 45.)
+
+    large = kappa > 1e-3
+    sqrt_kappa = np.sqrt(kappa[large])
+    dawson = dawsn(sqrt_kappa)
+    derivative[large] = (1 / (2 * kappa[large] ** 2)
+                         - (dawson + sqrt_kappa - 2 * kappa[large] * dawson) / (4 * sqrt_kappa ** 3 * dawson ** 2))
+    return derivative
+
+
+def compute_tensor_maps(results_folder, compartment_name=None, output_folder=None, batch_size=10000):
+    """Recompute the DTI and DKI measures from the Tensor or Kurtosis maps in an existing output folder.
+
+    This computes the maps of :meth:`DTIMeasures.extra_optimization_maps` and, if the Kurtosis elements are present,
+    of :meth:`DKIMeasures.extra_optimization_maps` on the CPU, in batches of voxels to bound the memory usage. The
+    computation is limited to the voxels in the ``UsedMask`` of the results folder, if present. If the standard
+    deviations and the covariances of the diffusivities are present, we also compute the standard deviations.
+
+    Args:
+        results_folder (str): the folder with the output maps of a model, for example ``<output>/Kurtosis``
+        compartment_name (str): the name of the Tensor-like compartment in the results. If not given, we use the
+            single compartment with the maps ``d``, ``dperp0`` and ``dperp1`` in the results folder.
+        output_folder (str): the folder to write the maps to, defaults to the results folder
+        batch_size (int): the number of voxels to process at once
+
+    Returns:
+        dict: the computed maps as volumes, named as ``<compartment_name>.<map_name>``
+
+    Raises:
+        ValueError: if the compartment name could not be determined from the results folder
+    """
+    maps = load_volume_maps(results_folder)
+
+    if compartment_name is None:
+        compartment_names = [name[:-len('.dperp1')] for name in maps if name.endswith('.dperp1')]
+        if len(compartment_names) != 1:
+            raise ValueError('Could not determine the Tensor compartment in the folder "{}", '
+                             'candidates are: {}.'.format(results_folder, compartment_names))
+        compartment_name = compartment_names[0]
+
+    if 'UsedMask' in maps:
+        mask = load_brain_mask(maps['UsedMask'])
+    else:
+        mask = np.ones(maps[compartment_name + '.d'].shape[:3], dtype=np.bool)
+
+    parameter_names = ['d', 'dperp0', 'dperp1', 'theta', 'phi', 'psi']
+    parameter_names.extend('W_' + ''.join(map(str, ind)) for ind in itertools.product(range(3), repeat=4)
+                           if list(ind) == sorted(ind, reverse=True))
+    parameter_names.extend(name + '.std' for name in ['d', 'dperp0', 'dperp1'])
+
+    parameters = {name: create_roi(maps[compartment_name + '.' + name], mask)[:, 0] for name in parameter_names
+                  if compartment_name + '.' + name in maps}
+
+    covariances = {}
+    for name, volume in load_covariance_maps(results_folder).items():
+        if re.match(r'^{0}\.\w+_to_{0}\.\w+$'.format(re.escape(compartment_name)), name):
+            covariances[name.replace(compartment_name + '.', '')] = np.reshape(create_roi(volume, mask), (-1,))
+
+    output = {}
+    for batch_start, batch_end in split_in_batches(np.count_nonzero(mask), batch_size):
+        batch = {name: value[batch_start:batch_end] for name, value in parameters.items()}
+        batch['covariances'] = {name: value[batch_start:batch_end] for name, value in covariances.items()}
+
+        results = DTIMeasures.extra_optimization_maps(batch)
+        if 'W_0000' in batch:
+            results.update(DKIMeasures.extra_optimization_maps(batch))
+
+        for name, value in results.items():
+            output.setdefault('{}.{}'.format(compartment_name, name), []).append(
+                np.reshape(value, (batch_end - batch_start, -1)))
+
+    output = {name: np.squeeze(np.concatenate(batches), axis=1) if batches[0].shape[1] == 1
+              else np.concatenate(batches) for name, batches in output.items()}
+    volumes = restore_volumes(output, mask, with_volume_dim=False)
+
+    header = load_nifti(nifti_filepath_resolution(os.path.join(results_folder, compartment_name + '.d'))).header
+    write_all_as_nifti(volumes, output_folder or results_folder, nifti_header=header)
+    return volumes
@@ -26,11 +26,17 @@ from mdt.lib.fsl_sampling_routine import FSLSamplingRoutine
 from mdt.lib.nifti import write_all_as_nifti, get_all_nifti_data
 from mdt.configuration import gzip_optimization_results, gzip_sampling_results
 from mdt.utils import create_roi, load_samples
+from mdt.lib.quantized_samples import QUANTIZED_SAMPLES_EXTENSION, write_quantized_samples, \
+    get_quantization_precision
+from mdt.lib.voxel_samples import write_voxel_major_samples, remove_voxel_major_samples, write_voxel_index
+from mdt.lib.packed_covariances import PACKED_COVARIANCES_MAP_NAME, write_packed_covariances_parameters, \
+    remove_packed_covariances_parameters
 import collections
 
 from mot.sample import AdaptiveMetropolisWithinGibbs, SingleComponentAdaptiveMetropolis
 from mdt.model_building.utils import ObjectiveFunctionWrapper
 from mot.configuration import CLRuntimeInfo
+from mot.lib.kernel_data import Array, Zeros
 from mot.optimize import minimize
 from mot.sample.mwg import MetropolisWithinGibbs
 from mot.sample.t_walk import ThoughtfulWalk
@@ -289,10 +295,43 @@ class SimpleModelProcessor(ModelProcessor):
         """By default this will store some information about already processed voxels.
 
         This will call the user implementable function :meth:`_process` to do the processing.
+
+        Returns:
+            the output of :meth:`_process`, if any
         """
-        self._process(roi_indices, next_indices=next_indices)
+        results = self._process(roi_indices, next_indices=next_indices)
         self._write_volumes({'processed_voxels': np.ones(roi_indices.shape[0], dtype=np.bool)},
                             roi_indices, self._processing_tmp_dir)
+        return results
+
+    def reuse_results(self, reuse_mask, results_dir, maps_subdirs=('',)):
+        """Reuse existing results for some of the voxels instead of computing them.
+
+        This copies the existing results of the voxels in the given mask to the temporary storage and marks these
+        voxels as processed. Afterwards, only the remaining voxels are computed and the final output is combined
+        from the reused and the newly computed results.
+
+        Args:
+            reuse_mask (ndarray): the voxels for which we reuse the existing results, should be within the mask
+            results_dir (str): the directory with the existing results
+            maps_subdirs (list of str): the subdirectories with results maps in the results directory, the
+                empty string stands for the results directory itself.
+
+        Returns:
+            ndarray: the ROI indices of the reused voxels
+        """
+        roi_indices = np.where(create_roi(reuse_mask, self._mask))[0]
+        if not len(roi_indices):
+            return roi_indices
+
+        for subdir in maps_subdirs:
+            maps = get_all_nifti_data(os.path.join(results_dir, subdir))
+            self._write_volumes({name: create_roi(data, self._mask)[roi_indices] for name, data in maps.items()},
+                                roi_indices, os.path.join(self._tmp_storage_dir, subdir))
+
+        self._write_volumes({'processed_voxels': np.ones(roi_indices.shape[0], dtype=np.bool)},
+                            roi_indices, self._processing_tmp_dir)
+        return roi_indices
 
     def get_voxels_to_compute(self):
         """By default this will return the indices of all the voxels we have not yet computed.
@@ -301,16 +340,51 @@ class SimpleModelProcessor(ModelProcessor):
         function will only return the indices of the voxels we have not yet processed.
         """
         roi_list = np.arange(0, self._total_nmr_voxels)
-        processed_voxels_path = os.path.join(self._processing_tmp_dir, 'processed_voxels.npy')
-        if os.path.exists(processed_voxels_path):
-            return roi_list[np.logical_not(np.squeeze(create_roi(np.load(processed_voxels_path, mmap_mode='r'),
-                                                                 self._mask)[roi_list]))]
-        return roi_list
+        return roi_list[np.logical_not(self._get_processed_voxels(roi_list))]
 
     def get_total_nmr_voxels(self):
         """Returns the number of nonzero elements in the mask."""
         return self._total_nmr_voxels
 
+    def _get_processed_voxels(self, roi_indices):
+        """Get which of the given voxels have already been processed, for example before an interrupted run.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels to check
+
+        Returns:
+            ndarray: per voxel a boolean indicating if it has been processed
+        """
+        processed_voxels_path = os.path.join(self._processing_tmp_dir, 'processed_voxels.npy')
+        if not os.path.exists(processed_voxels_path):
+            return np.zeros(len(roi_indices), dtype=np.bool)
+
+        volume_indices = self._volume_indices[roi_indices, :]
+        processed_voxels = np.load(processed_voxels_path, mmap_mode='r')
+        return np.array(processed_voxels[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2], 0])
+
+    def _load_volumes(self, roi_indices, tmp_dir):
+        """Load the results of the given voxels from the temporary storage, the inverse of :meth:`_write_volumes`.
+
+        Args:
+            roi_indices (ndarray): the indices of the voxels to load
+            tmp_dir (str): the directory with the intermediate results
+
+        Returns:
+            dict: the results of the given voxels per map in the given directory
+        """
+        volume_indices = self._volume_indices[roi_indices, :]
+
+        results = {}
+        for fname in os.listdir(tmp_dir):
+            if fname.endswith('.npy'):
+                data = np.load(os.path.join(tmp_dir, fname), mmap_mode='r')
+                data = np.array(data[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]])
+                if data.ndim == 2 and data.shape[1] == 1:
+                    data = data[:, 0]
+                results[fname[:-len('.npy')]] = data
+        return results
+
     def finalize(self):
         """Cleans the temporary storage directory."""
         del self._volume_indices
@@ -441,13 +515,11 @@ class FittingProcessor(SimpleModelProcessor):
         self._method = method
         self._optimizer_options = optimizer_options
         self._write_volumes_gzipped = gzip_optimization_results()
-        self._subdirs = set()
+        self._subdirs = self._get_existing_subdirs()
         self._logger=logging.getLogger(__name__)
 
     def _process(self, roi_indices, next_indices=None):
         with self._model.voxels_to_analyze_context(roi_indices):
-            codec = self._model.get_parameter_codec()
-
             cl_runtime_info = CLRuntimeInfo()
 
             self._logger.info('Starting optimization')
@@ -464,34 +536,47 @@ class FittingProcessor(SimpleModelProcessor):
             else:
                 self._logger.info('We will use the optimizer {} with default settings.'.format(self._method))
 
-            x0 = codec.encode(self._model.get_initial_parameters(), self._model.get_kernel_data())
-            lower_bounds, upper_bounds = codec.encode_bounds(self._model.get_lower_bounds(),
-                                                             self._model.get_upper_bounds())
-
-            wrapper = ObjectiveFunctionWrapper(x0.shape[1])
-            objective_func = wrapper.wrap_objective_function(self._model.get_objective_function(),
-                                                             codec.get_decode_function())
-            input_data = wrapper.wrap_input_data(self._model.get_kernel_data())
-
-            results = minimize(objective_func, x0, method=self._method,
-                               nmr_observations=self._model.get_nmr_observations(),
-                               cl_runtime_info=cl_runtime_info,
-                               data=input_data,
-                               lower_bounds=lower_bounds,
-                               upper_bounds=upper_bounds,
-                               options=self._optimizer_options)
+            x_final, return_codes = _minimize_model(self._model, self._method, cl_runtime_info,
+                                                    optimizer_options=self._optimizer_options)
 
             self._logger.info('Finished optimization')
             self._logger.info('Starting post-processing')
 
-            x_final = codec.decode(results['x'], self._model.get_kernel_data())
-
-            results = self._model.get_post_optimization_output(x_final, results['status'])
+            results = self._model.get_post_optimization_output(x_final, return_codes)
             results.update({self._used_mask_name: np.ones(roi_indices.shape[0], dtype=np.bool)})
 
             self._logger.info('Finished post-processing')
 
             self._write_output_recursive(results, roi_indices)
+            return results
+
+    def reuse_results(self, reuse_mask, results_dir, maps_subdirs=('',)):
+        self._subdirs.update(maps_subdirs)
+        return super().reuse_results(reuse_mask, results_dir, maps_subdirs=maps_subdirs)
+
+    def get_results(self, roi_indices, next_indices=None):
+        """Get the results of the given voxels, only fitting the voxels which have not been processed before.
+
+        The results of the voxels processed before, for example before an interrupted run, are loaded from the
+        temporary storage. This allows another processor to drive this processor, while respecting its resume state.
+
+        Args:
+            roi_indices (ndarray): the list of ROI indices we will use for the current batch
+            next_indices (ndarray): the list of ROI indices we will use for the batch after this one. May be None
+                if there is no next batch.
+
+        Returns:
+            dict: the results maps of the given voxels, without the maps in subdirectories
+        """
+        to_process = roi_indices[np.logical_not(self._get_processed_voxels(roi_indices))]
+        if len(to_process):
+            self.process(to_process, next_indices=next_indices)
+        return self._load_volumes(roi_indices, self._tmp_storage_dir)
+
+    @property
+    def maps_subdirs(self):
+        """The subdirectories (relative to the output directory) in which this processor writes results maps."""
+        return sorted(self._subdirs)
 
     def _write_output_recursive(self, results, roi_indices, sub_dir=''):
         current_output = {}
@@ -506,13 +591,221 @@ class FittingProcessor(SimpleModelProcessor):
         self._write_volumes(current_output, roi_indices, os.path.join(self._tmp_storage_dir, sub_dir))
         self._subdirs.add(sub_dir)
 
+    def _get_existing_subdirs(self):
+        """Get the subdirectories of the temporary storage holding the results of a previous run.
+
+        Returns:
+            set: the subdirectories (relative to the temporary storage) with results maps, the empty string stands for
+                the temporary storage directory itself.
+        """
+        subdirs = set()
+        for dirpath, dirnames, filenames in os.walk(self._tmp_storage_dir):
+            if dirpath == self._tmp_storage_dir and os.path.basename(self._processing_tmp_dir) in dirnames:
+                dirnames.remove(os.path.basename(self._processing_tmp_dir))
+            if any(fname.endswith('.npy') for fname in filenames):
+                subdir = os.path.relpath(dirpath, self._tmp_storage_dir)
+                subdirs.add('' if subdir == os.curdir else subdir)
+        return subdirs
+
     def combine(self):
         super().combine()
         for subdir in self._subdirs:
             self._combine_volumes(self._output_dir, self._tmp_storage_dir,
                                   self._nifti_header, maps_subdir=subdir)
+
+        covariances_dir = os.path.join(self._output_dir, 'covariances')
+        if os.path.isfile(os.path.join(self._tmp_storage_dir, 'covariances', PACKED_COVARIANCES_MAP_NAME + '.npy')):
+            write_packed_covariances_parameters(covariances_dir, self._model.get_free_param_names())
+        else:
+            remove_packed_covariances_parameters(covariances_dir)
+
+        return create_roi(get_all_nifti_data(self._output_dir), self._mask)
+
+
+class ModelSelectionProcessor(SimpleModelProcessor):
+
+    def __init__(self, candidates, mask, nifti_header, output_dir, tmp_storage_dir, recalculate,
+                 information_criterion='BIC'):
+        """Processes a set of candidate models together and selects per voxel the best model.
+
+        Every chunk of voxels is first processed by each of the candidates, after which the information criterion
+        maps of the candidates are compared to create, per voxel, the index of the winning model, the Akaike weights
+        of every model and model-averaged parameter estimates. Parameters are averaged over the candidates that have
+        that parameter, with the weights renormalized over those candidates.
+
+        When resuming an interrupted run, this computes the voxels not yet processed by this processor or by any of
+        the candidates. The candidates only fit the voxels they have not processed before and load the others from
+        their temporary storage.
+
+        Args:
+            candidates (list of tuple): per candidate model a tuple with the model name, the list of free parameter
+                names and either a :class:`FittingProcessor` or a dictionary with the already computed ROI results.
+            information_criterion (str): the information criterion map to use for the comparison,
+                one of 'BIC', 'AIC' or 'AICc'.
+        """
+        super().__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate)
+        self._candidates = candidates
+        self._information_criterion = information_criterion
+        self._write_volumes_gzipped = gzip_optimization_results()
+
+    def get_voxels_to_compute(self):
+        voxels_to_compute = [super().get_voxels_to_compute()]
+        for _, _, source in self._candidates:
+            if isinstance(source, FittingProcessor):
+                voxels_to_compute.append(source.get_voxels_to_compute())
+        return np.unique(np.concatenate(voxels_to_compute))
+
+    def _process(self, roi_indices, next_indices=None):
+        results = []
+        for _, _, source in self._candidates:
+            if isinstance(source, FittingProcessor):
+                results.append(source.get_results(roi_indices, next_indices=next_indices))
+            else:
+                results.append({key: value[roi_indices] for key, value in source.items()})
+
+        criteria = np.column_stack([np.squeeze(r[self._information_criterion]) for r in results]).astype(np.float64)
+        criteria[~np.isfinite(criteria)] = np.inf
+
+        weights = _get_akaike_weights(criteria)
+
+        output = {'Winner': np.argmin(criteria, axis=1).astype(np.int32)}
+        for ind, (model_name, _, _) in enumerate(self._candidates):
+            output['{}.weight'.format(model_name)] = weights[:, ind]
+
+        param_names = []
+        for _, free_param_names, _ in self._candidates:
+            param_names.extend(name for name in free_param_names if name not in param_names)
+
+        for param_name in param_names:
+            model_indices = [ind for ind, (_, free_param_names, _) in enumerate(self._candidates)
+                             if param_name in free_param_names]
+            param_weights = _get_akaike_weights(criteria[:, model_indices])
+            values = np.column_stack([np.squeeze(results[ind][param_name]) for ind in model_indices])
+            output[param_name] = np.sum(param_weights * values, axis=1)
+
+        self._write_volumes(output, roi_indices, self._tmp_storage_dir)
+        return output
+
+    def combine(self):
+        super().combine()
+        for _, _, source in self._candidates:
+            if isinstance(source, ModelProcessor):
+                source.combine()
+        self._combine_volumes(self._output_dir, self._tmp_storage_dir, self._nifti_header)
         return create_roi(get_all_nifti_data(self._output_dir), self._mask)
 
+    def finalize(self):
+        for _, _, source in self._candidates:
+            if isinstance(source, ModelProcessor):
+                source.finalize()
+        super().finalize()
+
+
+class BootstrapProcessor(SimpleModelProcessor):
+
+    def __init__(self, method, model, mask, nifti_header, output_dir, tmp_storage_dir, recalculate,
+                 nmr_bootstraps=100, bootstrap_method='residual', quantiles=(0.025, 0.5, 0.975), seed=None,
+                 optimizer_options=None):
+        """The processing worker for bootstrapping a model fit.
+
+        Per chunk of voxels, this computes the model signal at the initial parameters (which should be set to the
+        original fit results) and the residuals with respect to the observations. From these, ``nmr_bootstraps``
+        resampled observation sets are generated per voxel, which are then all fitted as one batch of
+        (voxels x bootstraps) problems, warm-started from the original fit. Only the summary statistics (mean, std and
+        quantiles) of the free parameters over the bootstrap replicates are stored.
+
+        Args:
+            method (str): the optimization routine to use
+            nmr_bootstraps (int): the number of bootstrap replicates per voxel
+            bootstrap_method (str): one of 'residual', resampling the residuals of a voxel with replacement,
+                or 'wild', multiplying the residuals with random Rademacher (+1/-1) weights.
+            quantiles (tuple of float): the quantiles to store, each in [0, 1]
+            seed (int): the seed for the random number generator. The generator is seeded per chunk using this seed
+                and the first voxel of the chunk, making the results independent of the processing order.
+            optimizer_options (dict): extra options passed to the optimization routine
+        """
+        super().__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate)
+        if bootstrap_method not in ('residual', 'wild'):
+            raise ValueError('The bootstrap method "{}" is not supported, '
+                             'use "residual" or "wild".'.format(bootstrap_method))
+
+        self._model = model
+        self._method = method
+        self._nmr_bootstraps = nmr_bootstraps
+        self._bootstrap_method = bootstrap_method
+        self._quantiles = quantiles
+        self._seed = seed
+        self._optimizer_options = optimizer_options
+        self._write_volumes_gzipped = gzip_optimization_results()
+        self._logger = logging.getLogger(__name__)
+
+    def _process(self, roi_indices, next_indices=None):
+        from mdt.simulations import _get_simulate_function
+
+        with self._model.voxels_to_analyze_context(roi_indices):
+            parameters = self._model.get_initial_parameters()
+            observations = self._model.get_input_data().get_observations(roi_indices).astype(np.float32)
+
+            kernel_data = {'data': self._model.get_kernel_data(),
+                           'parameters': Array(parameters, ctype='mot_float_type'),
+                           'estimates': Zeros(observations.shape, 'mot_float_type')}
+            _get_simulate_function(self._model).evaluate(kernel_data, parameters.shape[0])
+            estimates = kernel_data['estimates'].get_data()
+
+        bootstrap_observations = self._get_bootstrap_observations(roi_indices, observations, estimates)
+
+        self._logger.info('Fitting {} bootstrap replicates for {} voxels.'.format(
+            self._nmr_bootstraps, roi_indices.shape[0]))
+
+        with self._model.voxels_to_analyze_context(np.repeat(roi_indices, self._nmr_bootstraps)), \
+                self._model.observations_context(bootstrap_observations):
+            x_final, _ = _minimize_model(self._model, self._method, CLRuntimeInfo(),
+                                         optimizer_options=self._optimizer_options)
+
+        x_final = np.reshape(x_final, (roi_indices.shape[0], self._nmr_bootstraps, -1))
+
+        results = {self._used_mask_name: np.ones(roi_indices.shape[0], dtype=np.bool)}
+        for ind, name in enumerate(self._model.get_free_param_names()):
+            results[name] = np.mean(x_final[..., ind], axis=1)
+            results[name + '.std'] = np.std(x_final[..., ind], axis=1)
+
+            quantiles = np.percentile(x_final[..., ind], [q * 100 for q in self._quantiles], axis=1)
+            for quantile, values in zip(self._quantiles, quantiles):
+                results['{}.quantile_{}'.format(name, quantile)] = values
+
+        self._write_volumes(results, roi_indices, self._tmp_storage_dir)
+        return results
+
+    def combine(self):
+        super().combine()
+        self._combine_volumes(self._output_dir, self._tmp_storage_dir, self._nifti_header)
+        return create_roi(get_all_nifti_data(self._output_dir), self._mask)
+
+    def _get_bootstrap_observations(self, roi_indices, observations, estimates):
+        """Generate the bootstrap observations for the voxels in this chunk.
+
+        Returns:
+            ndarray: matrix of shape (nmr_voxels * nmr_bootstraps, nmr_observations), with the bootstrap replicates of
+                a voxel on consecutive rows.
+        """
+        seed = None
+        if self._seed is not None:
+            seed = [self._seed, int(roi_indices[0])]
+        random_state = np.random.RandomState(seed)
+
+        residuals = observations - estimates
+        shape = (observations.shape[0], self._nmr_bootstraps, observations.shape[1])
+
+        if self._bootstrap_method == 'residual':
+            resample_indices = random_state.randint(0, observations.shape[1], size=shape)
+            voxel_indices = np.arange(observations.shape[0])[:, None, None]
+            bootstrap_residuals = residuals[voxel_indices, resample_indices]
+        else:
+            bootstrap_residuals = residuals[:, None, :] * random_state.choice(
+                np.array([-1, 1], dtype=np.float32), size=shape)
+
+        return np.reshape(estimates[:, None, :] + bootstrap_residuals, (-1, observations.shape[1]))
+
 
 class SamplingProcessor(SimpleModelProcessor):
 
@@ -627,7 +920,17 @@ class SamplingProcessor(SimpleModelProcessor):
             self._combine_volumes(self._output_dir, self._tmp_storage_dir,
                                   self._nifti_header, maps_subdir=subdir)
 
+        for output_name in sorted(set(self._samples_output_stored)):
+            if self._samples_to_save_method.get_quantization_bits(output_name) is not None:
+                precision = get_quantization_precision(
+                    os.path.join(self._output_dir, output_name + QUANTIZED_SAMPLES_EXTENSION))
+                self._logger.info('Stored the samples of {} using {} bit quantization, maximum absolute error {:.4g} '
+                                  '({:.2%} of the sample std.).'.format(output_name, precision['bits'],
+                                                                        precision['max_abs_error'],
+                                                                        precision['max_error_over_std']))
+
         if self._samples_output_stored:
+            write_voxel_index(self._output_dir, self._mask)
             return load_samples(self._output_dir)
 
         return SamplingProcessor.SampleChainNotStored()
@@ -659,14 +962,45 @@ class SamplingProcessor(SimpleModelProcessor):
         if not os.path.exists(self._output_dir):
             os.makedirs(self._output_dir)
 
+        if self._samples_to_save_method.store_voxel_major():
+            for output_name in results:
+                if self._samples_to_save_method.get_quantization_bits(output_name) is not None:
+                    raise ValueError('Quantized samples can not be stored voxel-major, '
+                                     'the samples of {} are to be quantized.'.format(output_name))
+                if os.path.isfile(os.path.join(self._output_dir, output_name + '.samples.npy')):
+                    os.remove(os.path.join(self._output_dir, output_name + '.samples.npy'))
+                if os.path.isdir(os.path.join(self._output_dir, output_name + QUANTIZED_SAMPLES_EXTENSION)):
+                    shutil.rmtree(os.path.join(self._output_dir, output_name + QUANTIZED_SAMPLES_EXTENSION))
+
+            write_voxel_major_samples(
+                self._output_dir,
+                {output_name: samples[:, self._samples_to_save_method.indices_to_store(output_name, samples.shape[1])]
+                 for output_name, samples in results.items()},
+                roi_indices, self._total_nmr_voxels)
+            return
+
+        remove_voxel_major_samples(self._output_dir)
+
         for fname in os.listdir(self._output_dir):
-            if fname.endswith('.samples.npy'):
-                chain_name = fname[0:-len('.samples.npy')]
-                if chain_name not in results:
-                    os.remove(os.path.join(self._output_dir, fname))
+            for extension in ['.samples.npy', QUANTIZED_SAMPLES_EXTENSION]:
+                if fname.endswith(extension):
+                    chain_name = fname[0:-len(extension)]
+                    quantized = self._samples_to_save_method.get_quantization_bits(chain_name) is not None
+                    if chain_name not in results or quantized != (extension == QUANTIZED_SAMPLES_EXTENSION):
+                        if os.path.isdir(os.path.join(self._output_dir, fname)):
+                            shutil.rmtree(os.path.join(self._output_dir, fname))
+                        else:
+                            os.remove(os.path.join(self._output_dir, fname))
 
         for output_name, samples in results.items():
             save_indices = self._samples_to_save_method.indices_to_store(output_name, samples.shape[1])
+
+            bits = self._samples_to_save_method.get_quantization_bits(output_name)
+            if bits is not None:
+                write_quantized_samples(os.path.join(self._output_dir, output_name + QUANTIZED_SAMPLES_EXTENSION),
+                                        samples[:, save_indices], roi_indices, self._total_nmr_voxels, bits=bits)
+                continue
+
             samples_path = os.path.join(self._output_dir, output_name + '.samples.npy')
             mode = 'w+'
 
@@ -719,6 +1053,28 @@ class SamplesStorageStrategy:
         """
         raise NotImplementedError()
 
+    def store_voxel_major(self):
+        """If the samples of all outputs should be stored together in one voxel-major matrix.
+
+        See :mod:`mdt.lib.voxel_samples` for details.
+
+        Returns:
+            boolean: if we store the samples voxel-major instead of in one file per output.
+        """
+        return False
+
+    def get_quantization_bits(self, output_name):
+        """Get the number of bits with which to store the samples of this output.
+
+        Args:
+            output_name (str): the name of the output item we want to store the samples of
+
+        Returns:
+            int or None: None for storing the samples at full precision, or 8 or 16 for storing the samples
+                quantized, see :mod:`mdt.lib.quantized_samples`.
+        """
+        return None
+
 
 class SaveSpecificMaps(SamplesStorageStrategy):
 
@@ -788,6 +1144,66 @@ class SaveNoSamples(SamplesStorageStrategy):
         return np.array([])
 
 
+class SaveQuantizedSamples(SamplesStorageStrategy):
+
+    def __init__(self, bits=16, samples_storage_strategy=None):
+        """Store the samples linearly quantized to 8 or 16 bits per sample.
+
+        The samples are quantized per voxel and per output using a scale and offset and are stored in compressed
+        chunks. This reduces the storage by at least a factor two compared to single precision storage, at the cost of
+        an error of at most half a quantization step per sample. See :mod:`mdt.lib.quantized_samples` for details.
+
+        Args:
+            bits (int): the number of bits per sample, 8 or 16
+            samples_storage_strategy (SamplesStorageStrategy): the strategy determining which samples of which outputs
+                are stored, defaults to storing all the samples.
+        """
+        if bits not in (8, 16):
+            raise ValueError('Only 8 or 16 bit quantization is supported, {} bits given.'.format(bits))
+        self._bits = bits
+        self._samples_storage_strategy = samples_storage_strategy or SaveAllSamples()
+
+    def store_samples(self, output_name):
+        return self._samples_storage_strategy.store_samples(output_name)
+
+    def indices_to_store(self, output_name, nmr_samples):
+        return self._samples_storage_strategy.indices_to_store(output_name, nmr_samples)
+
+    def get_quantization_bits(self, output_name):
+        return self._bits
+
+
+class SaveVoxelMajorSamples(SamplesStorageStrategy):
+
+    def __init__(self, samples_storage_strategy=None):
+        """Store the samples of all outputs together, with the chains of every voxel contiguous on disk.
+
+        This layout is optimized for reading all the chains of a few voxels, for example using
+        :func:`mdt.get_voxel_samples`. It requires that the same number of samples is stored for every output.
+        See :mod:`mdt.lib.voxel_samples` for details.
+
+        Args:
+            samples_storage_strategy (SamplesStorageStrategy): the strategy determining which samples of which outputs
+                are stored, defaults to storing all the samples. Quantization is not supported in this layout.
+
+        Raises:
+            ValueError: if the given strategy quantizes the samples
+        """
+        if isinstance(samples_storage_strategy, SaveQuantizedSamples):
+            raise ValueError('Quantized samples can not be stored voxel-major, '
+                             'please use either SaveQuantizedSamples or SaveVoxelMajorSamples.')
+        self._samples_storage_strategy = samples_storage_strategy or SaveAllSamples()
+
+    def store_samples(self, output_name):
+        return self._samples_storage_strategy.store_samples(output_name)
+
+    def indices_to_store(self, output_name, nmr_samples):
+        return self._samples_storage_strategy.indices_to_store(output_name, nmr_samples)
+
+    def store_voxel_major(self):
+        return True
+
+
 class SaveSpecificSamples(SamplesStorageStrategy):
 
     def __init__(self, sample_indices):
@@ -805,6 +1221,60 @@ class SaveSpecificSamples(SamplesStorageStrategy):
         return self._sample_indices
 
 
+def _get_akaike_weights(criteria):
+    """Get the Akaike weights of the candidate models from their information criteria.
+
+    The weights are computed relative to the lowest criterion per voxel, such that the winning model never underflows
+    to a weight of zero. Models with a non-finite criterion get a weight of zero, voxels in which none of the models
+    has a finite criterion get equal weights for every model.
+
+    Args:
+        criteria (ndarray): the (n, k) matrix with the information criteria of the k models for n voxels
+
+    Returns:
+        ndarray: the (n, k) matrix with the weights, summing to one per voxel
+    """
+    finite = np.isfinite(criteria)
+    minimum = np.min(np.where(finite, criteria, np.inf), axis=1)
+    minimum[~np.isfinite(minimum)] = 0
+
+    weights = np.where(finite, np.exp(-0.5 * (np.where(finite, criteria, minimum[:, None]) - minimum[:, None])), 0)
+    weights[~np.any(finite, axis=1)] = 1
+    return weights / np.sum(weights, axis=1)[:, None]
+
+
+def _minimize_model(model, method, cl_runtime_info, optimizer_options=None):
+    """Minimize the objective function of the given model for the voxels currently selected in the model.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model to optimize, with the voxels to analyze set.
+        method (str): the optimization routine to use
+        cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information
+        optimizer_options (dict): extra options passed to the optimization routine
+
+    Returns:
+        tuple: the decoded optimized parameters and the optimizer return codes
+    """
+    codec = model.get_parameter_codec()
+
+    x0 = codec.encode(model.get_initial_parameters(), model.get_kernel_data())
+    lower_bounds, upper_bounds = codec.encode_bounds(model.get_lower_bounds(), model.get_upper_bounds())
+
+    wrapper = ObjectiveFunctionWrapper(x0.shape[1])
+    objective_func = wrapper.wrap_objective_function(model.get_objective_function(), codec.get_decode_function())
+    input_data = wrapper.wrap_input_data(model.get_kernel_data())
+
+    results = minimize(objective_func, x0, method=method,
+                       nmr_observations=model.get_nmr_observations(),
+                       cl_runtime_info=cl_runtime_info,
+                       data=input_data,
+                       lower_bounds=lower_bounds,
+                       upper_bounds=upper_bounds,
+                       options=optimizer_options)
+
+    return codec.decode(results['x'], model.get_kernel_data()), results['status']
+
+
 def get_full_tmp_results_path(output_dir, tmp_dir):
     """Get a temporary results path for processing.
 
@@ -0,0 +1,81 @@
+"""Gaussian quadrature rules for integrating over distributions in the model functions.
+
+Compartments modelling a distribution of a tissue property (for example the Gamma distributed radii in the
+``GDRCylinders`` compartment) integrate the compartment signal over that distribution. Instead of a fixed step
+numerical integration, a Gaussian quadrature rule integrates polynomials up to degree ``2n - 1`` exactly with only
+``n`` integrand evaluations. The nodes and weights are computed here, on the host, and are then made available in the
+CL code as constant arrays, see :func:`get_quadrature_cl_code`. Compartments declare the integral using the
+``quadrature`` attribute of the :class:`~mdt.component_templates.compartment_models.CompartmentTemplate`, from which
+the quadrature evaluation is generated.
+
+For a Gauss-Legendre rule with nodes :math:`x_i` and weights :math:`w_i` the integral over an interval
+:math:`[a, b]` is approximated as:
+
+.. math::
+
+    \\int_a^b f(r) dr \\approx \\frac{b - a}{2} \\sum_i w_i f\\left(\\frac{b - a}{2} x_i + \\frac{a + b}{2}\\right)
+
+and for a generalized Gauss-Laguerre rule as:
+
+.. math::
+
+    \\int_0^\\infty x^\\alpha e^{-x} f(x) dx \\approx \\sum_i w_i f(x_i)
+"""
+import numpy as np
+from scipy.special import roots_genlaguerre
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-19'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def gauss_legendre(order):
+    """Get the nodes and weights of the Gauss-Legendre quadrature rule on the interval [-1, 1].
+
+    Args:
+        order (int): the number of nodes
+
+    Returns:
+        tuple: the nodes and the weights, both vectors of length ``order``
+    """
+    return np.polynomial.legendre.leggauss(order)
+
+
+def gauss_laguerre(order, alpha=0):
+    """Get the nodes and weights of the generalized Gauss-Laguerre quadrature rule.
+
+    This integrates functions on [0, inf) with respect to the weight function ``x**alpha * exp(-x)``.
+
+    Args:
+        order (int): the number of nodes
+        alpha (float): the power of the weight function, should be larger than -1
+
+    Returns:
+        tuple: the nodes and the weights, both vectors of length ``order``
+    """
+    return roots_genlaguerre(order, alpha)
+
+
+def get_quadrature_cl_code(name, nodes, weights):
+    """Get the CL code defining the nodes and weights of a quadrature rule as constant arrays.
+
+    This defines ``<name>_order``, the number of nodes, and the arrays ``<name>_nodes`` and ``<name>_weights``.
+
+    Args:
+        name (str): the name prefix for the CL constants
+        nodes (ndarray): the nodes of the quadrature rule
+        weights (ndarray): the weights of the quadrature rule
+
+    Returns:
+        str: the CL code with the constant definitions
+    """
+    def format_array(values):
+        return ', '.join(repr(float(v)) for v in values)
+
+    return '''
+        __constant int {name}_order = {order};
+        __constant double {name}_nodes[] = {{{nodes}}};
+        __constant double {name}_weights[] = {{{weights}}};
+    '''.format(name=name, order=len(nodes), nodes=format_array(nodes), weights=format_array(weights))
@@ -0,0 +1,212 @@
+"""Compact storage of sampling results using linear quantization.
+
+Instead of storing the samples of a parameter as one floating point (voxels x samples) matrix, the samples of every
+voxel are linearly quantized to 8 or 16 bit unsigned integers using a per voxel scale and offset. The quantized samples
+are stored in compressed chunks, one per batch of processed voxels, in a directory ``<name>.samples.quantized``.
+
+The quantization error per sample is at most half the scale, that is, half the range of the samples of that voxel
+divided by ``2**bits - 1``. The actual errors are recorded while writing and can be obtained using
+:func:`get_quantization_precision`.
+
+The stored samples can be loaded using :func:`mdt.load_samples` which returns a :class:`QuantizedSamples` object
+for quantized chains. This object can be indexed like a regular array, decoding the samples on the fly.
+"""
+import glob
+import json
+import os
+import numpy as np
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-17'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+QUANTIZED_SAMPLES_EXTENSION = '.samples.quantized'
+
+
+def quantize_samples(samples, bits=16):
+    """Linearly quantize the samples of every voxel to unsigned integers of the given number of bits.
+
+    Non-finite samples are stored as the minimum of the samples of that voxel.
+
+    Args:
+        samples (ndarray): matrix of shape (voxels, samples)
+        bits (int): either 8 or 16
+
+    Returns:
+        tuple: the quantized samples, the scale and the offset per voxel. The samples are restored using
+            ``codes * scale[:, None] + offset[:, None]``.
+    """
+    if bits not in (8, 16):
+        raise ValueError('Only 8 or 16 bit quantization is supported, {} bits given.'.format(bits))
+
+    samples = np.asarray(samples, dtype=np.float64)
+    finite = np.isfinite(samples)
+    samples = np.where(finite, samples, np.nan)
+
+    with np.errstate(invalid='ignore'):
+        offset = np.nan_to_num(np.nanmin(samples, axis=1))
+        scale = (np.nan_to_num(np.nanmax(samples, axis=1)) - offset) / (2 ** bits - 1)
+    scale[scale <= 0] = 1
+
+    codes = np.rint((np.nan_to_num(samples - offset[:, None])) / scale[:, None])
+    codes = np.clip(np.where(finite, codes, 0), 0, 2 ** bits - 1)
+    return codes.astype(np.uint8 if bits == 8 else np.uint16), scale, offset
+
+
+def dequantize_samples(codes, scale, offset, dtype=np.float32):
+    """Restore the samples from the quantized codes.
+
+    Args:
+        codes (ndarray): the quantized samples, matrix of shape (voxels, samples)
+        scale (ndarray): the scale per voxel
+        offset (ndarray): the offset per voxel
+        dtype (np.dtype): the data type of the returned samples
+
+    Returns:
+        ndarray: the restored samples
+    """
+    return (codes * scale[:, None] + offset[:, None]).astype(dtype)
+
+
+def write_quantized_samples(path, samples, roi_indices, total_nmr_voxels, bits=16):
+    """Quantize and write the samples of a chunk of voxels to the given quantized samples directory.
+
+    Args:
+        path (str): the path to the ``<name>.samples.quantized`` directory
+        samples (ndarray): the samples of this chunk, matrix of shape (voxels, samples)
+        roi_indices (ndarray): the ROI indices of the voxels in this chunk
+        total_nmr_voxels (int): the total number of voxels in the sampled ROI
+        bits (int): the number of bits for the quantization, 8 or 16
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    info = _load_info(path)
+    if info is None or info['nmr_samples'] != samples.shape[1] or info['bits'] != bits \
+            or info['nmr_voxels'] != total_nmr_voxels:
+        for fname in glob.glob(os.path.join(path, 'chunk_*.npz')):
+            os.remove(fname)
+        info = {'nmr_voxels': int(total_nmr_voxels), 'nmr_samples': int(samples.shape[1]),
+                'bits': bits, 'dtype': np.dtype(samples.dtype).str,
+                'max_abs_error': 0.0, 'max_error_over_std': 0.0}
+
+    codes, scale, offset = quantize_samples(samples, bits=bits)
+    np.savez_compressed(os.path.join(path, 'chunk_{:09d}.npz'.format(int(np.min(roi_indices)))),
+                        codes=codes, scale=scale, offset=offset, roi_indices=np.asarray(roi_indices, dtype=np.int64))
+
+    errors = np.abs(dequantize_samples(codes, scale, offset, dtype=np.float64) - samples)
+    errors[~np.isfinite(errors)] = 0
+    max_errors = np.max(errors, axis=1)
+    stds = np.nan_to_num(np.std(samples, axis=1))
+
+    if len(max_errors):
+        info['max_abs_error'] = max(info['max_abs_error'], float(np.max(max_errors)))
+    if np.any(stds > 0):
+        info['max_error_over_std'] = max(info['max_error_over_std'],
+                                         float(np.max(max_errors[stds > 0] / stds[stds > 0])))
+
+    with open(os.path.join(path, 'info.json'), 'w') as f:
+        json.dump(info, f, sort_keys=True, indent=4)
+
+
+def get_quantization_precision(path):
+    """Get the precision loss recorded while writing the quantized samples.
+
+    Args:
+        path (str): the path to the ``<name>.samples.quantized`` directory
+
+    Returns:
+        dict: with the elements ``bits``, ``max_abs_error``, the maximum absolute error over all samples, and
+            ``max_error_over_std``, the maximum over all voxels of the absolute error divided by the standard
+            deviation of the samples of that voxel.
+    """
+    info = _load_info(path)
+    return {key: info[key] for key in ['bits', 'max_abs_error', 'max_error_over_std']}
+
+
+class QuantizedSamples:
+
+    def __init__(self, path):
+        """Read access to quantized samples, decoding the samples on the fly.
+
+        This mimics the parts of the numpy array interface relevant for reading samples. Rows are voxels in ROI order,
+        columns are samples. Voxels that were never written return zeros, as is the case for the regular sample files.
+
+        Args:
+            path (str): the path to the ``<name>.samples.quantized`` directory
+        """
+        self._path = path
+        self._info = _load_info(path)
+        if self._info is None:
+            raise ValueError('Could not find quantized samples at the location "{}"'.format(path))
+
+        self.shape = (self._info['nmr_voxels'], self._info['nmr_samples'])
+        self.dtype = np.dtype(self._info['dtype'])
+        self.ndim = 2
+
+        self._chunk_files = sorted(glob.glob(os.path.join(path, 'chunk_*.npz')), key=os.path.getmtime)
+        self._chunk_lookup = np.full(self.shape[0], -1, dtype=np.int32)
+        self._row_lookup = np.zeros(self.shape[0], dtype=np.int64)
+        for chunk_ind, fname in enumerate(self._chunk_files):
+            with np.load(fname) as chunk:
+                roi_indices = chunk['roi_indices']
+            self._chunk_lookup[roi_indices] = chunk_ind
+            self._row_lookup[roi_indices] = np.arange(len(roi_indices))
+
+        self._cached_chunk = (None, None)
+
+    @property
+    def precision(self):
+        """The recorded precision loss, see :func:`get_quantization_precision`."""
+        return get_quantization_precision(self._path)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        samples = self[:]
+        if dtype is not None:
+            return samples.astype(dtype)
+        return samples
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        row_item, column_item = item[0], item[1:]
+
+        rows = np.arange(self.shape[0])[row_item]
+        single_row = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+
+        samples = np.zeros((len(rows), self.shape[1]), dtype=self.dtype)
+        chunk_indices = self._chunk_lookup[rows]
+        for chunk_ind in np.unique(chunk_indices[chunk_indices >= 0]):
+            codes, scale, offset = self._load_chunk(chunk_ind)
+            positions = np.where(chunk_indices == chunk_ind)[0]
+            chunk_rows = self._row_lookup[rows[positions]]
+            samples[positions] = dequantize_samples(codes[chunk_rows], scale[chunk_rows], offset[chunk_rows],
+                                                    dtype=self.dtype)
+
+        if single_row:
+            samples = samples[0]
+        if column_item:
+            samples = samples[(Ellipsis,) + column_item] if single_row else samples[(slice(None),) + column_item]
+        return samples
+
+    def _load_chunk(self, chunk_ind):
+        if self._cached_chunk[0] != chunk_ind:
+            with np.load(self._chunk_files[chunk_ind]) as chunk:
+                self._cached_chunk = (chunk_ind, (chunk['codes'], chunk['scale'], chunk['offset']))
+        return self._cached_chunk[1]
+
+
+def _load_info(path):
+    """Load the information file of a quantized samples directory, returns None if not present."""
+    info_path = os.path.join(path, 'info.json')
+    if not os.path.isfile(info_path):
+        return None
+    with open(info_path, 'r') as f:
+        return json.load(f)
@@ -6,8 +6,9 @@ and anti-sorting volumes (reversing the sort operation based on the sort index).
 """
 import collections
 from copy import copy
-import itertools
 import numpy as np
+from mot.lib.utils import split_in_batches
+
 from mdt.lib.nifti import get_all_nifti_data, load_nifti
 
 
@@ -18,7 +19,7 @@ __email__ = 'robbert.harms@maastrichtuniversity.nl'
 __licence__ = 'LGPL v3'
 
 
-def sort_orientations(data_input, weight_names, extra_sortable_maps):
+def sort_orientations(data_input, weight_names, extra_sortable_maps, mask=None, batch_size=100000):
     """Sort the orientations of multi-direction models voxel-wise.
 
     This expects as input 3d/4d volumes. Do not use this with 2d arrays.
@@ -33,6 +34,9 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
     This method accepts as input results from (MDT) model fitting and is able to sort all the maps belonging to
     a given set of equal compartments per voxel.
 
+    Only the voxels in the mask are sorted, by default the ``UsedMask`` of the input maps if present, else all voxels.
+    The voxels are processed in batches to bound the memory usage.
+
     Example::
 
         sort_orientations('./output/BallStick_r3',
@@ -47,6 +51,9 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
         extra_sortable_maps (iterable of iterable): the list of additional maps to sort. Every element in the given
             list should be another list with the names of the maps. The length of these second layer of lists should
             match the length of the ``weight_names``.
+        mask (ndarray): optionally, the 3d mask with the voxels to sort. If not given we use the map ``UsedMask``
+            of the input maps, if present, else we sort all voxels.
+        batch_size (int): the number of voxels to sort at once
 
     Returns:
         dict: the sorted results in a new dictionary. This returns all input maps with some of them sorted.
@@ -62,12 +69,29 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
     sortable_maps = copy(extra_sortable_maps)
     sortable_maps.append(weight_names)
 
-    sort_index_matrix = create_4d_sort_matrix([input_maps[k] for k in weight_names], reversed_sort=True)
+    weights = _load_4d_volumes([input_maps[k] for k in weight_names])
+    if any(m.shape[3] > 1 for m in weights):
+        raise ValueError('Can not sort input volumes where one has more than one items on the 4th dimension.')
+
+    if mask is None and 'UsedMask' in input_maps:
+        mask = input_maps['UsedMask']
+    if mask is None:
+        roi_indices = np.arange(int(np.prod(weights[0].shape[:3])))
+    else:
+        roi_indices = np.flatnonzero(np.reshape(mask, weights[0].shape[:3] + (-1,))[..., 0])
+
+    weights_roi = np.concatenate([_get_roi(m, roi_indices) for m in weights], axis=1)
+    ranking = np.argsort(weights_roi, axis=1)[:, ::-1]
 
     for sortable_map_names in sortable_maps:
-        sorted = dict(zip(sortable_map_names, sort_volumes_per_voxel([input_maps[k] for k in sortable_map_names],
-                                                                     sort_index_matrix)))
-        result_maps.update(sorted)
+        volumes = _load_4d_volumes([input_maps[k] for k in sortable_map_names])
+        sorted_roi = _sort_voxels([_get_roi(m, roi_indices) for m in volumes], ranking, batch_size=batch_size)
+
+        dtype = np.result_type(*volumes)
+        for name, volume, values in zip(sortable_map_names, volumes, sorted_roi):
+            result = np.array(volume, dtype=dtype, order='C')
+            np.reshape(result, (-1, result.shape[3]))[roi_indices] = values
+            result_maps[name] = result
 
     return result_maps
 
@@ -134,49 +158,32 @@ def create_4d_sort_matrix(input_volumes, reversed_sort=False):
     return sort_index
 
 
-def sort_volumes_per_voxel(input_volumes, sort_matrix):
+def sort_volumes_per_voxel(input_volumes, sort_matrix, batch_size=100000):
     """Sort the given volumes per voxel using the sort index in the given matrix.
 
     What this essentially does is to look per voxel from which map we should take the first value. Then we place that
     value in the first volume and we repeat for the next value and finally for the next voxel.
 
-    If the length of the 4th dimension is > 1 we shift the 4th dimension to the 5th dimension and sort
-    the array as if the 4th dimension values where a single value. This is useful for sorting (eigen)vector matrices.
+    If the length of the 4th dimension is > 1 we sort the 4th dimension values as if they were a single value.
+    This is useful for sorting (eigen)vector matrices.
 
     Args:
         input_volumes (:class:`list`): list of 4d ndarray
         sort_matrix (ndarray): 4d ndarray with for every voxel the sort index
+        batch_size (int): the number of voxels to sort at once
 
     Returns:
         :class:`list`: the same input volumes but then with every voxel sorted according to the given sort index.
     """
-    def load_maps(map_list):
-        tmp = []
-        for data in map_list:
-            if isinstance(data, str):
-                data = load_nifti(data).get_data()
-
-            if len(data.shape) < 4:
-                data = data[..., None]
-
-            tmp.append(data)
-        return tmp
-
-    input_volumes = load_maps(input_volumes)
+    input_volumes = _load_4d_volumes(input_volumes)
+    nmr_voxels = int(np.prod(input_volumes[0].shape[:3]))
 
-    if input_volumes[0].shape[3] > 1:
-        volume = np.concatenate([np.reshape(m, m.shape[0:3] + (1,) + (m.shape[3],)) for m in input_volumes], axis=3)
-        grid = np.ogrid[[slice(x) for x in volume.shape]]
-        sorted_volume = volume[list(grid[:-2]) + [np.reshape(sort_matrix, sort_matrix.shape + (1,))] + list(grid[-1])]
-        return [sorted_volume[..., ind, :] for ind in range(len(input_volumes))]
-    else:
-        volume = np.concatenate([m for m in input_volumes], axis=3)
-        sorted_volume = volume[list(np.ogrid[[slice(x) for x in volume.shape]][:-1])+[sort_matrix]]
-        return [np.reshape(sorted_volume[..., ind], sorted_volume.shape[0:3] + (1,))
-                for ind in range(len(input_volumes))]
+    sorted_volumes = _sort_voxels([np.reshape(m, (nmr_voxels, -1)) for m in input_volumes],
+                                  np.reshape(sort_matrix, (nmr_voxels, -1)), batch_size=batch_size)
+    return [np.reshape(m, volume.shape) for m, volume in zip(sorted_volumes, input_volumes)]
 
 
-def undo_sort_volumes_per_voxel(input_volumes, sort_matrix):
+def undo_sort_volumes_per_voxel(input_volumes, sort_matrix, batch_size=100000):
     """Undo the voxel-wise sorting of volumes based on the original sort matrix.
 
     This uses the original sort matrix to place the elements back into the original order. For example, suppose we had
@@ -186,17 +193,59 @@ def undo_sort_volumes_per_voxel(input_volumes, sort_matrix):
     Args:
         input_volumes (:class:`list`): list of 4d ndarray
         sort_matrix (ndarray): 4d ndarray with for every voxel the sort index
+        batch_size (int): the number of voxels to process at once
 
     Returns:
         :class:`list`: the same input volumes but then with every voxel anti-sorted according to the given sort index.
     """
-    results = [np.zeros_like(vol) for vol in input_volumes]
+    nmr_voxels = int(np.prod(input_volumes[0].shape[:3]))
+    inverse_sort_matrix = np.argsort(np.reshape(sort_matrix, (nmr_voxels, -1)), axis=1)
+
+    results = _sort_voxels([np.reshape(m, (nmr_voxels, -1)) for m in input_volumes], inverse_sort_matrix,
+                           batch_size=batch_size)
+    return [np.reshape(m, volume.shape).astype(volume.dtype, copy=False) for m, volume in zip(results, input_volumes)]
+
+
+def _sort_voxels(voxel_lists, ranking, batch_size=100000):
+    """Sort the values of the given lists voxel-wise using the given ranking.
+
+    This places per voxel the value of list ``ranking[voxel, i]`` in the output list ``i``, in batches of voxels.
+
+    Args:
+        voxel_lists (list of ndarray): the lists to sort, every list should be of shape (n, d) for n voxels
+        ranking (ndarray): the (n, k) matrix with for every voxel the index of the list to take the value from
+        batch_size (int): the number of voxels to sort at once
 
-    shape = input_volumes[0].shape
+    Returns:
+        list of ndarray: the sorted lists, all of the (common) data type of the input lists
+    """
+    nmr_voxels = ranking.shape[0]
+    dtype = np.result_type(*voxel_lists)
 
-    for x, y, z in itertools.product(range(shape[0]), range(shape[1]), range(shape[2])):
-        for ind, sort_ind in enumerate(list(sort_matrix[x, y, z])):
-            results[sort_ind][x, y, z] = input_volumes[ind][x, y, z]
+    results = [np.empty(voxel_list.shape, dtype=dtype) for voxel_list in voxel_lists]
+    for batch_start, batch_end in split_in_batches(nmr_voxels, batch_size):
+        stacked = np.concatenate([voxel_list[batch_start:batch_end, None] for voxel_list in voxel_lists], axis=1)
+        sorted_values = stacked[np.arange(batch_end - batch_start)[:, None], ranking[batch_start:batch_end]]
 
+        for ind, result in enumerate(results):
+            result[batch_start:batch_end] = sorted_values[:, ind]
     return results
 
+
+def _get_roi(volume, roi_indices):
+    """Get the (n, d) list of values of the given 4d volume at the given linear voxel indices."""
+    return np.reshape(volume, (-1, volume.shape[3]))[roi_indices]
+
+
+def _load_4d_volumes(map_list):
+    """Load the given volumes as 4d arrays, where the maps may also be given as filenames."""
+    tmp = []
+    for data in map_list:
+        if isinstance(data, str):
+            data = load_nifti(data).get_data()
+
+        if len(data.shape) < 4:
+            data = data[..., None]
+
+        tmp.append(data)
+    return tmp
@@ -0,0 +1,114 @@
+"""Voxel-major storage of sampling results with a spatial index.
+
+The regular sample storage writes one (voxels x samples) matrix per output. Reading all the chains of a single voxel
+then requires reading from every file. In the voxel-major layout all the outputs are stored in one matrix of shape
+(voxels, outputs, samples) in ``samples.voxel_major.npy``, such that all the chains of one voxel are contiguous on
+disk. The names of the outputs are stored in ``samples.voxel_major.json``.
+
+For both layouts, the sampling routine stores a spatial index ``voxel_index.npy``, a volume with per voxel the row of
+that voxel in the sample matrices, or -1 for voxels outside of the mask. This allows looking up the samples of a voxel
+without scanning the mask, see :func:`mdt.get_voxel_samples`.
+"""
+import json
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-01-18'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+VOXEL_MAJOR_SAMPLES_FILENAME = 'samples.voxel_major.npy'
+VOXEL_MAJOR_NAMES_FILENAME = 'samples.voxel_major.json'
+VOXEL_INDEX_FILENAME = 'voxel_index.npy'
+
+
+def write_voxel_index(output_dir, mask):
+    """Write the spatial index mapping voxel locations to rows in the sample matrices.
+
+    Args:
+        output_dir (str): the directory with the samples
+        mask (ndarray): the mask used during sampling
+    """
+    mask = mask.astype(np.bool)
+    index = np.full(mask.shape[:3], -1, dtype=np.int64)
+    index[mask] = np.arange(np.count_nonzero(mask))
+    np.save(os.path.join(output_dir, VOXEL_INDEX_FILENAME), index)
+
+
+def write_voxel_major_samples(output_dir, samples, roi_indices, total_nmr_voxels):
+    """Write the samples of a chunk of voxels to the voxel-major sample matrix.
+
+    Args:
+        output_dir (str): the directory with the samples
+        samples (dict): per output name a matrix of shape (voxels, samples) with the samples of this chunk
+        roi_indices (ndarray): the ROI indices of the voxels in this chunk
+        total_nmr_voxels (int): the total number of voxels in the sampled ROI
+    """
+    names = sorted(samples)
+    nmr_samples = set(value.shape[1] for value in samples.values())
+    if len(nmr_samples) > 1:
+        raise ValueError('The voxel-major sample storage requires the same number of samples for every output.')
+
+    shape = (int(total_nmr_voxels), len(names), int(nmr_samples.pop()))
+    dtype = np.result_type(*[value.dtype for value in samples.values()])
+    samples_path = os.path.join(output_dir, VOXEL_MAJOR_SAMPLES_FILENAME)
+
+    mode = 'w+'
+    if os.path.isfile(samples_path) and load_voxel_major_names(output_dir) == names:
+        current_results = open_memmap(samples_path, mode='r')
+        if current_results.shape == shape and current_results.dtype == dtype:
+            mode = 'r+'
+        del current_results
+
+    if mode == 'w+':
+        with open(os.path.join(output_dir, VOXEL_MAJOR_NAMES_FILENAME), 'w') as f:
+            json.dump(names, f)
+
+    saved = open_memmap(samples_path, mode=mode, dtype=dtype, shape=shape)
+    saved[roi_indices] = np.stack([samples[name] for name in names], axis=1)
+    del saved
+
+
+def load_voxel_major_names(output_dir):
+    """Load the names of the outputs in the voxel-major sample matrix.
+
+    Args:
+        output_dir (str): the directory with the samples
+
+    Returns:
+        list of str or None: the output names, in the order of the second axis of the sample matrix, or None if
+            there are no voxel-major samples in this directory.
+    """
+    names_path = os.path.join(output_dir, VOXEL_MAJOR_NAMES_FILENAME)
+    if not os.path.isfile(names_path) or not os.path.isfile(os.path.join(output_dir, VOXEL_MAJOR_SAMPLES_FILENAME)):
+        return None
+    with open(names_path, 'r') as f:
+        return json.load(f)
+
+
+def load_voxel_major_samples(output_dir, mode='r'):
+    """Load the voxel-major samples as a dictionary of memory mapped views, one per output.
+
+    Args:
+        output_dir (str): the directory with the samples
+        mode (str): the mode in which to open the memory mapped sample file (see numpy mode parameter)
+
+    Returns:
+        dict: per output a (voxels, samples) view on the voxel-major sample matrix, empty if not present.
+    """
+    names = load_voxel_major_names(output_dir)
+    if names is None:
+        return {}
+    samples = open_memmap(os.path.join(output_dir, VOXEL_MAJOR_SAMPLES_FILENAME), mode=mode)
+    return {name: samples[:, ind, :] for ind, name in enumerate(names)}
+
+
+def remove_voxel_major_samples(output_dir):
+    """Remove the voxel-major sample files from the given directory, if present."""
+    for filename in [VOXEL_MAJOR_SAMPLES_FILENAME, VOXEL_MAJOR_NAMES_FILENAME]:
+        if os.path.isfile(os.path.join(output_dir, filename)):
+            os.remove(os.path.join(output_dir, filename))
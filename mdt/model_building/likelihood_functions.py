@@ -2,6 +2,7 @@ import numpy as np
 from .model_functions import SimpleModelCLFunction
 from .parameters import CurrentObservationParam, CurrentModelSignalParam, NoiseStdFreeParameter
 from mot.library_functions import LogBesseli0, normal_logpdf
+from mot.library_functions.base import SimpleCLLibrary
 from .parameter_functions.transformations import ClampTransform
 
 
@@ -74,7 +75,7 @@ class OffsetGaussian(LikelihoodFunction):
 
 class Rician(LikelihoodFunction):
 
-    def __init__(self):
+    def __init__(self, fast_log_bessel=None):
         """This uses the log of the Rice PDF for the likelihood function.
 
         The PDF is defined as:
@@ -94,7 +95,18 @@ class Rician(LikelihoodFunction):
             log(PDF) = log(observation/sigma^2)
                         - (observation^2 + evaluation^2) / (2 * sigma^2)
                         + log(bessel_i0((observation * evaluation) / sigma^2))
+
+        The log of the Bessel function can be computed with the default routine, which evaluates the Bessel function
+        and then takes the log, or with a fast approximation of the log directly, see :class:`LogBesseli0Fast`.
+
+        Args:
+            fast_log_bessel (boolean): if we want to use the fast approximation of the log of the Bessel function.
+                If None, we use the setting in the configuration (``likelihood_functions.rician.fast_log_bessel``).
         """
+        if fast_log_bessel is None:
+            from mdt.configuration import use_fast_rician_log_bessel
+            fast_log_bessel = use_fast_rician_log_bessel()
+
         parameter_list = [
             CurrentObservationParam('observation'),
             CurrentModelSignalParam('model_evaluation'),
@@ -106,6 +118,69 @@ class Rician(LikelihoodFunction):
             
             return   log(obs_div / sigma)
                    - ((obs_div * obs_div + eval_div * eval_div) / 2)
-                   + log_bessel_i0(obs_div * eval_div);
-        '''
-        super().__init__('double', 'Rician', parameter_list, body, dependencies=(LogBesseli0(),))
+                   + {log_bessel_i0}(obs_div * eval_div);
+        '''.format(log_bessel_i0='log_bessel_i0_fast' if fast_log_bessel else 'log_bessel_i0')
+        log_bessel_library = LogBesseli0Fast() if fast_log_bessel else LogBesseli0()
+        super().__init__('double', 'Rician', parameter_list, body, dependencies=(log_bessel_library,))
+
+
+class LogBesseli0Fast(SimpleCLLibrary):
+
+    def __init__(self):
+        """Fast approximation of the log of the zeroth-order modified Bessel function of the first kind.
+
+        In contrast to the ``log_bessel_i0`` function in MOT, this does not evaluate the Bessel function itself.
+        Instead, we approximate the log directly, using two polynomials:
+
+        .. code-block:: c
+
+            log(I0(x)) = x^2 * P(2 * x^2 / 9 - 1)                     for |x| < 3
+            log(I0(x)) = x - log(2 * pi * x) / 2 + Q(6 / x - 1)         for |x| >= 3
+
+        Where P is a polynomial of degree 10 and Q a polynomial of degree 11. The second form is the asymptotic
+        expansion of the Bessel function, where Q corrects for the truncation of the expansion. Compared to the
+        default implementation this saves an exponent and a logarithm for large x and a logarithm for small x,
+        and it does not overflow for large x.
+
+        The coefficients are the Chebyshev least squares fits (on 2000 Chebyshev nodes) to the reference
+        ``log(scipy.special.i0e(x)) + x``, converted to monomials. The maximum absolute error is about 2e-8 and the
+        maximum relative error about 1.4e-8 (for x > 0.01), on the complete real line. Depending on the precision of
+        the ``log`` function of the device, the absolute error may be up to 3e-8. For comparison, the default
+        implementation has a maximum absolute error of about 5e-7 below x=700 and of about 2e-4 above, where it
+        switches to the leading term of the asymptotic expansion.
+        """
+        super().__init__('''
+            double log_bessel_i0_fast(double x){
+                x = fabs(x);
+
+                if(x < 3){
+                    double u = 2 * x * x / 9.0 - 1;
+                    return x * x * (0.20218147849664686
+                                    + u * (-0.033247945440022623
+                                    + u * (0.009569441902607423
+                                    + u * (-0.003186802894814976
+                                    + u * (0.0011336839669929247
+                                    + u * (-0.0004222573739823642
+                                    + u * (0.00016083332710702016
+                                    + u * (-5.495714701894999e-05
+                                    + u * (2.0733374565026673e-05
+                                    + u * (-1.53886778719977e-05
+                                    + u * 6.47398771391868e-06))))))))));
+                }
+
+                double u = 6.0 / x - 1;
+                return x - log(2 * M_PI * x) / 2.0
+                        + (0.0230033848407532
+                           + u * (0.025844349515925305
+                           + u * (0.003887421425685639
+                           + u * (0.0014554849543092143
+                           + u * (9.673063389901274e-05
+                           + u * (-0.0008027685788983814
+                           + u * (-0.00035551354374103626
+                           + u * (0.00044229808611938564
+                           + u * (0.00018838854838741013
+                           + u * (-0.00021566754068383934
+                           + u * (-4.4271301617480805e-05
+                           + u * 5.24621955532793e-05)))))))))));
+            }
+        ''')
@@ -0,0 +1,391 @@
+"""Translation of CL functions to vectorized NumPy functions.
+
+This translates the CL code of compartment models, likelihood functions and library functions into NumPy functions,
+such that models can be evaluated without compiling and running an OpenCL kernel. This is worthwhile for small
+problem sizes, where the CL compilation time dominates the evaluation time.
+
+Only CL functions consisting of a list of scalar declarations and assignments followed by a return statement can be
+translated, for example ``double adc = d * b; return exp(-adc);``. Functions with control flow, pointers, arrays or
+integer variables are not translated. Vector values (like the gradient vector ``g``) are only supported as arguments
+to other functions (like ``dot(g, SphericalToCartesian(theta, phi))``), or by their components (like ``g.x``). Library
+functions which can not be translated automatically but which are used by many compartments, like
+``TensorApparentDiffusion``, have a handwritten NumPy implementation.
+
+The resulting NumPy functions take and return arrays. Scalars can be of any shape, as long as all the inputs
+broadcast against each other. Vectors are arrays with a last axis of length three, the leading axes again broadcast
+against the other inputs.
+"""
+import ast
+import keyword
+import re
+import numpy as np
+from scipy.special import erf, erfc, i0e
+
+__author__ = 'Robbert Harms'
+__date__ = '2019-02-02'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+_scalar_types = ('double', 'float', 'half', 'mot_float_type')
+_vector_types = ('double4', 'float4', 'mot_float_type4')
+
+
+def get_numpy_function(cl_function):
+    """Get a NumPy implementation of the given CL function.
+
+    This first looks for a handwritten implementation of the function, matched by the CL function name, and else tries
+    to translate the CL code of the function and of the functions it depends on.
+
+    Args:
+        cl_function (mot.lib.cl_function.CLFunction): the CL function to translate
+
+    Returns:
+        Callable or None: the NumPy function, taking the same (positional) arguments as the CL function, or None if
+            the CL function could not be translated.
+    """
+    translated = _translate_function(cl_function)
+    if translated is None:
+        return None
+    return translated[0]
+
+
+def get_numpy_expression(expression, variable_names):
+    """Get a NumPy implementation of the given CL expression.
+
+    This can be used for the parameter dependencies, like ``max((double)1 - (w_stick0_w), (double)0)``.
+
+    Args:
+        expression (str): the CL expression to translate
+        variable_names (Iterable[str]): the names of the scalar variables the expression may use
+
+    Returns:
+        Callable or None: a function taking the variables as keyword arguments and returning the value of the
+            expression, or None if the expression could not be translated.
+    """
+    variable_names = tuple(variable_names)
+    if any(not _is_valid_name(name) for name in variable_names):
+        return None
+
+    key = (expression, variable_names)
+    if key not in _expressions_cache:
+        _expressions_cache[key] = _compile_function(
+            '_expression', variable_names, [], _convert_expression(expression, ()), False, _builtins,
+            set(_vector_builtins))
+    function = _expressions_cache[key]
+    if function is None:
+        return None
+
+    def expression_function(**variables):
+        return function(*[variables.get(name) for name in variable_names])
+    return expression_function
+
+
+def _translate_function(cl_function):
+    """Translate the given CL function, using a cache.
+
+    Returns:
+        tuple or None: the NumPy function and a boolean indicating if the function returns a vector
+    """
+    try:
+        key = (cl_function.get_cl_function_name(), cl_function.get_signature(), cl_function.get_cl_body())
+    except AttributeError:
+        return None
+
+    if key not in _translations_cache:
+        _translations_cache[key] = None
+        _translations_cache[key] = _translate_function_uncached(cl_function)
+    return _translations_cache[key]
+
+
+def _translate_function_uncached(cl_function):
+    function_name = cl_function.get_cl_function_name()
+    if function_name in _library_functions:
+        return _library_functions[function_name]
+
+    return_type = cl_function.get_return_type()
+    if return_type not in _scalar_types + _vector_types:
+        return None
+
+    parameter_names = []
+    vector_names = set()
+    for parameter in cl_function.get_parameters():
+        if parameter.is_pointer_type or parameter.is_array_type or not _is_valid_name(parameter.name):
+            return None
+        if parameter.is_vector_type:
+            if parameter.ctype not in _vector_types:
+                return None
+            vector_names.add(parameter.name)
+        elif parameter.ctype not in _scalar_types:
+            return None
+        parameter_names.append(parameter.name)
+
+    namespace = dict(_builtins)
+    vector_functions = set(_vector_builtins)
+    for dependency in (cl_function.get_dependencies() or []):
+        translated = _translate_function(dependency)
+        if translated is not None:
+            namespace[dependency.get_cl_function_name()] = translated[0]
+            if translated[1]:
+                vector_functions.add(dependency.get_cl_function_name())
+
+    statements = _split_statements(cl_function.get_cl_body())
+    if not statements or not statements[-1].startswith('return'):
+        return None
+
+    assignments = []
+    for statement in statements[:-1]:
+        assignment = _parse_assignment(statement, vector_names)
+        if assignment is None:
+            return None
+        assignments.append(assignment)
+
+    return_expression = re.match(r'^return\b\s*(.+)$', statements[-1], flags=re.S)
+    if return_expression is None:
+        return None
+
+    function = _compile_function(
+        function_name, parameter_names, assignments, _convert_expression(return_expression.group(1), vector_names),
+        return_type in _vector_types, namespace, vector_functions, vector_names)
+    if function is None:
+        return None
+    return function, return_type in _vector_types
+
+
+def _split_statements(cl_body):
+    """Split the given CL code into statements, returns None if the code contains more than simple statements."""
+    cl_body = re.sub(r'/\*.*?\*/', ' ', cl_body, flags=re.S)
+    cl_body = re.sub(r'//[^\n]*', ' ', cl_body)
+
+    if re.search(r'[{}\[\]#?:&|!<>%"\'\\~^]', cl_body):
+        return None
+    return [statement.strip() for statement in cl_body.split(';') if statement.strip()]
+
+
+def _parse_assignment(statement, vector_names):
+    """Parse a declaration or an assignment into a tuple with the variable name and the expression.
+
+    Declarations of vector variables add the variable name to the given set of vector names.
+    """
+    match = re.match(r'^(?:const\s+)?([A-Za-z_]\w*)\s+([A-Za-z_]\w*)\s*=(.+)$', statement, flags=re.S)
+    if match:
+        ctype, name, expression = match.groups()
+        if ctype in _vector_types:
+            vector_names.add(name)
+        elif ctype not in _scalar_types:
+            return None
+        return name, _convert_expression(expression, vector_names)
+
+    match = re.match(r'^([A-Za-z_]\w*)\s*([-+*/]?)=(.+)$', statement, flags=re.S)
+    if match:
+        name, operator, expression = match.groups()
+        expression = _convert_expression(expression, vector_names)
+        if operator:
+            expression = '{} {} ({})'.format(name, operator, expression)
+        return name, expression
+    return None
+
+
+def _convert_expression(expression, vector_names):
+    """Convert the syntax of a CL expression to Python syntax.
+
+    This removes the casts to floating point types, removes the suffixes of single precision literals and converts
+    vector literals and vector components to function calls. The result still needs to be validated.
+    """
+    expression = ' '.join(expression.split())
+    expression = re.sub(r'\(\s*(?:{})\s*\)\s*\('.format('|'.join(_vector_types)), '_vector(', expression)
+    expression = re.sub(r'\(\s*(?:const\s+)?(?:{})\s*\)'.format('|'.join(_scalar_types)), ' ', expression)
+    expression = re.sub(r'((?<![\w.])(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)[fF]\b', r'\1', expression)
+
+    for name in vector_names:
+        expression = re.sub(r'\b{}\s*\.\s*([xyz])\b'.format(name),
+                            lambda match: '_component({}, {})'.format(name, 'xyz'.index(match.group(1))),
+                            expression)
+    return expression
+
+
+def _compile_function(function_name, parameter_names, assignments, return_expression, returns_vector,
+                      namespace, vector_functions, vector_names=()):
+    """Create the Python function from the converted statements, after validating the syntax tree.
+
+    Returns:
+        Callable or None: the function, or None if the syntax tree contained unsupported elements
+    """
+    source = 'def {}({}):\n'.format('_numpy_function', ', '.join(parameter_names))
+    for name, expression in assignments:
+        source += '    {} = {}\n'.format(name, expression)
+    source += '    return {}\n'.format(return_expression)
+
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+
+    variables = set(parameter_names) | set(name for name, _ in assignments)
+    if variables & set(namespace) or not _is_valid_syntax_tree(
+            tree, variables, set(vector_names), namespace, vector_functions, returns_vector):
+        return None
+
+    scope = dict(namespace)
+    scope['__builtins__'] = {}
+    exec(compile(tree, '<{}>'.format(function_name), 'exec'), scope)
+    return scope['_numpy_function']
+
+
+def _is_valid_syntax_tree(tree, variables, vector_names, namespace, vector_functions, returns_vector):
+    """Check if the given syntax tree only uses the supported subset of the language.
+
+    This allows arithmetic on scalars and calls to the functions in the namespace. Vector values can only be used as
+    function argument, assigned to vector variables or returned from functions returning a vector.
+    """
+    allowed_nodes = (ast.Module, ast.FunctionDef, ast.arguments, ast.arg, ast.Return, ast.Assign, ast.Name,
+                     ast.Load, ast.Store, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+                     ast.UAdd, ast.USub, ast.Call, ast.Num)
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+
+    def is_number(node):
+        return isinstance(node, ast.Num) and isinstance(node.n, (int, float)) and not isinstance(node.n, bool)
+
+    def is_vector(node):
+        if isinstance(node, ast.Name):
+            return node.id in vector_names
+        return isinstance(node, ast.Call) and node.func.id in vector_functions
+
+    def is_valid_vector_use(node):
+        parent = parents[node]
+        if isinstance(parent, ast.Call):
+            return node in parent.args
+        if isinstance(parent, ast.Assign):
+            return parent.targets[0].id in vector_names
+        return isinstance(parent, ast.Return) and returns_vector
+
+    for node in ast.walk(tree):
+        if not isinstance(node, allowed_nodes):
+            if not (hasattr(ast, 'Constant') and isinstance(node, ast.Constant) and is_number(node)):
+                return False
+
+        if isinstance(node, ast.Num) and not is_number(node):
+            return False
+
+        if isinstance(node, ast.Assign) and (len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name)):
+            return False
+
+        if isinstance(node, ast.Assign) and is_vector(node.value) != (node.targets[0].id in vector_names):
+            return False
+
+        if isinstance(node, ast.Return) and is_vector(node.value) != returns_vector:
+            return False
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or not callable(namespace.get(node.func.id)) or node.keywords:
+                return False
+
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            if node.id in variables:
+                if is_vector(node) and not is_valid_vector_use(node):
+                    return False
+            elif node.id not in namespace:
+                return False
+            elif callable(namespace[node.id]) and not (isinstance(parents[node], ast.Call)
+                                                       and parents[node].func is node):
+                return False
+
+        if isinstance(node, ast.Call) and is_vector(node) and not is_valid_vector_use(node):
+            return False
+
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+            operands = (node.left, node.right)
+            if all(is_number(el) and isinstance(getattr(el, 'n', getattr(el, 'value', None)), int)
+                   for el in operands):
+                return False
+    return True
+
+
+def _is_valid_name(name):
+    return re.match(r'^[A-Za-z_]\w*$', name) is not None and not keyword.iskeyword(name) and name not in _builtins
+
+
+def _dot(vector_0, vector_1):
+    return np.sum(np.asarray(vector_0) * np.asarray(vector_1), axis=-1)
+
+
+def _vector(x, y, z, w=0):
+    """Create a vector from its components, broadcasting the components against each other."""
+    x, y, z = np.broadcast_arrays(*[np.asarray(el, dtype=np.float64) for el in (x, y, z)])
+    return np.concatenate([x[..., None], y[..., None], z[..., None]], axis=-1)
+
+
+def _component(vector, index):
+    return np.asarray(vector)[..., index]
+
+
+def _cross(vector_0, vector_1):
+    vector_0, vector_1 = np.broadcast_arrays(np.asarray(vector_0, dtype=np.float64),
+                                             np.asarray(vector_1, dtype=np.float64))
+    return np.cross(vector_0, vector_1)
+
+
+def _spherical_to_cartesian(theta, phi):
+    sin_theta = np.sin(theta)
+    return _vector(np.cos(phi) * sin_theta, np.sin(phi) * sin_theta, np.cos(theta))
+
+
+def _rotate_orthogonal_vector(basis, to_rotate, psi):
+    psi = np.asarray(psi)[..., None]
+    return np.asarray(to_rotate) * np.cos(psi) + _cross(basis, to_rotate) * np.sin(psi)
+
+
+def _rotate_vector(basis, to_rotate, psi):
+    psi = np.asarray(psi)[..., None]
+    return (np.asarray(to_rotate) * np.cos(psi) + _cross(basis, to_rotate) * np.sin(psi)
+            + np.asarray(basis) * _dot(basis, to_rotate)[..., None] * (1 - np.cos(psi)))
+
+
+def _tensor_apparent_diffusion(theta, phi, psi, d, dperp0, dperp1, g):
+    vec0 = _spherical_to_cartesian(theta, phi)
+    vec1 = _rotate_orthogonal_vector(vec0, _spherical_to_cartesian(np.asarray(theta) + np.pi / 2, phi), psi)
+    vec2 = _cross(vec0, vec1)
+    return d * _dot(vec0, g) ** 2 + dperp0 * _dot(vec1, g) ** 2 + dperp1 * _dot(vec2, g) ** 2
+
+
+def _log_bessel_i0(x):
+    """The log of the zeroth-order modified Bessel function of the first kind, stable for large arguments."""
+    x = np.abs(x)
+    return np.log(i0e(x)) + x
+
+
+_builtins = {
+    'exp': np.exp, 'exp2': np.exp2, 'exp10': lambda x: np.power(10., x), 'expm1': np.expm1,
+    'log': np.log, 'log2': np.log2, 'log10': np.log10, 'log1p': np.log1p,
+    'sqrt': np.sqrt, 'rsqrt': lambda x: 1 / np.sqrt(x),
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'asin': np.arcsin, 'acos': np.arccos, 'atan': np.arctan,
+    'atan2': np.arctan2, 'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+    'fabs': np.abs, 'abs': np.abs, 'floor': np.floor, 'ceil': np.ceil,
+    'pow': np.power, 'powr': np.power, 'pown': np.power, 'hypot': np.hypot,
+    'fmin': np.minimum, 'fmax': np.maximum, 'min': np.minimum, 'max': np.maximum,
+    'erf': erf, 'erfc': erfc,
+    'dot': _dot, 'length': lambda vector: np.sqrt(_dot(vector, vector)), 'cross': _cross,
+    '_vector': _vector, '_component': _component,
+    'M_E': np.e, 'M_LOG2E': np.log2(np.e), 'M_LOG10E': np.log10(np.e), 'M_LN2': np.log(2), 'M_LN10': np.log(10),
+    'M_PI': np.pi, 'M_PI_2': np.pi / 2, 'M_PI_4': np.pi / 4, 'M_1_PI': 1 / np.pi, 'M_2_PI': 2 / np.pi,
+    'M_2_SQRTPI': 2 / np.sqrt(np.pi), 'M_SQRT2': np.sqrt(2), 'M_SQRT1_2': np.sqrt(0.5)
+}
+_builtins.update({name + '_F': value for name, value in list(_builtins.items()) if name.startswith('M_')})
+
+_vector_builtins = ('cross', '_vector')
+
+_library_functions = {
+    'SphericalToCartesian': (_spherical_to_cartesian, True),
+    'RotateOrthogonalVector': (_rotate_orthogonal_vector, True),
+    'RotateVector': (_rotate_vector, True),
+    'TensorApparentDiffusion': (_tensor_apparent_diffusion, False),
+    'log_bessel_i0': (_log_bessel_i0, False),
+    'log_bessel_i0_fast': (_log_bessel_i0, False)
+}
+
+_translations_cache = {}
+_expressions_cache = {}
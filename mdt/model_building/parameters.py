@@ -1,3 +1,5 @@
+import inspect
+import numpy as np
 from mot.lib.cl_function import SimpleCLFunctionParameter
 from .parameter_functions.numdiff_info import SimpleNumDiffInfo
 from .parameter_functions.priors import UniformWithinBoundsPrior
@@ -41,6 +43,45 @@ class ProtocolParameter(InputDataParameter):
         super().__init__(declaration, value=value)
 
 
+class PrecomputedProtocolParameter(ProtocolParameter):
+
+    def __init__(self, declaration, function, gradient_scaling=None):
+        """A protocol parameter of which the values are computed from other protocol parameters.
+
+        This allows compartments to move computations that only depend on the protocol out of the CL code. The values
+        are computed once per protocol (and per voxel for voxel-wise protocol maps) and are then loaded in the kernel
+        like any other protocol parameter.
+
+        Args:
+            declaration (str): the declaration of this parameter. For example ``mot_float_type foo``.
+            function (Callable): the function computing the values. The names of the arguments of this function
+                are the names of the protocol parameters it depends on. These are given as numpy arrays and the
+                function should return the values using element-wise (broadcastable) operations.
+            gradient_scaling (int or None): if this parameter depends on the gradient amplitude (``G`` or ``b``),
+                the power of the gradient amplitude in the computed values. This is used to update the values
+                with the gradient deviations. If None, or if the values depend on the gradient direction ``g``, this
+                parameter can not be combined with gradient deviations.
+        """
+        super().__init__(declaration, value=None)
+        self.function = function
+        self.gradient_scaling = gradient_scaling
+        self.protocol_parameter_names = list(inspect.signature(function).parameters)
+
+    def compute(self, get_value):
+        """Compute the values of this parameter.
+
+        Args:
+            get_value (Callable[[str], ndarray]): function returning the value of a protocol parameter given its name
+
+        Returns:
+            ndarray or float: the computed values, or None if any of the protocol parameters is missing.
+        """
+        values = [get_value(name) for name in self.protocol_parameter_names]
+        if any(value is None for value in values):
+            return None
+        return np.asarray(self.function(*values))
+
+
 class FreeParameter(SimpleCLFunctionParameter):
 
     def __init__(self, declaration, fixed, value, lower_bound, upper_bound,
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 from collections import Mapping
 from textwrap import dedent
@@ -5,19 +6,23 @@ import copy
 import collections
 import numpy as np
 from contextlib import contextmanager
-from mdt.configuration import get_active_post_processing
+from mdt.configuration import get_active_post_processing, use_half_precision_gradient_deviations, \
+    get_numpy_evaluation_max_nmr_problems
 from mdt.lib.deferred_mappings import DeferredFunctionDict
 from mdt.lib.exceptions import DoubleModelNameException
+from mdt.lib.packed_covariances import PACKED_COVARIANCES_MAP_NAME
 from mdt.model_building.model_functions import WeightType
+from mdt.model_building.numpy_functions import get_numpy_function, get_numpy_expression
 from mdt.model_building.parameter_functions.dependencies import SimpleAssignment, AbstractParameterDependency
 from mdt.model_building.utils import ParameterCodec
 
 from mot.lib.cl_function import SimpleCLFunction, SimpleCLFunctionParameter
 from mot.cl_routines import compute_log_likelihood, numerical_hessian
-from mdt.model_building.parameters import ProtocolParameter, FreeParameter, CurrentObservationParam, \
-    DataCacheParameter, CurrentModelSignalParam, NoiseStdFreeParameter, NoiseStdInputParameter
+from mdt.model_building.parameters import ProtocolParameter, PrecomputedProtocolParameter, FreeParameter, \
+    CurrentObservationParam, DataCacheParameter, CurrentModelSignalParam, NoiseStdFreeParameter, \
+    NoiseStdInputParameter
 from mot.configuration import CLRuntimeInfo
-from mot.lib.utils import all_elements_equal, get_single_value
+from mot.lib.utils import split_in_batches
 from mot.lib.kernel_data import Array, Zeros, Scalar, LocalMemory, Struct, CompositeArray, PrivateMemory
 
 from mdt.models.base import MissingProtocolInput
@@ -128,6 +133,8 @@ class DMRICompositeModel(DMRIOptimizable):
         self._post_processing = get_active_post_processing()
 
         self._voxels_to_analyze = None
+        self._observations_override = None
+        self._gradient_deviations_layout = None
 
     @property
     def name(self):
@@ -145,6 +152,22 @@ class DMRICompositeModel(DMRIOptimizable):
         yield
         self._voxels_to_analyze = tmp
 
+    @contextmanager
+    def observations_context(self, observations):
+        """Temporarily replace the observations used in the kernel data with the given observations.
+
+        This can be used to evaluate or fit the model on observations different from those in the input data,
+        for example for bootstrapping. The given observations should match the current ``voxels_to_analyze``,
+        that is, they should have one row per voxel analyzed.
+
+        Args:
+            observations (ndarray): the (untransformed) observations to use, one row per analyzed voxel.
+        """
+        tmp = self._observations_override
+        self._observations_override = observations
+        yield
+        self._observations_override = tmp
+
     def get_composite_model_function(self):
         """Get the composite model function for the current model tree.
 
@@ -371,7 +394,8 @@ class DMRICompositeModel(DMRIOptimizable):
             2) Add the fixed maps to the results
             3) Apply each of the ``post_optimization_modifiers`` functions
             4) Add information criteria maps
-            5) Calculate the covariance matrix according to the Fisher Information Matrix theory
+            5) Calculate the covariance matrix according to the Fisher Information Matrix theory, the covariances
+               are stored per parameter pair or packed in one map (see :mod:`mdt.lib.packed_covariances`)
             6) Add the additional results from the ``additional_result_funcs``
 
         Args:
@@ -414,8 +438,11 @@ class DMRICompositeModel(DMRIOptimizable):
                 if not exc.args[0].endswith('.std'):
                     raise exc
 
-        if not self._post_processing['optimization']['store_covariances']:
-            del results_dict['covariances']
+        if 'covariances' in results_dict:
+            if not self._post_processing['optimization']['store_covariances']:
+                del results_dict['covariances']
+            elif self._post_processing['optimization']['packed_covariances']:
+                results_dict['covariances'] = {PACKED_COVARIANCES_MAP_NAME: fim['packed_covariances']}
 
         return results_dict
 
@@ -457,6 +484,65 @@ class DMRICompositeModel(DMRIOptimizable):
     def get_model_eval_function(self):
         return self._get_model_eval_function(include_cache_init_func=True)
 
+    def get_numpy_model_eval_function(self):
+        """Get a NumPy implementation of the model evaluation function, if this model can be translated to NumPy.
+
+        This evaluates the model like the function returned by :meth:`get_model_eval_function`, but without
+        compiling and running an OpenCL kernel. See :mod:`mdt.model_building.numpy_functions` for the compartments
+        that can be translated. Additionally, models with a signal noise model, with data caches, with dependencies
+        using pre-transform code or with protocol update callbacks (like for the gradient deviations) are not
+        supported.
+
+        Like the kernel data, the returned function uses the current ``voxels_to_analyze`` of this model.
+
+        Returns:
+            Callable or None: a function taking a (n, p) matrix with the parameters of n problems (as used in the
+                model fitting) and returning a (n, m) matrix with the model signals of the m observations.
+                None if this model can not be evaluated using NumPy.
+        """
+        signal_function = self._get_numpy_signal_function()
+        if signal_function is None:
+            return None
+
+        def model_eval_function(parameters):
+            return signal_function(self._get_numpy_parameter_values(parameters))
+        return model_eval_function
+
+    def get_numpy_log_likelihood_function(self):
+        """Get a NumPy implementation of the log-likelihood function, if this model can be translated to NumPy.
+
+        This is the NumPy counterpart of :meth:`get_log_likelihood_function`, see
+        :meth:`get_numpy_model_eval_function` for the models that are supported.
+
+        Returns:
+            Callable or None: a function taking a (n, p) matrix with the parameters of n problems (as used in the
+                model fitting) and returning the n log-likelihoods. None if this model can not be evaluated
+                using NumPy.
+        """
+        signal_function = self._get_numpy_signal_function()
+        likelihood_function = get_numpy_function(self._likelihood_function)
+        if signal_function is None or likelihood_function is None:
+            return None
+
+        def log_likelihood_function(parameters):
+            values = self._get_numpy_parameter_values(parameters)
+            signals = signal_function(values)
+
+            call_args = []
+            for p in self._likelihood_function.get_parameters():
+                if isinstance(p, CurrentObservationParam):
+                    call_args.append(self._get_numpy_observations())
+                elif isinstance(p, CurrentModelSignalParam):
+                    call_args.append(signals)
+                else:
+                    call_args.append(values['{}.{}'.format(self._likelihood_function.name, p.name).replace('.', '_')])
+
+            log_likelihoods = likelihood_function(*call_args) * np.ones(signals.shape)
+            if self._input_data.volume_weights is not None:
+                log_likelihoods *= self._get_numpy_volume_weights()
+            return np.sum(log_likelihoods, axis=1)
+        return log_likelihood_function
+
     def _post_sampling_extra_model_defined_maps(self, samples):
         """Compute the extra post-sample maps defined in the models.
 
@@ -669,7 +755,7 @@ class DMRICompositeModel(DMRIOptimizable):
                 covariances['{}_to_{}'.format(param_names[x_ind], param_names[y_ind])] = covars[..., ind_counter]
                 ind_counter += 1
 
-        return {'stds': stds, 'covariances': covariances}
+        return {'stds': stds, 'covariances': covariances, 'packed_covariances': covars}
 
     def _get_post_optimization_information_criterion_maps(self, results_array, log_likelihoods=None):
         """Add some final results maps to the results dictionary.
@@ -685,8 +771,16 @@ class DMRICompositeModel(DMRIOptimizable):
             dict: the calculated information criterion maps
         """
         if log_likelihoods is None:
-            log_likelihoods = compute_log_likelihood(self.get_log_likelihood_function(),
-                                                     results_array, data=self.get_kernel_data())
+            numpy_function = None
+            if results_array.shape[0] <= get_numpy_evaluation_max_nmr_problems():
+                numpy_function = self.get_numpy_log_likelihood_function()
+
+            if numpy_function is not None:
+                with np.errstate(all='ignore'):
+                    log_likelihoods = numpy_function(results_array)
+            else:
+                log_likelihoods = compute_log_likelihood(self.get_log_likelihood_function(),
+                                                         results_array, data=self.get_kernel_data())
             log_likelihoods[np.isinf(log_likelihoods)] = 0
             log_likelihoods = np.nan_to_num(log_likelihoods)
 
@@ -727,6 +821,72 @@ class DMRICompositeModel(DMRIOptimizable):
         """
         return copy.deepcopy(self._post_processing)
 
+    def get_configuration_checksum(self, exclude_voxelwise=False):
+        """Get a checksum over the current configuration of this model.
+
+        This covers the generated CL code of the objective function, the initial values, fixed values and bounds of
+        all the free parameters and the active post-processing. Together with a checksum over the input data, this
+        identifies the outcome of an optimization. The input data should be set before calling this method.
+
+        Args:
+            exclude_voxelwise (boolean): if set, the values with one element per voxel are not part of the checksum,
+                making the checksum independent of the mask. These values are available using
+                :meth:`get_voxelwise_configuration`.
+
+        Returns:
+            str: the checksum as an hexadecimal string
+        """
+        checksum = hashlib.md5()
+        checksum.update(self.get_objective_function().get_cl_code().encode('utf-8'))
+
+        for name, value in self._get_configuration_values():
+            checksum.update(name.encode('utf-8'))
+            if isinstance(value, AbstractParameterDependency):
+                checksum.update((value.pre_transform_code + value.assignment_code).encode('utf-8'))
+            elif isinstance(value, str):
+                checksum.update(value.encode('utf-8'))
+            elif exclude_voxelwise and self._is_voxelwise_value(value):
+                checksum.update(b'voxelwise')
+            else:
+                checksum.update(np.ascontiguousarray(value, dtype=np.float64).tobytes())
+
+        checksum.update(repr(sorted((processing_type, sorted(settings.items()))
+                                    for processing_type, settings in self._post_processing.items())).encode('utf-8'))
+        return checksum.hexdigest()
+
+    def get_voxelwise_configuration(self):
+        """Get the initial values, fixed values and bounds that are specified per voxel.
+
+        Returns:
+            list of ndarray: per voxel-wise value a two dimensional matrix with one row per voxel.
+        """
+        return [np.reshape(value, (value.shape[0], -1)) for _, value in self._get_configuration_values()
+                if self._is_voxelwise_value(value)]
+
+    def _get_configuration_values(self):
+        """Get the initial or fixed value and the bounds of every free parameter.
+
+        Returns:
+            list of tuple: (name, value) tuples, one per parameter value and bound.
+        """
+        values = []
+        for m, p in self._model_functions_info.get_model_parameter_list():
+            if isinstance(p, FreeParameter):
+                param_name = '{}.{}'.format(m.name, p.name)
+                values.extend([
+                    ('{} {}'.format(param_name, self._model_functions_info.is_fixed(param_name)),
+                     self._model_functions_info.get_parameter_value(param_name)),
+                    (param_name + '.lower_bound', self._lower_bounds[param_name]),
+                    (param_name + '.upper_bound', self._upper_bounds[param_name])])
+        return values
+
+    def _is_voxelwise_value(self, value):
+        """Check if the given parameter value or bound has one element per voxel."""
+        if is_scalar(value) or isinstance(value, (str, AbstractParameterDependency)):
+            return False
+        value = np.asarray(value)
+        return value.ndim > 0 and value.shape[0] == self._get_nmr_problems(None) and value.size > 1
+
     def get_parameter_codec(self):
         """Get a parameter codec that can be used to transform the parameters to and from optimization and model space.
 
@@ -916,10 +1076,11 @@ class DMRICompositeModel(DMRIOptimizable):
         """
         self._check_data_consistency(input_data)
         self._original_input_data = input_data
+        self._gradient_deviations_layout = None
 
         input_data = self._prepare_input_data(input_data)
 
-        if input_data.gradient_deviations is not None and self._model_functions_info.has_protocol_parameter('g'):
+        if input_data.has_gradient_deviations() and self._model_functions_info.has_protocol_parameter('g'):
             self._logger.info('Using the gradient deviations in the model optimization.')
 
         self._input_data = input_data
@@ -956,6 +1117,14 @@ class DMRICompositeModel(DMRIOptimizable):
         """Get the names of the free parameters"""
         return ['{}.{}'.format(m.name, p.name) for m, p in self._model_functions_info.get_estimable_parameters_list()]
 
+    def get_free_weight_names(self):
+        """Get the names of the free parameters that are compartment weights.
+
+        Returns:
+            list: the names of the estimable weight parameters, a subset of :meth:`get_free_param_names`.
+        """
+        return ['{}.{}'.format(m.name, p.name) for m, p in self._model_functions_info.get_estimable_weights()]
+
     def get_required_protocol_names(self):
         """Get a list with the constant data names that are needed for this model to work.
 
@@ -965,8 +1134,13 @@ class DMRICompositeModel(DMRIOptimizable):
         Returns:
             list: A list of columns names that need to be present in the protocol
         """
-        return list(set([p.name for m, p in self._model_functions_info.get_model_parameter_list() if
-                         isinstance(p, ProtocolParameter)]))
+        names = set()
+        for m, p in self._model_functions_info.get_model_parameter_list():
+            if isinstance(p, PrecomputedProtocolParameter):
+                names.update(p.protocol_parameter_names)
+            elif isinstance(p, ProtocolParameter):
+                names.add(p.name)
+        return list(names)
 
     def is_input_data_sufficient(self, input_data=None):
         return not self.get_input_data_problems(input_data=input_data)
@@ -980,9 +1154,10 @@ class DMRICompositeModel(DMRIOptimizable):
         missing_columns = []
         for name in self.get_required_protocol_names():
             if not input_data.has_input_data(name):
-                for p in self._model_functions_info.get_unique_protocol_parameters():
-                    if p.name == name and p.value is None:
-                        missing_columns.append(name)
+                defaults = [p.value for p in self._model_functions_info.get_unique_protocol_parameters()
+                            if p.name == name]
+                if all(value is None for value in defaults):
+                    missing_columns.append(name)
 
         if missing_columns:
             problems.append(MissingProtocolInput(missing_columns))
@@ -1012,70 +1187,37 @@ class DMRICompositeModel(DMRIOptimizable):
         Returns:
             ProtocolAdaptionCallbacks: the protocol adaption callback for the gradient deformations.
         """
-        if self._input_data.gradient_deviations is None:
+        if not self._input_data.has_gradient_deviations():
             return None
 
         if not self._model_functions_info.has_protocol_parameter('g'):
             return None
 
-        def flatten_deviations_matrix(deviations):
-            """Converts a deviation matrix of shape (n, 3, 3) into (n, 9) and (n, m, 3, 3) into (n, m, 9)."""
-            if len(deviations.shape) > 3:
-                return deviations.reshape(-1, deviations.shape[1], 9)
-            else:
-                return deviations.reshape(-1, 9)
-
-        def compress_zeros(deviations):
-            """Find array indices that hold zeros throughout.
-
-            In some cases, the user only knows the diagonal of the deviations matrix, but still had to provide the
-            full matrix. In those cases we are wasting 2/3th of the memory on zeros. This method reduces the size
-            by removing the all-zero components from the deviations matrix.
-
-            Args:
-                deviations (ndarray): either an (n, 9) of an (n, m, 9) matrix
-
-            Returns:
-                 tuple: the compressed deviations matrix and a tuple of length 9 indicating the positions of the
-                    zero elements.
-            """
-            zero_locations = [np.all(gradient_deviations[..., ind] == 0) for ind in range(9)]
-
-            if any(zero_locations):
-                compressed_deviations = np.delete(deviations, [ind for ind in range(9) if zero_locations[ind]], axis=-1)
-                return compressed_deviations, zero_locations
-
-            return deviations, zero_locations
+        half_precision = use_half_precision_gradient_deviations()
+        layout = self._get_gradient_deviations_layout(half_precision)
 
-        def get_observation_multiplier(deviations):
-            """Get the multiplier for correctly indexing the matrix in the case of per volume deformation matrices.
-
-            If the user provide a deviation matrix per volume, we have to correctly index the matrices by
-            multiplying the number of non-compressed deviations with the observation index.
-
-            Args:
-                deviations (ndarray): either an (n, X) or an (n, m, X) matrix.
-
-            Returns:
-                int: if an (n, X) matrix is provided we will return 0 because we don't need to index based on
-                    volumes. If an (n, m, X) matrix is provided, we will return X.
-            """
-            if len(deviations.shape) > 2:
-                return deviations.shape[-1]
-            return 0
-
-        def get_cl_deviations_computation_code(zero_locations):
+        def get_cl_deviations_computation_code():
             """Get the CL computation code for the new non-normalized gradient vector.
 
-            This method takes into account the locations of the removed elements.
+            This method takes into account the locations of the removed elements and, for the half precision
+            storage, adds the identity matrix back to the stored deviations.
             """
             index_counter = 0
             elements = []
             for ind in range(9):
-                if zero_locations[ind]:
-                    elements.append('0')
+                is_diagonal = ind in (0, 4, 8)
+
+                if layout['zero_locations'][ind]:
+                    elements.append('1' if (half_precision and is_diagonal) else '0')
                 else:
-                    elements.append('gradient_deviations[{} + matrix_index]'.format(index_counter))
+                    if half_precision:
+                        element = 'vload_half({} + matrix_index, (global half*)gradient_deviations)'.format(
+                            index_counter)
+                        if is_diagonal:
+                            element = '(1 + ' + element + ')'
+                    else:
+                        element = 'gradient_deviations[{} + matrix_index]'.format(index_counter)
+                    elements.append(element)
                     index_counter += 1
 
             return '''
@@ -1094,21 +1236,17 @@ class DMRICompositeModel(DMRIOptimizable):
                 0);
             '''
 
-        gradient_deviations = flatten_deviations_matrix(self._input_data.gradient_deviations)
-        gradient_deviations, zero_locations = compress_zeros(gradient_deviations)
-
         parameters_needed = [p for p in ['g', 'b', 'G'] if self._model_functions_info.has_protocol_parameter(p)]
 
         function_arguments = [self._model_functions_info.get_protocol_parameter_by_name(p).ctype
                               + '* ' + p for p in parameters_needed]
-        function_arguments.append('global float* gradient_deviations')
+        function_arguments.append('global {}* gradient_deviations'.format('ushort' if half_precision else 'float'))
         function_arguments.append('uint observation_index')
 
         body = '''
-            const uint matrix_index = ''' + str(get_observation_multiplier(gradient_deviations)) + ''' 
-                                        * observation_index;
+            const uint matrix_index = ''' + str(layout['observation_multiplier']) + ''' * observation_index;
 
-            ''' + get_cl_deviations_computation_code(zero_locations) + '''
+            ''' + get_cl_deviations_computation_code() + '''
 
             mot_float_type new_g_length = length(new_g_non_normalized);
             *g = new_g_non_normalized / new_g_length;
@@ -1118,6 +1256,16 @@ class DMRICompositeModel(DMRIOptimizable):
         if 'G' in parameters_needed:
             body += '*G *= new_g_length;' + "\n"
 
+        for p in self._model_functions_info.get_unique_protocol_parameters():
+            if isinstance(p, PrecomputedProtocolParameter) and p.name not in parameters_needed \
+                    and set(p.protocol_parameter_names) & {'g', 'b', 'G'}:
+                if p.gradient_scaling is None or 'g' in p.protocol_parameter_names:
+                    raise ValueError('The precomputed protocol parameter "{}" depends on the gradient and can not be '
+                                     'combined with gradient deviations.'.format(p.name))
+                parameters_needed.append(p.name)
+                function_arguments.insert(len(parameters_needed) - 1, p.ctype + '* ' + p.name)
+                body += '*{} *= pown(new_g_length, {});'.format(p.name, int(p.gradient_scaling)) + "\n"
+
         class GradientDeviationProtocolUpdate(ProtocolAdaptionCallbacks):
 
             def get_protocol_parameter_names(self):
@@ -1127,13 +1275,85 @@ class DMRICompositeModel(DMRIOptimizable):
                 return SimpleCLFunction('void', 'gradient_deformations_protocol_callback', function_arguments, body)
 
             def get_kernel_input_data(self, voxels_to_analyze=None):
-                grad_dev = gradient_deviations
-                if voxels_to_analyze is not None:
-                    grad_dev = grad_dev[voxels_to_analyze, ...]
-                return {'gradient_deviations': Array(grad_dev, ctype='float')}
+                return {'gradient_deviations': Array(encode_deviations(voxels_to_analyze))}
+
+        def encode_deviations(voxels_to_analyze):
+            """Load and encode the deviations of the given voxels in the layout of the kernel.
+
+            In half precision, the float16 values are returned as their unsigned short bit patterns, which the kernel
+            reads using ``vload_half``.
+
+            Returns:
+                ndarray: an (n, X) or (n, m, X) matrix, with X the number of non-zero elements of the 3x3 matrices
+            """
+            deviations = self._input_data.get_gradient_deviations(voxels_to_analyze)
+            deviations = np.reshape(deviations, deviations.shape[:-2] + (9,))
+
+            if layout['volume_invariant'] and deviations.ndim > 2:
+                deviations = deviations[:, 0]
+
+            stored_elements = [ind for ind in range(9) if not layout['zero_locations'][ind]]
+            deviations = deviations[..., stored_elements]
+
+            if half_precision:
+                deviations -= np.eye(3).flatten()[stored_elements].astype(deviations.dtype)
+                return deviations.astype(np.float16).view(np.uint16)
+            return deviations.astype(np.float32, copy=False)
 
         return GradientDeviationProtocolUpdate()
 
+    def _get_gradient_deviations_layout(self, half_precision, batch_size=10000):
+        """Get the layout of the gradient deviations in the kernel data.
+
+        This makes one pass over the gradient deviations, in batches of voxels, to find:
+
+        - the elements of the 3x3 matrices which are zero throughout. In some cases, the user only knows the diagonal
+          of the deviations matrix, but still had to provide the full matrix. We do not store these elements in the
+          kernel data. For half precision storage, the deviations are stored minus the identity matrix, and we look
+          for the elements equal to the identity instead.
+        - if the deviations given per volume are the same for all volumes. If so, we store only one matrix per voxel.
+
+        The layout is cached until new input data is set.
+
+        Args:
+            half_precision (boolean): if the deviations are stored minus the identity matrix in half precision
+            batch_size (int): the number of voxels to load at once
+
+        Returns:
+            dict: with the elements ``zero_locations``, a list of length 9 indicating the elements not stored,
+                ``volume_invariant``, if we store only one matrix per voxel, and ``observation_multiplier``, the number
+                of elements to skip per observation index in the kernel.
+        """
+        if self._gradient_deviations_layout is not None \
+                and self._gradient_deviations_layout['half_precision'] == half_precision:
+            return self._gradient_deviations_layout
+
+        reference = np.eye(3).flatten() if half_precision else np.zeros(9)
+        zero_locations = np.ones(9, dtype=np.bool)
+        volume_invariant = True
+        per_volume = False
+
+        for batch_start, batch_end in split_in_batches(self._input_data.nmr_problems, batch_size):
+            deviations = self._input_data.get_gradient_deviations(np.arange(batch_start, batch_end))
+            deviations = np.reshape(deviations, deviations.shape[:-2] + (9,))
+
+            if deviations.ndim > 2:
+                per_volume = True
+                volume_invariant = volume_invariant and np.all(deviations == deviations[:, :1])
+
+            zero_locations &= np.all(np.reshape(deviations, (-1, 9)) == reference, axis=0)
+
+        volume_invariant = volume_invariant and per_volume
+        nmr_elements = int(np.count_nonzero(~zero_locations))
+
+        self._gradient_deviations_layout = {
+            'half_precision': half_precision,
+            'zero_locations': list(zero_locations),
+            'volume_invariant': volume_invariant,
+            'observation_multiplier': nmr_elements if (per_volume and not volume_invariant) else 0
+        }
+        return self._gradient_deviations_layout
+
     def _prepare_input_data(self, input_data):
         """Update the input data to make it suitable for this model.
 
@@ -1170,6 +1390,9 @@ class DMRICompositeModel(DMRIOptimizable):
         Also, by doing this here instead of in the Protocol class we ensure that the warnings end up in the log file.
         The final argument for putting this here is that I do not want any log output in the protocol tab.
 
+        The voxel-wise values are compared in batches of voxels, such that we do not need to create matrices with a
+        value for every voxel and every observation.
+
         Args:
             input_data (mdt.utils.MRIInputData): the input data to analyze.
         """
@@ -1177,17 +1400,30 @@ class DMRICompositeModel(DMRIOptimizable):
         def warn(warning):
             self._logger.warning('{}, proceeding with seemingly inconsistent values.'.format(warning))
 
-        def convert_to_total_map(value):
-            if is_scalar(value):
-                return np.ones((input_data.nmr_problems, input_data.nmr_observations)) * value
+        def as_broadcastable_map(value):
+            """Get the value as an array broadcastable to a (nmr_problems, nmr_observations) matrix, without copying"""
+            value = np.asarray(value)
+            if value.ndim == 0:
+                return value
             if value.shape[0] == input_data.nmr_observations:
-                return np.tile(np.squeeze(value)[None, :], (input_data.nmr_problems, 1))
-            if value.shape[0] == input_data.nmr_problems and value.shape[1] != input_data.nmr_observations:
-                return np.tile(np.squeeze(value)[:, None], (1, input_data.nmr_observations))
+                return np.reshape(value, (1, input_data.nmr_observations))
+            if value.shape[0] == input_data.nmr_problems:
+                if value.ndim == 1 or value.shape[1] != input_data.nmr_observations:
+                    return np.reshape(value, (input_data.nmr_problems, 1))
             return value
 
         def any_greater(a, b):
-            return np.any(np.greater(convert_to_total_map(a), convert_to_total_map(b)))
+            a, b = as_broadcastable_map(a), as_broadcastable_map(b)
+            voxelwise = [el.ndim == 2 and el.shape[0] == input_data.nmr_problems and el.shape[0] > 1 for el in (a, b)]
+            if not any(voxelwise):
+                return np.any(np.greater(a, b))
+
+            for batch_start, batch_end in split_in_batches(input_data.nmr_problems, 10000):
+                a_batch = a[batch_start:batch_end] if voxelwise[0] else a
+                b_batch = b[batch_start:batch_end] if voxelwise[1] else b
+                if np.any(np.greater(a_batch, b_batch)):
+                    return True
+            return False
 
         if input_data.has_input_data('TE') and input_data.has_input_data('TR'):
             if any_greater(input_data.get_input_data('TE'), input_data.get_input_data('TR')):
@@ -1361,19 +1597,60 @@ class DMRICompositeModel(DMRIOptimizable):
             if value is None:
                 raise ValueError('Could not find a suitable value for the protocol parameter "{}".'.format(p.name))
 
-            if all_elements_equal(value):
-                const_d = {p.name: Scalar(get_single_value(value), ctype=p.ctype)}
+            value, storage, _ = self._get_protocol_value_layout(value)
+
+            if storage == 'scalar':
+                return_data[p.name] = Scalar(value, ctype=p.ctype)
+            elif storage == 'voxelwise':
+                if voxels_to_analyze is not None:
+                    value = value[voxels_to_analyze, ...]
+                return_data[p.name] = Array(value, ctype=p.ctype)
             else:
-                if value.shape[0] == self._input_data.nmr_problems:
-                    if voxels_to_analyze is not None:
-                        value = value[voxels_to_analyze, ...]
-                    const_d = {p.name: Array(value, ctype=p.ctype)}
-                else:
-                    const_d = {p.name: Array(value, ctype=p.ctype, offset_str='0')}
-            return_data.update(const_d)
+                return_data[p.name] = Array(value, ctype=p.ctype, offset_str='0')
         return return_data
 
+    def _get_protocol_value_layout(self, value):
+        """Get the most compact layout of the given protocol value in the kernel data.
+
+        Protocol values can be given as a scalar, as a column with one value per observation, as a map with one value
+        per voxel or as a map with one value per voxel per observation. Voxel-wise maps which do not vary over the
+        voxels are stored as a single column, and maps with one value per voxel per observation which do not vary over
+        the observations are stored with a single value per voxel. The equality checks are done in batches of voxels.
+
+        Args:
+            value (float or ndarray): the protocol value as given in the input data or in the parameter
+
+        Returns:
+            tuple: the value to store in the kernel data, the type of storage (one of ``'scalar'``, ``'shared'``
+                for a single array used by all voxels or ``'voxelwise'`` for an array with a row per voxel) and the
+                index in the array to use in the kernel (None, ``'0'`` or ``'observation_index'``).
+        """
+        nmr_problems = self._input_data.nmr_problems
+        nmr_observations = self._input_data.nmr_observations
+
+        if _all_elements_equal(value):
+            return _get_first_element(value), 'scalar', None
+
+        value = np.asarray(value)
+        if value.shape[0] == nmr_problems and value.shape[0] != nmr_observations and value.ndim == 1:
+            value = value[:, None]
+
+        if value.shape[0] == nmr_problems and value.ndim > 1:
+            if value.shape[1] == nmr_observations:
+                if _all_rows_equal(value):
+                    return value[0], 'shared', 'observation_index'
+                if value.ndim == 2 and _all_columns_equal(value):
+                    return value[:, :1], 'voxelwise', '0'
+                return value, 'voxelwise', 'observation_index'
+            if _all_rows_equal(value):
+                return value[0], 'shared', '0'
+            return value, 'voxelwise', '0'
+        return value, 'shared', 'observation_index'
+
     def _get_protocol_value(self, parameter):
+        if isinstance(parameter, PrecomputedProtocolParameter):
+            return parameter.compute(self._get_protocol_value_by_name)
+
         if isinstance(parameter, ProtocolParameter):
             value = parameter.value
 
@@ -1381,15 +1658,39 @@ class DMRICompositeModel(DMRIOptimizable):
                 value = self._input_data.get_input_data(parameter.name)
             return value
 
+    def _get_protocol_value_by_name(self, name):
+        """Get the value of a protocol parameter by name, used as input to the precomputed protocol parameters.
+
+        Protocol columns are returned as vectors such that they broadcast with voxel-wise protocol maps.
+
+        Args:
+            name (str): the name of the protocol parameter
+
+        Returns:
+            float or ndarray: the value, or None if no value could be found
+        """
+        if self._input_data.has_input_data(name):
+            value = np.asarray(self._input_data.get_input_data(name))
+            if value.ndim == 2 and value.shape[1] == 1 and value.shape[0] == self._input_data.nmr_observations:
+                return value[:, 0]
+            return value
+
+        for p in self._model_functions_info.get_unique_protocol_parameters():
+            if p.name == name and p.value is not None:
+                return p.value
+        return None
+
     def _get_observations_data(self, voxels_to_analyze):
         """Get the observations to use in the kernel.
 
         Can return None if there are no observations.
         """
-        observations = self._input_data.observations
-        if observations is not None:
-            if voxels_to_analyze is not None:
-                observations = observations[voxels_to_analyze, ...]
+        if self._observations_override is not None:
+            observations = self._transform_observations(self._observations_override).astype(np.float32)
+            return {'observations': Array(observations)}
+
+        if self._input_data.has_observations():
+            observations = self._input_data.get_observations(voxels_to_analyze)
             observations = self._transform_observations(observations).astype(np.float32)
             return {'observations': Array(observations)}
         return {}
@@ -1501,13 +1802,10 @@ class DMRICompositeModel(DMRIOptimizable):
             value = self._get_protocol_value(p)
 
             if p.name not in protocol_params_seen:
-                if all_elements_equal(value):
-                    assignment = 'model_data->protocol->' + p.name
-                elif len(value.shape) > 1 and value.shape[0] == self._input_data.nmr_problems and \
-                    value.shape[1] != self._input_data.nmr_observations:
-                    assignment = 'model_data->protocol->' + p.name + '[0]'
-                else:
-                    assignment = 'model_data->protocol->' + p.name + '[observation_index]'
+                index = self._get_protocol_value_layout(value)[2]
+                assignment = 'model_data->protocol->' + p.name
+                if index is not None:
+                    assignment += '[' + index + ']'
                 func += "\t" * 4 + p.ctype + ' ' + p.name + ' = ' + assignment + ';' + "\n"
                 protocol_params_seen.append(p.name)
         return func
@@ -1556,8 +1854,8 @@ class DMRICompositeModel(DMRIOptimizable):
             value = self._model_functions_info.get_parameter_value('{}.{}'.format(m.name, p.name))
             param_name = '{}.{}'.format(m.name, p.name).replace('.', '_')
 
-            if all_elements_equal(value):
-                var_data_dict[param_name] = Scalar(get_single_value(value), ctype=p.ctype)
+            if _all_elements_equal(value):
+                var_data_dict[param_name] = Scalar(_get_first_element(value), ctype=p.ctype)
             else:
                 if voxels_to_analyze is not None:
                     value = value[voxels_to_analyze, ...]
@@ -1575,8 +1873,8 @@ class DMRICompositeModel(DMRIOptimizable):
             for elements, value in zip((lower_bounds, upper_bounds), (lower_bound, upper_bound)):
                 data = value
 
-                if all_elements_equal(value):
-                    elements.append(Scalar(get_single_value(data), ctype=p.ctype))
+                if _all_elements_equal(value):
+                    elements.append(Scalar(_get_first_element(data), ctype=p.ctype))
                 else:
                     if voxels_to_analyze is not None:
                         data = data[voxels_to_analyze, ...]
@@ -1799,7 +2097,7 @@ class DMRICompositeModel(DMRIOptimizable):
                 if isinstance(param, ProtocolParameter):
                     param_list.append(param.name)
                 elif isinstance(param, CurrentObservationParam):
-                    if self._input_data.observations is not None:
+                    if self._input_data.has_observations():
                         param_list.append('model_data->observations[observation_index]')
                     else:
                         param_list.append('0.0')
@@ -1859,6 +2157,176 @@ class DMRICompositeModel(DMRIOptimizable):
         return SimpleCLFunction(
             'double', '_evaluateModel', get_function_parameters(), get_function_body(), dependencies=get_dependencies())
 
+    def _get_numpy_signal_function(self):
+        """Get the NumPy counterpart of the composite model function.
+
+        Returns:
+            Callable or None: a function taking the dictionary with the parameter values (as returned by
+                :meth:`_get_numpy_parameter_values`) and returning the (n, m) matrix with the model signals. None if
+                this model can not be evaluated using NumPy.
+        """
+        operators = {'*': np.multiply, '+': np.add, '-': np.subtract, '/': np.divide}
+
+        if self._signal_noise_model is not None or self._get_protocol_update_callbacks():
+            return None
+        if any(node.data not in operators for node in self._model_tree.internal_nodes):
+            return None
+        if self._get_numpy_dependencies() is None:
+            return None
+
+        compartment_functions = {}
+        for compartment in self._model_functions_info.get_compartment_models():
+            if compartment.get_cache_init_function():
+                return None
+            compartment_functions[compartment.name] = get_numpy_function(compartment)
+            if compartment_functions[compartment.name] is None:
+                return None
+
+        def evaluate_compartment(compartment, values):
+            call_args = []
+            for p in compartment.get_parameters():
+                if isinstance(p, (ProtocolParameter, CurrentObservationParam)):
+                    call_args.append(values[p.name])
+                elif isinstance(p, NoiseStdInputParameter):
+                    std_param = self._model_functions_info.get_noise_std_param()
+                    call_args.append(values['{}.{}'.format(self._likelihood_function.name,
+                                                           std_param.name).replace('.', '_')])
+                else:
+                    call_args.append(values['{}.{}'.format(compartment.name, p.name).replace('.', '_')])
+            return compartment_functions[compartment.name](*call_args)
+
+        def evaluate_tree(node, values):
+            if not node.children:
+                return evaluate_compartment(node.data, values)
+            results = [evaluate_tree(child, values) for child in node.children]
+            signal = results[0]
+            for result in results[1:]:
+                signal = operators[node.data](signal, result)
+            return signal
+
+        def signal_function(values):
+            signal = evaluate_tree(self._model_tree, values)
+            return signal * np.ones((values['_nmr_problems'], self.get_nmr_observations()))
+        return signal_function
+
+    def _get_numpy_dependencies(self):
+        """Get the NumPy functions for the parameters fixed to a dependency.
+
+        Returns:
+            list or None: per dependent parameter (in the order of the CL parameter listing) a tuple with the
+                parameter name (with an underscore) and the function computing its value from the other parameter
+                values. None if any of the dependencies can not be translated.
+        """
+        names = ['{}.{}'.format(m.name, p.name).replace('.', '_')
+                 for m, p in self._model_functions_info.get_model_parameter_list()
+                 if isinstance(p, FreeParameter)]
+
+        dependencies = []
+        for m, p in self._model_functions_info.get_dependency_fixed_parameters_list(exclude_priors=True):
+            dependency = self._model_functions_info.get_parameter_value('{}.{}'.format(m.name, p.name))
+            if dependency.pre_transform_code:
+                return None
+
+            function = get_numpy_expression(self._convert_parameters_dot_to_bar(dependency.assignment_code), names)
+            if function is None:
+                return None
+            dependencies.append(('{}.{}'.format(m.name, p.name).replace('.', '_'), function))
+        return dependencies
+
+    def _get_numpy_parameter_values(self, parameters):
+        """Get the values of all the parameters and the protocol for use in the NumPy functions.
+
+        The values are shaped such that they broadcast to a (n, m) matrix for n problems and m observations, with
+        the vectors in the protocol having an extra last axis.
+
+        Args:
+            parameters (ndarray): the (n, p) matrix with the estimable parameters of the problems in the current
+                ``voxels_to_analyze``.
+
+        Returns:
+            dict: the values of the protocol parameters by name and of the model parameters by their names with
+                an underscore, like ``Stick0_theta``.
+        """
+        parameters = np.asarray(parameters, dtype=np.float64)
+        values = {'_nmr_problems': parameters.shape[0]}
+
+        for p in self._model_functions_info.get_unique_protocol_parameters():
+            values[p.name] = self._get_numpy_protocol_value(p)
+
+        for compartment in self._model_functions_info.get_compartment_models():
+            for p in compartment.get_parameters():
+                if isinstance(p, CurrentObservationParam):
+                    if self._input_data.has_observations() or self._observations_override is not None:
+                        values[p.name] = self._get_numpy_observations()
+                    else:
+                        values[p.name] = 0.0
+
+        for m, p in self._model_functions_info.get_value_fixed_parameters_list(exclude_priors=True):
+            value = self._model_functions_info.get_parameter_value('{}.{}'.format(m.name, p.name))
+            if _all_elements_equal(value):
+                value = float(_get_first_element(value))
+            else:
+                value = np.asarray(value, dtype=np.float64)
+                if self._voxels_to_analyze is not None:
+                    value = value[self._voxels_to_analyze, ...]
+                value = np.reshape(value, (-1, 1))
+            values['{}.{}'.format(m.name, p.name).replace('.', '_')] = value
+
+        estimable_parameters = self._model_functions_info.get_estimable_parameters_list(exclude_priors=True)
+        for ind, (m, p) in enumerate(estimable_parameters):
+            values['{}.{}'.format(m.name, p.name).replace('.', '_')] = parameters[:, ind, None]
+
+        for name, function in self._get_numpy_dependencies():
+            values[name] = function(**values)
+
+        return values
+
+    def _get_numpy_protocol_value(self, parameter):
+        """Get the value of the given protocol parameter, shaped for use in the NumPy functions.
+
+        This uses the same layouts as the kernel data, see :meth:`_get_protocol_value_layout`.
+
+        Returns:
+            float or ndarray: the value as a scalar or as an array broadcasting to the shape (n, m), with
+                a last axis of length three for vector parameters.
+        """
+        value, storage, index = self._get_protocol_value_layout(self._get_protocol_value(parameter))
+
+        if storage == 'scalar':
+            if parameter.is_vector_type:
+                return np.full((1, 1, 3), value, dtype=np.float64)
+            return float(value)
+
+        value = np.asarray(value, dtype=np.float64)
+        if storage == 'voxelwise':
+            if self._voxels_to_analyze is not None:
+                value = value[self._voxels_to_analyze, ...]
+        else:
+            value = value[None, ...]
+
+        if parameter.is_vector_type:
+            if index == 'observation_index':
+                return np.reshape(value, (value.shape[0], self.get_nmr_observations(), -1))[..., :3]
+            return np.reshape(value, (value.shape[0], 1, -1))[..., :3]
+
+        if index == 'observation_index':
+            return np.reshape(value, (value.shape[0], -1))
+        return np.reshape(value, (value.shape[0], -1))[:, :1]
+
+    def _get_numpy_observations(self):
+        """Get the (transformed) observations of the current ``voxels_to_analyze`` for use in the NumPy functions."""
+        if self._observations_override is not None:
+            return self._transform_observations(self._observations_override).astype(np.float32).astype(np.float64)
+        observations = self._input_data.get_observations(self._voxels_to_analyze)
+        return self._transform_observations(observations).astype(np.float32).astype(np.float64)
+
+    def _get_numpy_volume_weights(self):
+        """Get the volume weights of the current ``voxels_to_analyze`` for use in the NumPy functions."""
+        volume_weights = np.asarray(self._input_data.volume_weights).astype(np.float16).astype(np.float64)
+        if self._voxels_to_analyze is not None:
+            volume_weights = volume_weights[self._voxels_to_analyze]
+        return volume_weights
+
     def _get_protocol_update_callbacks(self):
         """Get a list of all protocol update callbacks"""
         protocol_update_callbacks = []
@@ -2675,6 +3143,48 @@ class ProtocolAdaptionCallbacks:
         raise NotImplementedError()
 
 
+def _all_elements_equal(value, batch_size=1000000):
+    """Check if all the elements of the given value are equal, comparing the elements in batches.
+
+    Args:
+        value (ndarray or number): a numpy array or a single number
+        batch_size (int): the number of elements to compare at once
+
+    Returns:
+        boolean: True if all elements are equal to each other, False otherwise
+    """
+    if is_scalar(value):
+        return True
+    value = np.reshape(value, (-1,))
+    for batch_start, batch_end in split_in_batches(value.shape[0], batch_size):
+        if not np.all(value[batch_start:batch_end] == value[0]):
+            return False
+    return True
+
+
+def _all_rows_equal(value, batch_size=10000):
+    """Check if all the rows (the elements on the first axis) of the given array are equal, in batches of rows."""
+    for batch_start, batch_end in split_in_batches(value.shape[0], batch_size):
+        if not np.all(value[batch_start:batch_end] == value[:1]):
+            return False
+    return True
+
+
+def _all_columns_equal(value, batch_size=10000):
+    """Check if every row of the given 2d array holds a single value, in batches of rows."""
+    for batch_start, batch_end in split_in_batches(value.shape[0], batch_size):
+        if not np.all(value[batch_start:batch_end] == value[batch_start:batch_end, :1]):
+            return False
+    return True
+
+
+def _get_first_element(value):
+    """Get the first element of the given array, or the value itself if it is a scalar."""
+    if is_scalar(value):
+        return value
+    return np.asarray(value).item(0)
+
+
 def calculate_dependent_parameters(kernel_data, estimated_parameters_list,
                                    parameters_listing, dependent_parameter_names, cl_runtime_info=None):
     """Calculate the dependent parameters
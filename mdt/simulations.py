@@ -1,10 +1,19 @@
+import hashlib
+import logging
+import os
+import time
 import numpy as np
 import collections
+import yaml
+from mdt.configuration import get_numpy_evaluation_max_nmr_problems
 from mdt.lib.components import get_model
 from mdt.lib.nifti import get_all_nifti_data
-from mdt.utils import create_roi, restore_volumes, MockMRIInputData
-from mot.lib.cl_function import SimpleCLFunction
+from mdt.utils import create_roi, restore_volumes, MockMRIInputData, cartesian_to_spherical
+from mot.configuration import CLRuntimeInfo
+from mot.lib.cl_function import SimpleCLFunction, _ProcedureWorker
 from mot.lib.kernel_data import Array, Zeros
+from mot.lib.utils import split_in_batches
+from mot.library_functions import Rand123
 
 __author__ = 'Robbert Harms'
 __date__ = '2017-05-29'
@@ -41,14 +50,7 @@ def create_signal_estimates(model, input_data, parameters):
     parameters = create_roi(parameters, input_data.mask)
     parameters = model.param_dict_to_array(parameters)
 
-    kernel_data = {'data': model.get_kernel_data(),
-                   'parameters': Array(parameters, ctype='mot_float_type'),
-                   'estimates': Zeros((parameters.shape[0], model.get_nmr_observations()), 'mot_float_type')}
-
-    _get_simulate_function(model).evaluate(kernel_data, parameters.shape[0])
-    results = kernel_data['estimates'].get_data()
-
-    return restore_volumes(results, input_data.mask)
+    return restore_volumes(_evaluate_model(model, parameters), input_data.mask)
 
 
 def simulate_signals(model, protocol, parameters):
@@ -75,15 +77,7 @@ def simulate_signals(model, protocol, parameters):
     if isinstance(parameters, collections.Mapping):
         parameters = model.param_dict_to_array(parameters)
 
-    nmr_problems = parameters.shape[0]
-
-    kernel_data = {'data': model.get_kernel_data(),
-                   'parameters': Array(parameters, ctype='mot_float_type'),
-                   'estimates': Zeros((nmr_problems, model.get_nmr_observations()), 'mot_float_type')
-                   }
-
-    _get_simulate_function(model).evaluate(kernel_data, nmr_problems)
-    return kernel_data['estimates'].get_data()
+    return _evaluate_model(model, parameters)
 
 
 def add_rician_noise(signals, noise_level, seed=None):
@@ -104,7 +98,486 @@ def add_rician_noise(signals, noise_level, seed=None):
     random_state = np.random.RandomState(seed)
     x = noise_level * random_state.normal(size=signals.shape) + signals
     y = noise_level * random_state.normal(size=signals.shape)
-    return np.sqrt(x**2, y**2).astype(signals.dtype)
+    return np.sqrt(x**2 + y**2).astype(signals.dtype)
+
+
+def stream_simulated_signals(model, protocol, parameter_distributions, nmr_samples, output_dir, snrs=None,
+                             noise_type='rician', noise_reference='S0.s0', store_noiseless=False, chunk_size=10000,
+                             seed=None):
+    """Simulate a large number of (noisy) model signals, streaming the results to ``.npy`` files.
+
+    This draws the model parameters from the given distributions and evaluates the model signals in chunks of
+    samples. The noise is added in the same kernel as the model evaluation, using a counter based random number
+    generator. The results are written per chunk to memory mapped ``.npy`` files in the output directory:
+
+    * ``parameters.npy``: a (n, p) matrix with the drawn parameters, in the order of ``parameter_names`` in the settings
+    * ``signals.npy``: a (n, m) matrix with the noiseless signals, if no SNRs are given or if ``store_noiseless`` is set
+    * ``noisy_signals.npy``: a (n, s, m) matrix with for every SNR the noisy signals, if SNRs are given
+
+    Next to these, ``settings.yaml`` stores the simulation settings and ``completed_chunks.npy`` the chunks which
+    have been completed. When called again with the same settings and output directory, the simulation resumes
+    with the chunks which were not yet completed. Since the random numbers of each chunk only depend on the seed and
+    the chunk index, a resumed simulation gives the same results as an uninterrupted one. The throughput is logged
+    after every chunk.
+
+    Args:
+        model (str or model): the model or the name of the model to simulate
+        protocol (mdt.protocols.Protocol): the protocol we will use for the signal simulation
+        parameter_distributions (dict): for every free parameter of the model a
+            :class:`SimulationDistribution` or a scalar for a constant value. Distributions drawing multiple parameters
+            at once, like :class:`UniformOrientation`, use a tuple of parameter names as key.
+        nmr_samples (int): the number of parameter sets to simulate
+        output_dir (str): the directory to write the results to
+        snrs (float or list of float): the signal to noise ratios for which to generate noisy signals
+        noise_type (str): the type of noise to add, either 'rician' or 'gaussian'
+        noise_reference (str or float): the signal relative to which the SNRs are defined, the noise standard deviation
+            is this value divided by the SNR. Either the name of a model parameter, like the default ``S0.s0``,
+            or a constant value.
+        store_noiseless (boolean): if set, we also store the noiseless signals when SNRs are given
+        chunk_size (int): the number of samples to simulate and write at once
+        seed (int): the seed for the random number generation. If not given, we use a random seed, or on resume the
+            seed of the simulation we are resuming.
+
+    Returns:
+        dict: read only memory maps of the results, with the keys 'parameters', 'signals' and 'noisy_signals'
+            (if applicable).
+
+    Raises:
+        ValueError: if the output directory contains a simulation with different settings
+    """
+    logger = logging.getLogger(__name__)
+
+    if isinstance(model, str):
+        model = get_model(model)()
+    model.set_input_data(MockMRIInputData(protocol=protocol))
+
+    if noise_type not in ('rician', 'gaussian'):
+        raise ValueError('The noise type should be one of "rician" or "gaussian", "{}" given.'.format(noise_type))
+
+    snrs = [] if snrs is None else [float(snr) for snr in np.atleast_1d(snrs)]
+    parameter_names = model.get_free_param_names()
+    distributions = _get_simulation_distributions(parameter_distributions, parameter_names)
+
+    if isinstance(noise_reference, str) and snrs and noise_reference not in parameter_names:
+        raise ValueError('The noise reference "{}" is not a free parameter of the model.'.format(noise_reference))
+
+    settings = {'model': model.name,
+                'protocol_checksum': _get_protocol_checksum(protocol),
+                'parameter_names': parameter_names,
+                'parameter_distributions': [[list(names), repr(distribution)] for names, distribution in distributions],
+                'nmr_samples': int(nmr_samples),
+                'chunk_size': int(chunk_size),
+                'snrs': snrs,
+                'noise_type': noise_type,
+                'noise_reference': noise_reference if isinstance(noise_reference, str) else float(noise_reference),
+                'store_noiseless': bool(store_noiseless),
+                'seed': seed}
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    settings_file = os.path.join(output_dir, 'settings.yaml')
+    resume = os.path.isfile(settings_file)
+    if resume:
+        with open(settings_file, 'r') as f:
+            previous_settings = yaml.safe_load(f)
+        if seed is None:
+            settings['seed'] = previous_settings.get('seed')
+        if previous_settings != settings:
+            raise ValueError('The output directory "{}" contains a simulation with different settings.'.format(
+                output_dir))
+    else:
+        if seed is None:
+            settings['seed'] = int(np.random.randint(np.iinfo(np.int32).max))
+        with open(settings_file, 'w') as f:
+            yaml.safe_dump(settings, f, default_flow_style=False)
+
+    nmr_observations = model.get_nmr_observations()
+    shapes = {'parameters': (nmr_samples, len(parameter_names))}
+    if not snrs or store_noiseless:
+        shapes['signals'] = (nmr_samples, nmr_observations)
+    if snrs:
+        shapes['noisy_signals'] = (nmr_samples, len(snrs), nmr_observations)
+
+    chunks = list(split_in_batches(nmr_samples, chunk_size))
+    missing_outputs = [name for name in shapes if not os.path.isfile(os.path.join(output_dir, name + '.npy'))]
+    outputs = {name: _open_output_memmap(os.path.join(output_dir, name + '.npy'), np.float32, shape)
+               for name, shape in shapes.items()}
+    completed_chunks = _open_output_memmap(os.path.join(output_dir, 'completed_chunks.npy'), np.bool, (len(chunks),))
+    if missing_outputs:
+        completed_chunks[:] = False
+
+    simulate_kernel = _SimulationKernel(
+        _get_noisy_simulate_function(model, len(snrs), noise_type, 'signals' in shapes))
+    model_kernel_data = model.get_kernel_data()
+
+    logger.info('Simulating {} samples of the model {} in {} chunks, {} chunks were already completed.'.format(
+        nmr_samples, model.name, len(chunks), np.count_nonzero(completed_chunks)))
+    start_time = time.time()
+    nmr_simulated = 0
+
+    for chunk_index, (chunk_start, chunk_end) in enumerate(chunks):
+        if completed_chunks[chunk_index]:
+            continue
+
+        chunk_start_time = time.time()
+        random_state = np.random.RandomState([settings['seed'], chunk_index])
+        parameters = _draw_simulation_parameters(distributions, parameter_names, chunk_end - chunk_start,
+                                                 random_state)
+
+        kernel_data = {'data': model_kernel_data,
+                       'parameters': Array(parameters, ctype='mot_float_type')}
+        if 'signals' in shapes:
+            kernel_data['signals'] = Zeros((parameters.shape[0], nmr_observations), 'float')
+        if snrs:
+            if isinstance(noise_reference, str):
+                reference = parameters[:, parameter_names.index(noise_reference), None]
+            else:
+                reference = np.full((parameters.shape[0], 1), noise_reference)
+            rng_state = random_state.uniform(0, np.iinfo(np.uint32).max + 1, size=(parameters.shape[0], 6))
+            kernel_data.update({
+                'noise_stds': Array((reference / np.array(snrs)[None, :]).astype(np.float32), ctype='float'),
+                'rng_state': Array(rng_state.astype(np.uint32), ctype='uint'),
+                'noisy_signals': Zeros((parameters.shape[0], len(snrs) * nmr_observations), 'float')})
+
+        simulate_kernel.evaluate(kernel_data, parameters.shape[0])
+
+        outputs['parameters'][chunk_start:chunk_end] = parameters
+        if 'signals' in shapes:
+            outputs['signals'][chunk_start:chunk_end] = kernel_data['signals'].get_data()
+        if snrs:
+            outputs['noisy_signals'][chunk_start:chunk_end] = np.reshape(
+                kernel_data['noisy_signals'].get_data(), (-1, len(snrs), nmr_observations))
+        for output in outputs.values():
+            output.flush()
+
+        completed_chunks[chunk_index] = True
+        completed_chunks.flush()
+
+        nmr_simulated += chunk_end - chunk_start
+        logger.info('Simulated chunk {} of {}, {:.0f} samples per second ({:.0f} overall).'.format(
+            chunk_index + 1, len(chunks), (chunk_end - chunk_start) / (time.time() - chunk_start_time),
+            nmr_simulated / (time.time() - start_time)))
+
+    if nmr_simulated:
+        duration = time.time() - start_time
+        logger.info('Simulated {} samples in {:.1f} seconds, {:.0f} samples per second.'.format(
+            nmr_simulated, duration, nmr_simulated / duration))
+
+    del outputs, completed_chunks
+    return {name: np.load(os.path.join(output_dir, name + '.npy'), mmap_mode='r') for name in shapes}
+
+
+def _open_output_memmap(path, dtype, shape):
+    """Open one of the output files of :func:`stream_simulated_signals` for writing.
+
+    This opens existing files for resuming and creates the files which do not yet exist, for example when a previous
+    simulation was interrupted before all the output files were created.
+    """
+    if os.path.isfile(path):
+        return np.lib.format.open_memmap(path, mode='r+')
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+class _SimulationKernel:
+
+    def __init__(self, cl_function, cl_runtime_info=None):
+        """Evaluates the given CL function for every chunk of the simulations, compiling the kernel only once.
+
+        The method :meth:`~mot.lib.cl_function.SimpleCLFunction.evaluate` compiles the kernel on every call. Since
+        all chunks use the same kernel source, this keeps the compiled programs and only creates new buffers per chunk.
+
+        Args:
+            cl_function (mot.lib.cl_function.CLFunction): the function to evaluate
+            cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information
+        """
+        self._cl_function = cl_function
+        self._cl_runtime_info = cl_runtime_info or CLRuntimeInfo()
+        self._programs = {}
+
+    def evaluate(self, kernel_data, nmr_instances):
+        """Evaluate the CL function for all the instances of one chunk.
+
+        Args:
+            kernel_data (dict[str: mot.lib.kernel_data.KernelData]): the data to use as input to the function
+            nmr_instances (int): the number of instances to evaluate
+        """
+        workers = [_CachedProgramWorker(self._programs, cl_environment, self._cl_runtime_info.compile_flags,
+                                        self._cl_function, kernel_data, self._cl_runtime_info.double_precision, False)
+                   for cl_environment in self._cl_runtime_info.cl_environments]
+
+        for batch_start, batch_end in split_in_batches(nmr_instances, 1e4 * len(workers)):
+            items_per_worker = [(batch_end - batch_start) // len(workers) for _ in range(len(workers) - 1)]
+            items_per_worker.append(batch_end - batch_start - sum(items_per_worker))
+
+            offset = batch_start
+            for worker, nmr_items in zip(workers, items_per_worker):
+                if nmr_items:
+                    worker.calculate(offset, offset + nmr_items)
+                    worker.cl_queue.flush()
+                offset += nmr_items
+
+            for worker in workers:
+                worker.cl_queue.finish()
+
+
+class _CachedProgramWorker(_ProcedureWorker):
+
+    def __init__(self, programs, *args):
+        """A MOT procedure worker which takes the compiled program from the given cache, if present.
+
+        Args:
+            programs (dict): the compiled programs, per CL context and kernel source
+            *args: the arguments to the MOT procedure worker
+        """
+        self._programs = programs
+        super().__init__(*args)
+
+    def _build_kernel(self, kernel_source, compile_flags=()):
+        key = (self._cl_context.int_ptr, kernel_source)
+        if key not in self._programs:
+            self._programs[key] = super()._build_kernel(kernel_source, compile_flags)
+        return self._programs[key]
+
+
+class SimulationDistribution:
+    """The distribution of one or more model parameters in :func:`stream_simulated_signals`."""
+
+    def draw(self, nmr_samples, random_state):
+        """Draw samples from this distribution.
+
+        Args:
+            nmr_samples (int): the number of samples to draw
+            random_state (numpy.random.RandomState): the random state to use for drawing the samples
+
+        Returns:
+            ndarray: a vector with the samples, or a (n, k) matrix for distributions over k parameters
+        """
+        raise NotImplementedError()
+
+
+class Constant(SimulationDistribution):
+
+    def __init__(self, value):
+        """A constant value for the parameter."""
+        self.value = value
+
+    def draw(self, nmr_samples, random_state):
+        return np.full(nmr_samples, self.value, dtype=np.float64)
+
+    def __repr__(self):
+        return 'Constant({!r})'.format(self.value)
+
+
+class Uniform(SimulationDistribution):
+
+    def __init__(self, low, high):
+        """The uniform distribution between ``low`` and ``high``."""
+        self.low = low
+        self.high = high
+
+    def draw(self, nmr_samples, random_state):
+        return random_state.uniform(self.low, self.high, nmr_samples)
+
+    def __repr__(self):
+        return 'Uniform({!r}, {!r})'.format(self.low, self.high)
+
+
+class Normal(SimulationDistribution):
+
+    def __init__(self, mean, std, low=-np.inf, high=np.inf):
+        """The normal distribution, optionally truncated to the interval [low, high] by redrawing.
+
+        Args:
+            mean (float): the mean of the distribution
+            std (float): the standard deviation of the distribution
+            low (float): the lower limit of the samples
+            high (float): the upper limit of the samples
+        """
+        self.mean = mean
+        self.std = std
+        self.low = low
+        self.high = high
+
+    def draw(self, nmr_samples, random_state):
+        samples = random_state.normal(self.mean, self.std, nmr_samples)
+        outside = (samples < self.low) | (samples > self.high)
+        while np.any(outside):
+            samples[outside] = random_state.normal(self.mean, self.std, np.count_nonzero(outside))
+            outside = (samples < self.low) | (samples > self.high)
+        return samples
+
+    def __repr__(self):
+        return 'Normal({!r}, {!r}, low={!r}, high={!r})'.format(self.mean, self.std, self.low, self.high)
+
+
+class UniformOrientation(SimulationDistribution):
+
+    def __init__(self):
+        """Orientations uniformly distributed over the sphere, drawing the angles ``theta`` and ``phi`` at once.
+
+        Use this with a tuple of the two parameter names as key, for example ``('Stick0.theta', 'Stick0.phi')``.
+        """
+
+    def draw(self, nmr_samples, random_state):
+        theta, phi = cartesian_to_spherical(random_state.normal(size=(nmr_samples, 3)))
+        return np.concatenate([theta[:, None], phi[:, None]], axis=1)
+
+    def __repr__(self):
+        return 'UniformOrientation()'
+
+
+def _get_simulation_distributions(parameter_distributions, parameter_names):
+    """Get the list of distributions as tuples with the parameter names and the distribution.
+
+    Raises:
+        ValueError: if not all the parameters are covered by exactly one distribution
+    """
+    distributions = []
+    for names, distribution in parameter_distributions.items():
+        if isinstance(names, str):
+            names = (names,)
+        if not isinstance(distribution, SimulationDistribution):
+            distribution = Constant(distribution)
+        distributions.append((tuple(names), distribution))
+
+    declared = [name for names, _ in distributions for name in names]
+    unknown = [name for name in declared if name not in parameter_names]
+    missing = [name for name in parameter_names if name not in declared]
+    if unknown or missing or len(set(declared)) != len(declared):
+        raise ValueError('The parameter distributions should declare every free parameter once, missing: {}, '
+                         'not free: {}. Use unfix() on the model to simulate fixed parameters.'.format(
+                             missing, unknown))
+    return distributions
+
+
+def _draw_simulation_parameters(distributions, parameter_names, nmr_samples, random_state):
+    """Draw the parameters of one chunk of the simulations, with the columns in the order of the parameter names."""
+    parameters = np.zeros((nmr_samples, len(parameter_names)), dtype=np.float32)
+    for names, distribution in distributions:
+        samples = np.reshape(distribution.draw(nmr_samples, random_state), (nmr_samples, len(names)))
+        for ind, name in enumerate(names):
+            parameters[:, parameter_names.index(name)] = samples[:, ind]
+    return parameters
+
+
+def _get_protocol_checksum(protocol):
+    """Get a checksum of the values of the protocol, to detect changes in the protocol when resuming simulations."""
+    checksum = hashlib.md5()
+    for name in sorted(protocol.column_names):
+        checksum.update(name.encode('utf-8'))
+        checksum.update(np.ascontiguousarray(protocol.get_column(name), dtype=np.float64).tobytes())
+    return checksum.hexdigest()
+
+
+def _evaluate_model(model, parameters):
+    """Evaluate the model signals for the given parameters.
+
+    For small numbers of problems (see the ``numpy_evaluation`` section of the configuration) and models which can
+    be translated to NumPy, this evaluates the model in NumPy. Else, this evaluates the model using OpenCL.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model with the input data loaded
+        parameters (ndarray): the matrix with the model parameters, one row per problem
+
+    Returns:
+        ndarray: a 2d array with for every parameter combination the model signal
+    """
+    nmr_problems = parameters.shape[0]
+
+    if nmr_problems <= get_numpy_evaluation_max_nmr_problems():
+        numpy_function = model.get_numpy_model_eval_function()
+        if numpy_function is not None:
+            return numpy_function(parameters).astype(np.float32)
+
+    kernel_data = {'data': model.get_kernel_data(),
+                   'parameters': Array(parameters, ctype='mot_float_type'),
+                   'estimates': Zeros((nmr_problems, model.get_nmr_observations()), 'mot_float_type')
+                   }
+
+    _get_simulate_function(model).evaluate(kernel_data, nmr_problems)
+    return kernel_data['estimates'].get_data()
+
+
+def _get_noisy_simulate_function(model, nmr_snrs, noise_type, store_noiseless):
+    """Get the simulation function which adds the noise to the model signals.
+
+    Like :func:`_get_simulate_function`, this wraps the model evaluation function. Next to the noiseless signals,
+    this generates for every SNR the signals with Rician or Gaussian noise, using the Random123 generator. Since every
+    call to the generator gives four normally distributed values, we use these for two (Rician) or four (Gaussian)
+    noisy observations.
+    """
+    eval_function_info = model.get_model_eval_function()
+    nmr_observations = model.get_nmr_observations()
+
+    parameters = ['void* data', 'local mot_float_type* parameters']
+    body = ''
+    if store_noiseless:
+        parameters.append('global float* signals')
+    if nmr_snrs:
+        parameters.extend(['global float* noise_stds', 'global uint* rng_state', 'global float* noisy_signals'])
+        body += '''
+            uint rng_state_private[8] = {rng_state[0], rng_state[1], rng_state[2],
+                                         rng_state[3], rng_state[4], rng_state[5], 0, 0};
+            rand123_data rand123_rng_data = rand123_initialize_data(rng_state_private);
+            float4 normals;
+            float noise[4];
+            uint noise_index = 4;
+        '''
+
+    body += '''
+        float signal;
+        for(uint i = 0; i < ''' + str(nmr_observations) + '''; i++){
+            signal = ''' + eval_function_info.get_cl_function_name() + '''(data, parameters, i);
+    '''
+    if store_noiseless:
+        body += '''
+            signals[i] = signal;
+        '''
+    if nmr_snrs:
+        if noise_type == 'rician':
+            noisy_signal = ('length((float2)(signal + noise_stds[j] * noise[noise_index], '
+                            'noise_stds[j] * noise[noise_index + 1]))')
+            nmr_normals = 2
+        else:
+            noisy_signal = 'signal + noise_stds[j] * noise[noise_index]'
+            nmr_normals = 1
+        body += '''
+            for(uint j = 0; j < ''' + str(nmr_snrs) + '''; j++){
+                if(noise_index == 4){
+                    normals = simulation_randn4(&rand123_rng_data);
+                    noise[0] = normals.x; noise[1] = normals.y; noise[2] = normals.z; noise[3] = normals.w;
+                    noise_index = 0;
+                }
+                noisy_signals[j * ''' + str(nmr_observations) + ''' + i] = ''' + noisy_signal + ''';
+                noise_index += ''' + str(nmr_normals) + ''';
+            }
+        '''
+    body += '''
+        }
+    '''
+    return SimpleCLFunction('void', 'simulate_noisy', parameters, body,
+                            dependencies=[eval_function_info, _get_normal_distribution_function()])
+
+
+def _get_normal_distribution_function():
+    """Get the CL function generating four standard normal random numbers in single precision.
+
+    This applies the Box-Muller transform on the random bits of one call to the Random123 generator. In contrast to the
+    Random123 functions of MOT, this computes in single precision, which suffices for the single precision output, and
+    maps the random bits to the uniform interval (0, 1] such that the logarithm is always finite.
+    """
+    return SimpleCLFunction.from_string('''
+        float4 simulation_randn4(rand123_data* rng_data){
+            float4 uniforms = (convert_float4(rand123_generate_bits(rng_data)) + 0.5f) * (1 / 4294967296.0f);
+            rand123_increment_counters(rng_data);
+
+            float2 radii = sqrt(-2 * log(uniforms.xz));
+            float2 cosines;
+            float2 sines = sincos(2 * M_PI_F * uniforms.yw, &cosines);
+            return (float4)(radii.x * cosines.x, radii.x * sines.x, radii.y * cosines.y, radii.y * sines.y);
+        }
+    ''', dependencies=[Rand123()])
 
 
 def _get_simulate_function(model):
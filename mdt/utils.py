@@ -16,7 +16,7 @@ from numpy.lib.format import open_memmap
 import mot.lib.utils
 from mdt.lib.components import get_model
 from mdt.configuration import get_config_dir
-from mdt.configuration import get_logging_configuration_dict, get_tmp_results_dir
+from mdt.configuration import get_logging_configuration_dict, get_tmp_results_dir, get_observations_storage_type
 from mdt.lib.deferred_mappings import DeferredActionDict, DeferredActionTuple
 from mdt.lib.exceptions import NoiseStdEstimationNotPossible
 from mdt.lib.log_handlers import ModelOutputLogHandler
@@ -90,6 +90,31 @@ class MRIInputData:
         """
         raise NotImplementedError()
 
+    def has_observations(self):
+        """Check if this input data has observations.
+
+        Returns:
+            boolean: if observations are present
+        """
+        return self.observations is not None
+
+    def get_observations(self, voxels_to_analyze=None):
+        """Get the observations of all voxels or of a subset of the voxels.
+
+        Contrary to the property :attr:`observations`, this allows implementing classes to store the observations in a
+        compact data type and only convert the requested voxels.
+
+        Args:
+            voxels_to_analyze (ndarray): if given, the indices of the voxels for which we want the observations
+
+        Returns:
+            None or ndarray: the (n, d) matrix with the observations of the (selected) voxels
+        """
+        observations = self.observations
+        if observations is None or voxels_to_analyze is None:
+            return observations
+        return observations[voxels_to_analyze]
+
     @property
     def noise_std(self):
         """The noise standard deviation we will use during model evaluation.
@@ -151,6 +176,32 @@ class MRIInputData:
         """
         return None
 
+    def has_gradient_deviations(self):
+        """Check if this input data has gradient deviations.
+
+        Returns:
+            boolean: if gradient deviations are present
+        """
+        return self.gradient_deviations is not None
+
+    def get_gradient_deviations(self, voxels_to_analyze=None):
+        """Get the gradient deviations for all voxels or for a subset of the voxels.
+
+        Contrary to the property :attr:`gradient_deviations`, this allows implementing classes to only load the
+        deviations of the requested voxels, for example from a memory mapped volume.
+
+        Args:
+            voxels_to_analyze (ndarray): if given, the indices of the voxels for which we want the deviations
+
+        Returns:
+            None or ndarray: either a (n, 3, 3) or a (n, m, 3, 3) matrix with the deviations for the (selected) voxels.
+                If not applicable, return None.
+        """
+        gradient_deviations = self.gradient_deviations
+        if gradient_deviations is None or voxels_to_analyze is None:
+            return gradient_deviations
+        return gradient_deviations[voxels_to_analyze]
+
     @property
     def volume_weights(self):
         """Get the volume weights per voxel.
@@ -185,7 +236,7 @@ class MRIInputData:
 class SimpleMRIInputData(MRIInputData):
 
     def __init__(self, protocol, signal4d, mask, nifti_header, extra_protocol=None, gradient_deviations=None,
-                 noise_std=None, volume_weights=None):
+                 noise_std=None, volume_weights=None, observations_storage_type=None):
         """An implementation of the input data for diffusion MRI models.
 
         Args:
@@ -222,6 +273,12 @@ class SimpleMRIInputData(MRIInputData):
             volume_weights (ndarray): if given, a float matrix of the same size as the volume with per voxel and volume
                 a weight in [0, 1]. If set, these weights are used during model fitting to weigh the objective function
                 values per observation.
+
+            observations_storage_type (str): the data type in which we store the observations of the voxels in the
+                mask, one of 'native' (the data type of the DWI volume), 'float16' or 'int16' (with a scale factor per
+                volume). The compact types are converted to single precision by :meth:`get_observations`. If not
+                given, we use the ``observations`` section of the configuration. With a compact type, this object
+                no longer references the DWI volume after the observations are created, see :attr:`signal4d`.
         """
         self._logger = logging.getLogger(__name__)
         self._signal4d = signal4d
@@ -229,11 +286,16 @@ class SimpleMRIInputData(MRIInputData):
         self._mask = mask
         self._protocol = protocol
         self._observation_list = None
+        self._observation_scales = None
+        self._observations_storage_type = observations_storage_type or get_observations_storage_type()
+        self._parent = None
+        self._volume_indices = None
         self._extra_protocol = self._preload_extra_protocol_items(extra_protocol)
         self._noise_std = noise_std
 
         self._gradient_deviations = gradient_deviations
         self._gradient_deviations_list = None
+        self._mask_coordinates = None
 
         self._volume_weights = volume_weights
         self._volume_weights_list = None
@@ -251,6 +313,10 @@ class SimpleMRIInputData(MRIInputData):
         if self._volume_weights is not None and self._volume_weights.shape != self._signal4d.shape:
             raise ValueError('The dimensions of the volume weights does not match the dimensions of the signal4d.')
 
+        if self._observations_storage_type not in ('native', 'float16', 'int16'):
+            raise ValueError('The observations storage type should be one of "native", "float16" or "int16", '
+                             '"{}" given.'.format(self._observations_storage_type))
+
     def has_input_data(self, parameter_name):
         try:
             self.get_input_data(parameter_name)
@@ -292,7 +358,22 @@ class SimpleMRIInputData(MRIInputData):
         """
         args = [self._protocol, self.signal4d, self._mask, self.nifti_header]
         kwargs = dict(extra_protocol=self._extra_protocol, gradient_deviations=self._gradient_deviations,
-                      noise_std=self._noise_std)
+                      noise_std=self._noise_std, volume_weights=self._volume_weights,
+                      observations_storage_type=self._observations_storage_type)
+
+        if self._parent is not None:
+            parent_kwargs = self._parent._get_constructor_args()[1]
+
+            gradient_deviations = parent_kwargs['gradient_deviations']
+            if gradient_deviations is not None and gradient_deviations.ndim > 4 \
+                    and gradient_deviations.shape[3] == self._parent.nmr_observations:
+                gradient_deviations = gradient_deviations[:, :, :, self._volume_indices]
+
+            volume_weights = parent_kwargs['volume_weights']
+            if volume_weights is not None:
+                volume_weights = volume_weights[..., self._volume_indices]
+
+            kwargs.update(gradient_deviations=gradient_deviations, volume_weights=volume_weights)
         return args, kwargs
 
     def get_subset(self, volumes_to_keep=None, volumes_to_remove=None):
@@ -311,32 +392,33 @@ class SimpleMRIInputData(MRIInputData):
             volumes_to_keep = list(range(self.nmr_observations))
             volumes_to_keep = [ind for ind in volumes_to_keep if ind not in volumes_to_remove]
 
-        new_protocol = self.protocol
-        if self.protocol is not None:
-            new_protocol = self.protocol.get_new_protocol_with_indices(volumes_to_keep)
+        volume_indices = np.array(volumes_to_keep, dtype=np.int64)
+        if self._parent is not None:
+            return self._parent._create_volume_subset(self._volume_indices[volume_indices])
+        return self._create_volume_subset(volume_indices)
 
-        new_dwi_volume = self.signal4d
-        if self.signal4d is not None:
-            new_dwi_volume = self.signal4d[..., volumes_to_keep]
+    def _create_volume_subset(self, volume_indices):
+        """Create an input data object with a subset of the volumes, referencing the data of this object.
 
-        new_volume_weights = self._volume_weights
-        if self._volume_weights is not None:
-            new_volume_weights = new_volume_weights[..., volumes_to_keep]
+        The subset does not copy the DWI volume, the gradient deviations or the volume weights. Instead, it selects the
+        volumes at the moment the data of a batch of voxels is requested, for example in :meth:`get_observations`.
+        The observations of the voxels in the mask are loaded once by this object and shared by all its subsets.
 
-        new_gradient_deviations = self._gradient_deviations
-        if self._gradient_deviations is not None:
-            if self._gradient_deviations.ndim > 4 and self._gradient_deviations[3] == self.protocol.length:
-                if self._gradient_deviations.ndim == 5:
-                    new_gradient_deviations = self._gradient_deviations[..., volumes_to_keep, :]
-                else:
-                    new_gradient_deviations = self._gradient_deviations[..., volumes_to_keep, :, :]
+        Args:
+            volume_indices (ndarray): the indices of the volumes to keep
 
-        return self.copy_with_updates(new_protocol, new_dwi_volume, gradient_deviations=new_gradient_deviations,
-                                      volume_weights=new_volume_weights)
+        Returns:
+            SimpleMRIInputData: the input data of the subset of the volumes
+        """
+        new_protocol = self._protocol.get_new_protocol_with_indices(volume_indices)
+        subset = self.copy_with_updates(new_protocol, None, gradient_deviations=None, volume_weights=None)
+        subset._parent = self
+        subset._volume_indices = volume_indices
+        return subset
 
     @property
     def nmr_problems(self):
-        return self.observations.shape[0]
+        return self._get_observation_list().shape[0]
 
     @property
     def nmr_observations(self):
@@ -344,6 +426,22 @@ class SimpleMRIInputData(MRIInputData):
 
     @property
     def signal4d(self):
+        """Return the 4d volume with on the first three axis the voxel coordinates and on the last axis the volumes.
+
+        For a subset of the volumes of another input data object, this creates a new volume with the selected volumes
+        on every call.
+
+        If the observations are stored in a compact data type, we drop the reference to the DWI volume after creating
+        the observations. Afterwards, this restores a single precision volume from the stored observations on every
+        call, with zeros outside of the mask.
+
+        Returns:
+            ndarray: a 4d numpy array with all the volumes
+        """
+        if self._parent is not None:
+            return self._parent.signal4d[..., self._volume_indices]
+        if self._signal4d is None and self._observation_list is not None:
+            return restore_volumes(self.get_observations(), self._mask)
         return self._signal4d
 
     @property
@@ -352,20 +450,61 @@ class SimpleMRIInputData(MRIInputData):
 
     @property
     def gradient_deviations(self):
-        if self._gradient_deviations is None:
+        if not self.has_gradient_deviations():
             return None
         if self._gradient_deviations_list is None:
-            grad_dev = create_roi(self._gradient_deviations, self.mask)
+            self._gradient_deviations_list = self.get_gradient_deviations()
+        return self._gradient_deviations_list
 
-            if grad_dev.shape[-1] == 9:  # HCP WUMINN format, Fortran major. Also adds the identity matrix as specified.
-                grad_dev = np.reshape(grad_dev, (-1, 3, 3), order='F') + np.eye(3)
+    def has_gradient_deviations(self):
+        if self._parent is not None:
+            return self._parent.has_gradient_deviations()
+        return self._gradient_deviations is not None
 
-            self._gradient_deviations_list = grad_dev
+    def get_gradient_deviations(self, voxels_to_analyze=None):
+        """Get the gradient deviations for all voxels or for a subset of the voxels.
 
-        return self._gradient_deviations_list
+        If the deviations of all voxels have not been loaded before, this only reads the requested voxels from the
+        gradient deviations volume. If that volume is memory mapped, as for example for uncompressed nifti files, this
+        only loads the deviations of the requested voxels into memory.
+
+        Args:
+            voxels_to_analyze (ndarray): if given, the indices of the voxels for which we want the deviations
+
+        Returns:
+            None or ndarray: either a (n, 3, 3) or a (n, m, 3, 3) matrix with the deviations for the (selected) voxels.
+        """
+        if self._gradient_deviations_list is not None:
+            return super().get_gradient_deviations(voxels_to_analyze)
+
+        if self._parent is not None:
+            grad_dev = self._parent.get_gradient_deviations(voxels_to_analyze)
+            if grad_dev is not None and grad_dev.ndim > 3 and grad_dev.shape[1] == self._parent.nmr_observations:
+                return grad_dev[:, self._volume_indices]
+            return grad_dev
+
+        if self._gradient_deviations is None:
+            return None
+
+        if voxels_to_analyze is None:
+            grad_dev = create_roi(self._gradient_deviations, self.mask)
+        else:
+            if self._mask_coordinates is None:
+                self._mask_coordinates = np.nonzero(load_brain_mask(self.mask))
+            grad_dev = self._gradient_deviations[tuple(ind[voxels_to_analyze] for ind in self._mask_coordinates)]
+
+        if grad_dev.shape[-1] == 9:  # HCP WUMINN format, Fortran major. Also adds the identity matrix as specified.
+            grad_dev = np.reshape(grad_dev, (-1, 3, 3), order='F') + np.eye(3)
+        return grad_dev
 
     @property
     def volume_weights(self):
+        if self._parent is not None:
+            volume_weights = self._parent.volume_weights
+            if volume_weights is None:
+                return None
+            return volume_weights[:, self._volume_indices]
+
         if self._volume_weights is None:
             return None
         if self._volume_weights_list is None:
@@ -378,10 +517,68 @@ class SimpleMRIInputData(MRIInputData):
 
     @property
     def observations(self):
-        if self._observation_list is None:
-            self._observation_list = create_roi(self.signal4d, self._mask)
+        if self._observations_storage_type == 'native' and self._parent is None:
+            return self._get_observation_list()
+        return self.get_observations()
+
+    def has_observations(self):
+        if self._parent is not None:
+            return self._parent.has_observations()
+        return self._signal4d is not None or self._observation_list is not None
+
+    def get_observations(self, voxels_to_analyze=None):
+        """Get the observations of all voxels or of a subset of the voxels.
+
+        If the observations are stored in a compact data type, this converts the (selected) voxels to single precision.
+        For a subset of the volumes of another input data object, this selects the volumes from the observations
+        stored by that object.
+
+        Args:
+            voxels_to_analyze (ndarray): if given, the indices of the voxels for which we want the observations
+
+        Returns:
+            ndarray: the (n, d) matrix with the observations of the (selected) voxels
+        """
+        observations = self._get_observation_list()
+        scales = self._get_observation_scales()
+        if voxels_to_analyze is not None:
+            observations = observations[voxels_to_analyze]
+
+        if self._volume_indices is not None:
+            observations = observations[:, self._volume_indices]
+            if scales is not None:
+                scales = scales[self._volume_indices]
+
+        if self._observations_storage_type == 'native':
+            return observations
+
+        observations = observations.astype(np.float32)
+        if scales is not None:
+            observations *= scales
+        return observations
 
-            signal_max = np.max(self._observation_list)
+    def _get_observation_list(self):
+        """Get the observations of the voxels in the mask, in the data type in which we store them.
+
+        Returns:
+            ndarray: the (n, d) matrix with the stored observations, for a subset of the volumes of another input data
+                object this contains all the volumes of that object
+        """
+        if self._parent is not None:
+            return self._parent._get_observation_list()
+
+        if self._observation_list is None:
+            if self._observations_storage_type == 'native':
+                self._observation_list = create_roi(self.signal4d, self._mask)
+            else:
+                self._observation_list, self._observation_scales = _create_compact_roi(
+                    self._signal4d, self._mask, self._observations_storage_type)
+                self._signal4d = None
+
+            signal_max = np.max(self._observation_list, axis=0)
+            if self._observation_scales is not None:
+                signal_max = signal_max * self._observation_scales
+            signal_max = np.max(signal_max)
             if signal_max < 10:
                 logger = logging.getLogger(__name__)
                 logger.warning(
@@ -390,6 +587,16 @@ class SimpleMRIInputData(MRIInputData):
 
         return self._observation_list
 
+    def _get_observation_scales(self):
+        """Get the scale factors per volume of the stored observations.
+
+        Returns:
+            None or ndarray: the scale factors if the observations are stored as int16, else None
+        """
+        if self._parent is not None:
+            return self._parent._get_observation_scales()
+        return self._observation_scales
+
     @property
     def mask(self):
         """Return the mask in use
@@ -480,7 +687,7 @@ class MockMRIInputData(SimpleMRIInputData):
 
 
 def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_deviations=None,
-                    noise_std=None, volume_weights=None):
+                    noise_std=None, volume_weights=None, observations_storage_type=None):
     """Load and create the input data object for diffusion MRI modeling.
 
     Args:
@@ -520,6 +727,10 @@ def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_d
             a weight in [0, 1]. If set, these weights are used during model fitting to weigh the objective function
             values per observation.
 
+        observations_storage_type (str): the data type in which we store the observations of the voxels in the mask,
+            one of 'native' (the data type of the DWI volume), 'float16' or 'int16' (with a scale factor per volume).
+            If not given, we use the ``observations`` section of the configuration.
+
     Returns:
         SimpleMRIInputData: the input data object containing all the info needed for diffusion MRI model fitting
     """
@@ -540,7 +751,8 @@ def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_d
         volume_weights = load_nifti(volume_weights).get_data()
 
     return SimpleMRIInputData(protocol, signal4d, mask, img_header, extra_protocol=extra_protocol, noise_std=noise_std,
-                              gradient_deviations=gradient_deviations, volume_weights=volume_weights)
+                              gradient_deviations=gradient_deviations, volume_weights=volume_weights,
+                              observations_storage_type=observations_storage_type)
 
 
 class InitializationData:
@@ -950,6 +1162,71 @@ def create_roi(data, brain_mask):
     return creator(data)
 
 
+def _create_compact_roi(signal4d, brain_mask, storage_type, batch_size=10000):
+    """Create the ROI of the given 4d volume in a compact data type.
+
+    The voxels are converted in batches, such that we never hold a full precision copy of the ROI in memory.
+
+    For the int16 storage type we use a scale factor per volume. Volumes with only integer values within the int16
+    range are stored without loss, using a scale factor of one. Other volumes are scaled to use the full int16 range,
+    non-finite values are stored as zero.
+
+    Args:
+        signal4d (ndarray): the 4d volume
+        brain_mask (ndarray): the 3d mask with the voxels to use
+        storage_type (str): the data type to store the values in, either 'float16' or 'int16'
+        batch_size (int): the number of voxels to convert at once
+
+    Returns:
+        tuple: the (n, d) matrix with the values of the n voxels in the mask in the given data type and, for int16,
+            a vector with the d scale factors as float32 (else None)
+
+    Raises:
+        ValueError: if the values can not be stored in float16 since they are larger than the float16 maximum
+    """
+    coordinates = np.nonzero(load_brain_mask(brain_mask))
+    nmr_voxels = coordinates[0].shape[0]
+    nmr_volumes = signal4d.shape[3] if signal4d.ndim > 3 else 1
+
+    def get_batch(batch_start, batch_end):
+        values = np.asarray(signal4d[tuple(ind[batch_start:batch_end] for ind in coordinates)])
+        return np.reshape(values, (-1, nmr_volumes))
+
+    def get_finite_batch(batch_start, batch_end):
+        values = get_batch(batch_start, batch_end)
+        return np.where(np.isfinite(values), values, 0)
+
+    batches = list(mot.lib.utils.split_in_batches(nmr_voxels, batch_size))
+
+    if storage_type == 'float16':
+        roi = np.zeros((nmr_voxels, nmr_volumes), dtype=np.float16)
+        float16_max = np.finfo(np.float16).max
+        for batch_start, batch_end in batches:
+            values = get_batch(batch_start, batch_end)
+            if np.any(np.abs(values[np.isfinite(values)]) > float16_max):
+                raise ValueError('The observations exceed the maximum of float16 ({}), '
+                                 'please use another storage type.'.format(float16_max))
+            roi[batch_start:batch_end] = values
+        return roi, None
+
+    int16_max = np.iinfo(np.int16).max
+    max_values = np.zeros(nmr_volumes)
+    is_integer = np.ones(nmr_volumes, dtype=np.bool)
+    for batch_start, batch_end in batches:
+        values = get_finite_batch(batch_start, batch_end)
+        max_values = np.maximum(max_values, np.max(np.abs(values), axis=0))
+        is_integer &= np.all(values == np.round(values), axis=0)
+
+    scales = np.where(is_integer & (max_values <= int16_max), 1, max_values / int16_max)
+    scales = np.where(scales > 0, scales, 1).astype(np.float32)
+
+    roi = np.zeros((nmr_voxels, nmr_volumes), dtype=np.int16)
+    for batch_start, batch_end in batches:
+        values = np.round(get_finite_batch(batch_start, batch_end) / scales)
+        roi[batch_start:batch_end] = np.clip(values, -int16_max, int16_max)
+    return roi, scales
+
+
 def restore_volumes(data, brain_mask, with_volume_dim=True):
     """Restore the given data to a whole brain volume
 
@@ -1423,6 +1700,9 @@ def model_output_exists(model, output_folder, append_model_name_to_path=True):
     for a given subject. For example NODDI requires two shells. If that is not given we can not calculate it and
     hence no maps will be generated. When we are testing if the output exists it will therefore return False.
 
+    This does not check if the results were computed using the current data and settings, for that, please compare the
+    fingerprints, see :mod:`mdt.lib.fingerprints`.
+
     Args:
         model (AbstractModel, CascadeModel or str): the model to check for existence, accepts cascade models.
             If a string is given the model is tried to be loaded from the components loader.
@@ -1561,6 +1841,11 @@ def apply_mask_to_file(input_fname, mask, output_fname=None):
 def load_samples(data_folder, mode='r'):
     """Load sampled results as a dictionary of numpy memmap.
 
+    Samples stored using quantization (see :mod:`mdt.lib.quantized_samples`) are loaded as
+    :class:`~mdt.lib.quantized_samples.QuantizedSamples` objects, which decode the samples when indexed.
+    These can only be opened for reading. Samples stored voxel-major (see :mod:`mdt.lib.voxel_samples`) are returned
+    as views on the voxel-major matrix.
+
     Args:
         data_folder (str): the folder from which to use the samples
         mode (str): the mode in which to open the memory mapped sample files (see numpy mode parameter)
@@ -1568,14 +1853,53 @@ def load_samples(data_folder, mode='r'):
     Returns:
         dict: the memory loaded samples per sampled parameter.
     """
+    from mdt.lib.quantized_samples import QuantizedSamples, QUANTIZED_SAMPLES_EXTENSION
+    from mdt.lib.voxel_samples import load_voxel_major_samples
+
     data_dict = {}
     for fname in glob.glob(os.path.join(data_folder, '*.samples.npy')):
         samples = open_memmap(fname, mode=mode)
         map_name = os.path.basename(fname)[0:-len('.samples.npy')]
         data_dict.update({map_name: samples})
+    for fname in glob.glob(os.path.join(data_folder, '*' + QUANTIZED_SAMPLES_EXTENSION)):
+        map_name = os.path.basename(fname)[0:-len(QUANTIZED_SAMPLES_EXTENSION)]
+        data_dict.update({map_name: QuantizedSamples(fname)})
+    data_dict.update(load_voxel_major_samples(data_folder, mode=mode))
     return data_dict
 
 
+def get_voxel_samples(data_folder, xyz):
+    """Get the samples of all the outputs of a single voxel.
+
+    This uses the spatial index stored next to the samples to find the voxel, without loading the mask. With samples
+    stored voxel-major (see :class:`~mdt.lib.processing_strategies.SaveVoxelMajorSamples`) this is a single
+    contiguous read.
+
+    Args:
+        data_folder (str): the folder with the samples
+        xyz (tuple of int): the voxel location in the volume
+
+    Returns:
+        dict: per output the samples of that voxel, empty if the voxel was not sampled.
+    """
+    from mdt.lib.voxel_samples import VOXEL_INDEX_FILENAME, load_voxel_major_names, VOXEL_MAJOR_SAMPLES_FILENAME
+
+    index_path = os.path.join(data_folder, VOXEL_INDEX_FILENAME)
+    if not os.path.isfile(index_path):
+        raise ValueError('Could not find the voxel index at the location "{}".'.format(index_path))
+
+    row = int(np.load(index_path, mmap_mode='r')[tuple(int(el) for el in xyz[:3])])
+    if row < 0:
+        return {}
+
+    names = load_voxel_major_names(data_folder)
+    if names is not None:
+        voxel_samples = np.array(open_memmap(os.path.join(data_folder, VOXEL_MAJOR_SAMPLES_FILENAME), mode='r')[row])
+        return {name: voxel_samples[ind] for ind, name in enumerate(names)}
+
+    return {name: np.array(samples[row]) for name, samples in load_samples(data_folder).items()}
+
+
 def load_sample(fname, mode='r'):
     """Load an matrix of samples from a ``.samples.npy`` file.
 
@@ -1586,8 +1910,16 @@ def load_sample(fname, mode='r'):
         mode (str): the mode in which to open the memory mapped sample files (see numpy mode parameter)
 
     Returns:
-        ndarray: a memory mapped array with the results
+        ndarray: a memory mapped array with the results, or a
+            :class:`~mdt.lib.quantized_samples.QuantizedSamples` object for quantized samples.
     """
+    from mdt.lib.quantized_samples import QuantizedSamples, QUANTIZED_SAMPLES_EXTENSION
+
+    if fname.endswith(QUANTIZED_SAMPLES_EXTENSION) and os.path.isdir(fname):
+        return QuantizedSamples(fname)
+    if os.path.isdir(fname + QUANTIZED_SAMPLES_EXTENSION):
+        return QuantizedSamples(fname + QUANTIZED_SAMPLES_EXTENSION)
+
     if not os.path.isfile(fname) and not os.path.isfile(fname + '.samples.npy'):
         raise ValueError('Could not find sample results at the location "{}"'.format(fname))
 
@@ -1617,15 +1949,17 @@ def estimate_noise_std(input_data):
     logger = logging.getLogger(__name__)
     logger.info('Trying to estimate a noise std.')
 
-    def all_unweighted_volumes(input_data):
+    def all_unweighted_volumes(input_data, batch_size=10000):
         unweighted_indices = input_data.protocol.get_unweighted_indices()
-        unweighted_volumes = input_data.signal4d[..., unweighted_indices]
 
         if len(unweighted_indices) < 2:
             raise NoiseStdEstimationNotPossible('Not enough unweighted volumes for this estimator.')
 
-        voxel_list = create_roi(unweighted_volumes, input_data.mask)
-        return np.mean(np.std(voxel_list, axis=1))
+        stds = []
+        for batch_start, batch_end in mot.lib.utils.split_in_batches(input_data.nmr_problems, batch_size):
+            observations = input_data.get_observations(np.arange(batch_start, batch_end))
+            stds.append(np.std(observations[:, unweighted_indices], axis=1))
+        return np.mean(np.concatenate(stds))
 
     noise_std = all_unweighted_volumes(input_data)
 
@@ -2015,7 +2349,7 @@ def covariance_to_correlation(input_maps):
     return correlation_maps
 
 
-def load_volume_maps(directory, map_names=None, deferred=True):
+def load_volume_maps(directory, map_names=None, deferred=True, derived_maps=False, persist_derived_maps=False):
     """Read a number of Nifti volume maps from a directory.
 
     Args:
@@ -2023,13 +2357,17 @@ def load_volume_maps(directory, map_names=None, deferred=True):
         map_names (list or tuple): the names of the maps we want to use. If given we only use and return these maps.
         deferred (boolean): if True we return an deferred loading dictionary instead of a dictionary with the values
             loaded as arrays.
+        derived_maps (boolean): if we want to add the maps missing in the directory which can be derived from the
+            maps in the directory, see :mod:`mdt.lib.derived_maps`. These are computed on the moment they are needed.
+        persist_derived_maps (boolean): if set, we write the derived maps to the directory once computed
 
     Returns:
         dict: A dictionary with the volumes. The keys of the dictionary are the filenames (without the extension) of the
             files in the given directory.
     """
     from mdt.lib.nifti import get_all_nifti_data
-    return get_all_nifti_data(directory, map_names=map_names, deferred=deferred)
+    return get_all_nifti_data(directory, map_names=map_names, deferred=deferred, derived_maps=derived_maps,
+                              persist_derived_maps=persist_derived_maps)
 
 
 def unzip_nifti(in_file, out_file=None, remove_old=False):
@@ -2084,15 +2422,9 @@ def voxelwise_vector_matrix_vector_product(a, B, c):
         c (ndarray): of size (n, m) or (x, y, z, m), vector elements per voxel
 
     Returns:
-        ndarray: either of size (n, 1) or of size (x, y, z, 1), the voxelwise matrix multiplication of aBc.
+        ndarray: either of size (n,) or of size (x, y, z), the voxelwise matrix multiplication of aBc.
     """
-    m = a.shape[-1]
-
-    tmp = np.zeros_like(a)
-    for ind in range(m):
-        tmp[..., ind] = np.sum(a * B[..., ind, :], axis=-1)
-
-    return np.sum(tmp * c, axis=-1)
+    return np.einsum('...i,...ij,...j->...', a, B, c)
 
 
 def create_covariance_matrix(results, names, result_covars=None):
@@ -2107,22 +2439,25 @@ def create_covariance_matrix(results, names, result_covars=None):
             Since the order is undefined, this tests for <x>_to_<y> as <y>_to_<x>.
 
     Returns:
-        ndarray: matrix of size (n, m) for n voxels and m names.
+        ndarray: matrix of size (n, m, m) for n voxels and m names.
             If no covariance elements are given, we use zero for all off-diagonal terms.
     """
-    shape = results[list(results.keys())[0]].shape
-    n = 1 if not len(shape) else shape[0]
+    stds = [np.reshape(results.get(name + '.std', 0), (-1,)) for name in names]
+    n = max(std.shape[0] for std in stds)
+    if n == 1:
+        shape = np.shape(results[list(results.keys())[0]])
+        n = 1 if not len(shape) else shape[0]
     m = len(names)
-    covars = np.zeros((n, m, m)).astype(np.float64)
+    covars = np.zeros((n, m, m), dtype=np.float64)
 
-    for ind in range(m):
-        covars[:, ind, ind] = results.get(names[ind] + '.std', 0)**2
+    diagonal = np.arange(m)
+    covars[:, diagonal, diagonal] = np.column_stack([np.broadcast_to(std, (n,)) for std in stds]) ** 2
 
     if result_covars:
         for x in range(m):
-            for y in range(m):
-                if '{}_to_{}'.format(names[x], names[y]) in result_covars:
-                    covars[:, x, y] = result_covars['{}_to_{}'.format(names[x], names[y])]
-                elif '{}_to_{}'.format(names[y], names[x]) in result_covars:
-                    covars[:, x, y] = result_covars['{}_to_{}'.format(names[y], names[x])]
+            for y in range(x + 1, m):
+                for key in ['{}_to_{}'.format(names[x], names[y]), '{}_to_{}'.format(names[y], names[x])]:
+                    if key in result_covars:
+                        covars[:, x, y] = covars[:, y, x] = np.reshape(result_covars[key], (-1,))
+                        break
     return covars
@@ -0,0 +1,116 @@
+"""
+test_dictionary_matching
+----------------------------------
+
+Tests the dictionary matching initialization of `mdt.lib.dictionary_matching`.
+"""
+import glob
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pkg_resources
+
+import mdt
+from mdt.lib.dictionary_matching import get_dictionary_matching_inits, match_dictionary, _get_cache_key, \
+    _get_dictionary_parameters, _get_hemisphere_directions, _get_parameter_grid
+from mdt.simulations import simulate_signals
+from mdt.utils import MockMRIInputData, SimpleMRIInputData, spherical_to_cartesian
+
+
+def get_protocol():
+    return mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+        'mdt', 'data/mdt_example_data/b1k_b2k/*.prtcl'))[0])
+
+
+def get_model(model_name, protocol, **kwargs):
+    model = mdt.get_model(model_name)(**kwargs)
+    model.set_input_data(MockMRIInputData(protocol=protocol))
+    return model
+
+
+class MatchDictionaryTest(unittest.TestCase):
+
+    def test_match_dictionary(self):
+        random_state = np.random.RandomState(0)
+        dictionary = random_state.uniform(0, 1, (50, 20))
+        entries = random_state.randint(50, size=30)
+        observation_scales = random_state.uniform(100, 1000, 30)
+
+        indices, scales = match_dictionary(dictionary[entries] * observation_scales[:, None], dictionary,
+                                           max_batch_size=7)
+        np.testing.assert_array_equal(indices, entries)
+        np.testing.assert_allclose(scales, observation_scales)
+
+
+class DictionaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = get_protocol()
+        self.directions = _get_hemisphere_directions(16)
+
+    def get_cache_key(self, model, protocol):
+        return _get_cache_key(model, protocol, _get_parameter_grid(model, {}, 3), self.directions)
+
+    def test_cache_key(self):
+        model = get_model('BallStick_r1', self.protocol)
+        key = self.get_cache_key(model, self.protocol)
+        self.assertEqual(key, self.get_cache_key(get_model('BallStick_r1', self.protocol), self.protocol))
+
+        changed_protocol = self.protocol.with_new_column('Delta', self.protocol.get_column('Delta') * 2)
+        self.assertNotEqual(key, self.get_cache_key(get_model('BallStick_r1', changed_protocol), changed_protocol))
+
+        changed_model = get_model('BallStick_r1', self.protocol)
+        changed_model.set_initial_parameters({'w_stick0.w': 0.3})
+        self.assertNotEqual(key, self.get_cache_key(changed_model, self.protocol))
+
+    def test_independent_orientations(self):
+        model = get_model('BallStick_r2', self.protocol)
+        dictionary_grid = _get_parameter_grid(model, {}, 3)
+        parameters = _get_dictionary_parameters(model, dictionary_grid, self.directions)
+
+        names = model.get_free_param_names()
+        nmr_grid_points = parameters.shape[0] // self.directions.shape[0]
+        first = spherical_to_cartesian(parameters[:, names.index('Stick0.theta')],
+                                       parameters[:, names.index('Stick0.phi')])
+        second = spherical_to_cartesian(parameters[:, names.index('Stick1.theta')],
+                                        parameters[:, names.index('Stick1.phi')])
+
+        np.testing.assert_allclose(np.abs(np.sum(first * np.repeat(self.directions, nmr_grid_points, axis=0), axis=1)),
+                                   1, rtol=1e-7)
+        self.assertLess(np.mean(np.abs(np.sum(first * second, axis=1))), 0.9)
+        self.assertTrue(np.all(np.ptp(second[:nmr_grid_points], axis=0) > 0.5))
+
+
+class DictionaryMatchingInitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.protocol = get_protocol()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_inits(self):
+        random_state = np.random.RandomState(0)
+        nmr_voxels = 50
+        theta = random_state.uniform(0, np.pi, nmr_voxels)
+        phi = random_state.uniform(0, np.pi, nmr_voxels)
+        s0 = random_state.uniform(500, 1500, nmr_voxels)
+        parameters = np.column_stack([s0, np.full(nmr_voxels, 0.6), theta, phi])
+
+        signals = simulate_signals('BallStick_r1', self.protocol, parameters)
+        input_data = SimpleMRIInputData(self.protocol, np.reshape(signals, (nmr_voxels, 1, 1, -1)),
+                                        np.ones((nmr_voxels, 1, 1), dtype=np.bool), None)
+
+        for data in [input_data, input_data.get_subset(volumes_to_remove=[1, 2, 3])]:
+            inits = get_dictionary_matching_inits('BallStick_r1', data, nmr_directions=32, cache_dir=self.cache_dir)
+
+            directions = spherical_to_cartesian(inits['Stick0.theta'].ravel(), inits['Stick0.phi'].ravel())
+            np.testing.assert_allclose(np.abs(np.sum(directions * spherical_to_cartesian(theta, phi), axis=1)),
+                                       1, atol=1e-3)
+            np.testing.assert_allclose(inits['S0.s0'].ravel(), s0, rtol=0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
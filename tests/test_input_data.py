@@ -0,0 +1,86 @@
+"""
+test_input_data
+----------------------------------
+
+Tests the storage of the observations in `mdt.utils.SimpleMRIInputData`.
+"""
+import glob
+import unittest
+import numpy as np
+import pkg_resources
+
+import mdt
+from mdt.utils import SimpleMRIInputData
+
+
+def get_protocol():
+    return mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+        'mdt', 'data/mdt_example_data/b1k_b2k/*.prtcl'))[0])
+
+
+class ObservationsStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.protocol = get_protocol()
+        self.signal4d = np.round(random_state.uniform(0, 3000, (4, 5, 6, self.protocol.length)))
+        self.mask = random_state.uniform(size=(4, 5, 6)) > 0.3
+        self.volumes = [0, 5, 10, 50]
+
+    def get_input_data(self, storage_type, signal4d=None):
+        return SimpleMRIInputData(self.protocol, self.signal4d if signal4d is None else signal4d, self.mask, None,
+                                  observations_storage_type=storage_type)
+
+    def assert_round_trip(self, input_data, signal4d, rtol=0, atol=0):
+        np.testing.assert_allclose(input_data.get_observations(), signal4d[self.mask], rtol=rtol, atol=atol)
+        np.testing.assert_allclose(input_data.get_observations(np.array([3, 1])), signal4d[self.mask][[3, 1]],
+                                   rtol=rtol, atol=atol)
+        np.testing.assert_allclose(input_data.signal4d, signal4d * self.mask[..., None], rtol=rtol, atol=atol)
+
+        subset = input_data.get_subset(volumes_to_keep=self.volumes)
+        np.testing.assert_allclose(subset.get_observations(), signal4d[self.mask][:, self.volumes],
+                                   rtol=rtol, atol=atol)
+        np.testing.assert_allclose(subset.signal4d, (signal4d * self.mask[..., None])[..., self.volumes],
+                                   rtol=rtol, atol=atol)
+
+        copy = input_data.copy_with_updates()
+        np.testing.assert_allclose(copy.get_observations(), signal4d[self.mask], rtol=rtol, atol=atol)
+
+    def test_native(self):
+        input_data = self.get_input_data('native')
+        self.assertEqual(input_data.nmr_problems, np.count_nonzero(self.mask))
+        self.assertIs(input_data.signal4d, self.signal4d)
+        np.testing.assert_array_equal(input_data.get_observations(), self.signal4d[self.mask])
+
+    def test_float16(self):
+        input_data = self.get_input_data('float16')
+        self.assertEqual(input_data.nmr_problems, np.count_nonzero(self.mask))
+        self.assertEqual(input_data._get_observation_list().dtype, np.float16)
+        self.assertIsNone(input_data._signal4d)
+        self.assertTrue(input_data.has_observations())
+        self.assert_round_trip(input_data, self.signal4d, rtol=2 ** -11)
+
+    def test_int16_integer_values(self):
+        input_data = self.get_input_data('int16')
+        self.assertEqual(input_data.nmr_problems, np.count_nonzero(self.mask))
+        self.assertEqual(input_data._get_observation_list().dtype, np.int16)
+        self.assertIsNone(input_data._signal4d)
+        self.assertTrue(input_data.has_observations())
+        self.assert_round_trip(input_data, self.signal4d)
+
+    def test_int16_scaled_values(self):
+        signal4d = self.signal4d * 100.5
+        input_data = self.get_input_data('int16', signal4d)
+        input_data.get_observations()
+        scales = input_data._get_observation_scales()
+        self.assertTrue(np.all(scales > 1))
+        self.assert_round_trip(input_data, signal4d, atol=np.max(scales) / 2.)
+
+    def test_float16_overflow(self):
+        input_data = self.get_input_data('float16', self.signal4d * 1e5)
+        with self.assertRaises(ValueError):
+            input_data.get_observations()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+test_likelihood_functions
+----------------------------------
+
+Tests the fast log-Bessel approximation used by the Rician likelihood function in
+`mdt.model_building.likelihood_functions`.
+"""
+import unittest
+import numpy as np
+from scipy.special import i0e
+from mot.lib.cl_function import SimpleCLFunction
+
+from mdt.model_building.likelihood_functions import LogBesseli0Fast
+
+
+class LogBesseli0FastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_bessel_i0_fast = SimpleCLFunction.from_string('''
+            double test_log_bessel_i0_fast(double x){
+                return log_bessel_i0_fast(x);
+            }
+        ''', dependencies=(LogBesseli0Fast(),))
+
+    def evaluate(self, x):
+        return self.log_bessel_i0_fast.evaluate({'x': x}, x.shape[0])
+
+    def test_accuracy(self):
+        x = np.concatenate([np.linspace(0, 20, 100001), np.logspace(-6, 6, 10001)])
+        reference = np.log(i0e(x)) + x
+        results = self.evaluate(x)
+
+        self.assertLess(np.max(np.abs(results - reference)), 3e-8)
+        self.assertLess(np.max(np.abs(results - reference)[x > 0.01] / reference[x > 0.01]), 2e-8)
+
+    def test_symmetry(self):
+        x = np.linspace(0, 20, 1001)
+        np.testing.assert_array_equal(self.evaluate(-x), self.evaluate(x))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+"""
+test_lookup_tables
+----------------------------------
+
+Tests the precision of the interpolated lookup tables in `mdt.lib.lookup_tables`.
+"""
+import unittest
+import numpy as np
+from scipy.special import factorial, poch
+from mot.lib.cl_function import SimpleCLFunction
+
+from mdt.configuration import config_context, YamlStringAction
+from mdt.lib.components import get_component
+from mdt.lib.lookup_tables import bingham_normalization_constant, bingham_log_normalization, get_bingham_tables, \
+    get_noddi_watson_tables, watson_hindered_diffusion_factor, watson_sh_coefficients
+
+
+def bingham_normalization_series(e0, e1, e2, nmr_terms=40):
+    """The power series of 4 * pi * 1F1(1/2; 3/2; -diag(e0, e1, e2)), only accurate for small eigenvalues."""
+    i, j, k = np.meshgrid(*[np.arange(nmr_terms)] * 3, indexing='ij')
+    terms = (poch(0.5, i) * poch(0.5, j) * poch(0.5, k) / poch(1.5, i + j + k)
+             * (-e0) ** i * (-e1) ** j * (-e2) ** k / (factorial(i) * factorial(j) * factorial(k)))
+    return 4 * np.pi * np.sum(terms)
+
+
+def bingham_log_normalization_gradient(eigenvalues, step=1e-4):
+    """The central differences of the log of the reference Bingham normalization constant, per eigenvalue."""
+    gradient = np.zeros_like(eigenvalues)
+    for ind in range(3):
+        upper, lower = eigenvalues.copy(), eigenvalues.copy()
+        upper[:, ind] += step
+        lower[:, ind] -= step
+        gradient[:, ind] = (np.log(bingham_normalization_constant(*upper.T))
+                            - np.log(bingham_normalization_constant(*lower.T))) / (2 * step)
+    return gradient
+
+
+def get_bingham_cl_functions(use_lookup_table):
+    """Get CL functions for the log of the Bingham normalization constant and its gradient."""
+    with config_context(YamlStringAction('lookup_tables: {{general: {{bingham: {}}}}}'.format(use_lookup_table))):
+        log_normalization = SimpleCLFunction.from_string('''
+            double test_log_normalization(double e0, double e1, double e2){
+                return log(ConfluentHyperGeometricFirstKind(e0, e1, e2));
+            }
+        ''', dependencies=(get_component('library_functions', 'ConfluentHyperGeometricFirstKind')(),))
+        log_normalization_gradient = SimpleCLFunction.from_string('''
+            void test_log_normalization_gradient(double e0, double e1, double e2, double* gradient){
+                ConfluentHyperGeometricFirstKindLogGradient(e0, e1, e2, gradient);
+            }
+        ''', dependencies=(get_component('library_functions', 'ConfluentHyperGeometricFirstKindLogGradient')(),))
+
+    def evaluate_log_normalization(eigenvalues):
+        return log_normalization.evaluate({'e0': eigenvalues[:, 0], 'e1': eigenvalues[:, 1], 'e2': eigenvalues[:, 2]},
+                                          eigenvalues.shape[0])
+
+    def evaluate_log_normalization_gradient(eigenvalues):
+        gradient = np.zeros_like(eigenvalues)
+        log_normalization_gradient.evaluate({'e0': eigenvalues[:, 0], 'e1': eigenvalues[:, 1],
+                                             'e2': eigenvalues[:, 2], 'gradient': gradient}, eigenvalues.shape[0])
+        return gradient
+
+    return evaluate_log_normalization, evaluate_log_normalization_gradient
+
+
+class BinghamLookupTableTest(unittest.TestCase):
+
+    def test_reference_against_series(self):
+        rng = np.random.RandomState(0)
+        for eigenvalues in rng.uniform(-3, 3, (10, 3)):
+            np.testing.assert_allclose(bingham_normalization_constant(*eigenvalues),
+                                       bingham_normalization_series(*eigenvalues), rtol=1e-10)
+
+    def test_table_against_reference(self):
+        table = get_bingham_tables()[0]
+        self.assertLess(table.max_error, 2e-5)
+
+        rng = np.random.RandomState(0)
+        a, b = rng.uniform(0, np.sqrt(table.upper_bound), (2, 10000)) ** 2
+        errors = np.abs(table.interpolate(a, b) - bingham_log_normalization(a, b))
+        self.assertLessEqual(np.max(errors), table.max_error * 1.5)
+
+    def test_table_against_series(self):
+        table = get_bingham_tables()[0]
+        rng = np.random.RandomState(0)
+        for e0, e1, e2 in rng.uniform(-3, 3, (10, 3)):
+            e_min, e_mid, e_max = np.sort([e0, e1, e2])
+            interpolated = np.exp(table.interpolate(e_mid - e_min, e_max - e_min) - e_min)
+            np.testing.assert_allclose(interpolated, bingham_normalization_series(e0, e1, e2), rtol=2e-5)
+
+    def test_table_gradient(self):
+        table = get_bingham_tables()[0]
+        rng = np.random.RandomState(0)
+        a, b = rng.uniform(0, np.sqrt(table.upper_bound), (2, 1000)) ** 2
+        gradient = table.interpolate_gradient(a, b)
+
+        step = 1e-6
+        np.testing.assert_allclose(gradient[0], (table.interpolate(a + step, b) - table.interpolate(a - step, b))
+                                   / (2 * step), atol=1e-7)
+        np.testing.assert_allclose(gradient[1], (table.interpolate(a, b + step) - table.interpolate(a, b - step))
+                                   / (2 * step), atol=1e-7)
+
+    def test_cl_gradient(self):
+        """The gradient of the table should be at least as accurate as the central differences on the saddlepoint."""
+        rng = np.random.RandomState(0)
+        eigenvalues = -rng.uniform(0, 64, (1000, 3))
+        eigenvalues[:, 2] = 0
+        reference = bingham_log_normalization_gradient(eigenvalues)
+
+        gradient = get_bingham_cl_functions(True)[1](eigenvalues)
+        saddlepoint_gradient = get_bingham_cl_functions(False)[1](eigenvalues)
+
+        np.testing.assert_allclose(np.sum(gradient, axis=1), -1, atol=1e-10)
+        self.assertLess(np.max(np.abs(gradient - reference)), 1e-3)
+        self.assertLess(np.max(np.abs(gradient - reference)), np.max(np.abs(saddlepoint_gradient - reference)))
+
+    def test_cl_table_border(self):
+        """The normalization constant should be continuous at the border of the table and accurate beyond it."""
+        upper_bound = get_bingham_tables()[0].upper_bound
+        log_normalization = get_bingham_cl_functions(True)[0]
+        saddlepoint_log_normalization = get_bingham_cl_functions(False)[0]
+
+        ratios = np.linspace(0, 1, 101)
+        inside = np.column_stack([np.zeros_like(ratios), ratios * upper_bound, np.full_like(ratios, upper_bound)])
+        outside = inside * (1 + 1e-10)
+        np.testing.assert_allclose(log_normalization(outside), log_normalization(inside), atol=1e-8)
+
+        beyond = inside * 4
+        reference = np.log(bingham_normalization_constant(*beyond.T))
+        errors = np.abs(log_normalization(beyond) - reference)
+        saddlepoint_errors = np.abs(saddlepoint_log_normalization(beyond) - reference)
+        self.assertLess(np.max(errors), 2e-4)
+        self.assertLess(np.max(errors), np.max(saddlepoint_errors) / 10)
+
+
+class NODDIWatsonLookupTableTest(unittest.TestCase):
+
+    def test_tables_against_reference(self):
+        sh_table, hindered_table = get_noddi_watson_tables()
+        self.assertTrue(np.all(sh_table.max_error < 1e-5))
+        self.assertLess(hindered_table.max_error[0], 1e-6)
+
+        kappa = np.random.RandomState(0).uniform(0, 64, 1000)
+        sh_errors = np.abs(sh_table.interpolate(kappa) - watson_sh_coefficients(kappa)[:, 1:])
+        hindered_errors = np.abs(hindered_table.interpolate(kappa)[:, 0] - watson_hindered_diffusion_factor(kappa))
+
+        self.assertTrue(np.all(np.max(sh_errors, axis=0) <= sh_table.max_error * 1.5))
+        self.assertLessEqual(np.max(hindered_errors), hindered_table.max_error[0] * 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
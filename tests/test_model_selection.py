@@ -0,0 +1,107 @@
+"""
+test_model_selection
+----------------------------------
+
+Tests resuming the fitting of a set of candidate models with the `ModelSelectionProcessor`.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from mdt.lib.nifti import get_all_nifti_data
+from mdt.lib.processing_strategies import FittingProcessor, ModelSelectionProcessor, VoxelRange
+from mdt.utils import create_roi
+
+
+class CandidateProcessor(FittingProcessor):
+
+    def __init__(self, criterion_offset, *args):
+        """A fitting processor which, instead of fitting a model, computes its results from the voxel indices."""
+        super().__init__(None, None, *args)
+        self.criterion_offset = criterion_offset
+        self.processed = []
+
+    def _process(self, roi_indices, next_indices=None):
+        self.processed.extend(roi_indices)
+        results = {'BIC': roi_indices + self.criterion_offset,
+                   'x': roi_indices * 2.,
+                   'covariances': {'x_to_x': roi_indices * 3.}}
+        self._write_output_recursive(results, roi_indices)
+        return results
+
+
+class ModelSelectionResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.mask = np.ones((30, 1, 1), dtype=np.bool)
+        self.chunks = [np.arange(0, 10), np.arange(10, 20), np.arange(20, 30)]
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def get_processors(self, recalculate_second=False):
+        candidates = []
+        for name, criterion_offset, recalculate in [('First', 0, False), ('Second', 0.5, recalculate_second)]:
+            candidates.append((name, ['x'], CandidateProcessor(
+                criterion_offset, self.mask, None, os.path.join(self.output_dir, name),
+                os.path.join(self.output_dir, 'tmp', name), recalculate)))
+
+        selection = ModelSelectionProcessor(candidates, self.mask, None,
+                                            os.path.join(self.output_dir, 'ModelSelection'),
+                                            os.path.join(self.output_dir, 'tmp', 'ModelSelection'), False)
+        return selection, candidates[0][2], candidates[1][2]
+
+    def interrupt(self):
+        """Process the first chunk with all processors and the second chunk only with the first candidate."""
+        selection, first, second = self.get_processors()
+        selection.process(self.chunks[0])
+        first.process(self.chunks[1])
+
+    def assert_results(self, results):
+        np.testing.assert_array_equal(np.squeeze(results['Winner']), 0)
+        np.testing.assert_allclose(np.squeeze(results['x']), np.arange(30) * 2.)
+
+        for name in ['First', 'Second']:
+            maps = create_roi(get_all_nifti_data(os.path.join(self.output_dir, name)), self.mask)
+            np.testing.assert_allclose(np.squeeze(maps['x']), np.arange(30) * 2.)
+            covariances = create_roi(get_all_nifti_data(os.path.join(self.output_dir, name, 'covariances')), self.mask)
+            np.testing.assert_allclose(np.squeeze(covariances['x_to_x']), np.arange(30) * 3.)
+
+    def test_resume(self):
+        self.interrupt()
+
+        selection, first, second = self.get_processors()
+        results = VoxelRange(max_nmr_voxels=10).process(selection)
+
+        self.assertEqual(sorted(first.processed), list(range(20, 30)))
+        self.assertEqual(sorted(second.processed), list(range(10, 30)))
+        self.assert_results(results)
+
+    def test_resume_completed_candidate(self):
+        self.interrupt()
+        selection, first, second = self.get_processors()
+        first.process(self.chunks[2])
+
+        selection, first, second = self.get_processors()
+        results = VoxelRange(max_nmr_voxels=10).process(selection)
+
+        self.assertEqual(first.processed, [])
+        self.assertEqual(sorted(second.processed), list(range(10, 30)))
+        self.assert_results(results)
+
+    def test_recalculated_candidate(self):
+        self.interrupt()
+
+        selection, first, second = self.get_processors(recalculate_second=True)
+        results = VoxelRange(max_nmr_voxels=10).process(selection)
+
+        self.assertEqual(sorted(first.processed), list(range(20, 30)))
+        self.assertEqual(sorted(second.processed), list(range(30)))
+        self.assert_results(results)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+test_numpy_evaluation
+----------------------------------
+
+Tests the NumPy evaluation of the composite models against the evaluation using OpenCL.
+"""
+import glob
+import unittest
+import numpy as np
+import pkg_resources
+
+import mdt
+from mdt.configuration import config_context, YamlStringAction
+from mdt.component_templates.composite_models import parse_composite_model_expression
+from mdt.lib.components import get_component
+from mdt.models.composite import DMRICompositeModel
+from mdt.model_building.numpy_functions import get_numpy_function
+from mdt.model_building.trees import CompartmentModelTree
+from mdt.simulations import simulate_signals
+from mdt.utils import SimpleMRIInputData
+from mot.cl_routines import compute_log_likelihood
+from mot.lib.cl_function import SimpleCLFunction
+
+
+def get_protocol():
+    protocol = mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+        'mdt', 'data/mdt_example_data/b1k_b2k/*.prtcl'))[0])
+    return protocol.with_new_column('TE', np.linspace(0.05, 0.1, protocol.length))
+
+
+def get_model(model_expression, likelihood_function):
+    model_tree = CompartmentModelTree(parse_composite_model_expression(model_expression))
+    return DMRICompositeModel('Test', model_tree, likelihood_function, volume_selection=False)
+
+
+def get_random_parameters(model, nmr_problems, random_state):
+    """Sample the parameters uniformly between half and one and a half times their initial value, within the bounds."""
+    parameters = []
+    for ind, initial in enumerate(model.get_initial_parameters()[0]):
+        lower = max(np.asarray(model.get_lower_bounds()[ind]).item(0), initial / 2)
+        upper = min(np.asarray(model.get_upper_bounds()[ind]).item(0), initial * 1.5 + 1e-3)
+        parameters.append(random_state.uniform(lower, upper, nmr_problems))
+    return np.array(parameters).T
+
+
+class NumPyEvaluationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.protocol = get_protocol()
+        self.nmr_problems = 20
+
+        signals = self.random_state.uniform(100, 1000, (self.nmr_problems, 1, 1, self.protocol.length))
+        self.input_data = SimpleMRIInputData(self.protocol, signals, np.ones(signals.shape[:3], dtype=np.bool),
+                                             None, noise_std=30)
+
+    def test_signals(self):
+        for model_name in ['BallStick_r2', 'Tensor', 'NonParametricTensor', 'S0T2']:
+            model = mdt.get_model(model_name)(volume_selection=False)
+            model.set_input_data(self.input_data)
+            self.assertIsNotNone(model.get_numpy_model_eval_function(), model_name)
+
+            parameters = get_random_parameters(model, self.nmr_problems, self.random_state)
+            with config_context(YamlStringAction('numpy_evaluation: {max_nmr_problems: 0}')):
+                cl_signals = simulate_signals(model, self.protocol, parameters)
+            with config_context(YamlStringAction('numpy_evaluation: {max_nmr_problems: 1000}')):
+                numpy_signals = simulate_signals(model, self.protocol, parameters)
+
+            np.testing.assert_allclose(numpy_signals, cl_signals, rtol=1e-4, atol=1e-5 * np.max(cl_signals),
+                                       err_msg=model_name)
+
+    def test_log_likelihoods(self):
+        likelihood_functions = [get_component('likelihood_functions', 'Gaussian')(),
+                                get_component('likelihood_functions', 'OffsetGaussian')(),
+                                get_component('likelihood_functions', 'Rician')(fast_log_bessel=False),
+                                get_component('likelihood_functions', 'Rician')(fast_log_bessel=True)]
+
+        for likelihood_function in likelihood_functions:
+            model = get_model('S0 * (Weight(w_ball) * Ball + Weight(w_stick0) * Stick(Stick0))', likelihood_function)
+            model.set_input_data(self.input_data)
+
+            parameters = get_random_parameters(model, self.nmr_problems, self.random_state)
+            cl_log_likelihoods = compute_log_likelihood(model.get_log_likelihood_function(), parameters,
+                                                        data=model.get_kernel_data())
+            numpy_log_likelihoods = model.get_numpy_log_likelihood_function()(parameters)
+
+            np.testing.assert_allclose(numpy_log_likelihoods, cl_log_likelihoods, rtol=1e-4,
+                                       err_msg=likelihood_function.name)
+
+    def test_unsupported_models(self):
+        model = mdt.get_model('Kurtosis')(volume_selection=False)
+        model.set_input_data(self.input_data)
+        self.assertIsNone(model.get_numpy_model_eval_function())
+        self.assertIsNone(model.get_numpy_log_likelihood_function())
+
+
+class TranslationTest(unittest.TestCase):
+
+    def test_translation(self):
+        function = get_numpy_function(SimpleCLFunction.from_string('''
+            double test(mot_float_type a, float4 g){
+                double b = a * 2.0f;
+                b += g.x; // comment
+                return exp(-b) * (double)dot(g, SphericalToCartesian(0, M_PI_2_F));
+            }
+        ''', dependencies=[get_component('library_functions', 'SphericalToCartesian')()]))
+        np.testing.assert_allclose(function(np.array([0.5, 1]), np.array([[1., 2., 3.]])),
+                                   np.exp(-np.array([2., 3.])) * 3, atol=1e-12)
+
+    def test_unsupported_code(self):
+        for cl_code in ['double test(double a){ if(a > 0){ return a; } return -a; }',
+                        'double test(double a){ return a * (1 / 2); }',
+                        'double test(double a){ int b = a; return b; }',
+                        'double test(double* a){ return *a; }',
+                        'double test(float4 g){ return g * 2; }',
+                        'double test(double a){ return unknown_function(a); }']:
+            self.assertIsNone(get_numpy_function(SimpleCLFunction.from_string(cl_code)), cl_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+test_packed_covariances
+----------------------------------
+
+Tests the packed storage of the parameter covariances in `mdt.lib.packed_covariances`.
+"""
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from mdt.lib.nifti import write_all_as_nifti
+from mdt.lib.packed_covariances import get_packed_index, packed_to_matrices, matrices_to_packed, \
+    load_covariance_maps, load_covariance_matrices, get_voxel_covariance_matrix, PACKED_COVARIANCES_MAP_NAME, \
+    PACKED_COVARIANCES_PARAMETERS_FILENAME
+from mdt.lib.processing_strategies import FittingProcessor, VoxelRange
+from mdt.utils import restore_volumes
+
+
+def get_covariance_matrices(nmr_matrices, nmr_parameters, random_state):
+    """Get random symmetric positive definite matrices."""
+    factors = random_state.normal(size=(nmr_matrices, nmr_parameters, nmr_parameters))
+    return np.matmul(factors, np.transpose(factors, (0, 2, 1)))
+
+
+class PackingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matrices = get_covariance_matrices(10, 4, np.random.RandomState(0))
+
+    def test_round_trip(self):
+        packed = matrices_to_packed(self.matrices)
+        self.assertEqual(packed.shape, (10, 10))
+        np.testing.assert_array_equal(packed_to_matrices(packed, 4), self.matrices)
+        np.testing.assert_array_equal(packed_to_matrices(packed.reshape(2, 5, 10), 4),
+                                      self.matrices.reshape(2, 5, 4, 4))
+
+    def test_row_major_order(self):
+        np.testing.assert_array_equal(matrices_to_packed(np.arange(9).reshape(3, 3)), [0, 1, 2, 4, 5, 8])
+
+    def test_packed_index(self):
+        packed = matrices_to_packed(self.matrices)
+        for row, column in itertools.product(range(4), repeat=2):
+            np.testing.assert_array_equal(packed[:, get_packed_index(4, row, column)], self.matrices[:, row, column])
+
+    def test_wrong_size(self):
+        with self.assertRaises(ValueError):
+            packed_to_matrices(np.zeros((10, 9)), 4)
+
+
+class LoadCovariancesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.results_folder = tempfile.mkdtemp()
+        self.covariances_dir = os.path.join(self.results_folder, 'covariances')
+        os.makedirs(self.covariances_dir)
+
+        self.parameter_names = ['S0.s0', 'w_stick0.w', 'Stick0.theta']
+        self.mask = np.random.RandomState(0).uniform(size=(3, 4, 5)) > 0.5
+        self.matrices = get_covariance_matrices(np.count_nonzero(self.mask), 3, np.random.RandomState(1))
+
+    def tearDown(self):
+        shutil.rmtree(self.results_folder)
+
+    def write_packed(self, used_mask=True):
+        packed = restore_volumes(matrices_to_packed(self.matrices), self.mask)
+        write_all_as_nifti({PACKED_COVARIANCES_MAP_NAME: packed}, self.covariances_dir)
+        if used_mask:
+            write_all_as_nifti({'UsedMask': self.mask.astype(np.float32)}, self.results_folder)
+        with open(os.path.join(self.covariances_dir, PACKED_COVARIANCES_PARAMETERS_FILENAME), 'w') as f:
+            f.write('["S0.s0", "w_stick0.w", "Stick0.theta"]')
+
+    def test_load_covariance_maps(self):
+        self.write_packed()
+        maps = load_covariance_maps(self.results_folder)
+
+        self.assertEqual(sorted(maps), sorted(['S0.s0_to_w_stick0.w', 'S0.s0_to_Stick0.theta',
+                                               'w_stick0.w_to_Stick0.theta']))
+        for (x, first), (y, second) in itertools.combinations(enumerate(self.parameter_names), 2):
+            np.testing.assert_allclose(maps['{}_to_{}'.format(first, second)][self.mask], self.matrices[:, x, y],
+                                       rtol=1e-6)
+
+    def test_load_separate_covariance_maps(self):
+        write_all_as_nifti({'S0.s0_to_w_stick0.w': restore_volumes(self.matrices[:, 0, 1], self.mask)},
+                           self.covariances_dir)
+        maps = load_covariance_maps(self.results_folder)
+
+        self.assertEqual(list(maps), ['S0.s0_to_w_stick0.w'])
+        np.testing.assert_allclose(np.squeeze(maps['S0.s0_to_w_stick0.w'][self.mask]), self.matrices[:, 0, 1],
+                                   rtol=1e-6)
+
+    def test_load_covariance_matrices(self):
+        self.write_packed()
+        names, matrices = load_covariance_matrices(self.results_folder)
+        self.assertEqual(names, self.parameter_names)
+        np.testing.assert_allclose(matrices, self.matrices, rtol=1e-6)
+
+        sub_mask = self.mask.copy()
+        sub_mask[0] = False
+        names, matrices = load_covariance_matrices(self.results_folder, mask=sub_mask)
+        np.testing.assert_allclose(matrices, self.matrices[sub_mask[self.mask]], rtol=1e-6)
+
+    def test_load_covariance_matrices_without_used_mask(self):
+        self.write_packed(used_mask=False)
+        names, matrices = load_covariance_matrices(self.results_folder)
+        self.assertEqual(matrices.shape, (self.mask.size, 3, 3))
+        np.testing.assert_allclose(matrices[self.mask.ravel()], self.matrices, rtol=1e-6)
+
+    def test_get_voxel_covariance_matrix(self):
+        self.write_packed()
+        for ind, xyz in enumerate(np.argwhere(self.mask)[:5]):
+            names, matrix = get_voxel_covariance_matrix(self.results_folder, xyz)
+            self.assertEqual(names, self.parameter_names)
+            np.testing.assert_allclose(matrix, self.matrices[ind], rtol=1e-6)
+
+    def test_missing_packed_covariances(self):
+        with self.assertRaises(ValueError):
+            load_covariance_matrices(self.results_folder)
+        with self.assertRaises(ValueError):
+            get_voxel_covariance_matrix(self.results_folder, (0, 0, 0))
+
+
+class MockModel:
+
+    def get_free_param_names(self):
+        return ['S0.s0', 'w_stick0.w']
+
+
+class CovariancesProcessor(FittingProcessor):
+
+    def __init__(self, packed, *args):
+        """A fitting processor which, instead of fitting a model, writes covariances computed from the voxel indices."""
+        super().__init__(None, MockModel(), *args)
+        self.packed = packed
+
+    def _process(self, roi_indices, next_indices=None):
+        if self.packed:
+            covariances = {PACKED_COVARIANCES_MAP_NAME: np.column_stack([roi_indices, roi_indices * 2.,
+                                                                         roi_indices * 3.])}
+        else:
+            covariances = {'S0.s0_to_w_stick0.w': roi_indices * 2.}
+        results = {'S0.s0': roi_indices * 1., 'covariances': covariances}
+        self._write_output_recursive(results, roi_indices)
+        return results
+
+
+class FittingProcessorCombineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.mask = np.ones((10, 1, 1), dtype=np.bool)
+        self.parameters_file = os.path.join(self.output_dir, 'covariances', PACKED_COVARIANCES_PARAMETERS_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def fit(self, packed, recalculate=False):
+        processor = CovariancesProcessor(packed, self.mask, None, self.output_dir,
+                                         os.path.join(self.output_dir, 'tmp_results'), recalculate)
+        return VoxelRange(max_nmr_voxels=4).process(processor)
+
+    def test_packed(self):
+        self.fit(True)
+        self.assertTrue(os.path.isfile(self.parameters_file))
+
+        names, matrices = load_covariance_matrices(self.output_dir, mask=self.mask)
+        self.assertEqual(names, ['S0.s0', 'w_stick0.w'])
+        np.testing.assert_allclose(matrices[:, 0, 1], np.arange(10) * 2.)
+        np.testing.assert_allclose(matrices[:, 1, 1], np.arange(10) * 3.)
+        np.testing.assert_allclose(np.squeeze(load_covariance_maps(self.output_dir)['S0.s0_to_w_stick0.w']),
+                                   np.arange(10) * 2.)
+
+    def test_separate_removes_parameters_file(self):
+        self.fit(True)
+        self.fit(False, recalculate=True)
+        self.assertFalse(os.path.isfile(self.parameters_file))
+
+        with self.assertRaises(ValueError):
+            load_covariance_matrices(self.output_dir, mask=self.mask)
+
+
+if __name__ == '__main__':
+    unittest.main()
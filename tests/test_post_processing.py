@@ -0,0 +1,115 @@
+"""
+test_post_processing
+----------------------------------
+
+Tests the analytic DKI measures and the elliptic integrals they use in `mdt.lib.post_processing`.
+"""
+import itertools
+import unittest
+import numpy as np
+from scipy.integrate import quad
+
+from mdt.lib.post_processing import DKIMeasures, DTIMeasures, _carlson_rf, _carlson_rd
+from mdt.utils import tensor_spherical_to_cartesian
+
+
+class CarlsonIntegralsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = [(1., 2., 3.), (0.5, 0.5, 1.), (1., 1., 1.), (0., 1., 2.), (10., 0.01, 1.), (1e-3, 1e3, 1.)]
+
+    def test_rf(self):
+        for x, y, z in self.inputs:
+            reference = quad(lambda t: 0.5 / np.sqrt((t + x) * (t + y) * (t + z)), 0, np.inf,
+                             epsabs=0, epsrel=1e-12, limit=200)[0]
+            np.testing.assert_allclose(_carlson_rf(x, y, z), reference, rtol=1e-9, err_msg=str((x, y, z)))
+
+    def test_rd(self):
+        for x, y, z in self.inputs:
+            reference = quad(lambda t: 1.5 / ((t + z) * np.sqrt((t + x) * (t + y) * (t + z))), 0, np.inf,
+                             epsabs=0, epsrel=1e-12, limit=200)[0]
+            np.testing.assert_allclose(_carlson_rd(x, y, z), reference, rtol=1e-9, err_msg=str((x, y, z)))
+
+    def test_vectorized(self):
+        x, y, z = np.array(self.inputs).T
+        np.testing.assert_allclose(_carlson_rf(x, y, z), [_carlson_rf(*el) for el in self.inputs], rtol=1e-12)
+        np.testing.assert_allclose(_carlson_rd(x, y, z), [_carlson_rd(*el) for el in self.inputs], rtol=1e-12)
+
+
+class DKIMeasuresTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.nmr_voxels = 5
+
+        self.parameters = {'theta': random_state.uniform(0, np.pi, self.nmr_voxels),
+                           'phi': random_state.uniform(0, np.pi, self.nmr_voxels),
+                           'psi': random_state.uniform(0, np.pi, self.nmr_voxels)}
+        for name in ['W_0000', 'W_1111', 'W_2222']:
+            self.parameters[name] = random_state.uniform(0.5, 1.5, self.nmr_voxels)
+        for name in ['W_1100', 'W_2200', 'W_2211']:
+            self.parameters[name] = random_state.uniform(0.2, 0.5, self.nmr_voxels)
+        for name in ['W_1000', 'W_1110', 'W_2000', 'W_2100', 'W_2110', 'W_2111', 'W_2210', 'W_2220', 'W_2221']:
+            self.parameters[name] = random_state.uniform(-0.1, 0.1, self.nmr_voxels)
+
+    def set_eigenvalues(self, eigenvalues):
+        self.parameters['d'], self.parameters['dperp0'], self.parameters['dperp1'] = np.array(eigenvalues).T
+
+    def get_apparent_kurtosis(self, voxel_ind, directions):
+        """Get the apparent Kurtosis of a voxel along each of the given (m, 3) directions."""
+        eigenvectors = [vector[voxel_ind] for vector in tensor_spherical_to_cartesian(
+            self.parameters['theta'], self.parameters['phi'], self.parameters['psi'])]
+        eigenvalues = [self.parameters[name][voxel_ind] for name in ['d', 'dperp0', 'dperp1']]
+        diffusion_tensor = sum(value * np.outer(vector, vector) for value, vector in zip(eigenvalues, eigenvectors))
+
+        kurtosis = np.zeros(len(directions))
+        for name in (name for name in self.parameters if name.startswith('W_')):
+            for i, j, k, l in set(itertools.permutations(int(el) for el in name[2:])):
+                kurtosis += self.parameters[name][voxel_ind] * (directions[:, i] * directions[:, j]
+                                                                * directions[:, k] * directions[:, l])
+
+        diffusivities = np.einsum('mi,ij,mj->m', directions, diffusion_tensor, directions)
+        return (np.mean(eigenvalues) / diffusivities) ** 2 * kurtosis
+
+    def get_numerical_measures(self):
+        """Get the Mean, Axial and Radial Kurtosis by numerical integration of the apparent Kurtosis.
+
+        For equal eigenvalues, the axial direction is the eigenvector which is ranked first by the sorting.
+        """
+        sorted_eigenvectors = DTIMeasures._sort_eigensystem(self.parameters)[1]
+        cos_theta, weights = np.polynomial.legendre.leggauss(100)
+        phi = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+        sin_theta = np.sqrt(1 - cos_theta ** 2)
+        sphere = np.column_stack([np.outer(sin_theta, np.cos(phi)).ravel(), np.outer(sin_theta, np.sin(phi)).ravel(),
+                                  np.repeat(cos_theta, len(phi))])
+        sphere_weights = np.repeat(weights, len(phi)) / (2 * len(phi))
+        angles = np.linspace(0, 2 * np.pi, 360, endpoint=False)
+
+        measures = {'MK': [], 'AK': [], 'RK': []}
+        for voxel_ind in range(self.nmr_voxels):
+            eigenvectors = sorted_eigenvectors[:, voxel_ind]
+            measures['MK'].append(np.sum(self.get_apparent_kurtosis(voxel_ind, sphere) * sphere_weights))
+            measures['AK'].append(self.get_apparent_kurtosis(voxel_ind, eigenvectors[:1])[0])
+
+            circle = np.outer(np.cos(angles), eigenvectors[1]) + np.outer(np.sin(angles), eigenvectors[2])
+            measures['RK'].append(np.mean(self.get_apparent_kurtosis(voxel_ind, circle)))
+        return measures
+
+    def assert_measures(self, rtol):
+        results = DKIMeasures.extra_optimization_maps(self.parameters)
+        for name, values in self.get_numerical_measures().items():
+            np.testing.assert_allclose(results[name], values, rtol=rtol, err_msg=name)
+
+    def test_distinct_eigenvalues(self):
+        self.set_eigenvalues([[2e-9, 1e-9, 0.5e-9], [1.7e-9, 0.4e-9, 0.3e-9], [1e-9, 0.9e-9, 0.8e-9],
+                              [3e-9, 2e-9, 1e-9], [1.2e-9, 0.6e-9, 0.59e-9]])
+        self.assert_measures(1e-8)
+
+    def test_equal_eigenvalues(self):
+        self.set_eigenvalues([[2e-9, 1e-9, 1e-9], [1e-9, 1e-9, 0.5e-9], [1e-9, 1e-9, 1e-9],
+                              [2e-9, 1e-9, 0.99999e-9], [1e-9, 1e-9 * (1 - 1e-7), 1e-9 * (1 - 2e-7)]])
+        self.assert_measures(1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+test_protocol_layout
+----------------------------------
+
+Tests the storage of the protocol values in the kernel data of the composite models and the consistency checks
+of the protocol values in `mdt.models.composite`.
+"""
+import glob
+import unittest
+from unittest import mock
+import numpy as np
+import pkg_resources
+
+import mdt
+from mdt.utils import SimpleMRIInputData
+from mot.cl_routines import compute_log_likelihood
+
+
+def get_protocol():
+    protocol = mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+        'mdt', 'data/mdt_example_data/b1k_b2k/*.prtcl'))[0])
+    return protocol.with_new_column('TE', np.linspace(0.05, 0.1, protocol.length))
+
+
+class ProtocolLayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.protocol = get_protocol()
+        self.nmr_problems = 20
+        self.nmr_observations = self.protocol.length
+
+        self.signals = self.random_state.uniform(100, 1000, (self.nmr_problems, 1, 1, self.nmr_observations))
+        self.mask = np.ones(self.signals.shape[:3], dtype=np.bool)
+        self.parameters = np.column_stack([self.random_state.uniform(500, 1500, self.nmr_problems),
+                                           self.random_state.uniform(0.01, 0.1, self.nmr_problems)])
+
+    def get_model(self, te=None):
+        extra_protocol = {} if te is None else {'TE': te}
+        input_data = SimpleMRIInputData(self.protocol, self.signals, self.mask, None, extra_protocol=extra_protocol,
+                                        noise_std=30)
+        model = mdt.get_model('S0T2')(volume_selection=False)
+        model.set_input_data(input_data)
+        return model
+
+    def get_layout(self, value):
+        return self.get_model()._get_protocol_value_layout(value)
+
+    def get_log_likelihoods(self, te=None):
+        model = self.get_model(te)
+        return compute_log_likelihood(model.get_log_likelihood_function(), self.parameters,
+                                      data=model.get_kernel_data())
+
+    def as_volume(self, value):
+        return np.reshape(value, (self.nmr_problems, 1, 1) + np.shape(value)[1:])
+
+    def test_scalar(self):
+        for value in [0.05, np.full(self.nmr_observations, 0.05), np.full((self.nmr_problems, 1), 0.05),
+                      np.full((self.nmr_problems, self.nmr_observations), 0.05)]:
+            self.assertEqual(self.get_layout(value), (0.05, 'scalar', None))
+
+    def test_shared(self):
+        column = np.ravel(self.protocol.get_column('TE'))
+
+        value, storage, index = self.get_layout(column)
+        np.testing.assert_array_equal(value, column)
+        self.assertEqual((storage, index), ('shared', 'observation_index'))
+
+        value, storage, index = self.get_layout(np.tile(column, (self.nmr_problems, 1)))
+        np.testing.assert_array_equal(value, column)
+        self.assertEqual((storage, index), ('shared', 'observation_index'))
+
+    def test_voxelwise(self):
+        voxel_values = self.random_state.uniform(0.05, 0.1, self.nmr_problems)
+
+        for te in [voxel_values, voxel_values[:, None],
+                   np.tile(voxel_values[:, None], (1, self.nmr_observations))]:
+            value, storage, index = self.get_layout(te)
+            np.testing.assert_array_equal(value, voxel_values[:, None])
+            self.assertEqual((storage, index), ('voxelwise', '0'))
+
+        te = self.random_state.uniform(0.05, 0.1, (self.nmr_problems, self.nmr_observations))
+        value, storage, index = self.get_layout(te)
+        np.testing.assert_array_equal(value, te)
+        self.assertEqual((storage, index), ('voxelwise', 'observation_index'))
+
+    def test_log_likelihoods(self):
+        column = np.ravel(self.protocol.get_column('TE'))
+        reference = self.get_log_likelihoods()
+        np.testing.assert_array_equal(
+            self.get_log_likelihoods(self.as_volume(np.tile(column, (self.nmr_problems, 1)))), reference)
+
+        voxel_values = self.random_state.uniform(0.05, 0.1, self.nmr_problems)
+        reference = self.get_log_likelihoods(self.as_volume(voxel_values))
+        np.testing.assert_array_equal(
+            self.get_log_likelihoods(self.as_volume(np.tile(voxel_values[:, None], (1, self.nmr_observations)))),
+            reference)
+
+
+class CheckDataConsistencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = get_protocol()
+        self.nmr_problems = 10005
+        self.model = mdt.get_model('S0T2')(volume_selection=False)
+        self.model._logger = mock.Mock()
+
+    def check(self, extra_protocol):
+        signals = np.ones((self.nmr_problems, 1, 1, self.protocol.length))
+        input_data = SimpleMRIInputData(self.protocol, signals, np.ones(signals.shape[:3], dtype=np.bool), None,
+                                        extra_protocol=extra_protocol)
+        self.model._logger.reset_mock()
+        self.model._check_data_consistency(input_data)
+        return [call[0][0] for call in self.model._logger.warning.call_args_list]
+
+    def test_consistent(self):
+        self.assertEqual(self.check({'TR': np.full((self.nmr_problems, 1, 1), 2.)}), [])
+        self.assertEqual(self.check({'TR': np.full((self.nmr_problems, 1, 1, self.protocol.length), 2.)}), [])
+
+    def test_voxelwise_inconsistency(self):
+        tr = np.full((self.nmr_problems, 1, 1), 2.)
+        tr[-1] = 0.07
+        warnings = self.check({'TR': tr})
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('TE > TR', warnings[0])
+
+        tr = np.full((self.nmr_problems, 1, 1, self.protocol.length), 2.)
+        tr[-1, ..., -1] = 0.07
+        warnings = self.check({'TR': tr})
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('TE > TR', warnings[0])
+
+    def test_voxelwise_te(self):
+        te = np.full((self.nmr_problems, 1, 1), 0.05)
+        te[-1] = 2
+        warnings = self.check({'TE': te})
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('TE >= 1 second', warnings[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
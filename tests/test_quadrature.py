@@ -0,0 +1,115 @@
+"""
+test_quadrature
+----------------------------------
+
+Tests the quadrature rules of `mdt.lib.quadrature` and the accuracy of the quadrature integration in the
+``GDRCylinders`` compartment of the AxCaliber model.
+"""
+import glob
+import unittest
+import numpy as np
+import pkg_resources
+from scipy.special import gamma
+
+import mdt
+from mdt import CompartmentTemplate
+from mdt.component_templates.composite_models import parse_composite_model_expression
+from mdt.lib.components import get_component, get_template, temporary_component_updates
+from mdt.lib.quadrature import gauss_legendre, gauss_laguerre
+from mdt.models.composite import DMRICompositeModel
+from mdt.model_building.trees import CompartmentModelTree
+from mdt.simulations import simulate_signals
+
+
+def get_midpoint_template(nmr_radii):
+    """Get a GDRCylinders compartment integrating over the radii with a midpoint rule of the given number of steps.
+
+    With 16 steps this is the integration used by the GDRCylinders compartment before the quadrature rules.
+    """
+    gdr_cylinders = get_template('compartment_models', 'GDRCylinders')
+
+    class GDRCylindersMidpoint(CompartmentTemplate):
+        name = 'GDRCylindersMidpoint{}'.format(nmr_radii)
+        parameters = ('g', 'b', 'G', 'Delta', 'delta', 'd', 'theta', 'phi', 'shape', 'scale')
+        dependencies = ('VanGelderenCylinder', 'SphericalToCartesian', 'gamma_ppf', 'gamma_pdf')
+        cl_code = '''
+            double direction_2 = pown(dot(g, SphericalToCartesian(theta, phi)), 2);
+            double lower_radius = gamma_ppf(0.01, shape, scale);
+            double radius_spacing = (gamma_ppf(0.99, shape, scale) - lower_radius) / ''' + str(nmr_radii) + ''';
+
+            double radius;
+            double weight;
+            double weight_sum = 0;
+            double signal_sum = 0;
+            for(uint i = 0; i < ''' + str(nmr_radii) + '''; i++){
+                radius = lower_radius + (i + 0.5) * radius_spacing;
+                weight = gamma_pdf(radius, shape, scale) * (radius * radius);
+                signal_sum += weight * exp(-b * d * direction_2
+                                           + (1 - direction_2) * VanGelderenCylinder(G, Delta, delta, d, radius));
+                weight_sum += weight;
+            }
+            return signal_sum / weight_sum;
+        '''
+        shape = gdr_cylinders.shape
+        scale = gdr_cylinders.scale
+
+    return GDRCylindersMidpoint
+
+
+def simulate_compartment(compartment_name, protocol, parameters):
+    """Simulate the signal of the given cylinders compartment for the given parameters, with S0 set to one."""
+    model = DMRICompositeModel('Test', CompartmentModelTree(parse_composite_model_expression(
+        'S0 * {}'.format(compartment_name))), get_component('likelihood_functions', 'Gaussian')(),
+        volume_selection=False)
+    parameters = dict(parameters, s0=np.ones_like(parameters['d']))
+    return simulate_signals(model, protocol, np.column_stack(
+        [parameters[name.split('.')[1]] for name in model.get_free_param_names()]))
+
+
+class QuadratureRulesTest(unittest.TestCase):
+
+    def test_gauss_legendre(self):
+        nodes, weights = gauss_legendre(10)
+        for degree in range(20):
+            self.assertAlmostEqual(np.sum(weights * nodes ** degree), (1 + (-1) ** degree) / (degree + 1.), 12)
+
+    def test_gauss_laguerre(self):
+        for alpha in [0, 0.5, 2]:
+            nodes, weights = gauss_laguerre(10, alpha)
+            for degree in range(20):
+                self.assertAlmostEqual(np.sum(weights * nodes ** degree) / gamma(degree + alpha + 1), 1, 10)
+
+
+class GDRCylindersQuadratureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+            'mdt', 'data/mdt_example_data/multishell_b6k_max/*.prtcl'))[0])
+
+        random_state = np.random.RandomState(0)
+        nmr_problems = 100
+        shape = random_state.uniform(0.5, 20, nmr_problems)
+        self.parameters = {'d': random_state.uniform(0.5e-9, 2.5e-9, nmr_problems),
+                           'theta': random_state.uniform(0, np.pi, nmr_problems),
+                           'phi': random_state.uniform(0, np.pi, nmr_problems),
+                           'shape': shape,
+                           'scale': random_state.uniform(0.5e-6, 8e-6, nmr_problems) / shape}
+
+    def test_accuracy(self):
+        """The 10 node quadrature should be at least as accurate as the previous 16 step midpoint rule."""
+        with temporary_component_updates():
+            get_midpoint_template(16)
+            get_midpoint_template(1000)
+
+            reference = simulate_compartment('GDRCylindersMidpoint1000', self.protocol, self.parameters)
+            previous_errors = np.abs(simulate_compartment(
+                'GDRCylindersMidpoint16', self.protocol, self.parameters) - reference)
+
+        errors = np.abs(simulate_compartment('GDRCylinders', self.protocol, self.parameters) - reference)
+
+        self.assertLessEqual(np.max(errors), np.max(previous_errors))
+        self.assertLess(np.median(errors), np.median(previous_errors))
+
+
+if __name__ == '__main__':
+    unittest.main()
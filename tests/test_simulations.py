@@ -0,0 +1,142 @@
+"""
+test_simulations
+----------------------------------
+
+Tests the streaming simulations of `mdt.simulations.stream_simulated_signals`.
+"""
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pkg_resources
+from scipy.stats import truncnorm
+
+import mdt
+from mdt.simulations import stream_simulated_signals, Constant, Uniform, Normal, UniformOrientation
+from mdt.utils import spherical_to_cartesian
+
+
+def get_protocol():
+    return mdt.load_protocol(glob.glob(pkg_resources.resource_filename(
+        'mdt', 'data/mdt_example_data/b1k_b2k/*.prtcl'))[0])
+
+
+def get_distributions():
+    return {'S0.s0': Uniform(500, 2000),
+            'w_stick0.w': Uniform(0.2, 0.8),
+            ('Stick0.theta', 'Stick0.phi'): UniformOrientation()}
+
+
+class SimulationDistributionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+
+    def test_constant(self):
+        np.testing.assert_array_equal(Constant(3.0).draw(10, self.random_state), np.full(10, 3.0))
+
+    def test_uniform(self):
+        samples = Uniform(2, 5).draw(10000, self.random_state)
+        self.assertTrue(np.all((samples >= 2) & (samples < 5)))
+        self.assertAlmostEqual(np.mean(samples), 3.5, delta=0.05)
+
+    def test_truncated_normal(self):
+        samples = Normal(1, 2, low=0, high=3).draw(10000, self.random_state)
+        self.assertTrue(np.all((samples >= 0) & (samples <= 3)))
+        self.assertAlmostEqual(np.mean(samples), truncnorm.mean(-0.5, 1, loc=1, scale=2), delta=0.02)
+
+    def test_uniform_orientation(self):
+        orientations = UniformOrientation().draw(10000, self.random_state)
+        self.assertEqual(orientations.shape, (10000, 2))
+        self.assertTrue(np.all((orientations[:, 0] >= 0) & (orientations[:, 0] <= np.pi)))
+
+        vectors = spherical_to_cartesian(orientations[:, 0], orientations[:, 1])
+        np.testing.assert_allclose(np.mean(vectors, axis=0), [0, 0.5, 0], atol=0.02)
+        np.testing.assert_allclose(np.mean(vectors ** 2, axis=0), 1 / 3., atol=0.02)
+
+
+class StreamSimulatedSignalsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = get_protocol()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def simulate(self, output_dir, **kwargs):
+        settings = dict(snrs=[10, 30], store_noiseless=True, chunk_size=100, seed=1)
+        settings.update(kwargs)
+        return stream_simulated_signals('BallStick_r1', self.protocol, get_distributions(), 500, output_dir,
+                                        **settings)
+
+    def assert_results_equal(self, results, reference):
+        self.assertEqual(sorted(results), sorted(reference))
+        for name in reference:
+            np.testing.assert_array_equal(results[name], reference[name], err_msg=name)
+
+    def test_noise_statistics(self):
+        distributions = {'S0.s0': 1000, 'w_stick0.w': 0.5, 'Stick0.theta': 1, 'Stick0.phi': 1}
+        snrs = [2, 10]
+
+        for noise_type in ['gaussian', 'rician']:
+            output_dir = os.path.join(self.output_dir, noise_type)
+            results = stream_simulated_signals('BallStick_r1', self.protocol, distributions, 2000, output_dir,
+                                               snrs=snrs, noise_type=noise_type, store_noiseless=True,
+                                               chunk_size=500, seed=0)
+            signals = results['signals']
+
+            for ind, snr in enumerate(snrs):
+                noise_std = 1000. / snr
+                noisy_signals = results['noisy_signals'][:, ind]
+
+                if noise_type == 'gaussian':
+                    residuals = noisy_signals - signals
+                    np.testing.assert_allclose(np.mean(residuals), 0, atol=0.01 * noise_std)
+                    np.testing.assert_allclose(np.std(residuals), noise_std, rtol=0.01)
+                else:
+                    self.assertTrue(np.all(noisy_signals >= 0))
+                    np.testing.assert_allclose(np.mean(noisy_signals.astype(np.float64) ** 2 - signals ** 2),
+                                               2 * noise_std ** 2, rtol=0.03)
+
+    def test_resume(self):
+        reference = self.simulate(os.path.join(self.output_dir, 'reference'))
+        self.assertEqual(reference['parameters'].shape, (500, 4))
+        self.assertEqual(reference['signals'].shape, (500, self.protocol.length))
+        self.assertEqual(reference['noisy_signals'].shape, (500, 2, self.protocol.length))
+
+        output_dir = os.path.join(self.output_dir, 'resumed')
+        del self.simulate(output_dir)['noisy_signals']
+
+        for repeat in range(3):
+            completed_chunks = np.load(os.path.join(output_dir, 'completed_chunks.npy'), mmap_mode='r+')
+            noisy_signals = np.load(os.path.join(output_dir, 'noisy_signals.npy'), mmap_mode='r+')
+            for chunk_index in [1, 3]:
+                completed_chunks[chunk_index] = False
+                noisy_signals[chunk_index * 100:(chunk_index + 1) * 100] = 0
+            del completed_chunks, noisy_signals
+
+            self.assert_results_equal(self.simulate(output_dir), reference)
+
+    def test_missing_output_files(self):
+        reference = self.simulate(os.path.join(self.output_dir, 'reference'))
+
+        output_dir = os.path.join(self.output_dir, 'interrupted')
+        self.simulate(output_dir)
+        for name in ['parameters', 'signals', 'noisy_signals', 'completed_chunks']:
+            os.remove(os.path.join(output_dir, name + '.npy'))
+
+        self.assert_results_equal(self.simulate(output_dir), reference)
+
+    def test_different_settings(self):
+        self.simulate(self.output_dir)
+        with self.assertRaises(ValueError):
+            self.simulate(self.output_dir, snrs=[20])
+        with self.assertRaises(ValueError):
+            self.simulate(self.output_dir, seed=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
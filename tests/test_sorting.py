@@ -0,0 +1,63 @@
+"""
+test_sorting
+----------------------------------
+
+Tests the voxel-wise sorting of the orientations of multi-direction models.
+"""
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import nibabel as nib
+
+from mdt.lib.nifti import write_all_as_nifti
+from mdt.lib.sorting import sort_orientations
+
+
+def get_maps(random_state, shape=(4, 5, 3)):
+    maps = {}
+    for ind in range(3):
+        maps['w_stick{}.w'.format(ind)] = random_state.rand(*shape)
+        maps['Stick{}.theta'.format(ind)] = random_state.rand(*shape)
+    return maps
+
+
+class SortOrientationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.weight_names = ['w_stick0.w', 'w_stick1.w', 'w_stick2.w']
+        self.theta_names = ['Stick0.theta', 'Stick1.theta', 'Stick2.theta']
+        self.maps = get_maps(np.random.RandomState(0))
+
+    def assert_sorted(self, sorted_maps):
+        def stacked(maps, names):
+            return np.concatenate([np.reshape(maps[name], (-1, 1)) for name in names], axis=1)
+
+        weights = stacked(sorted_maps, self.weight_names)
+        self.assertTrue(np.all(weights[:, :-1] >= weights[:, 1:]))
+
+        input_weights = stacked(self.maps, self.weight_names)
+        ranking = np.argsort(input_weights, axis=1)[:, ::-1]
+        voxels = np.arange(ranking.shape[0])[:, None]
+        np.testing.assert_allclose(weights, input_weights[voxels, ranking], rtol=1e-6)
+        np.testing.assert_allclose(stacked(sorted_maps, self.theta_names),
+                                   stacked(self.maps, self.theta_names)[voxels, ranking], rtol=1e-6)
+
+    def test_c_ordered(self):
+        self.assert_sorted(sort_orientations(self.maps, self.weight_names, [self.theta_names]))
+
+    def test_fortran_ordered(self):
+        maps = {name: np.asfortranarray(volume) for name, volume in self.maps.items()}
+        self.assert_sorted(sort_orientations(maps, self.weight_names, [self.theta_names]))
+
+    def test_nifti_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            write_all_as_nifti(self.maps, directory, nifti_header=nib.Nifti1Header())
+            self.assert_sorted(sort_orientations(directory, self.weight_names, [self.theta_names]))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()